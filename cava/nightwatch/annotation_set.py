@@ -25,6 +25,16 @@ default_annotations = dict(
     lifetime=c_dsl.Expr("AVA_CALL"),
     lifetime_coupled=c_dsl.Expr("NULL"),
     disable_native=False,
+    guest_allocated_handle=False,
+    cacheable=False,
+    invalidates_cache=False,
+    prefetch_at_init=[],
+    memoize=False,
+    zerocopy_threshold=None,
+    global_order=False,
+    dedup_input=False,
+    stream=False,
+    compress=False,
 )
 
 combinable_annotations = dict(
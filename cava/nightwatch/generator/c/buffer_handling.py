@@ -13,13 +13,47 @@ from typing import Optional, Union, Any, Iterable, Callable
 
 from nightwatch import location, term
 from nightwatch.c_dsl import ExprOrStr, Expr
-from nightwatch.generator.c.util import compute_buffer_size, for_all_elements
+from nightwatch.generator.c.util import compute_buffer_size, for_all_elements, predicate_for_direction
 from nightwatch.generator.common import comment_block, nl
 from nightwatch.model import Type, Argument, ConditionalType, lines
 
 # FIXME: Add support for NW_ZEROCOPY_BUFFER
 
-DECLARE_BUFFER_SIZE_EXPR = Expr("volatile size_t __buffer_size = 0;")
+DECLARE_BUFFER_SIZE_EXPR = Expr("size_t __buffer_size = 0;")
+
+
+def shadow_buffer_allocator(type: Type) -> str:
+    """
+    :return: The allocator and deallocator arguments of the shadow buffer functions for buffers of `type`. Buffers
+        with the default `ava_buffer_allocator(malloc, free)` are allocated from the buffer pool.
+    """
+    if type.buffer_allocator.equals("malloc").is_true() and type.buffer_deallocator.equals("free").is_true():
+        return "ava_buffer_pool_alloc, ava_buffer_pool_free"
+    return f"{type.buffer_allocator}, {type.buffer_deallocator}"
+
+
+def hoists_buffer_size(arg: Argument, direction: ExprOrStr) -> bool:
+    """
+    :param direction: An expression which is true if `arg` is transferred in the current direction.
+    :return: True if the size of the buffer `arg` is computed once (by `declare_buffer_sizes`) and reused by the
+        size accounting, attach and copy code of the current direction.
+    """
+    type = arg.type
+    return not isinstance(type, ConditionalType) and hasattr(type, "pointee") and \
+        Expr(type.transfer).equals("NW_BUFFER").is_true() and not Expr(type.buffer).is_constant() and \
+        Expr(direction).is_true()
+
+
+def declare_buffer_sizes(args: Iterable[Argument], direction: Callable[[Argument], ExprOrStr]) -> str:
+    """
+    Generate code to compute the sizes of the buffer arguments, so the size expressions are evaluated once per call.
+    The sizes must not change between this code and the uses of `buffer_size_spelling`.
+    :param direction: A function which returns an expression which is true if the argument is transferred.
+    :return: A series of C statements.
+    """
+    return lines(
+        f"const size_t {a.buffer_size_spelling} = ({a.name} != NULL) ? {compute_buffer_size(a.type)} : 0;"
+        for a in args if hoists_buffer_size(a, direction(a)))
 
 
 def get_transfer_buffer_expr(value, type, *, not_null=False) -> ExprOrStr:
@@ -53,7 +87,7 @@ def get_buffer_expr(value, type: Type, *, not_null=False, size_out=None):
         f"""
         ({type.spelling})ava_shadow_buffer_get_buffer(&__ava_endpoint, __chan, __cmd, {value},
                 {type.lifetime}, {type.lifetime_coupled},
-                {size_out}, {type.buffer_allocator}, {type.buffer_deallocator})
+                {size_out}, {shadow_buffer_allocator(type)}, ava_is_in)
         """,
         (type.lifetime.equals("AVA_CALL") & type.transfer.one_of({"NW_BUFFER", "NW_ZEROCOPY_BUFFER"})).if_then_else_expression(
             get_transfer_buffer_expr(value, type, not_null=not_null),
@@ -92,11 +126,26 @@ def get_buffer(target, value, type: Type, *, original_type: Optional[Type], prec
     ))
 
 
+def get_shadow_data(target, value, local, type: Type) -> Expr:
+    """
+    Generate code that sets target to the data to copy into the local buffer of the shadow buffer value.
+    If only the changed blocks of value were sent, `ava_shadow_buffer_get_buffer` has already copied them and target is
+    set to local.
+    :param target: The variable in which to store the data pointer.
+    :param value: The original value (the offset of the attached buffer).
+    :param local: The local buffer returned by `get_buffer`.
+    :param type: The type of value.
+    :return: A series of C statements.
+    """
+    return type.lifetime.not_equals("AVA_CALL").if_then_else(
+        f"{target} = ({type.spelling})ava_shadow_buffer_get_data(__chan, __cmd, {value}, {local});")
+
+
 def size_to_bytes(size: ExprOrStr, type: Type) -> str:
     return f"{size} * sizeof({type.pointee.spelling})"
 
 
-def attach_buffer(target, value, data, type: Type, copy: Union[Expr, Any], *, cmd, original_type: Optional[Type], expect_reply: bool, precomputed_size=None):
+def attach_buffer(target, value, data, type: Type, copy: Union[Expr, Any], *, cmd, original_type: Optional[Type], expect_reply: bool, precomputed_size=None, by_reference=False):
     """
     Generate code to attach a buffer to a command.
 
@@ -107,6 +156,8 @@ def attach_buffer(target, value, data, type: Type, copy: Union[Expr, Any], *, cm
     :param cmd: The command to attach to.
     :param original_type: The original type if type is immediately inside a ConditionalType.
     :param precomputed_size: The expression for a precomputed size of value in *elements*.
+    :param by_reference: True if call lifetime buffers stay unchanged until the command is sent, so the channel may
+        send them without copying them into the command.
     :return: A series of C statements.
     """
     cmd = f"(struct command_base*){cmd}"
@@ -124,14 +175,15 @@ def attach_buffer(target, value, data, type: Type, copy: Union[Expr, Any], *, cm
     def shadow_attach(func):
         return lambda: f"""{target} = ({type.nonconst.spelling}){func}(&__ava_endpoint,
                         __chan, {cmd}, {value}, {data}, {size_expr},
-                        {type.lifetime}, {type.buffer_allocator}, {type.buffer_deallocator},
+                        {type.lifetime}, {shadow_buffer_allocator(type)},
                         alloca(sizeof(struct ava_buffer_header_t)));"""
 
     return type.transfer.equals("NW_ZEROCOPY_BUFFER").if_then_else(
         zerocopy_attach(),
         type.lifetime.equals("AVA_CALL").if_then_else(
             Expr(copy).if_then_else(
-                simple_attach("command_channel_attach_buffer"),
+                simple_attach("command_channel_attach_buffer_by_reference" if by_reference else
+                              "command_channel_attach_buffer"),
                 f"{target} = HAS_OUT_BUFFER_SENTINEL;" if expect_reply else f"{target} = NULL; /* No output */\n"
             ),
             Expr(copy).if_then_else(
@@ -141,30 +193,48 @@ def attach_buffer(target, value, data, type: Type, copy: Union[Expr, Any], *, cm
         ))
 
 
-def compute_total_size(args: Iterable[Argument], copy_pred: Callable[[Argument], Expr]) -> str:
+def compute_total_size(args: Iterable[Argument], copy_pred: Callable[[Argument], Expr],
+                       direction: Optional[Callable[[Argument], ExprOrStr]] = None, *,
+                       is_in: Optional[bool] = None) -> str:
     """
     Sum the sizes of all the buffers created by all arguments.
     :param args: All the arguments to sum.
     :param copy_pred: A function which returns true if the data associated with this argument will be copied.
+    :param direction: The direction passed to `declare_buffer_sizes`, if the sizes were declared with it.
+    :param is_in: The value of `ava_is_in` where the code runs, if it is known (see `predicate_for_direction`).
     :return: A series of C statements.
     """
     size = "__total_buffer_size"
 
     def compute_size(values, type: Type, depth, argument: Argument, original_type=None, **other):
         if isinstance(type, ConditionalType):
-            return Expr(type.predicate).if_then_else(
+            return predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 compute_size(values, type.then_type, depth, argument, original_type=type.original_type, **other),
                 compute_size(values, type.else_type, depth, argument, original_type=type.original_type, **other))
 
         value, = values
         pred = Expr(type.transfer).equals("NW_BUFFER") & Expr(value).not_equals("NULL") & (Expr(type.buffer) > 0)
 
-        def add_buffer_size():
-            size_expr = size_to_bytes(compute_buffer_size(type, original_type), type)
+        def add_buffer_size(delta=False):
+            if depth == 0 and direction and hoists_buffer_size(argument, direction(argument)):
+                size_expr = size_to_bytes(argument.buffer_size_spelling, type)
+            else:
+                size_expr = size_to_bytes(compute_buffer_size(type, original_type), type)
+            # Buffers which are copied without translation can be sent as deltas of their last transfer, unless the
+            # command is recorded for replay. Calls are only sent with deltas if the stub can send them again whole
+            # (`retry_loop`).
+            f = argument.function
+            delta = delta and not f.object_record and not any(t.object_record for t in f.contained_types) and \
+                (is_in is False or (is_in is True and f.shadow_deltas))
+            whole = "__retry_attempt > 0" if is_in else "0"
+            shadow_size = (Expr(delta) & type.is_simple_buffer()).if_then_else(
+                f"{size} += ava_shadow_buffer_delta_size(&__ava_endpoint, __chan, {value}, {size_expr}, {whole});\n",
+                f"{size} += ava_shadow_buffer_size(&__ava_endpoint, __chan, {size_expr});\n"
+            )
             return Expr(copy_pred(argument)).if_then_else(
                 type.lifetime.equals("AVA_CALL").if_then_else(
                     f"{size} += command_channel_buffer_size(__chan, {size_expr});\n",
-                    f"{size} += ava_shadow_buffer_size(&__ava_endpoint, __chan, {size_expr});\n"
+                    shadow_size
                 ),
                 type.lifetime.equals("AVA_CALL").if_then_else(
                     "",
@@ -175,7 +245,7 @@ def compute_total_size(args: Iterable[Argument], copy_pred: Callable[[Argument],
         def simple_buffer_case():
             if not hasattr(type, "pointee"):
                 return """abort_with_reason("Reached code to handle buffer in non-pointer type.");"""
-            return pred.if_then_else(add_buffer_size)
+            return pred.if_then_else(lambda: add_buffer_size(delta=True))
 
         def buffer_case():
             if not hasattr(type, "pointee"):
@@ -197,17 +267,17 @@ def compute_total_size(args: Iterable[Argument], copy_pred: Callable[[Argument],
         comment_block(f"Size: {a}",
                       compute_size((a.name,), a.type, depth=0,
                                    name=a.name,
-                                   kernel=compute_size,
+                                   kernel=compute_size, is_in=is_in,
                                    only_complex_buffers=False,
                                    argument=a, self_index=0))
         for a in args)
     return f"size_t {size} = 0;{nl}{{ {size_code} }}"
 
 
-def deallocate_managed_for_argument(arg: Argument, src):
+def deallocate_managed_for_argument(arg: Argument, src, *, is_in: Optional[bool] = None):
     def convert_result_value(values, type: Type, depth, original_type=None, **other):
         if isinstance(type, ConditionalType):
-            return Expr(type.predicate).if_then_else(
+            return predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 convert_result_value(values, type.then_type, depth, original_type=type.original_type, **other),
                 convert_result_value(values, type.else_type, depth, original_type=type.original_type, **other))
 
@@ -248,13 +318,13 @@ def deallocate_managed_for_argument(arg: Argument, src):
     with location(f"at {term.yellow(str(arg.name))}", arg.location):
         conv = convert_result_value((f"""{src + "->" if src else ""}{arg.name}""",), arg.type,
                                     depth=0, name=arg.name,
-                                    kernel=convert_result_value, self_index=0)
+                                    kernel=convert_result_value, self_index=0, is_in=is_in)
         return comment_block(f"Dealloc: {arg}", conv)
 
 
-def allocate_tmp_buffer(tmp_name, size_name, type, *, alloc_list, original_type=None):
+def allocate_tmp_buffer(tmp_name, size_name, type, *, alloc_list, original_type=None, precomputed_size=None):
     return f"""
-        const size_t {size_name} = {compute_buffer_size(type, original_type)};
+        const size_t {size_name} = {precomputed_size or compute_buffer_size(type, original_type)};
         {type.nonconst.attach_to(tmp_name)};
         {tmp_name} = ({type.nonconst.spelling})calloc(1, {size_to_bytes(size_name, type)});
         {alloc_list.insert(tmp_name, "free")}
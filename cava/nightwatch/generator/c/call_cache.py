@@ -0,0 +1,228 @@
+from nightwatch import location, term
+from nightwatch.c_dsl import Expr
+from nightwatch.generator import generate_requires
+from nightwatch.generator.c.buffer_handling import size_to_bytes
+from nightwatch.generator.c.util import compute_buffer_size
+from nightwatch.generator.common import lines, unpack_struct
+from nightwatch.model import API, Argument, ConditionalType, Function
+
+
+def _is_buffer(arg: Argument) -> bool:
+    return not Expr(arg.type.transfer).equals("NW_BUFFER").is_false()
+
+
+def _buffer_size_bytes(arg: Argument) -> str:
+    return size_to_bytes(compute_buffer_size(arg.type), arg.type)
+
+
+def _check_cacheable(f: Function):
+    generate_requires(Expr(f.synchrony).equals("NW_SYNC").is_true(), "ava_cacheable functions must be synchronous.")
+    generate_requires(not f.prologue and not f.epilogue and not f.logue_declarations,
+                      "ava_cacheable functions cannot have a prologue or epilogue.")
+    for a in f.arguments:
+        with location(f"argument {term.yellow(a.name)}"):
+            generate_requires(not any(isinstance(t, ConditionalType) for t in a.contained_types),
+                              "ava_cacheable functions cannot have conditional types.")
+            if _is_buffer(a):
+                generate_requires(a.type.is_simple_buffer(allow_handle=True).is_true(),
+                                  "Buffers of ava_cacheable functions must not contain pointers.")
+            else:
+                generate_requires(not any(t.buffer for t in a.contained_types),
+                                  "Arguments of ava_cacheable functions must not contain buffers.")
+    ret = f.return_value
+    generate_requires(not ret.type.buffer or ret.type.lifetime == Expr("AVA_STATIC"),
+                      "Buffers returned by ava_cacheable functions must have static lifetime.")
+
+
+def cache_lookup_code(f: Function, dealloc_code: str) -> str:
+    """
+    Generate code to build the cache key of a call and return the cached results if there are any.
+    :param f: An `ava_cacheable` function.
+    :param dealloc_code: Code to free temporary allocations of the stub before returning.
+    :return: A series of C statements which declare `__cache_key`.
+    """
+    if not f.cacheable:
+        return ""
+    _check_cacheable(f)
+
+    def key_code(a: Argument):
+        if _is_buffer(a):
+            size = f"({a.name} != NULL) ? {_buffer_size_bytes(a)} : 0"
+            return f"""ava_call_cache_key_add_buffer(__cache_key, {a.name}, {size}, {Expr(a.input)});"""
+        return f"ava_call_cache_key_add(__cache_key, &{a.name}, sizeof({a.name}));"
+
+    def read_code(a: Argument):
+        return (Expr(a.output) & Expr(a.name).not_equals("NULL")).if_then_else(
+            f"ava_call_cache_read(__cached, &__cache_offset, (void*){a.name}, {_buffer_size_bytes(a)});")
+
+    ret = f.return_value
+    if ret.type.is_void:
+        read_ret, return_statement = "", "return;"
+    else:
+        read_ret = f"""
+            {ret.type.nonconst.attach_to(ret.name)};
+            ava_call_cache_read(__cached, &__cache_offset, &{ret.name}, sizeof({ret.name}));
+        """.strip()
+        return_statement = f"return {ret.name};"
+
+    return f"""
+        GByteArray *__cache_key = ava_call_cache_key_new({f.call_id_spelling});
+        {lines(key_code(a) for a in f.arguments)}
+        {{
+            GBytes *__cached = ava_call_cache_lookup(__cache_key);
+            if (__cached != NULL) {{
+                size_t __cache_offset = 0;
+                {read_ret}
+                {lines(read_code(a) for a in f.arguments if _is_buffer(a))}
+                g_bytes_unref(__cached);
+                g_byte_array_unref(__cache_key);
+                {dealloc_code}
+                {return_statement}
+            }}
+        }}
+    """.strip()
+
+
+def cache_insert_code(f: Function) -> str:
+    """
+    Generate code to insert the results of a completed call into the cache. The return value and output buffers must
+    be in scope.
+    :param f: An `ava_cacheable` function.
+    :return: A series of C statements which consume `__cache_key`.
+    """
+    if not f.cacheable:
+        return ""
+
+    def write_code(a: Argument):
+        return (Expr(a.output) & Expr(a.name).not_equals("NULL")).if_then_else(
+            f"g_byte_array_append(__cache_value, (const guint8*){a.name}, {_buffer_size_bytes(a)});")
+
+    ret = f.return_value
+    write_ret = "" if ret.type.is_void else \
+        f"g_byte_array_append(__cache_value, (const guint8*)&{ret.name}, sizeof({ret.name}));"
+    # Failed calls are not cached, so they are retried.
+    success = Expr(True) if ret.type.is_void or ret.type.success is None else \
+        Expr(f"{ret.name} == ({ret.type.success})")
+    return success.if_then_else(
+        f"""
+        GByteArray *__cache_value = g_byte_array_new();
+        {write_ret}
+        {lines(write_code(a) for a in f.arguments if _is_buffer(a))}
+        ava_call_cache_insert(__cache_key, __cache_value);
+        """.strip(),
+        "g_byte_array_unref(__cache_key);")
+
+
+def _insert_function_spelling(f: Function) -> str:
+    return f"__ava_call_cache_insert_{f.name}"
+
+
+def cache_insert_function(f: Function) -> str:
+    """
+    Generate a function which inserts the results of a completed call into the cache from its call record.
+    :param f: A function.
+    :return: A C function definition of type `ava_call_cache_insert_function`, or "" if `f` is not cacheable.
+    """
+    if not f.cacheable:
+        return ""
+    ret = f.return_value
+    return f"""
+    static void {_insert_function_spelling(f)}(void *__record, GByteArray *__cache_key) {{
+        struct {f.call_record_spelling}* __call_record = (struct {f.call_record_spelling}*)__record;
+        {unpack_struct("__call_record", f.arguments, "->")}
+        {"" if ret.type.is_void else f"{ret.type.nonconst.attach_to(ret.name)} = __call_record->{ret.name};"}
+        {cache_insert_code(f)}
+    }}
+    """.strip()
+
+
+def cache_insert_call(f: Function) -> str:
+    """
+    :return: A C statement which inserts the results of the completed call in `__call_record` into the cache.
+    """
+    if not f.cacheable:
+        return ""
+    return f"{_insert_function_spelling(f)}(__call_record, __cache_key);"
+
+
+def cache_prefetch_code(f: Function, dealloc_code: str) -> str:
+    """
+    Generate code to queue the call instead of sending it while the guestlib prefetches at init. The results are
+    cached by `ava_call_cache_end_prefetch`.
+    :param f: A function.
+    :param dealloc_code: Code to free temporary allocations of the stub before returning.
+    :return: A C statement which returns from the stub if the calling thread is prefetching.
+    """
+    if not f.cacheable:
+        return ""
+    ret = f.return_value
+    if ret.type.is_void:
+        return_statement = "return;"
+    else:
+        # The value is ignored by the prefetch.
+        return_statement = f"""
+            {ret.type.nonconst.attach_to(ret.name)};
+            memset(&{ret.name}, 0, sizeof({ret.name}));
+            return {ret.name};
+        """.strip()
+    return f"""
+        if (ava_call_cache_prefetching()) {{
+            ava_async_batch_append(__chan, (struct command_base*)__cmd);
+            ava_call_cache_add_prefetch(&__call_record->__call_complete, __call_record,
+                {_insert_function_spelling(f)}, __cache_key);
+            {dealloc_code}
+            {return_statement}
+        }}
+    """.strip()
+
+
+def prefetch_function_spelling(api: API) -> str:
+    return f"__ava_prefetch_{api.identifier.lower()}"
+
+
+def prefetch_function(api: API) -> str:
+    """
+    Generate a function which calls every `ava_prefetch_at_init` function with each of its argument tuples and
+    caches the results.
+    :param api: The API.
+    :return: A C function definition, or "" if no function is prefetched.
+    """
+    functions = [f for f in api.real_functions if f.prefetch_at_init]
+    if not functions:
+        return ""
+
+    def call_code(f: Function, values):
+        arguments = list(f.real_arguments)
+        generate_requires(len(values) == len(arguments),
+                          f"ava_prefetch_at_init tuples must have a value for each of the {len(arguments)} arguments.")
+        scalars, inputs, outputs = [], [], []
+        for a, v in zip(arguments, values):
+            if not _is_buffer(a):
+                scalars.append(f"{a.original_declaration} = {v};")
+            elif Expr(a.input).is_true() or str(v) == "NULL":
+                inputs.append(f"{a.original_declaration} = {v};")
+            else:
+                outputs.append(f"{a.original_declaration} = "
+                               f"ava_call_cache_prefetch_alloc({_buffer_size_bytes(a)});")
+        # Buffer sizes may depend on the other arguments.
+        return f"""
+        {{
+            {lines(scalars)}
+            {lines(inputs)}
+            {lines(outputs)}
+            {f.name}({", ".join(a.name for a in arguments)});
+        }}
+        """.strip()
+
+    def function_code(f: Function):
+        with location(f"at {term.yellow(str(f.name))}", f.location):
+            generate_requires(f.cacheable, "ava_prefetch_at_init functions must be ava_cacheable.")
+            return lines(call_code(f, values) for values in f.prefetch_at_init)
+
+    return f"""
+    static void {prefetch_function_spelling(api)}(void) {{
+        ava_call_cache_begin_prefetch();
+        {lines(function_code(f) for f in functions)}
+        ava_call_cache_end_prefetch(ava_thread_command_channel());
+    }}
+    """.strip()
@@ -0,0 +1,60 @@
+from nightwatch.c_dsl import Expr
+from nightwatch.model import Function
+
+
+def _freelist_spelling(f: Function) -> str:
+    return f"__ava_call_records_{f.name}"
+
+
+def _record_on_stack(f: Function) -> Expr:
+    """
+    :return: An expression which is true if the call record of `f` lives on the stack of the stub. The prefetch keeps
+        the records of cacheable calls after the stub returns, so they are always allocated.
+    """
+    if f.cacheable:
+        return Expr(False)
+    return Expr(f.synchrony).equals("NW_SYNC")
+
+
+def call_record_freelist_declaration(f: Function) -> str:
+    """
+    :return: A C declaration of the per-thread freelist of the call records of `f`.
+    """
+    return f"static __thread struct ava_call_record_freelist {_freelist_spelling(f)};"
+
+
+def call_record_alloc_code(f: Function) -> str:
+    """
+    Generate code to allocate the call record of `f`: on the stack if the stub waits for the reply, otherwise from
+    the freelist of the record type.
+    :return: A series of C statements which declare `__call_record`.
+    """
+    on_stack = _record_on_stack(f)
+    record = f"struct {f.call_record_spelling}"
+    storage = "" if on_stack.is_false() else f"{record} __call_record_storage;"
+    alloc = on_stack.if_then_else_expression(
+        f"memset(&__call_record_storage, 0, sizeof({record}))",
+        f"ava_call_record_alloc(&{_freelist_spelling(f)}, sizeof({record}))")
+    return f"""
+        {storage}
+        {record}* __call_record = ({record}*){alloc};
+    """.strip()
+
+
+def call_record_free_code(f: Function, record: str = "__call_record") -> str:
+    """
+    Generate code for a stub to free its call record after a synchronous call completed.
+    :return: A C statement, or "" if the record is on the stack.
+    """
+    # Synchronous calls only allocate the records of cacheable functions.
+    if not f.cacheable:
+        return ""
+    return f"ava_call_record_free(&{_freelist_spelling(f)}, {record});"
+
+
+def call_record_handler_free_code(f: Function, record: str) -> str:
+    """
+    Generate code for the reply handler to free the record of an asynchronous call.
+    :return: A C statement.
+    """
+    return f"ava_call_record_free(&{_freelist_spelling(f)}, {record});"
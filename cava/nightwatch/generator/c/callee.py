@@ -1,12 +1,21 @@
-from typing import Optional
+from typing import List, Optional
 
 from nightwatch import location, term
 from nightwatch.c_dsl import Expr, ExprOrStr
-from nightwatch.generator.c.buffer_handling import get_transfer_buffer_expr, get_buffer, attach_buffer, \
-    compute_total_size, deallocate_managed_for_argument, size_to_bytes, allocate_tmp_buffer
+from nightwatch.generator import generate_expects
+from nightwatch.generator.c.buffer_handling import get_transfer_buffer_expr, get_buffer, get_shadow_data, attach_buffer, \
+    compute_total_size, deallocate_managed_for_argument, size_to_bytes, allocate_tmp_buffer, declare_buffer_sizes, \
+    hoists_buffer_size
+from nightwatch.generator.c.compress import compress_hint_code
+from nightwatch.generator.c.dedup import dedup_convert_input_code, dedup_lookup_code, dedup_release_code
 from nightwatch.generator.c.instrumentation import timing_code_worker
+from nightwatch.generator.c.memoize import memoize_lookup_code, memoize_store_code
+from nightwatch.generator.c.retry import miss_reply_code
+from nightwatch.generator.c.stream import stream_convert_input_code, stream_copy_predicate, stream_output_code
 from nightwatch.generator.c.stubs import call_function_wrapper
-from nightwatch.generator.c.util import AllocList, compute_buffer_size, for_all_elements
+from nightwatch.generator.c.util import AllocList, compute_buffer_size, for_all_elements, handle_buffer_translation, \
+    predicate_for_direction, copy_then_patch_elements
+from nightwatch.generator.c.zerocopy import zerocopy_convert_input_code
 from nightwatch.generator.common import comment_block, lines
 from nightwatch.model import Argument, Type, ConditionalType, Function
 
@@ -31,19 +40,19 @@ def convert_input_for_argument(arg: Argument, src):
         preassignment = f"{local_value} = {get_transfer_buffer_expr(param_value, type)};"
 
         if isinstance(type, ConditionalType):
-            return Expr(preassignment).then(Expr(type.predicate).if_then_else(
+            return Expr(preassignment).then(predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 convert_input_value(values, type.then_type, depth, original_type=type.original_type, **other),
                 convert_input_value(values, type.else_type, depth, original_type=type.original_type, **other)))
 
         if type.is_void:
             return """abort_with_reason("Reached code to handle void value.");"""
 
-        def maybe_alloc_local_temporary_buffer():
+        def maybe_alloc_local_temporary_buffer(size=None):
             # TODO: Deduplicate with allocate_tmp_buffer
             allocator = type.buffer_allocator
             deallocator = type.buffer_deallocator
             return Expr(param_value).not_equals("NULL").if_then_else(f"""{{
-            const size_t __size = {compute_buffer_size(type, original_type)};                                   
+            const size_t __size = {size or compute_buffer_size(type, original_type)};                                   
             {local_value} = ({type.nonconst.spelling}){allocator}({size_to_bytes("__size", type)});    
             {alloc_list.insert(local_value, deallocator)}
             }}""")
@@ -56,7 +65,7 @@ def convert_input_for_argument(arg: Argument, src):
                 {src_name} = {local_value};
                 {get_buffer(local_value, param_value, type, original_type=original_type, not_null=True)}
                 {(type.lifetime.equals("AVA_CALL") & (~type.is_simple_buffer() | type.buffer_allocator.not_equals("malloc"))).if_then_else(
-                        maybe_alloc_local_temporary_buffer)}
+                        lambda: maybe_alloc_local_temporary_buffer("__buffer_size"))}
                 """
 
         def simple_buffer_case():
@@ -67,6 +76,7 @@ def convert_input_for_argument(arg: Argument, src):
             return ((type.lifetime.not_equals("AVA_CALL") | arg.input) & Expr(param_value).not_equals("NULL")).if_then_else(
                 f"""
                     {get_buffer_code()}
+                    {Expr(arg.input).if_then_else(get_shadow_data(src_name, param_value, local_value, type.nonconst))}
                     {copy_code}
                 """.strip(),
                 (Expr(arg.input) | type.transfer.equals("NW_ZEROCOPY_BUFFER")).if_then_else(
@@ -82,8 +92,11 @@ def convert_input_for_argument(arg: Argument, src):
                 return simple_buffer_case()
 
             inner_values = (local_value, src_name)
-            core = for_all_elements(inner_values, type, depth=depth,
-                                    precomputed_size="__buffer_size", original_type=original_type, **other)
+            core = handle_buffer_translation(
+                inner_values, type, "nw_handle_pool_deref_n", "__buffer_size",
+                copy_then_patch_elements(inner_values, type, dest_index=0, depth=depth,
+                                         precomputed_size="__buffer_size", original_type=original_type, **other),
+                original_type=original_type)
             return ((type.lifetime.not_equals("AVA_CALL") | arg.input) & Expr(param_value).not_equals("NULL")).if_then_else(
                         f"""
                         {get_buffer_code()}
@@ -124,11 +137,12 @@ def convert_input_for_argument(arg: Argument, src):
     with location(f"at {term.yellow(str(arg.name))}", arg.location):
         conv = convert_input_value((arg.name, f"{src}->{arg.param_spelling}"), arg.type,
                                    depth=0, name=arg.name,
-                                   kernel=convert_input_value,
+                                   kernel=convert_input_value, is_in=True,
                                    original_type=arg.type, self_index=0)
         return comment_block(f"Input: {arg}", f"""\
         {arg.type.nonconst.attach_to(arg.name)}; \
-        {conv}
+        {dedup_convert_input_code(arg, src, zerocopy_convert_input_code(arg, src,
+                                                                        stream_convert_input_code(arg, src, conv)))}
         """)
 
 
@@ -143,7 +157,7 @@ def convert_result_for_argument(arg: Argument, dest) -> ExprOrStr:
 
     def convert_result_value(values, type: Type, depth, original_type=None, **other) -> str:
         if isinstance(type, ConditionalType):
-            return Expr(type.predicate).if_then_else(
+            return predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 convert_result_value(values, type.then_type, depth, original_type=type.original_type, **other),
                 convert_result_value(values, type.else_type, depth, original_type=type.original_type, **other))
 
@@ -151,9 +165,13 @@ def convert_result_for_argument(arg: Argument, dest) -> ExprOrStr:
             return """abort_with_reason("Reached code to handle void value.");"""
 
         param_value, local_value = values
+        # The size of the argument itself was computed by declare_buffer_sizes.
+        precomputed_size = arg.buffer_size_spelling \
+            if depth == 0 and hoists_buffer_size(arg, Expr(arg.output) | arg.ret) else None
 
-        def attach_data(data):
-            return attach_buffer(param_value, local_value, data, type, arg.output, cmd=dest, original_type=original_type, expect_reply=False)
+        def attach_data(data, size=None):
+            return attach_buffer(param_value, local_value, data, type, arg.output, cmd=dest, original_type=original_type,
+                                 expect_reply=False, precomputed_size=size or precomputed_size)
 
         def simple_buffer_case():
             if not hasattr(type, "pointee"):
@@ -171,11 +189,17 @@ def convert_result_for_argument(arg: Argument, dest) -> ExprOrStr:
             tmp_name = f"__tmp_{arg.name}_{depth}"
             size_name = f"__size_{arg.name}_{depth}"
             inner_values = (tmp_name, local_value)
+            core = handle_buffer_translation(
+                inner_values, type, "nw_handle_pool_lookup_or_insert_n", size_name,
+                copy_then_patch_elements(inner_values, type, dest_index=0, precomputed_size=size_name, depth=depth,
+                                         original_type=original_type, **other),
+                original_type=original_type)
             return Expr(local_value).not_equals("NULL").if_then_else(
                 f"""{{
-                {allocate_tmp_buffer(tmp_name, size_name, type, alloc_list=alloc_list, original_type=original_type)}
-                {for_all_elements(inner_values, type, precomputed_size=size_name, depth=depth, original_type=original_type, **other)}
-                {attach_data(tmp_name)}
+                {allocate_tmp_buffer(tmp_name, size_name, type, alloc_list=alloc_list, original_type=original_type,
+                                     precomputed_size=precomputed_size)}
+                {core}
+                {attach_data(tmp_name, size_name)}
                 }}""",
                 f"{param_value} = NULL;")
 
@@ -202,9 +226,9 @@ def convert_result_for_argument(arg: Argument, dest) -> ExprOrStr:
     with location(f"at {term.yellow(str(arg.name))}", arg.location):
         conv = convert_result_value((f"{dest}->{arg.param_spelling}", f"{arg.name}"), arg.type,
                                     depth=0, name=arg.name,
-                                    kernel=convert_result_value, self_index=1)
+                                    kernel=convert_result_value, self_index=1, is_in=False)
         return (Expr(arg.output) | arg.ret).if_then_else(
-            comment_block(f"Output: {arg}", conv))
+            comment_block(f"Output: {arg}", stream_output_code(arg, "__call", dest, conv)))
 
 
 def call_command_implementation(f: Function):
@@ -213,7 +237,7 @@ def call_command_implementation(f: Function):
 
         is_async = ~Expr(f.synchrony).equals("NW_SYNC");
         reply_code = f"""
-            command_channel_send_command(__chan, (struct command_base*)__ret);
+            ava_async_batch_send_reply(__chan, (struct command_base*)__ret);
         """.strip()
 
         if (f.api.reply_code):
@@ -229,36 +253,26 @@ def call_command_implementation(f: Function):
             exec(import_code, globals(), ldict)
             worker_argument_process_code = ldict['worker_argument_process_code']
 
-        return f"""
-        case {f.call_id_spelling}: {{\
-            {timing_code_worker("before_unmarshal", str(f.name), f.generate_timing_code)}
-            ava_is_in = 1; ava_is_out = 0;
-            {alloc_list.alloc}
-            struct {f.call_spelling}* __call = (struct {f.call_spelling}*)__cmd;
-            assert(__call->base.api_id == {f.api.number_spelling});
-            assert(__call->base.command_size == sizeof(struct {f.call_spelling}) && "Command size does not match ID. (Can be caused by incorrectly computed buffer sizes, expecially using `strlen(s)` instead of `strlen(s)+1`)");
-
-            /* Unpack and translate arguments */
-            {lines(convert_input_for_argument(a, "__call") for a in f.arguments)}
-
-            {timing_code_worker("after_unmarshal", str(f.name), f.generate_timing_code)}
-            /* Perform Call */
-            {worker_argument_process_code}
-            {call_function_wrapper(f)}
-            {timing_code_worker("after_execution", str(f.name), f.generate_timing_code)}
-
+        build_ret_code = f"""
             ava_is_in = 0; ava_is_out = 1;
-            {compute_total_size(f.arguments + [f.return_value], lambda a: a.output)}
+            {declare_buffer_sizes(f.arguments + [f.return_value], lambda a: Expr(a.output) | a.ret)}
+            {compute_total_size(f.arguments + [f.return_value],
+                                lambda a: stream_copy_predicate(a, a.output, f"__call->{a.stream_spelling}"),
+                                lambda a: Expr(a.output) | a.ret, is_in=False)}
             struct {f.ret_spelling}* __ret = (struct {f.ret_spelling}*)command_channel_new_command(
                 __chan, sizeof(struct {f.ret_spelling}), __total_buffer_size);
             __ret->base.api_id = {f.api.number_spelling};
             __ret->base.command_id = {f.ret_id_spelling};
             __ret->base.thread_id = __call->base.original_thread_id;
             __ret->__call_id = __call->__call_id;
+            {is_async.if_then_else("__ret->__async_error.failed = 0;", "ava_async_error_take(&__ret->__async_error);")}
 
             {convert_result_for_argument(f.return_value, "__ret") if not f.return_value.type.is_void else ""}
             {lines(convert_result_for_argument(a, "__ret") for a in f.arguments if a.type.contains_buffer)}
+            {compress_hint_code(f, "__ret", output=True)}
+        """
 
+        record_code = f"""
             #ifdef AVA_RECORD_REPLAY
             {log_call_declaration}
             {log_ret_declaration}
@@ -267,17 +281,191 @@ def call_command_implementation(f: Function):
             {record_argument_metadata(f.return_value, "__ret") if not f.return_value.type.is_void else ""}
             {record_call_metadata("NULL", None) if f.object_record else ""}
             #endif
+        """
 
+        if f.fire_and_forget:
+            # The guest did not keep a call record, so it only expects a reply if it explicitly asked for one.
+            finish_code = f"""
+            ava_is_in = 0; ava_is_out = 1;
+            {record_code}
+            {timing_code_worker("after_marshal", str(f.name), f.generate_timing_code)}
+            if (!(__call->base.flags & COMMAND_FLAG_NO_REPLY)) {{
+                {build_ret_code}
+                /* Send reply message */
+                {reply_code}
+            }}
+            """
+        else:
+            finish_code = f"""
+            {build_ret_code}
+            {memoize_store_code(f)}
+            {record_code}
             {timing_code_worker("after_marshal", str(f.name), f.generate_timing_code)}
             /* Send reply message */
             {reply_code}
+            """
+
+        # A delta for another version of a shadow buffer was not applied, so the call cannot be executed.
+        shadow_miss_code = "" if not f.shadow_deltas else f"""
+            if (ava_shadow_buffer_take_miss()) {{
+                {dedup_release_code(f)}
+                {miss_reply_code(f, "__shadow_miss", reply_code, alloc_list.dealloc)}
+            }}
+        """
+
+        return f"""
+        case {f.call_id_spelling}: {{\
+            {timing_code_worker("before_unmarshal", str(f.name), f.generate_timing_code)}
+            ava_is_in = 1; ava_is_out = 0;
+            {alloc_list.alloc}
+            struct {f.call_spelling}* __call = (struct {f.call_spelling}*)__cmd;
+            assert(__call->base.api_id == {f.api.number_spelling});
+            assert(__call->base.command_size == sizeof(struct {f.call_spelling}) && "Command size does not match ID. (Can be caused by incorrectly computed buffer sizes, expecially using `strlen(s)` instead of `strlen(s)+1`)");
+
+            {memoize_lookup_code(f, reply_code, alloc_list.dealloc)}
+            {dedup_lookup_code(f, miss_reply_code(f, "__dedup_miss", reply_code, alloc_list.dealloc))}
+
+            {poison_check_code(f, "__call")}
+            /* Unpack and translate arguments */
+            {lines(convert_input_for_argument(a, "__call") for a in f.arguments)}
+            {shadow_miss_code}
+
+            {timing_code_worker("after_unmarshal", str(f.name), f.generate_timing_code)}
+            /* Perform Call */
+            {worker_argument_process_code}
+            {call_unless_poisoned(f)}
+            {lines(bind_guest_allocated_handle(f, a, "__call") for a in f.guest_allocated_handles)}
+            {record_async_error(f) if f.checks_success else ""}
+            {timing_code_worker("after_execution", str(f.name), f.generate_timing_code)}
+
+            {finish_code}
+            {dedup_release_code(f)}
             {alloc_list.dealloc}
-            {lines(deallocate_managed_for_argument(a, "") for a in f.arguments)}
+            {lines(deallocate_managed_for_argument(a, "", is_in=False) for a in f.arguments)}
             break;
         }}
         """.strip()
 
 
+def _poisonable_arguments(f: Function) -> List[Argument]:
+    """
+    :return: The handle arguments of `f` whose IDs may be poisoned, because they may be guest allocated handles whose
+        creation failed.
+    """
+    return [a for a in f.arguments if not isinstance(a.type, ConditionalType) and
+            Expr(a.type.transfer).equals("NW_HANDLE").is_true()]
+
+
+def poison_check_code(f: Function, src: str) -> str:
+    """
+    Generate code to check whether a handle argument of the call is poisoned (see `nw_handle_pool_assign_poison`).
+    :param src: The CALL command.
+    :return: A series of C statements which declare `__poisoned` and `__poison`, or "" if `f` has no handle arguments.
+    """
+    args = _poisonable_arguments(f)
+    if not args:
+        return ""
+    checks = lines(f"""
+        if (!__poisoned)
+            __poisoned = nw_handle_pool_poisoned(handle_pool, (const void*){src}->{a.param_spelling}, &__poison);
+        """.strip() for a in args)
+    return f"""
+        int __poisoned = 0;
+        struct ava_async_error __poison;
+        {checks}
+    """.strip()
+
+
+def call_unless_poisoned(f: Function) -> str:
+    """
+    Call the function, unless one of its handle arguments is poisoned. Then the call fails with the error of the call
+    which should have created the handle: the error is recorded as the thread's deferred error, so the guest reports
+    it according to `AVA_ASYNC_ERROR_POLICY`. The call returns the error if the return types of the functions match,
+    NULL if it returns a guest allocated handle, and otherwise the `ava_failure` value of its return type. Without a
+    failure value the worker aborts, since any value it returned could mean success.
+    :return: A series of C statements which declare and set the return value.
+    """
+    if not _poisonable_arguments(f):
+        return call_function_wrapper(f)
+    ret = f.return_value
+    call = f"__wrapper_{f.name}({', '.join(a.name for a in f.arguments)});"
+    if ret.type.is_void:
+        return f"""
+            if (__poisoned)
+                ava_async_error_record(__poison.command_id, __poison.type_id, __poison.value);
+            else
+                {call}
+        """.strip()
+    if ret.guest_allocated_handle_type:
+        failure = f"{ret.name} = NULL;"
+    elif ret.type.failure is not None:
+        failure = f"{ret.name} = ({ret.type.nonconst.spelling})({ret.type.failure});"
+    else:
+        generate_expects(not any(g.guest_allocated_handles for g in f.api.functions),
+                         f"A handle argument of {f.name} may be poisoned, but its return type has no ava_failure "
+                         f"value, so the worker aborts if it is.")
+        failure = f"""abort_with_reason("{f.name} used a handle whose creation failed, and has no failure value.");"""
+    if f.checks_success and not ret.guest_allocated_handle_type:
+        failure = f"""
+            if (__poison.type_id == {f.return_type_id}u)
+                {ret.name} = ({ret.type.nonconst.spelling})__poison.value;
+            else {{
+                {failure}
+            }}
+        """.strip()
+    return f"""
+        {ret.type.nonconst.attach_to(ret.name)};
+        if (__poisoned) {{
+            ava_async_error_record(__poison.command_id, __poison.type_id, __poison.value);
+            {failure}
+        }} else {{
+            {ret.name} = {call}
+        }}
+    """.strip()
+
+
+def bind_guest_allocated_handle(f: Function, arg: Argument, src: str) -> str:
+    """
+    Bind the object created by the call to the handle ID the guest minted for it. If the call failed, or was not
+    executed because of a poisoned argument, the ID is poisoned with the error so later calls using it fail too.
+    :param f: The function.
+    :param arg: An argument (or return value) with a guest allocated handle.
+    :param src: The CALL command containing the guest's handle ID.
+    :return: A C statement.
+    """
+    if arg.ret:
+        pred, value = f"{arg.name} != NULL", arg.name
+    else:
+        pred, value = f"{arg.name} != NULL && *{arg.name} != NULL", f"*{arg.name}"
+    error_value = f.failure_value(f.return_value.name) if f.checks_success else "0"
+    if _poisonable_arguments(f):
+        pred, error = f"!__poisoned && {pred}", "__poisoned ? &__poison : &__handle_error"
+    else:
+        error = "&__handle_error"
+    return f"""
+        if ({pred}) {{
+            nw_handle_pool_assign_handle(handle_pool, {src}->{arg.guest_handle_spelling}, (const void*){value});
+        }} else {{
+            struct ava_async_error __handle_error = {{
+                .failed = 1, .command_id = {f.call_id_spelling}, .type_id = {f.return_type_id}u, .value = {error_value}}};
+            nw_handle_pool_assign_poison(handle_pool, {src}->{arg.guest_handle_spelling}, {error});
+        }}
+    """.strip()
+
+
+def record_async_error(f: Function) -> ExprOrStr:
+    """
+    Record a failure of an async call, which the guest stub reported as a success, as the thread's deferred error.
+    :param f: A function with `checks_success`.
+    :return: A C statement.
+    """
+    is_async = ~Expr(f.synchrony).equals("NW_SYNC")
+    return is_async.if_then_else(f"""
+        if ({f.failure_predicate(f.return_value.name)})
+            ava_async_error_record({f.call_id_spelling}, {f.return_type_id}u, {f.failure_value(f.return_value.name)});
+    """.strip())
+
+
 def record_call_metadata(handle, type: Optional[Type]):
     log_call_command = f"""if(__call_log_offset == -1) {{
         __call_log_offset = 
@@ -301,7 +489,7 @@ def record_call_metadata(handle, type: Optional[Type]):
 def record_argument_metadata(arg: Argument, src):
     def convert_result_value(values, type: Type, depth, original_type=None, **other) -> str:
         if isinstance(type, ConditionalType):
-            return Expr(type.predicate).if_then_else(
+            return predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 convert_result_value(values, type.then_type, depth, original_type=type.original_type, **other),
                 convert_result_value(values, type.else_type, depth, original_type=type.original_type, **other))
 
@@ -352,7 +540,7 @@ def record_argument_metadata(arg: Argument, src):
     with location(f"at {term.yellow(str(arg.name))}", arg.location):
         conv = convert_result_value((f"{arg.name}",), arg.type,
                                     depth=0, name=arg.name,
-                                    kernel=convert_result_value, self_index=0)
+                                    kernel=convert_result_value, self_index=0, is_in=False)
         return conv
 
 
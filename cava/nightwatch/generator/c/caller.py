@@ -2,8 +2,15 @@ from nightwatch import location, term
 from nightwatch.c_dsl import ExprOrStr, Expr
 from nightwatch.generator import generate_requires, generate_expects
 from nightwatch.generator.c.buffer_handling import get_buffer, get_transfer_buffer_expr, attach_buffer, get_buffer_expr, \
-    deallocate_managed_for_argument, size_to_bytes, allocate_tmp_buffer, DECLARE_BUFFER_SIZE_EXPR
-from nightwatch.generator.c.util import compute_buffer_size, for_all_elements, AllocList
+    get_shadow_data, deallocate_managed_for_argument, size_to_bytes, allocate_tmp_buffer, DECLARE_BUFFER_SIZE_EXPR, \
+    hoists_buffer_size
+from nightwatch.generator.c.call_record import call_record_handler_free_code
+from nightwatch.generator.c.dedup import input_copy_predicate
+from nightwatch.generator.c.retry import copy_miss_code
+from nightwatch.generator.c.stream import stream_copy_predicate, stream_copy_result_code
+from nightwatch.generator.c.util import compute_buffer_size, for_all_elements, AllocList, predicate_for_direction, \
+    copy_then_patch_elements
+from nightwatch.generator.c.zerocopy import zerocopy_attach_code
 from nightwatch.generator.common import comment_block, unpack_struct, lines
 from nightwatch.model import Argument, Type, ConditionalType, Function
 from nightwatch.generator.c.instrumentation import timing_code_guest
@@ -20,7 +27,7 @@ def copy_result_for_argument(arg: Argument, dest, src) -> ExprOrStr:
     reported_missing_lifetime = False
     def convert_result_value(values, type: Type, depth, original_type=None, **other):
         if isinstance(type, ConditionalType):
-            return Expr(type.predicate).if_then_else(
+            return predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 convert_result_value(values, type.then_type, depth, original_type=type.original_type, **other),
                 convert_result_value(values, type.else_type, depth, original_type=type.original_type, **other))
 
@@ -53,7 +60,11 @@ def copy_result_for_argument(arg: Argument, dest, src) -> ExprOrStr:
             if not hasattr(type, "pointee"):
                 return """abort_with_reason("Reached code to handle buffer in non-pointer type.");"""
             copy_code = Expr(arg.output).if_then_else(
-                f"""memcpy({param_value}, {src_name}, {size_to_bytes("__buffer_size", type)});""")
+                f"""
+                {get_shadow_data(src_name, local_value, param_value, type)}
+                if ({param_value} != {src_name})
+                    memcpy({param_value}, {src_name}, {size_to_bytes("__buffer_size", type)});
+                """.strip())
             if copy_code:
                 return Expr(local_value).not_equals("NULL").if_then_else(
                     f"""
@@ -71,7 +82,8 @@ def copy_result_for_argument(arg: Argument, dest, src) -> ExprOrStr:
                 return simple_buffer_case()
 
             inner_values = (param_value, src_name)
-            loop = for_all_elements(inner_values, type, depth=depth, precomputed_size="__buffer_size", original_type=original_type, **other)
+            loop = copy_then_patch_elements(inner_values, type, dest_index=0, depth=depth, precomputed_size="__buffer_size",
+                                            original_type=original_type, values_only=True, **other)
             if loop:
                 return Expr(local_value).not_equals("NULL").if_then_else(
                     f"""
@@ -105,8 +117,8 @@ def copy_result_for_argument(arg: Argument, dest, src) -> ExprOrStr:
     with location(f"at {term.yellow(str(arg.name))}", arg.location):
         conv = convert_result_value((f"{dest}->{arg.param_spelling}", f"{src}->{arg.name}"), arg.type,
                                     depth=0, name=arg.name,
-                                    kernel=convert_result_value, self_index=0)
-        return comment_block(f"Output: {arg}", conv)
+                                    kernel=convert_result_value, self_index=0, is_in=False)
+        return comment_block(f"Output: {arg}", stream_copy_result_code(arg, src, conv))
 
 
 def compute_argument_value(arg: Argument):
@@ -130,14 +142,18 @@ def attach_for_argument(arg: Argument, dest):
 
     def copy_for_value(values, type: Type, depth, argument, original_type=None, **other):
         if isinstance(type, ConditionalType):
-            return Expr(type.predicate).if_then_else(
+            return predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 copy_for_value(values, type.then_type, depth, argument, original_type=type.original_type, **other),
                 copy_for_value(values, type.else_type, depth, argument, original_type=type.original_type, **other))
 
         arg_value, cmd_value = values
+        # The size of the argument itself was computed by declare_buffer_sizes.
+        precomputed_size = arg.buffer_size_spelling if depth == 0 and hoists_buffer_size(arg, arg.input) else None
 
-        def attach_data(data):
-            return attach_buffer(cmd_value, arg_value, data, type, arg.input, cmd=dest, original_type=original_type, expect_reply=True)
+        def attach_data(data, size=None):
+            return attach_buffer(cmd_value, arg_value, data, type, stream_copy_predicate(arg, input_copy_predicate(arg)),
+                                 cmd=dest, original_type=original_type, expect_reply=True,
+                                 precomputed_size=size or precomputed_size, by_reference=True)
 
         def simple_buffer_case():
             if not hasattr(type, "pointee"):
@@ -154,13 +170,14 @@ def attach_for_argument(arg: Argument, dest):
 
             tmp_name = f"__tmp_{arg.name}_{depth}"
             size_name = f"__size_{arg.name}_{depth}"
-            loop = for_all_elements((arg_value, tmp_name), type, depth=depth, argument=argument,
-                                    precomputed_size=size_name, original_type=original_type, **other)
+            loop = copy_then_patch_elements((arg_value, tmp_name), type, dest_index=1, depth=depth, argument=argument,
+                                            precomputed_size=size_name, original_type=original_type, **other)
             return (Expr(arg_value).not_equals("NULL") & (Expr(type.buffer) > 0)).if_then_else(
                 f"""
-                    {allocate_tmp_buffer(tmp_name, size_name, type, alloc_list=alloc_list, original_type=original_type)}
+                    {allocate_tmp_buffer(tmp_name, size_name, type, alloc_list=alloc_list, original_type=original_type,
+                                         precomputed_size=precomputed_size)}
                     {loop}
-                    {attach_data(tmp_name)}
+                    {attach_data(tmp_name, size_name)}
                 """,
                 f"{cmd_value} = NULL;"
             )
@@ -202,12 +219,12 @@ def attach_for_argument(arg: Argument, dest):
             """
         return comment_block(
             f"Input: {arg}",
-            Expr(userdata_code).then(
+            Expr(userdata_code).then(zerocopy_attach_code(arg, dest,
             copy_for_value((arg.param_spelling, f"{dest}->{arg.param_spelling}"), arg.type, depth=0,
                            argument=arg,
                            name=arg.name,
-                           kernel=copy_for_value,
-                           only_complex_buffers=False, self_index=0)))
+                           kernel=copy_for_value, is_in=True,
+                           only_complex_buffers=False, self_index=0))))
 
 
 def return_command_implementation(f: Function):
@@ -215,6 +232,21 @@ def return_command_implementation(f: Function):
         # pthread_mutex_lock(&nw_handler_lock);
         # took_lock = 1;
         generate_requires(not f.return_value.type.buffer or f.return_value.type.lifetime != Expr("AVA_CALL"), "Returned buffers must have a lifetime other than `call' (i.e., must be annotated with `ava_lifetime_static', `ava_lifetime_coupled', or `ava_lifetime_manual').")
+        # Only replies to sync calls carry deferred errors from earlier async calls.
+        if (~Expr(f.synchrony).equals("NW_SYNC")).is_true():
+            async_error_code = ""
+        elif f.checks_success and not f.return_value.guest_allocated_handle_type:
+            # The error is only returned if it has the type of this function's return value. Errors of other types are
+            # logged (or abort) since there is no failure value of this type to return.
+            ret = f.return_value
+            async_error_code = f"""
+                if (ava_async_error_report(&__ret->__async_error, "{f.name}",
+                                           __ret->__async_error.type_id == {f.return_type_id}u) &&
+                    __local->{ret.name} == ({ret.type.success}))
+                    __local->{ret.name} = ({ret.type.nonconst.spelling})__ret->__async_error.value;
+            """.strip()
+        else:
+            async_error_code = f"""ava_async_error_report(&__ret->__async_error, "{f.name}", 0);"""
         return f"""
         case {f.ret_id_spelling}: {{\
             {timing_code_guest("before_unmarshal", str(f.name), f.generate_timing_code)}
@@ -224,6 +256,7 @@ def return_command_implementation(f: Function):
             assert(__ret->base.command_size == sizeof(struct {f.ret_spelling}) && "Command size does not match ID. (Can be caused by incorrectly computed buffer sizes, especially using `strlen(s)` instead of `strlen(s)+1`)");
             struct {f.call_record_spelling}* __local = (struct {f.call_record_spelling}*)ava_remove_call(&__ava_endpoint, __ret->__call_id);
         
+            {copy_miss_code(f)}
             {{
                 {unpack_struct("__local", f.arguments, "->")} \
                 {unpack_struct("__local", f.logue_declarations, "->")} \
@@ -232,15 +265,18 @@ def return_command_implementation(f: Function):
                 {lines(copy_result_for_argument(a, "__local", "__ret")
                        for a in f.arguments if a.type.contains_buffer)}
                 {copy_result_for_argument(f.return_value, "__local", "__ret") if not f.return_value.type.is_void else ""}\
+                {async_error_code}
                 {lines(f.epilogue)}
-                {lines(deallocate_managed_for_argument(a, "__local")
+                {lines(deallocate_managed_for_argument(a, "__local", is_in=False)
                        for a in f.arguments)}
             }}
 
             {timing_code_guest("after_unmarshal", str(f.name), f.generate_timing_code)}
+            // A synchronous stub may return, and free or leave its record, as soon as the call is complete.
+            char __handler_deallocate = __local->__handler_deallocate;
             __local->__call_complete = 1;
-            if(__local->__handler_deallocate) {{
-                free(__local);
+            if (__handler_deallocate) {{
+                {call_record_handler_free_code(f, "__local")}
             }}
             break;
         }}
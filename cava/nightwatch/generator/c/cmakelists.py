@@ -31,6 +31,7 @@ endif()
 find_package(Threads REQUIRED)
 find_package(PkgConfig REQUIRED)
 pkg_check_modules(GLIB2 REQUIRED IMPORTED_TARGET glib-2.0)
+find_package(ZLIB REQUIRED)
 
 set(protobuf_MODULE_COMPATIBLE TRUE)
 find_package(Protobuf CONFIG REQUIRED)
@@ -87,9 +88,23 @@ add_executable(worker
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_record.c
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_hv.c
   ${{CMAKE_SOURCE_DIR}}/../../common/shadow_thread_pool.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/spsc_ring.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/thread_channel.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/call_record.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/buffer_pool.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/size_class.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/env.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/stats.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/async_batch.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/call_cache.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/dedup.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/memoize.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/stream.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/compress.c
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_utilities.cpp
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_tcp.cpp
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_vsock.cpp
+  ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_unix.cpp
   ${{CMAKE_SOURCE_DIR}}/../../proto/manager_service.cpp
   ${{manager_service_grpc_srcs}}
 )
@@ -99,6 +114,7 @@ target_link_libraries(worker
   ${{_PROTOBUF_LIBPROTOBUF}}
   ${{_FLATBUFFERS}}
   ${{GLIB2_LIBRARIES}}
+  ZLIB::ZLIB
   Threads::Threads
   {api.libs}
 )
@@ -118,9 +134,23 @@ add_library(guestlib SHARED
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_record.c
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_hv.c
   ${{CMAKE_SOURCE_DIR}}/../../common/shadow_thread_pool.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/spsc_ring.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/thread_channel.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/call_record.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/buffer_pool.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/size_class.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/env.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/stats.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/async_batch.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/call_cache.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/dedup.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/memoize.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/stream.c
+  ${{CMAKE_SOURCE_DIR}}/../../common/compress.c
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_utilities.cpp
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_tcp.cpp
   ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_vsock.cpp
+  ${{CMAKE_SOURCE_DIR}}/../../common/cmd_channel_socket_unix.cpp
   ${{CMAKE_SOURCE_DIR}}/../../proto/manager_service.cpp
   ${{manager_service_grpc_srcs}}
 )
@@ -130,6 +160,7 @@ target_link_libraries(guestlib
   ${{_PROTOBUF_LIBPROTOBUF}}
   ${{_FLATBUFFERS}}
   ${{GLIB2_LIBRARIES}}
+  ZLIB::ZLIB
   Threads::Threads
   ${{_LIBCONFIG_CONFIG++}}
 )
@@ -1,3 +1,4 @@
+from nightwatch.generator.c.call_record import call_record_freelist_declaration
 from nightwatch.generator.c.callee import call_command_implementation
 from nightwatch.generator.c.caller import return_command_implementation
 from nightwatch.generator.c.printer import print_command_function
@@ -47,6 +48,12 @@ def handle_command_function(api: API, calls: Iterable[Function], returns: Iterab
 def handle_command_header(api: API):
     return f"""
 #include "common/endpoint_lib.h"
+#include "common/async_batch.h"
+#include "common/call_cache.h"
+#include "common/dedup.h"
+#include "common/memoize.h"
+#include "common/stream.h"
+#include "common/thread_channel.h"
 #include "common/linkage.h"
 
 // Must be included before {api.c_header_spelling}, so that API
@@ -87,4 +94,6 @@ void __print_command_{api.identifier.lower()}(FILE* file, const struct command_c
 #endif
 #pragma GCC diagnostic ignored "-Wunused-but-set-variable"
 #pragma GCC diagnostic ignored "-Wunused-variable"
+
+{lines(call_record_freelist_declaration(f) for f in api.supported_functions)}
     """
@@ -0,0 +1,13 @@
+from nightwatch.c_dsl import Expr
+from nightwatch.generator.common import lines
+from nightwatch.model import Function
+
+
+def compress_hint_code(f: Function, dest: str, output: bool) -> str:
+    """
+    :param dest: The command the `ava_compress` buffers of `f` are attached to.
+    :param output: True if `dest` is the RET command, False if it is the CALL command.
+    :return: C statements which mark `dest` as worth compressing if it carries one of the buffers (see compress.h).
+    """
+    return lines(f"if ({a.name} != NULL) {dest}->base.flags |= COMMAND_FLAG_COMPRESSIBLE;"
+                 for a in f.compress_arguments if Expr(a.output if output else a.input).is_true())
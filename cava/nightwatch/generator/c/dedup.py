@@ -0,0 +1,116 @@
+from nightwatch import location, term
+from nightwatch.c_dsl import Expr
+from nightwatch.generator import generate_requires
+from nightwatch.generator.c.buffer_handling import hoists_buffer_size, size_to_bytes
+from nightwatch.generator.c.util import compute_buffer_size
+from nightwatch.generator.common import lines
+from nightwatch.model import Argument, ConditionalType, Function
+
+
+def _buffer_size_bytes(arg: Argument, hoisted: bool = False) -> str:
+    size = arg.buffer_size_spelling if hoisted and hoists_buffer_size(arg, arg.input) else compute_buffer_size(arg.type)
+    return size_to_bytes(size, arg.type)
+
+
+def _check_dedup_input(arg: Argument):
+    f = arg.function
+    with location(f"argument {term.yellow(arg.name)}"):
+        generate_requires(Expr(f.synchrony).equals("NW_SYNC").is_true(),
+                          "ava_dedup_input is only allowed on arguments of synchronous functions.")
+        # The stub sends the call again if the worker no longer has the buffer.
+        generate_requires(not f.prologue and not f.epilogue and not f.logue_declarations,
+                          "Functions with ava_dedup_input arguments cannot have a prologue or epilogue.")
+        generate_requires(not any(a.userdata for a in f.arguments),
+                          "Functions with ava_dedup_input arguments cannot have ava_userdata arguments.")
+        generate_requires(not f.prefetch_at_init, "ava_prefetch_at_init functions cannot have ava_dedup_input arguments.")
+        generate_requires(not isinstance(arg.type, ConditionalType) and
+                          Expr(arg.type.transfer).equals("NW_BUFFER").is_true() and
+                          arg.type.is_simple_buffer().is_true() and
+                          arg.type.lifetime.equals("AVA_CALL").is_true(),
+                          "ava_dedup_input arguments must be simple buffers with call lifetime.")
+        generate_requires(Expr(arg.input).is_true() and Expr(arg.output).is_false(),
+                          "ava_dedup_input arguments must be input-only.")
+
+
+def input_copy_predicate(arg: Argument) -> Expr:
+    """
+    :return: An expression which is true if the contents of the input buffer `arg` are attached to the CALL command.
+    """
+    if not arg.dedup_input:
+        return Expr(arg.input)
+    return Expr(f"{arg.dedup_spelling}.state != AVA_DEDUP_DIGEST")
+
+
+def dedup_digest_code(f: Function) -> str:
+    """
+    Generate code to hash the `ava_dedup_input` buffers of a call. Must run before the size of the CALL command is
+    computed, inside `retry_loop`.
+    :return: A series of C statements which declare the digests.
+    """
+    def digest_code(a: Argument):
+        _check_dedup_input(a)
+        return f"""
+            struct ava_dedup_digest {a.dedup_spelling} = {{{{0}}, AVA_DEDUP_NONE}};
+            if ({a.name} != NULL)
+                ava_dedup_digest({a.name}, {_buffer_size_bytes(a, hoisted=True)}, __retry_attempt > 0,
+                                 &{a.dedup_spelling});
+        """.strip()
+
+    return lines(digest_code(a) for a in f.dedup_inputs)
+
+
+def dedup_attach_code(f: Function, dest: str) -> str:
+    """
+    :return: C statements which copy the digests into the CALL command `dest`.
+    """
+    return lines(f"{dest}->{a.dedup_spelling} = {a.dedup_spelling};" for a in f.dedup_inputs)
+
+
+def dedup_lookup_code(f: Function, miss_code: str) -> str:
+    """
+    Generate code to read the deduplicated buffers of a call from the worker's store.
+    :param miss_code: Code to run if a buffer is not in the store.
+    :return: A series of C statements which declare the `__dedup_data_*` variables.
+    """
+    def lookup_code(i: int, a: Argument):
+        release_previous = lines(f"if (__dedup_data_{b.name} != NULL) g_bytes_unref(__dedup_data_{b.name});"
+                                 for b in f.dedup_inputs[:i])
+        return f"""
+            GBytes *__dedup_data_{a.name} = NULL;
+            if (__call->{a.dedup_spelling}.state == AVA_DEDUP_DIGEST) {{
+                __dedup_data_{a.name} = ava_dedup_store_lookup(&__call->{a.dedup_spelling});
+                if (__dedup_data_{a.name} == NULL) {{
+                    {release_previous}
+                    {miss_code}
+                }}
+            }}
+        """.strip()
+
+    return lines(lookup_code(i, a) for i, a in enumerate(f.dedup_inputs))
+
+
+def dedup_convert_input_code(arg: Argument, src: str, conv: str) -> str:
+    """
+    Wrap the code which extracts the input buffer `arg` from the CALL command `src`. The buffer is read from the
+    store if the command only has its digest, and is stored if the guest asked for it.
+    :param conv: The code which extracts `arg` from the command.
+    :return: A series of C statements.
+    """
+    if not arg.dedup_input:
+        return conv
+    return f"""
+        if (__dedup_data_{arg.name} != NULL) {{
+            {arg.name} = ({arg.type.nonconst.spelling})g_bytes_get_data(__dedup_data_{arg.name}, NULL);
+        }} else {{
+            {conv}
+            if ({src}->{arg.dedup_spelling}.state == AVA_DEDUP_DATA && {arg.name} != NULL)
+                ava_dedup_store_insert(&{src}->{arg.dedup_spelling}, {arg.name}, {_buffer_size_bytes(arg)});
+        }}
+    """.strip()
+
+
+def dedup_release_code(f: Function) -> str:
+    """
+    :return: C statements which release the buffers read from the store.
+    """
+    return lines(f"if (__dedup_data_{a.name} != NULL) g_bytes_unref(__dedup_data_{a.name});" for a in f.dedup_inputs)
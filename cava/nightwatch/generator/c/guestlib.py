@@ -1,3 +1,4 @@
+from nightwatch.generator.c.call_cache import cache_insert_function, prefetch_function, prefetch_function_spelling
 from nightwatch.generator.c.stubs import function_implementation, unsupported_function_implementation
 from .command_handler import *
 
@@ -7,6 +8,7 @@ def source(api: API, errors):
         api,
         api.callback_functions,
         list(api.real_functions) + list(api.callback_functions))
+    prefetch_func_code = prefetch_function(api)
     code = f"""
 #define __AVA__ 1
 #define ava_is_worker 0
@@ -16,11 +18,14 @@ def source(api: API, errors):
 
 {handle_command_header(api)}
 
+{f"static void {prefetch_function_spelling(api)}(void);" if prefetch_func_code else ""}
+
 void __attribute__((constructor(1))) init_{api.identifier.lower()}_guestlib(void) {{
     __handle_command_{api.identifier.lower()}_init();
     {api.guestlib_init_prologue};
     nw_init_guestlib({api.number_spelling});
     {api.guestlib_init_epilogue};
+    {f"{prefetch_function_spelling(api)}();" if prefetch_func_code else ""}
 }}
 
 void __attribute__((destructor)) destroy_{api.identifier.lower()}_guestlib(void) {{
@@ -34,12 +39,14 @@ void __attribute__((destructor)) destroy_{api.identifier.lower()}_guestlib(void)
 
 ////// API function stub implementations
 
-#define __chan nw_global_command_channel
+{lines(cache_insert_function(f) for f in api.real_functions)}
 
 {lines(function_implementation(f) for f in api.callback_functions)}
 {lines(function_implementation(f) for f in api.real_functions)}
 {lines(unsupported_function_implementation(f) for f in api.unsupported_functions)}
 
+{prefetch_func_code}
+
 ////// Replacement declarations
 
 #define ava_begin_replacement 
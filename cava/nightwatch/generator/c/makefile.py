@@ -27,7 +27,7 @@ override CFLAGS+=$(AVA_RELEASE_FLAG) -fmax-errors=25 {api.cflags} \
     -Werror=implicit \
     -D_FILE_OFFSET_BITS=64
 
-override LIBS+=-pthread -lrt -ldl
+override LIBS+=-pthread -lrt -ldl -lz -lm
 
 override CXXFLAGS+={api.cxxflags} \
     -fpermissive
@@ -45,8 +45,10 @@ vpath %.cpp ../../worker/
 vpath %.c ../../guestlib/src/
 
 GENERAL_SOURCES_C=cmd_channel.c murmur3.c cmd_handler.c endpoint_lib.c socket.c zcopy.c \\
-                  cmd_channel_record.c cmd_channel_hv.c shadow_thread_pool.c \\
-                  cmd_channel_socket_utilities.cpp cmd_channel_socket_tcp.cpp cmd_channel_socket_vsock.cpp
+                  cmd_channel_record.c cmd_channel_hv.c shadow_thread_pool.c spsc_ring.c async_batch.c call_cache.c \\
+                  thread_channel.c call_record.c buffer_pool.c size_class.c env.c stats.c dedup.c memoize.c stream.c \\
+                  compress.c cmd_channel_socket_utilities.cpp cmd_channel_socket_tcp.cpp cmd_channel_socket_vsock.cpp \\
+                  cmd_channel_socket_unix.cpp
 WORKER_SPECIFIC_SOURCES={api.c_worker_spelling}
 WORKER_SPECIFIC_SOURCES_C=worker.cpp cmd_channel_shm_worker.c
 GUESTLIB_SPECIFIC_SOURCES={api.c_library_spelling}
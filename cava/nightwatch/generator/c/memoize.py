@@ -0,0 +1,69 @@
+from nightwatch import location, term
+from nightwatch.c_dsl import Expr
+from nightwatch.generator import generate_requires
+from nightwatch.model import ConditionalType, Function
+
+
+def _check_memoize(f: Function):
+    generate_requires(Expr(f.synchrony).equals("NW_SYNC").is_true(), "ava_memoize functions must be synchronous.")
+    generate_requires(not f.object_record, "ava_memoize functions cannot be recorded.")
+    for a in f.arguments + [f.return_value]:
+        with location(f"argument {term.yellow(a.name)}"):
+            for t in a.contained_types:
+                generate_requires(not isinstance(t, ConditionalType), "ava_memoize functions cannot have conditional types.")
+                # These name objects of one worker. A cached reply can neither re-create the objects it returned nor
+                # repeat the effects of the call on the objects it was passed.
+                generate_requires(Expr(t.transfer).one_of({"NW_HANDLE", "NW_CALLBACK", "NW_CALLBACK_REGISTRATION",
+                                                           "NW_FILE", "NW_ZEROCOPY_BUFFER"}).is_false(),
+                                  "ava_memoize functions cannot take or return handles, callbacks, files or "
+                                  "zero-copy buffers.")
+                generate_requires(not t.buffer or t.lifetime.equals("AVA_CALL").is_true(),
+                                  "Buffers of ava_memoize functions must have call lifetime.")
+
+
+def memoize_lookup_code(f: Function, reply_code: str, dealloc_code: str) -> str:
+    """
+    Generate code to send the cached reply to a call, if there is one, instead of executing the call.
+    :param f: An `ava_memoize` function.
+    :param reply_code: Code to send `__ret`.
+    :param dealloc_code: Code to free the temporary allocations of the handler.
+    :return: A series of C statements which declare `__memoize_key`.
+    """
+    if not f.memoize:
+        return ""
+    _check_memoize(f)
+    return f"""
+        struct ava_memoize_key __memoize_key;
+        ava_memoize_key(__chan, __cmd, offsetof(struct {f.call_spelling}, __call_id) + sizeof(intptr_t),
+                        &__memoize_key);
+        {{
+            struct {f.ret_spelling}* __ret = (struct {f.ret_spelling}*)ava_memoize_load(__chan, &__memoize_key);
+            if (__ret != NULL) {{
+                assert(__ret->base.command_size == sizeof(struct {f.ret_spelling}));
+                __ret->base.api_id = {f.api.number_spelling};
+                __ret->base.command_id = {f.ret_id_spelling};
+                __ret->base.thread_id = __call->base.original_thread_id;
+                __ret->__call_id = __call->__call_id;
+                ava_async_error_take(&__ret->__async_error);
+                {reply_code}
+                {dealloc_code}
+                break;
+            }}
+        }}
+    """.strip()
+
+
+def memoize_store_code(f: Function) -> str:
+    """
+    Generate code to add the reply `__ret` of a successful call to the cache. The return value must be in scope.
+    :param f: An `ava_memoize` function.
+    :return: A C statement.
+    """
+    if not f.memoize:
+        return ""
+    ret = f.return_value
+    # Failed calls are not cached, so they are retried.
+    success = Expr(True) if ret.type.is_void or ret.type.success is None else \
+        Expr(f"{ret.name} == ({ret.type.success})")
+    return success.if_then_else(
+        "ava_memoize_store(__chan, (struct command_base*)__ret, &__memoize_key);")
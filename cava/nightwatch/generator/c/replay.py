@@ -3,8 +3,9 @@ from nightwatch.c_dsl import Expr
 from nightwatch.generator.c.buffer_handling import get_buffer
 from nightwatch.generator.c.callee import convert_input_for_argument, record_call_metadata, record_argument_metadata, \
     log_call_declaration, log_ret_declaration
+from nightwatch.generator.c.dedup import dedup_lookup_code, dedup_release_code
 from nightwatch.generator.c.stubs import call_function_wrapper
-from nightwatch.generator.c.util import for_all_elements, AllocList
+from nightwatch.generator.c.util import for_all_elements, AllocList, predicate_for_direction
 from nightwatch.generator.common import lines, comment_block
 from nightwatch.model import Type, Argument, ConditionalType, Function, FunctionPointer, API
 
@@ -21,6 +22,8 @@ def replay_command_implementation(f: Function):
             assert(__call->base.api_id == {f.api.number_spelling});
             assert(__call->base.command_size == sizeof(struct {f.call_spelling}) && "Command size does not match ID. (Can be caused by incorrectly computed buffer sizes, expecially using `strlen(s)` instead of `strlen(s)+1`)");
         
+            {dedup_lookup_code(f, 'abort_with_reason("Deduplicated buffer is not in the store.");')}
+
             /* Unpack and translate arguments */
             {lines(convert_input_for_argument(a, "__call") for a in f.arguments)}
         
@@ -48,6 +51,7 @@ def replay_command_implementation(f: Function):
             {record_call_metadata("NULL", None) if f.object_record else ""}
             #endif
 
+            {dedup_release_code(f)}
             {alloc_list.dealloc}
             break;
         }}
@@ -57,7 +61,7 @@ def replay_command_implementation(f: Function):
 def assign_original_handle_for_argument(arg: Argument, original: str):
     def convert_result_value(values, type: Type, depth, original_type=None, **other) -> str:
         if isinstance(type, ConditionalType):
-            return Expr(type.predicate).if_then_else(
+            return predicate_for_direction(type.predicate, other.get("is_in")).if_then_else(
                 convert_result_value(values, type.then_type, depth, original_type=type.original_type, **other),
                 convert_result_value(values, type.else_type, depth, original_type=type.original_type, **other))
 
@@ -104,7 +108,7 @@ def assign_original_handle_for_argument(arg: Argument, original: str):
     with location(f"at {term.yellow(str(arg.name))}", arg.location):
         conv = convert_result_value((f"{original}->{arg.param_spelling}", f"{arg.name}"), arg.type,
                                     depth=0, name=arg.name,
-                                    kernel=convert_result_value, self_index=1)
+                                    kernel=convert_result_value, self_index=1, is_in=False)
         return (Expr(arg.output) | arg.ret).if_then_else(
             comment_block(f"Assign or check: {arg}", conv))
 
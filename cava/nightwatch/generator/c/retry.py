@@ -0,0 +1,79 @@
+from nightwatch.generator.c.call_record import call_record_free_code
+from nightwatch.generator.common import lines
+from nightwatch.model import Function
+
+
+def retry_loop(f: Function, body: str) -> str:
+    """
+    Wrap the code which marshals, sends, and waits for a call in a loop, so the call can be sent again with all its
+    data if the worker missed some of it. The second attempt sends every deduplicated buffer with its data and every
+    shadow buffer whole, so it cannot miss.
+    :param body: C statements which return from the stub, or continue the loop after a miss (see `retry_code`).
+    :return: A series of C statements.
+    """
+    if not f.miss_fields:
+        return body
+    return f"""
+        for (int __retry_attempt = 0; __retry_attempt < 2; __retry_attempt++) {{
+            {body}
+        }}
+        abort_with_reason("The worker missed data of a call which was sent with all its data.");
+    """.strip()
+
+
+def retry_code(f: Function) -> str:
+    """
+    Generate code to start the next attempt of `retry_loop` if the worker missed data of the call. Must run after the
+    reply has been received.
+    :return: A C statement.
+    """
+    fields = f.miss_fields
+    if not fields:
+        return ""
+    return f"""
+        if ({" || ".join(f"__call_record->{field}" for field in fields)}) {{
+            {lines(f"ava_dedup_forget(&{a.dedup_spelling});" for a in f.dedup_inputs)}
+            {call_record_free_code(f)}
+            {"g_byte_array_unref(__cache_key);" if f.cacheable else ""}
+            continue;
+        }}
+    """.strip()
+
+
+def miss_reply_code(f: Function, field: str, reply_code: str, dealloc_code: str) -> str:
+    """
+    Generate code to tell the guest that the worker missed data of the call, and leave the handler without executing
+    the call.
+    :param field: The flag of the RET command to set (see `Function.miss_fields`).
+    :param reply_code: Code to send `__ret`.
+    :param dealloc_code: Code to free the temporary allocations of the handler.
+    :return: A series of C statements.
+    """
+    return f"""
+        struct {f.ret_spelling}* __ret = (struct {f.ret_spelling}*)command_channel_new_command(
+            __chan, sizeof(struct {f.ret_spelling}), 0);
+        __ret->base.api_id = {f.api.number_spelling};
+        __ret->base.command_id = {f.ret_id_spelling};
+        __ret->base.thread_id = __call->base.original_thread_id;
+        __ret->__call_id = __call->__call_id;
+        __ret->__async_error.failed = 0;
+        __ret->{field} = 1;
+        {reply_code}
+        {dealloc_code}
+        break;
+    """.strip()
+
+
+def copy_miss_code(f: Function) -> str:
+    """
+    :return: The start of a C `if` statement which copies the miss flags of the RET command `__ret` into the call
+        record `__local`, followed by `else` so that the reply is only unpacked if there was no miss.
+    """
+    fields = f.miss_fields
+    if not fields:
+        return ""
+    return f"""
+        if ({" || ".join(f"__ret->{field}" for field in fields)}) {{
+            {lines(f"__local->{field} = __ret->{field};" for field in fields)}
+        }} else
+    """.strip()
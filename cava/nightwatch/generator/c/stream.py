@@ -0,0 +1,143 @@
+from nightwatch import location, term
+from nightwatch.c_dsl import Expr, ExprOrStr
+from nightwatch.generator import generate_requires
+from nightwatch.generator.c.buffer_handling import hoists_buffer_size, size_to_bytes
+from nightwatch.generator.c.util import AllocList, compute_buffer_size
+from nightwatch.generator.common import lines
+from nightwatch.model import Argument, ConditionalType, Function
+
+
+def _buffer_size_bytes(arg: Argument, direction: ExprOrStr = None) -> str:
+    size = arg.buffer_size_spelling if direction is not None and hoists_buffer_size(arg, direction) else \
+        compute_buffer_size(arg.type)
+    return size_to_bytes(size, arg.type)
+
+
+def _check_stream(arg: Argument):
+    f = arg.function
+    with location(f"argument {term.yellow(arg.name)}"):
+        generate_requires(Expr(f.synchrony).equals("NW_SYNC").is_true(),
+                          "ava_stream is only allowed on arguments of synchronous functions.")
+        # Streamed buffers are not part of the CALL and RET commands, so they cannot be cached or logged.
+        generate_requires(not f.memoize and not f.prefetch_at_init and not f.callback_decl and not f.object_record and
+                          not any(t.object_record for t in f.contained_types),
+                          "ava_stream is not allowed in memoized, prefetched, recorded or callback functions.")
+        generate_requires(not arg.dedup_input, "ava_stream arguments cannot be ava_dedup_input.")
+        generate_requires(not isinstance(arg.type, ConditionalType) and hasattr(arg.type, "pointee") and
+                          Expr(arg.type.transfer).equals("NW_BUFFER").is_true() and
+                          arg.type.is_simple_buffer().is_true() and
+                          arg.type.lifetime.equals("AVA_CALL").is_true(),
+                          "ava_stream arguments must be simple buffers with call lifetime.")
+
+
+def stream_select_code(f: Function) -> str:
+    """
+    Generate code to stream the large `ava_stream` buffers of a call. Input buffers are sent before the CALL command
+    and the destinations of output buffers are registered. Must run after `declare_buffer_sizes` and before the size
+    of the CALL command is computed.
+    :return: A series of C statements which declare the `__stream_*` variables.
+    """
+    def select_code(a: Argument):
+        _check_stream(a)
+        size = _buffer_size_bytes(a, a.input)
+        return f"""
+            int64_t {a.stream_spelling} = 0;
+            if ({a.name} != NULL && {size} > ava_stream_chunk_size()) {{
+                {a.stream_spelling} = ava_stream_new_id();
+                {Expr(a.input).if_then_else(f'''
+                    ava_async_batch_flush(__chan, AVA_BATCH_FLUSH_SYNC);
+                    ava_stream_send(__chan, {a.stream_spelling}, {a.name}, {size},
+                                    shadow_thread_id(nw_shadow_thread_pool));
+                ''')}
+                {Expr(a.output).if_then_else(f"ava_stream_expect({a.stream_spelling}, {a.name}, {size});")}
+            }}
+        """.strip()
+
+    return lines(select_code(a) for a in f.stream_arguments)
+
+
+def stream_attach_code(f: Function, dest: str) -> str:
+    """
+    :return: C statements which copy the stream IDs into the CALL command `dest`.
+    """
+    return lines(f"{dest}->{a.stream_spelling} = {a.stream_spelling};" for a in f.stream_arguments)
+
+
+def stream_copy_predicate(arg: Argument, copy: ExprOrStr, stream_id: str = None) -> Expr:
+    """
+    :param copy: An expression which is true if the contents of `arg` are attached to the command.
+    :param stream_id: The expression of the stream ID of `arg`. Defaults to the variable declared by
+        `stream_select_code`.
+    :return: `copy` restricted to the calls where `arg` is not streamed.
+    """
+    if not arg.stream:
+        return Expr(copy)
+    return Expr(copy) & f"{stream_id or arg.stream_spelling} == 0"
+
+
+def stream_release_code(f: Function) -> str:
+    """
+    :return: C statements which drop the registered destinations of the output streams. Must run after the reply
+        has been received.
+    """
+    return lines(f"if ({a.stream_spelling} != 0) ava_stream_forget({a.stream_spelling});"
+                 for a in f.stream_arguments if Expr(a.output).is_true())
+
+
+def stream_convert_input_code(arg: Argument, src: str, conv: str) -> str:
+    """
+    Wrap the code which extracts the input buffer `arg` from the CALL command `src`, so the buffer is taken from its
+    stream if the guest streamed it.
+    :param conv: The code which extracts `arg` from the command.
+    :return: A series of C statements.
+    """
+    if not arg.stream or not Expr(arg.input).is_true():
+        return conv
+    return f"""
+        if ({src}->{arg.stream_spelling} != 0 && {src}->{arg.param_spelling} != NULL) {{
+            {arg.name} = ({arg.type.nonconst.spelling})ava_stream_take({src}->{arg.stream_spelling},
+                {_buffer_size_bytes(arg)});
+            {AllocList(arg.function).insert(arg.name, "free")}
+        }} else {{
+            {conv}
+        }}
+    """.strip()
+
+
+def stream_output_code(arg: Argument, src: str, dest: str, conv: ExprOrStr) -> ExprOrStr:
+    """
+    Wrap the code which attaches the output buffer `arg` to the RET command `dest`, so the buffer is streamed
+    instead if the guest asked for it in the CALL command `src`.
+    :param conv: The code which attaches `arg` to the command.
+    :return: A series of C statements.
+    """
+    if not arg.stream or not Expr(arg.output).is_true():
+        return conv
+    return f"""
+        if ({src}->{arg.stream_spelling} != 0 && {arg.name} != NULL) {{
+            ava_stream_send(__chan, {src}->{arg.stream_spelling}, {arg.name},
+                            {_buffer_size_bytes(arg, Expr(arg.output) | arg.ret)},
+                            {src}->base.original_thread_id);
+            {dest}->{arg.param_spelling} = NULL;
+            {dest}->{arg.stream_spelling} = 1;
+        }} else {{
+            {dest}->{arg.stream_spelling} = 0;
+            {conv}
+        }}
+    """.strip()
+
+
+def stream_copy_result_code(arg: Argument, src: str, copy: ExprOrStr) -> ExprOrStr:
+    """
+    Wrap the code which copies the output buffer `arg` out of the RET command `src`, so it is skipped if the worker
+    streamed the buffer directly into place.
+    :param copy: The code which copies `arg`.
+    :return: A series of C statements.
+    """
+    if not arg.stream or not Expr(arg.output).is_true():
+        return copy
+    return f"""
+        if (!{src}->{arg.stream_spelling}) {{
+            {copy}
+        }}
+    """.strip()
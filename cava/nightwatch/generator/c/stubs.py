@@ -1,10 +1,18 @@
 from nightwatch import location, term
 from nightwatch.c_dsl import ExprOrStr
 from nightwatch.generator import generate_requires
-from nightwatch.generator.c.buffer_handling import compute_total_size
+from nightwatch.generator.c.buffer_handling import compute_total_size, declare_buffer_sizes
+from nightwatch.generator.c.call_cache import cache_lookup_code, cache_insert_call, cache_prefetch_code
+from nightwatch.generator.c.call_record import call_record_alloc_code, call_record_free_code
 from nightwatch.generator.c.caller import compute_argument_value, attach_for_argument
+from nightwatch.generator.c.compress import compress_hint_code
+from nightwatch.generator.c.dedup import dedup_digest_code, dedup_attach_code, input_copy_predicate
 from nightwatch.generator.c.instrumentation import timing_code_guest, report_alloc_resources, report_consume_resources
+from nightwatch.generator.c.retry import retry_code, retry_loop
+from nightwatch.generator.c.stream import stream_select_code, stream_attach_code, stream_copy_predicate, \
+    stream_release_code
 from nightwatch.generator.c.util import *
+from nightwatch.generator.c.zerocopy import zerocopy_select_code, zerocopy_copy_predicate, zerocopy_release_code
 from nightwatch.generator.common import *
 from nightwatch.model import *
 
@@ -17,7 +25,9 @@ def function_implementation(f: Function) -> Union[str, Expr]:
     :return: A C function definition (as a string or Expr)
     """
     with location(f"at {term.yellow(str(f.name))}", f.location):
-        if f.return_value.type.buffer:
+        if f.return_value.guest_allocated_handle_type:
+            forge_success = f"return ({f.return_value.type.spelling}){f.return_value.guest_handle_spelling};"
+        elif f.return_value.type.buffer:
             forge_success = f"#error Async returned buffers are not implemented."
         elif f.return_value.type.is_void:
             forge_success = "return;"
@@ -28,14 +38,16 @@ def function_implementation(f: Function) -> Union[str, Expr]:
 
         if f.return_value.type.is_void:
             return_statement = f"""
-                free(__call_record);
+                {cache_insert_call(f)}
+                {call_record_free_code(f)}
                 return;
             """.strip()
         else:
             return_statement = f"""
                 {f.return_value.declaration};
                 {f.return_value.name} = __call_record->{f.return_value.name};
-                free(__call_record);
+                {cache_insert_call(f)}
+                {call_record_free_code(f)}
                 return {f.return_value.name};
             """.strip()
 
@@ -43,9 +55,17 @@ def function_implementation(f: Function) -> Union[str, Expr]:
 
         alloc_list = AllocList(f)
 
-        send_code = f"""
+        # Async calls are batched. Anything else sends the calling thread's batch first to preserve ordering.
+        flush_reason = Expr(f.synchrony).equals("NW_FLUSH").if_then_else_expression(
+            "AVA_BATCH_FLUSH_EXPLICIT", "AVA_BATCH_FLUSH_SYNC")
+        send_code = Expr(f.synchrony).equals("NW_ASYNC").if_then_else(
+            f"""
+            ava_async_batch_append(__chan, (struct command_base*)__cmd);
+            """.strip(),
+            f"""
+            ava_async_batch_flush(__chan, {flush_reason});
             command_channel_send_command(__chan, (struct command_base*)__cmd);
-        """.strip()
+            """.strip())
 
         if (f.api.send_code):
             import_code = f.api.send_code.encode('ascii', 'ignore').decode('unicode_escape')[1:-1]
@@ -57,14 +77,35 @@ def function_implementation(f: Function) -> Union[str, Expr]:
             forge_success,
             f"""
                 shadow_thread_handle_command_until(nw_shadow_thread_pool, __call_record->__call_complete);
+                {zerocopy_release_code(f)}
+                {stream_release_code(f)}
+                {retry_code(f)}
                 {return_statement}
             """.strip())
 
-        return f"""
-        EXPORTED {(f.api.export_qualifier + " ") if f.api.export_qualifier else ""}{f.return_value.type.spelling} {f.name}(
-                    {", ".join(a.original_declaration for a in f.real_arguments)}) {{
-            {timing_code_guest("before_marshal", str(f.name), f.generate_timing_code)}
+        if f.fire_and_forget:
+            # Nothing will come back from the worker, so do not track the call.
+            call_record_code = "__cmd->base.flags |= COMMAND_FLAG_NO_REPLY;"
+        else:
+            call_record_code = f"""
+            {call_record_alloc_code(f)}
+            {pack_struct("__call_record", f.arguments + f.logue_declarations, "->")}
+            __call_record->__call_complete = 0;
+            __call_record->__handler_deallocate = {is_async};
+            __cmd->__call_id = ava_add_call(&__ava_endpoint, __call_id, __call_record);
+            """.strip()
 
+        # Handles minted here are bound to the real objects by the worker, so the guest does not need to wait for them.
+        mint_guest_handles_code = lines(f"""
+            void* {a.guest_handle_spelling} = nw_handle_pool_new_id();
+            __cmd->{a.guest_handle_spelling} = {a.guest_handle_spelling};
+            """.strip() for a in f.guest_allocated_handles)
+        output_guest_handles_code = lines(f"""
+            if ({a.name} != NULL)
+                *{a.name} = ({a.guest_allocated_handle_type.nonconst.spelling}){a.guest_handle_spelling};
+            """.strip() for a in f.arguments if a.guest_allocated_handle_type)
+
+        call_code = f"""
             const int ava_is_in = 1, ava_is_out = 0;
             intptr_t __call_id = ava_get_call_id(&__ava_endpoint);
 
@@ -81,7 +122,15 @@ def function_implementation(f: Function) -> Union[str, Expr]:
 
             {"".join(compute_argument_value(a) for a in f.implicit_arguments)}
 
-            {compute_total_size(f.arguments, lambda a: a.input)}
+            {cache_lookup_code(f, alloc_list.dealloc)}
+
+            {declare_buffer_sizes(f.arguments, lambda a: a.input)}
+            {dedup_digest_code(f)}
+            {zerocopy_select_code(f)}
+            {stream_select_code(f)}
+            {compute_total_size(f.arguments,
+                                lambda a: stream_copy_predicate(a, zerocopy_copy_predicate(a, input_copy_predicate(a))),
+                                lambda a: a.input, is_in=True)}
             struct {f.call_spelling}* __cmd = (struct {f.call_spelling}*)command_channel_new_command(
                 __chan, sizeof(struct {f.call_spelling}), __total_buffer_size);
             __cmd->base.api_id = {f.api.number_spelling};
@@ -90,6 +139,9 @@ def function_implementation(f: Function) -> Union[str, Expr]:
             __cmd->base.original_thread_id = __cmd->base.thread_id;
 
             __cmd->__call_id = __call_id;
+            {mint_guest_handles_code}
+            {dedup_attach_code(f, "__cmd")}
+            {stream_attach_code(f, "__cmd")}
     
             {nl.join(a.declaration + ";" for a in f.logue_declarations)}
             {{
@@ -97,21 +149,30 @@ def function_implementation(f: Function) -> Union[str, Expr]:
                 {lines(f.prologue)}
                 {"".join(attach_for_argument(a, "__cmd") for a in f.real_arguments)}
             }}
+            {compress_hint_code(f, "__cmd", output=False)}
 
-            struct {f.call_record_spelling}* __call_record =
-                (struct {f.call_record_spelling}*)calloc(1, sizeof(struct {f.call_record_spelling}));
-            {pack_struct("__call_record", f.arguments + f.logue_declarations, "->")}
-            __call_record->__call_complete = 0;
-            __call_record->__handler_deallocate = {is_async};
-            ava_add_call(&__ava_endpoint, __call_id, __call_record);
+            {call_record_code}
+            {"ava_call_cache_invalidate();" if f.invalidates_cache else ""}
+            {cache_prefetch_code(f, alloc_list.dealloc)}
+            {"ava_thread_channel_barrier(__chan);" if f.global_order else ""}
 
             {timing_code_guest("before_send_command", str(f.name), f.generate_timing_code)}
 
             {send_code}
 
+            {output_guest_handles_code}
             {alloc_list.dealloc}
 
             {return_code}
+        """
+
+        return f"""
+        EXPORTED {(f.api.export_qualifier + " ") if f.api.export_qualifier else ""}{f.return_value.type.spelling} {f.name}(
+                    {", ".join(a.original_declaration for a in f.real_arguments)}) {{
+            {timing_code_guest("before_marshal", str(f.name), f.generate_timing_code)}
+            struct command_channel *__chan = ava_thread_command_channel();
+
+            {retry_loop(f, call_code)}
         }}
         """
 
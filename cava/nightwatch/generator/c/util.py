@@ -1,10 +1,12 @@
+import re
+from copy import copy
 from functools import reduce
 from typing import Optional
 
 from toposort import CircularDependencyError
 
 from nightwatch import location, term
-from nightwatch.c_dsl import Expr
+from nightwatch.c_dsl import Expr, ExprOrStr
 from nightwatch.generator import generate_expects
 from ..common import *
 
@@ -72,6 +74,37 @@ def compute_buffer_size(type: Type, original_type: Optional[Type] = None):
 
 
 
+def predicate_for_direction(predicate: ExprOrStr, is_in: Optional[bool]) -> Expr:
+    """
+    Replace `ava_is_in` and `ava_is_out` in a predicate with their values, which are known when generating code for one
+    direction of a call.
+    :param is_in: True for code which runs when entering the call, False for code which runs when returning from it,
+        and None if the direction is not known.
+    :return: The predicate, folded to a constant if it only depends on the direction.
+    """
+    predicate = Expr(predicate)
+    if is_in is None or predicate.is_constant():
+        return predicate
+    code = re.sub(r"\bava_is_in\b", str(int(is_in)), str(predicate))
+    code = re.sub(r"\bava_is_out\b", str(int(not is_in)), code)
+    if code == str(predicate):
+        return predicate
+    # Fold predicates such as `ava_is_in` or `!(ava_is_out)`.
+    simple = re.sub(r"[\s()]", "", code)
+    value = simple.lstrip("!")
+    if value in ("0", "1"):
+        negations = len(simple) - len(value)
+        return Expr(int(value) ^ (negations % 2))
+    return Expr(code)
+
+
+def is_loop_invariant(predicate: ExprOrStr) -> bool:
+    """
+    :return: True if `predicate` does not refer to the current element of a loop generated by `for_all_elements`.
+    """
+    return not re.search(r"\b(ava_index|ava_self)\b|\b__\w+", str(predicate))
+
+
 def for_all_elements(values: tuple, type: Type, *, depth: int, kernel,
                      name: str, self_index: int, precomputed_size=None, original_type=None, **extra):
     """
@@ -82,15 +115,18 @@ def for_all_elements(values: tuple, type: Type, *, depth: int, kernel,
 
     with location(f"in type {term.yellow(type.spelling)}"):
         if hasattr(type, "pointee") and type.pointee:
-            loop = ""
             size_expr = Expr(precomputed_size or compute_buffer_size(type, original_type))
             eval_size = f"const size_t {size} = {size_expr};"
             inner_values = tuple(f"__{name}_{_letters[i]}_{depth}" for i in range(len(values)))
             type_pointee = _char_type_like(type.pointee) if type.pointee.is_void else type.pointee
-            nested = kernel(tuple("*"+v for v in inner_values), type_pointee,
-                            depth=depth+1, name=name, kernel=kernel, self_index=self_index,
-                            **extra)
-            if nested:
+
+            def element_loop(element_type: Type, element_original_type: Optional[Type] = None) -> str:
+                nested = kernel(tuple("*"+v for v in inner_values), element_type,
+                                depth=depth+1, name=name, kernel=kernel, self_index=self_index,
+                                **({"original_type": element_original_type} if element_original_type else {}),
+                                **extra)
+                if not nested:
+                    return ""
                 set_inner_values = lines(
                      f"""
                      {type_pointee.nonconst.attach_to(iv, additional_inner_type_elements="*")}; 
@@ -98,14 +134,14 @@ def for_all_elements(values: tuple, type: Type, *, depth: int, kernel,
                      """
                      for v, iv in zip(values, inner_values))
                 if size_expr.is_constant(1):
-                    loop = f"""
+                    return f"""
                         const size_t {index} = 0;
                         const size_t ava_index = 0;
                         {set_inner_values}
                         {nested}
                     """
                 else:
-                    loop = f"""
+                    return f"""
                         for(size_t {index} = 0; {index} < {size}; {index}++) {{
                             const size_t ava_index = {index};
                             {set_inner_values}
@@ -113,10 +149,16 @@ def for_all_elements(values: tuple, type: Type, *, depth: int, kernel,
                         }}
                     """.strip()
 
-            if nested:
-                return eval_size + loop
-            else:
-                return ""
+            if isinstance(type_pointee, ConditionalType):
+                predicate = predicate_for_direction(type_pointee.predicate, extra.get("is_in"))
+                if not predicate.is_constant() and is_loop_invariant(predicate):
+                    # Select a loop specialized for each branch once, instead of testing the predicate per element.
+                    loop = str(predicate.if_then_else(
+                        element_loop(type_pointee.then_type, type_pointee.original_type),
+                        element_loop(type_pointee.else_type, type_pointee.original_type)))
+                    return eval_size + loop if loop.strip() else ""
+            loop = element_loop(type_pointee)
+            return eval_size + loop if loop else ""
         elif type.fields:
             prefix = f"""
                 {type.nonconst.attach_to("ava_self", additional_inner_type_elements="*")};
@@ -147,6 +189,97 @@ def for_all_elements(values: tuple, type: Type, *, depth: int, kernel,
             raise ValueError("Type must be a buffer of some kind.")
 
 
+def _is_plain_data(type: Type) -> bool:
+    """
+    :return: True if every marshalling kernel copies values of `type` unchanged.
+    """
+    if isinstance(type, ConditionalType):
+        return False
+    if type.fields:
+        return all(_is_plain_data(field) for field in type.fields.values())
+    return Expr(type.transfer).equals("NW_OPAQUE").is_true() and Expr(type.buffer).is_false() and \
+        Expr(type.deallocates).is_false()
+
+
+def _is_value_data(type: Type) -> bool:
+    """
+    :return: True if the marshalling kernels translate values of `type` by assigning a value computed from the source
+        value alone (opaque values and handles), without reading the destination.
+    """
+    if isinstance(type, ConditionalType):
+        return False
+    if type.fields:
+        return all(_is_value_data(field) for field in type.fields.values())
+    return Expr(type.transfer).one_of({"NW_OPAQUE", "NW_HANDLE"}).is_true() and Expr(type.buffer).is_false()
+
+
+def copy_then_patch_elements(values: tuple, type: Type, *, dest_index: int, depth: int, name: str,
+                             precomputed_size=None, original_type=None, values_only=False, **other) -> str:
+    """
+    Generate code to translate a buffer of structs which have only a few fields that need translation (handles,
+    callbacks or nested buffers). The whole buffer is copied with one `memcpy` and then a loop translates only those
+    fields. Other buffers are translated element by element with `for_all_elements`.
+    :param values: The values passed to `for_all_elements`.
+    :param dest_index: The index of the destination buffer in `values`. The other value is the source buffer.
+    :param values_only: Only copy with `memcpy` if the translated fields are handles or opaque values. The guest must
+        set this when it copies into the buffer of the application: the translation of a nested buffer copies through
+        the pointer in the destination, which the `memcpy` would replace with the pointer of the worker, and callbacks
+        of the worker must not reach the application.
+    :return: A series of C statements.
+    """
+    pointee = getattr(type, "pointee", None)
+    if pointee and not isinstance(pointee, ConditionalType) and pointee.fields and \
+            (not original_type or original_type.pointee.spelling == pointee.spelling):
+        patched_fields = {n: f for n, f in pointee.fields.items() if not _is_plain_data(f)}
+        if patched_fields and len(patched_fields) < len(pointee.fields) and \
+                (not values_only or all(_is_value_data(f) for f in patched_fields.values())):
+            patched_pointee = copy(pointee)
+            patched_pointee.fields = patched_fields
+            patched_type = copy(type)
+            patched_type.pointee = patched_pointee
+            size = f"__{name}_copy_size_{depth}"
+            dest, src = values[dest_index], values[1 - dest_index]
+            patch = for_all_elements(values, patched_type, depth=depth, name=name, precomputed_size=size,
+                                     original_type=original_type, **other)
+            return f"""
+                const size_t {size} = {precomputed_size or compute_buffer_size(type, original_type)};
+                if ((const void*){dest} != (const void*){src})
+                    memcpy((void*){dest}, {src}, {size} * sizeof({pointee.spelling}));
+                {patch}
+            """.strip()
+    return for_all_elements(values, type, depth=depth, name=name, precomputed_size=precomputed_size,
+                            original_type=original_type, **other)
+
+
+def handle_buffer_translation(values: tuple, type: Type, handlepool_function: str, size: str, loop: str,
+                              original_type: Optional[Type] = None) -> str:
+    """
+    Generate a single batched handle pool call to translate a buffer of handles, instead of a loop over the elements.
+    :param values: The destination and source buffers.
+    :param handlepool_function: The batched handle pool function (`nw_handle_pool_deref_n` or
+        `nw_handle_pool_lookup_or_insert_n`).
+    :param size: The number of elements in the buffer.
+    :param loop: The element loop (from `for_all_elements`) which performs the same translation.
+    :return: A C statement, or `loop` if the elements of `type` need more than a handle translation.
+    """
+    pointee = getattr(type, "pointee", None)
+    if not pointee or isinstance(pointee, ConditionalType) or pointee.fields or \
+            not Expr(pointee.buffer).is_false() or not Expr(pointee.transfer).equals("NW_HANDLE").is_true() or \
+            not Expr(pointee.deallocates).is_false():
+        return loop
+    if original_type and original_type.pointee.spelling != pointee.spelling:
+        return loop
+    dest, src = values
+    # The handle pool stores pointers, so other handle types keep the loop (the branch is resolved at compile time).
+    return f"""
+        if (sizeof({pointee.spelling}) == sizeof(void*)) {{
+            {handlepool_function}(handle_pool, (void**){dest}, (const void* const*){src}, {size});
+        }} else {{
+            {loop}
+        }}
+    """.strip()
+
+
 def _sort_fields(field_infos: List[tuple]):
     dag = {}
     fields = {name: (name, k, c) for name, k, c in field_infos}
@@ -29,8 +29,6 @@ void __attribute__((constructor(1))) init_{api.identifier.lower()}_worker(void)
     stubs = f"""
 ////// API function stub implementations
 
-#define __chan nw_global_command_channel
-
 {lines(function_implementation(f) for f in api.callback_functions)}
 """
 
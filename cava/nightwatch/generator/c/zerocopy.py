@@ -0,0 +1,89 @@
+from nightwatch.c_dsl import Expr, ExprOrStr
+from nightwatch.generator.c.buffer_handling import hoists_buffer_size, size_to_bytes
+from nightwatch.generator.c.util import compute_buffer_size
+from nightwatch.generator.common import lines
+from nightwatch.model import Argument, Function
+
+
+def _buffer_size_bytes(arg: Argument) -> str:
+    size = arg.buffer_size_spelling if hoists_buffer_size(arg, arg.input) else compute_buffer_size(arg.type)
+    return size_to_bytes(size, arg.type)
+
+
+def zerocopy_select_code(f: Function) -> str:
+    """
+    Generate code to choose the transport of each input buffer of a call which may use the zero-copy region. Must
+    run after `declare_buffer_sizes` and before the size of the CALL command is computed.
+    :return: A series of C statements which declare the `__zcopy_*` and `__zcopy_staging_*` variables.
+    """
+    threshold = f.zerocopy_threshold if f.zerocopy_threshold is not None else "__ava_endpoint.zcopy_threshold"
+
+    def select_code(a: Argument):
+        return f"""
+            void *{a.zerocopy_staging_spelling};
+            const void *{a.zerocopy_spelling} = ava_zcopy_select(&__ava_endpoint, {a.name},
+                ({a.name} != NULL) ? {_buffer_size_bytes(a)} : 0, {threshold}, &{a.zerocopy_staging_spelling});
+        """.strip()
+
+    return lines(select_code(a) for a in f.zerocopy_inputs)
+
+
+def zerocopy_copy_predicate(arg: Argument, copy: ExprOrStr) -> Expr:
+    """
+    :param copy: An expression which is true if the contents of `arg` are attached to the command.
+    :return: `copy` restricted to the calls where `arg` is not passed through the zero-copy region.
+    """
+    if arg not in arg.function.zerocopy_inputs:
+        return Expr(copy)
+    return Expr(copy) & f"{arg.zerocopy_spelling} == NULL"
+
+
+def zerocopy_attach_code(arg: Argument, dest: str, attach: ExprOrStr) -> ExprOrStr:
+    """
+    Wrap the code which attaches the input buffer `arg` to the CALL command `dest`, so it sends a position independent
+    pointer instead if the buffer is in the zero-copy region.
+    :param attach: The code which attaches `arg` to the command.
+    :return: A series of C statements.
+    """
+    if arg not in arg.function.zerocopy_inputs:
+        return attach
+    return f"""
+        if ({arg.zerocopy_spelling} != NULL) {{
+            {dest}->{arg.param_spelling} = ({arg.type.nonconst.spelling})ava_zcopy_region_encode_position_independent(
+                __ava_endpoint.zcopy_region, {arg.zerocopy_spelling});
+            {dest}->{arg.zerocopy_spelling} = 1;
+        }} else {{
+            {dest}->{arg.zerocopy_spelling} = 0;
+            {attach}
+        }}
+    """.strip()
+
+
+def zerocopy_release_code(f: Function) -> str:
+    """
+    :return: C statements which free the buffers staged in the zero-copy region. Must run after the reply has been
+        received.
+    """
+    return lines(f"""
+        if ({a.zerocopy_staging_spelling} != NULL)
+            ava_endpoint_zerocopy_free(&__ava_endpoint, {a.zerocopy_staging_spelling});
+    """.strip() for a in f.zerocopy_inputs)
+
+
+def zerocopy_convert_input_code(arg: Argument, src: str, conv: str) -> str:
+    """
+    Wrap the code which extracts the input buffer `arg` from the CALL command `src`, so the buffer is used in place
+    if the guest passed it through the zero-copy region.
+    :param conv: The code which extracts `arg` from the command.
+    :return: A series of C statements.
+    """
+    if arg not in arg.function.zerocopy_inputs:
+        return conv
+    return f"""
+        if ({src}->{arg.zerocopy_spelling}) {{
+            {arg.name} = ({arg.type.nonconst.spelling})ava_zcopy_region_decode_position_independent(
+                __ava_endpoint.zcopy_region, {src}->{arg.param_spelling});
+        }} else {{
+            {conv}
+        }}
+    """.strip()
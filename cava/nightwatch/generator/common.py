@@ -1,5 +1,7 @@
+import zlib
 from typing import Iterable
 
+from ..c_dsl import Expr
 from ..model import *
 from ..extension import extension
 
@@ -70,16 +72,183 @@ class _TypeSpelling:
 class _ArgumentSpelling:
     # Information
 
+    @property
+    def guest_allocated_handle_type(self) -> Optional[Type]:
+        """
+        The type of the handle minted by the guest for this value (see `ava_guest_allocated_handle`), or None. This is
+        the type of the return value itself or of the element of an output buffer argument.
+        """
+        if self.ret:
+            t = self.type
+        elif Expr(self.output).is_true() and hasattr(self.type, "pointee"):
+            t = self.type.pointee
+        else:
+            return None
+        if isinstance(t, ConditionalType) or not getattr(t, "guest_allocated_handle", False):
+            return None
+        return t
+
     # Identifiers
     @property
     def param_spelling(self):
         return "{}".format(self.name)
 
+    @property
+    def guest_handle_spelling(self):
+        return "__guest_handle_{}".format(self.name)
+
+    @property
+    def dedup_spelling(self):
+        return "__dedup_{}".format(self.name)
+
+    @property
+    def buffer_size_spelling(self):
+        return "__buffer_size_{}".format(self.name)
+
+    @property
+    def zerocopy_spelling(self):
+        return "__zcopy_{}".format(self.name)
+
+    @property
+    def zerocopy_staging_spelling(self):
+        return "__zcopy_staging_{}".format(self.name)
+
+    @property
+    def stream_spelling(self):
+        return "__stream_{}".format(self.name)
+
 
 @extension(Function)
 class _FunctionSpelling:
     # Information
 
+    @property
+    def fire_and_forget(self) -> bool:
+        """
+        True if calls to this function never need a reply: the function is async, has no outputs or epilogue, does not
+        deallocate or record objects, and its return value is forged from the success value or is a guest allocated
+        handle. Stubs for these functions do not create a call record and the worker does not send a RET command.
+        """
+        ret_type = self.return_value.type
+        return Expr(self.synchrony).equals("NW_ASYNC").is_true() and \
+            (ret_type.is_void or self.return_value.guest_allocated_handle_type or
+             (ret_type.success is not None and not ret_type.buffer)) and \
+            not self.epilogue and not self.object_record and \
+            all(Expr(a.output).is_false() or a.guest_allocated_handle_type for a in self.arguments) and \
+            all(Expr(t.deallocates).is_false() and not t.object_record for t in self.contained_types)
+
+    @property
+    def shadow_deltas(self) -> bool:
+        """
+        True if the stub may send the shadow buffers of calls to this function as deltas (see
+        `ava_shadow_buffer_delta_size`). The worker does not execute a call with a delta for another version of its
+        buffer, so the stub must be able to send the call again: the function must be synchronous, and must not have a
+        prologue or epilogue, ava_userdata arguments, or recorded objects.
+        """
+        return Expr(self.synchrony).equals("NW_SYNC").is_true() and \
+            not self.prologue and not self.epilogue and not self.logue_declarations and \
+            not self.prefetch_at_init and not self.memoize and not self.object_record and \
+            not any(a.userdata for a in self.arguments) and \
+            not any(t.object_record for t in self.contained_types) and \
+            any(not isinstance(t, ConditionalType) and t.buffer and not t.lifetime.equals("AVA_CALL").is_true()
+                for a in self.arguments for t in a.contained_types)
+
+    @property
+    def miss_fields(self) -> List[str]:
+        """
+        The flags of the RET command and call record which tell the stub that the worker did not execute the call
+        because it lacked data the stub assumed it had: a deduplicated buffer (`__dedup_miss`) or the base version of a
+        shadow buffer delta (`__shadow_miss`). The stub then sends the call again.
+        """
+        fields = []
+        if self.dedup_inputs:
+            fields.append("__dedup_miss")
+        if self.shadow_deltas:
+            fields.append("__shadow_miss")
+        return fields
+
+    @property
+    def checks_success(self) -> bool:
+        """
+        True if the return value shows whether the call failed: it can be compared with its success value, or it is a
+        guest allocated handle, which is NULL on failure. Async stubs for these functions forge the success value (or
+        the handle), so the worker records failures as deferred errors (`ava_async_error`).
+        """
+        ret = self.return_value
+        return not ret.type.is_void and not ret.type.buffer and \
+            (ret.type.success is not None or bool(ret.guest_allocated_handle_type))
+
+    def failure_predicate(self, value: str) -> str:
+        """
+        :param value: The return value of a call to this function, which `checks_success`.
+        :return: A C expression which is true if the call failed.
+        """
+        if self.return_value.guest_allocated_handle_type:
+            return f"{value} == NULL"
+        return f"{value} != ({self.return_value.type.success})"
+
+    def failure_value(self, value: str) -> str:
+        """
+        :param value: The return value of a failed call to this function, which `checks_success`.
+        :return: A C expression for the value of the deferred error (`ava_async_error::value`).
+        """
+        if self.return_value.guest_allocated_handle_type:
+            return "0"
+        return f"(int64_t){value}"
+
+    @property
+    def return_type_id(self) -> int:
+        """
+        A 32-bit identifier of the return type of this function. Deferred errors carry the identifier of the function
+        which failed, so a synchronous call only returns errors of its own return type.
+        """
+        return zlib.crc32(str(self.return_value.type.nonconst.spelling).encode())
+
+    @property
+    def guest_allocated_handles(self) -> List[Argument]:
+        """
+        The arguments (including the return value) whose handles are minted by the guest.
+        """
+        return [a for a in self.arguments + [self.return_value] if a.guest_allocated_handle_type]
+
+    @property
+    def dedup_inputs(self) -> List[Argument]:
+        """
+        The `ava_dedup_input` arguments.
+        """
+        return [a for a in self.arguments if a.dedup_input]
+
+    @property
+    def stream_arguments(self) -> List[Argument]:
+        """
+        The `ava_stream` arguments.
+        """
+        return [a for a in self.arguments if a.stream]
+
+    @property
+    def compress_arguments(self) -> List[Argument]:
+        """
+        The `ava_compress` arguments.
+        """
+        return [a for a in self.arguments if a.compress]
+
+    @property
+    def zerocopy_inputs(self) -> List[Argument]:
+        """
+        The input buffers which the stub may pass through the zero-copy region instead of the CALL command (see
+        `ava_zcopy_select`): simple buffers with call lifetime of synchronous functions. Memoized and recorded calls
+        must carry their data, and prefetched calls return before the worker reads them, so their buffers are always
+        copied.
+        """
+        if not Expr(self.synchrony).equals("NW_SYNC").is_true() or self.memoize or self.prefetch_at_init or \
+                self.callback_decl or self.object_record or any(t.object_record for t in self.contained_types):
+            return []
+        return [a for a in self.arguments
+                if not isinstance(a.type, ConditionalType) and hasattr(a.type, "pointee") and not a.dedup_input and
+                not a.stream and Expr(a.input).is_true() and Expr(a.type.transfer).equals("NW_BUFFER").is_true() and
+                a.type.lifetime.equals("AVA_CALL").is_true() and a.type.is_simple_buffer().is_true() and
+                a.type.buffer_allocator.equals("malloc").is_true()]
+
     # Identifiers
 
     @property
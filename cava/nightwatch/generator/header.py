@@ -8,15 +8,52 @@ def argument(arg: Argument):
     """.strip()
 
 
+_scalar_alignments = {
+    "char": 1, "signed char": 1, "unsigned char": 1, "bool": 1, "_Bool": 1, "int8_t": 1, "uint8_t": 1,
+    "short": 2, "short int": 2, "unsigned short": 2, "unsigned short int": 2, "int16_t": 2, "uint16_t": 2,
+    "int": 4, "signed": 4, "signed int": 4, "unsigned": 4, "unsigned int": 4, "float": 4,
+    "int32_t": 4, "uint32_t": 4,
+}
+
+
+def _alignment(type: Type) -> int:
+    """
+    :return: The alignment of a field of type `type`, as far as it can be told from its spelling. Pointers, structs
+    and typedefs which are not known to be small are assumed to have the largest alignment.
+    """
+    if hasattr(type, "pointee") or isinstance(type, FunctionPointer):
+        return 8
+    spelling = Type._drop_const(type.nonconst.spelling).strip()
+    if spelling.startswith("enum "):
+        return 4
+    return _scalar_alignments.get(spelling, 8)
+
+
+def fields_by_alignment(fields) -> str:
+    """
+    Lay out the fields of a command struct from the largest to the smallest alignment, so the struct has no padding
+    between them. Fields with the same alignment keep their order.
+    :param fields: Pairs of the type (or alignment) and the declaration of each field.
+    :return: The field declarations.
+    """
+    fields = [(t if isinstance(t, int) else _alignment(t), decl) for t, decl in fields]
+    return "\n".join(decl for _, decl in sorted(fields, key=lambda field: -field[0]))
+
+
 def function_call_struct(f: Function, errors):
     with capture_errors():
         with location(f"at {term.yellow(str(f.name))}", f.location, report_continue=errors):
-            arg_suffix = "\n"
+            fields = [(a.type, argument(a)) for a in f.arguments]
+            fields += [(8, f"void* {a.guest_handle_spelling};") for a in f.guest_allocated_handles]
+            fields += [(8, f"struct ava_dedup_digest {a.dedup_spelling};") for a in f.dedup_inputs]
+            fields += [(1, f"uint8_t {a.zerocopy_spelling};") for a in f.zerocopy_inputs]
+            fields += [(8, f"int64_t {a.stream_spelling};") for a in f.stream_arguments]
+            # __call_id must directly follow the header: the memoization key covers everything after it.
             return f"""
             struct {f.call_spelling} {{
                 struct command_base base;
                 intptr_t __call_id;
-                {"".join(argument(a) + arg_suffix for a in f.arguments).strip()}
+                {fields_by_alignment(fields)}
             }};
             """
         # noinspection PyUnreachableCode
@@ -26,13 +63,17 @@ def function_call_struct(f: Function, errors):
 def function_ret_struct(f: Function, errors):
     with capture_errors():
         with location(f"at {term.yellow(str(f.name))}", f.location, report_continue=errors):
-            arg_suffix = "\n"
+            fields = [(8, "struct ava_async_error __async_error;")]
+            fields += [(1, f"uint8_t {field};") for field in f.miss_fields]
+            fields += [(a.type, argument(a)) for a in f.arguments if a.type.contains_buffer and a.output]
+            fields += [(1, f"uint8_t {a.stream_spelling};") for a in f.stream_arguments if Expr(a.output).is_true()]
+            if not f.return_value.type.is_void:
+                fields.append((f.return_value.type, argument(f.return_value)))
             return f"""
             struct {f.ret_spelling} {{
                 struct command_base base;
                 intptr_t __call_id;
-                {"".join(argument(a) + arg_suffix for a in f.arguments if a.type.contains_buffer and a.output).strip()}\
-                {argument(f.return_value) if not f.return_value.type.is_void else ""}
+                {fields_by_alignment(fields)}
             }};
             """
         # noinspection PyUnreachableCode
@@ -42,13 +83,15 @@ def function_ret_struct(f: Function, errors):
 def function_call_record_struct(f: Function, errors):
     with capture_errors():
         with location(f"at {term.yellow(str(f.name))}", f.location, report_continue=errors):
-            arg_suffix = "\n"
+            fields = [(a.type, argument(a)) for a in f.arguments]
+            if not f.return_value.type.is_void:
+                fields.append((f.return_value.type, argument(f.return_value)))
+            fields += [(a.type, argument(a)) for a in f.logue_declarations]
             return f"""
             struct {f.call_record_spelling} {{
-                {"".join(argument(a) + arg_suffix for a in f.arguments).strip()}\
-                {argument(f.return_value) if not f.return_value.type.is_void else ""}\
-                {"".join(argument(a) + arg_suffix for a in f.logue_declarations).strip()}\
+                {fields_by_alignment(fields)}
                 char __handler_deallocate;
+                {lines(f"char {field};" for field in f.miss_fields)}
                 volatile char __call_complete;
             }};
             """
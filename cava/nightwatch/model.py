@@ -74,6 +74,7 @@ class Location(namedtuple("Location", ["filename", "line", "column", "offset"]))
 
 class Type(object):
     success: Optional[ExprOrStr]
+    failure: Optional[ExprOrStr]
     transfer: Optional[ExprOrStr]
     spelling: str
     pointee: Optional["Type"]
@@ -88,6 +89,7 @@ class Type(object):
         self.fields = {}
         self.spelling = spelling
         self.success = None
+        self.failure = None
         self.allocates_resources = {}
         self.deallocates_resources = {}
         self.type_cast = None
@@ -300,6 +302,9 @@ class Argument(object):
         self.input = 0
         self.output = 0
         self.no_copy = False
+        self.dedup_input = False
+        self.stream = False
+        self.compress = False
         self.ret = False
         self.__dict__.update(annotations)
 
@@ -375,6 +380,12 @@ class Function(object):
     ignore: bool
     generate_timing_code: bool
     disable_native: bool
+    cacheable: bool
+    invalidates_cache: bool
+    prefetch_at_init: List[List[Expr]]
+    memoize: bool
+    zerocopy_threshold: Optional[Expr]
+    global_order: bool
 
     def __init__(self, name: str, return_value: Argument, arguments: List[Argument], location, **annotations):
         self.prologue = ""
@@ -392,6 +403,12 @@ class Function(object):
         self.location = location
         self.generate_timing_code = False
         self.disable_native = False
+        self.cacheable = False
+        self.invalidates_cache = False
+        self.prefetch_at_init = []
+        self.memoize = False
+        self.zerocopy_threshold = None
+        self.global_order = False
         self.__dict__.update(annotations)
 
         assert not self.callback_decl or hasattr(self, "type") and self.type
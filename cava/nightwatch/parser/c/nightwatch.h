@@ -51,8 +51,8 @@ extern unsigned long int ava_index;
 /// Provide a return value which specifies success for a given type.
 #define ava_success(v) __AVA_ANNOTATE_STMT(success, v)
 
-// TODO: failure? There could be multiple kinds of failure. It's not clear how to represent this. When will failure need to be forged?
-// I think failure may need to be handled by code in the bodies of functions. Simply by returning the appropriate value.
+/// Provide a return value which specifies failure for a given type. Returned by calls which are not executed.
+#define ava_failure(v) __AVA_ANNOTATE_STMT(failure, v)
 
 enum ava_transfer_t {
     NW_NONE=0,
@@ -98,6 +98,16 @@ typedef void (*ava_buffer_deallocator)(void *ptr);
 /// cases).
 #define ava_handle __AVA_ANNOTATE_STMT_TYPED(enum ava_transfer_t, transfer, NW_HANDLE)
 
+/// The handle is created by this call, but its ID is minted by the
+/// guest instead of the worker. The guest returns the ID immediately
+/// and the worker binds the new object to it when the call executes, so
+/// the call can be `ava_async`. This annotation may be applied to a
+/// handle return value or to the element of an `ava_out` buffer of one
+/// handle (e.g., `cudaStream_t* pStream`). It implies `ava_handle`.
+#define ava_guest_allocated_handle ({ \
+    __AVA_ANNOTATE_STMT_TYPED(enum ava_transfer_t, transfer, NW_HANDLE); \
+    __AVA_ANNOTATE_FLAG(guest_allocated_handle); })
+
 /// Treat this value as an opaque value (effectively as a intptr_t if
 /// it is a pointer).
 #define ava_opaque __AVA_ANNOTATE_STMT_TYPED(enum ava_transfer_t, transfer, NW_OPAQUE)
@@ -201,6 +211,23 @@ typedef void (*ava_buffer_deallocator)(void *ptr);
 /// transfer annotation.
 #define ava_no_copy __AVA_ANNOTATE_FLAG(no_copy)
 
+/// The input buffer is often passed again with the same contents
+/// (e.g., program sources or constant tables). The guestlib sends only
+/// a digest of the contents if the worker has already received them.
+/// Only allowed on simple input buffers of synchronous functions.
+#define ava_dedup_input __AVA_ANNOTATE_FLAG(dedup_input)
+
+/// The buffer may be very large. Buffers larger than
+/// `AVA_STREAM_CHUNK_SIZE` are sent as a stream of chunks which the
+/// receiver copies into place while the following chunks are sent.
+/// Only allowed on simple buffers of synchronous functions.
+#define ava_stream __AVA_ANNOTATE_FLAG(stream)
+
+/// The buffer is large and usually compressible (e.g., sparse or
+/// zero-filled data). Commands carrying it are compressed by the TCP and
+/// vsock channels if they are larger than `AVA_COMPRESS_THRESHOLD`.
+#define ava_compress __AVA_ANNOTATE_FLAG(compress)
+
 /// The value is deallocated by this call.
 #define ava_deallocates __AVA_ANNOTATE_FLAG(deallocates)
 
@@ -282,6 +309,46 @@ typedef void (*ava_buffer_deallocator)(void *ptr);
 // This function's native API will not be called in the host worker.
 #define ava_disable_native_call __AVA_ANNOTATE_FLAG(disable_native)
 
+/// The results of this function depend only on its arguments and the
+/// contents of its input buffers (e.g., device property queries). The
+/// guestlib caches the return value and output buffers and returns
+/// them without calling the worker when the function is called again
+/// with the same inputs. The function must be synchronous and its
+/// buffers must not contain pointers.
+#define ava_cacheable __AVA_ANNOTATE_FLAG(cacheable)
+
+/// This function may change the results of `ava_cacheable` functions
+/// (e.g., it changes the current device). Calls to it clear the
+/// guestlib's call cache.
+#define ava_invalidates_cache __AVA_ANNOTATE_FLAG(invalidates_cache)
+
+/// Call this `ava_cacheable` function with each tuple of argument values
+/// when the guestlib is loaded, so the results are cached before the
+/// application asks for them. All the calls are sent in one batch.
+/// Tuples are separated by `;` and the values in a tuple by `,`. A tuple
+/// has a value for every argument, in order. The guestlib allocates output
+/// buffers, so their values are ignored unless they are `NULL`.
+/// For example, `ava_prefetch_at_init(0, NULL; 1, NULL)`.
+#define ava_prefetch_at_init(...) __AVA_ANNOTATE_STMT_TYPED(const char*, prefetch_at_init, #__VA_ARGS__)
+
+/// The outputs of this function are fully determined by its arguments
+/// and input buffers (e.g., compiling a program). The worker keeps the
+/// replies to successful calls in a persistent on-disk cache and sends
+/// the cached reply instead of calling the function again. The function
+/// must be synchronous and must not take or return handles.
+#define ava_memoize __AVA_ANNOTATE_FLAG(memoize)
+
+/// Input buffers of this synchronous function of at least `size` bytes
+/// are staged in the zero-copy region instead of being copied into the
+/// CALL command. This overrides `AVA_ZCOPY_THRESHOLD` for the function.
+#define ava_zerocopy_threshold(size) __AVA_ANNOTATE_STMT_TYPED(size_t, zerocopy_threshold, size)
+
+/// This function is a global ordering point (e.g., a device-wide
+/// synchronization). When guest threads have their own channels
+/// (`AVA_THREAD_CHANNELS`), the worker executes the call only after
+/// all calls which other threads sent before it.
+#define ava_global_order __AVA_ANNOTATE_FLAG(global_order)
+
 //////// Record and Replay
 
 /// Extract the explicit state of the object `o` and return it as a malloc'd buffer.
@@ -86,12 +86,15 @@ def convert_location(loc):
 resource_directory = Path(__file__).parent
 nightwatch_parser_c_header = "nightwatch.h"
 
-function_annotations = {"synchrony", "ignore", "callback_decl", "object_record", "generate_timing_code"}
-type_annotations = {"transfer", "success", "name", "element", "deallocates", "allocates", "buffer",
+function_annotations = {"synchrony", "ignore", "callback_decl", "object_record", "generate_timing_code",
+                        "cacheable", "invalidates_cache", "prefetch_at_init", "memoize",
+                        "zerocopy_threshold", "global_order"}
+type_annotations = {"transfer", "success", "failure", "name", "element", "deallocates", "allocates", "buffer",
                     "object_explicit_state_extract", "object_explicit_state_replace",
                     "buffer_allocator", "buffer_deallocator", "object_record", "object_depends_on",
-                    "callback_stub_function", "lifetime", "lifetime_coupled"}
-argument_annotations = {"depends_on", "value", "implicit_argument", "input", "output", "no_copy", "userdata"}
+                    "callback_stub_function", "lifetime", "lifetime_coupled", "guest_allocated_handle"}
+argument_annotations = {"depends_on", "value", "implicit_argument", "input", "output", "no_copy", "userdata",
+                        "dedup_input", "stream", "compress"}
 
 ignored_cursor_kinds = frozenset([CursorKind.MACRO_INSTANTIATION])
 
@@ -109,6 +112,37 @@ def _as_string_set(s):
     return set([s for s in NW_ANNOTATION_SPLIT_RE.split(s and ast.literal_eval(s)) if s])
 
 
+def _split_top_level(s, separator):
+    """
+    Split `s` at each `separator` which is not in brackets or a string or character literal.
+    """
+    parts = [""]
+    depth = 0
+    quote = None
+    escaped = False
+    for c in s:
+        if quote:
+            if c == quote and not escaped:
+                quote = None
+            escaped = not escaped and c == "\\"
+        elif c in "\"'":
+            quote = c
+        elif c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth -= 1
+        elif c == separator and depth == 0:
+            parts.append("")
+            continue
+        parts[-1] += c
+    return [p.strip() for p in parts]
+
+
+def _as_argument_tuples(s):
+    return [[Expr(v) for v in _split_top_level(t, ",")]
+            for t in _split_top_level(s and ast.literal_eval(s), ";") if t]
+
+
 def _as_cexpr_singleton_set(s):
     return set([Expr(s)])
 
@@ -124,6 +158,9 @@ annotation_parsers = dict(
     input=_as_bool,
     output=_as_bool,
     no_copy=_as_bool,
+    dedup_input=_as_bool,
+    stream=_as_bool,
+    compress=_as_bool,
     allocates=_as_bool,
     deallocates=_as_bool,
     buffer=Expr,
@@ -133,6 +170,13 @@ annotation_parsers = dict(
     lifetime=Expr,
     lifetime_coupled=Expr,
     generate_timing_code=_as_bool,
+    guest_allocated_handle=_as_bool,
+    cacheable=_as_bool,
+    invalidates_cache=_as_bool,
+    prefetch_at_init=_as_argument_tuples,
+    memoize=_as_bool,
+    zerocopy_threshold=Expr,
+    global_order=_as_bool,
 )
 
 annotation_relevant_kinds = frozenset((CursorKind.VAR_DECL, CursorKind.IF_STMT))
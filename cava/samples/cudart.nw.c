@@ -775,7 +775,10 @@ cudaPointerGetAttributes(struct cudaPointerAttributes *attributes, const void *p
 }
 
 __host__ __cudart_builtin__ cudaError_t CUDARTAPI
-cudaDeviceSynchronize(void);
+cudaDeviceSynchronize(void)
+{
+    ava_global_order;
+}
 
 __host__ cudaError_t CUDARTAPI
 cudaEventCreate(cudaEvent_t *event)
@@ -299,6 +299,17 @@ read_simple_buffer(struct simple_buffer_t *buf)
     }
 }
 
+void
+write_simple_buffers(struct simple_buffer_t *bufs, size_t count)
+{
+    ava_sync;
+
+    ava_argument(bufs) {
+        ava_buffer(count);
+        ava_in; ava_out;
+    }
+}
+
 void
 mutate_simple_buffer(struct simple_buffer_t *buf)
 {
@@ -463,6 +474,30 @@ benchmark_copy_out_shadow_buffer(size_t size, time_t execution_time)
     }
 }
 
+void
+benchmark_stream_in(void *data, size_t size, time_t execution_time)
+{
+    ava_sync;
+
+    ava_argument(data) {
+        ava_input;
+        ava_buffer(size);
+        ava_stream;
+    }
+}
+
+void
+benchmark_stream_out(void *data, size_t size, time_t execution_time)
+{
+    ava_sync;
+
+    ava_argument(data) {
+        ava_output;
+        ava_buffer(size);
+        ava_stream;
+    }
+}
+
 void
 benchmark_zero_copy_in(void *data, size_t size, time_t execution_time)
 {
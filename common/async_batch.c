@@ -0,0 +1,303 @@
+#include <assert.h>
+#include <glib.h>
+#include <inttypes.h>
+#include <pthread.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "common/async_batch.h"
+#include "common/cmd_channel.h"
+#include "common/cmd_handler.h"
+#include "common/debug.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/stats.h"
+
+#define DEFAULT_MAX_COMMANDS 64
+#define DEFAULT_MAX_BYTES (256 * 1024)
+#define DEFAULT_TIMEOUT_US 1000
+
+struct ava_async_batch {
+    pthread_mutex_t lock;
+    /* The channel the batched commands were created on. */
+    struct command_channel *chan;
+    /* The batched commands in the format described at struct command_handler_batch_command. */
+    GByteArray *data;
+    uint32_t count;
+    int64_t thread_id;
+    /* `COMMAND_FLAG_COMPRESSIBLE` if any of the batched commands has it. */
+    int8_t flags;
+    /* The time the first command in this batch was appended (g_get_monotonic_time). */
+    gint64 start_time;
+};
+
+static pthread_once_t batch_init_once = PTHREAD_ONCE_INIT;
+static int enabled;
+static size_t max_commands;
+static size_t max_bytes;
+static gint64 timeout_us;
+
+static pthread_key_t batch_key;
+/* All live batches. Used by the timeout thread. */
+static GPtrArray *batches;
+static pthread_mutex_t batches_lock = PTHREAD_MUTEX_INITIALIZER;
+/* Signaled (with `batches_lock`) when a batch becomes non-empty. Uses the monotonic clock. */
+static pthread_cond_t batches_cond;
+static pthread_t timeout_thread;
+
+/* Non-zero while the calling thread executes a batch, so its replies are batched. */
+static __thread int batching_replies;
+
+static struct ava_async_batch_stats batch_stats;
+static pthread_mutex_t batch_stats_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static const char *flush_reason_names[AVA_BATCH_FLUSH_REASONS] = {
+    [AVA_BATCH_FLUSH_SYNC] = "sync",
+    [AVA_BATCH_FLUSH_EXPLICIT] = "flush",
+    [AVA_BATCH_FLUSH_COUNT] = "count",
+    [AVA_BATCH_FLUSH_SIZE] = "size",
+    [AVA_BATCH_FLUSH_TIMEOUT] = "timeout",
+    [AVA_BATCH_FLUSH_THREAD_EXIT] = "thread_exit",
+};
+
+/**
+ * Send the batch as a single command. The caller must hold `batch->lock`.
+ */
+static void batch_send_locked(struct ava_async_batch *batch, enum ava_async_batch_flush_reason reason) {
+    if (batch->count == 0)
+        return;
+
+    struct command_channel *chan = batch->chan;
+    struct command_handler_batch_command *cmd = (struct command_handler_batch_command *)command_channel_new_command(
+            chan, sizeof(struct command_handler_batch_command), command_channel_buffer_size(chan, batch->data->len));
+    cmd->base.api_id = COMMAND_HANDLER_API;
+    cmd->base.command_id = COMMAND_HANDLER_BATCH;
+    cmd->base.thread_id = batch->thread_id;
+    cmd->base.original_thread_id = batch->thread_id;
+    cmd->base.flags = batch->flags;
+    cmd->command_count = batch->count;
+    cmd->commands = command_channel_attach_buffer(chan, (struct command_base *)cmd, batch->data->data, batch->data->len);
+    command_channel_send_command(chan, (struct command_base *)cmd);
+
+    pthread_mutex_lock(&batch_stats_lock);
+    batch_stats.batches++;
+    batch_stats.commands += batch->count;
+    batch_stats.bytes += batch->data->len;
+    if (batch->count > batch_stats.max_batch_commands)
+        batch_stats.max_batch_commands = batch->count;
+    batch_stats.flushes[reason]++;
+    pthread_mutex_unlock(&batch_stats_lock);
+
+    DEBUG_PRINT("Sent batch of %u commands (%u bytes, reason %s)\n",
+                batch->count, batch->data->len, flush_reason_names[reason]);
+    g_byte_array_set_size(batch->data, 0);
+    batch->count = 0;
+    batch->flags = 0;
+}
+
+static void batch_thread_exit(void *arg) {
+    struct ava_async_batch *batch = (struct ava_async_batch *)arg;
+
+    pthread_mutex_lock(&batches_lock);
+    g_ptr_array_remove_fast(batches, batch);
+    pthread_mutex_unlock(&batches_lock);
+
+    pthread_mutex_lock(&batch->lock);
+    batch_send_locked(batch, AVA_BATCH_FLUSH_THREAD_EXIT);
+    pthread_mutex_unlock(&batch->lock);
+
+    g_byte_array_unref(batch->data);
+    pthread_mutex_destroy(&batch->lock);
+    free(batch);
+}
+
+/**
+ * Send every batch which has been waiting for longer than `timeout_us`. This bounds the delay of
+ * asynchronous calls made by threads which do not make a synchronous call soon after. The thread
+ * sleeps until the oldest batch times out, or until a batch becomes non-empty if all are empty.
+ */
+static void *timeout_thread_loop(void *arg) {
+    (void)arg;
+    pthread_mutex_lock(&batches_lock);
+    while (1) {
+        gint64 now = g_get_monotonic_time();
+        gint64 deadline = G_MAXINT64;
+        for (guint i = 0; i < batches->len; i++) {
+            struct ava_async_batch *batch = g_ptr_array_index(batches, i);
+            pthread_mutex_lock(&batch->lock);
+            if (batch->count > 0 && now - batch->start_time >= timeout_us)
+                batch_send_locked(batch, AVA_BATCH_FLUSH_TIMEOUT);
+            else if (batch->count > 0 && batch->start_time + timeout_us < deadline)
+                deadline = batch->start_time + timeout_us;
+            pthread_mutex_unlock(&batch->lock);
+        }
+        if (deadline == G_MAXINT64) {
+            pthread_cond_wait(&batches_cond, &batches_lock);
+        } else {
+            // g_get_monotonic_time uses CLOCK_MONOTONIC, like the condition variable.
+            struct timespec timeout = {deadline / G_USEC_PER_SEC, (deadline % G_USEC_PER_SEC) * 1000};
+            pthread_cond_timedwait(&batches_cond, &batches_lock, &timeout);
+        }
+    }
+    return NULL;
+}
+
+static void batch_init(void) {
+    const char *s = getenv("AVA_BATCH");
+    max_commands = ava_getenv_size("AVA_BATCH_MAX_COMMANDS", DEFAULT_MAX_COMMANDS);
+    max_bytes = ava_getenv_size("AVA_BATCH_MAX_BYTES", DEFAULT_MAX_BYTES);
+    timeout_us = ava_getenv_size("AVA_BATCH_TIMEOUT_US", DEFAULT_TIMEOUT_US);
+    enabled = s != NULL && *s != '\0' && strcmp(s, "0") != 0 && max_commands > 1;
+    if (!enabled)
+        return;
+
+    pthread_key_create(&batch_key, batch_thread_exit);
+    batches = g_ptr_array_new();
+    if (timeout_us > 0) {
+        pthread_condattr_t attr;
+        pthread_condattr_init(&attr);
+        pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+        pthread_cond_init(&batches_cond, &attr);
+        pthread_condattr_destroy(&attr);
+        int r = pthread_create(&timeout_thread, NULL, timeout_thread_loop, NULL);
+        assert(r == 0);
+        (void)r;
+        pthread_detach(timeout_thread);
+    }
+}
+
+/**
+ * @return Non-zero if commands on `chan` are batched.
+ */
+static int batching(struct command_channel *chan) {
+    pthread_once(&batch_init_once, batch_init);
+    return enabled && command_channel_has_command_relative_buffer_ids(chan);
+}
+
+static struct ava_async_batch *batch_self(void) {
+    struct ava_async_batch *batch = pthread_getspecific(batch_key);
+    if (batch == NULL) {
+        batch = malloc(sizeof(struct ava_async_batch));
+        pthread_mutex_init(&batch->lock, NULL);
+        batch->chan = NULL;
+        batch->data = g_byte_array_sized_new(max_bytes);
+        batch->count = 0;
+        batch->thread_id = 0;
+        batch->flags = 0;
+        batch->start_time = 0;
+        pthread_setspecific(batch_key, batch);
+
+        pthread_mutex_lock(&batches_lock);
+        g_ptr_array_add(batches, batch);
+        pthread_mutex_unlock(&batches_lock);
+    }
+    return batch;
+}
+
+EXPORTED_WEAKLY void ava_async_batch_append(struct command_channel *chan, struct command_base *cmd) {
+    if (!batching(chan)) {
+        command_channel_send_command(chan, cmd);
+        return;
+    }
+
+    struct ava_async_batch *batch = batch_self();
+    size_t entry_size = command_handler_batch_entry_size(cmd);
+
+    pthread_mutex_lock(&batch->lock);
+    assert(batch->count == 0 || batch->chan == chan);
+    if (batch->count > 0 && batch->data->len + entry_size > max_bytes)
+        batch_send_locked(batch, AVA_BATCH_FLUSH_SIZE);
+    if (batch->count == 0) {
+        batch->chan = chan;
+        batch->thread_id = cmd->thread_id;
+        batch->start_time = g_get_monotonic_time();
+    }
+    assert(batch->thread_id == cmd->thread_id);
+    // Non-zero if the timeout thread has to start waiting for this batch.
+    int started = batch->count == 0 && timeout_us > 0;
+
+    // Get the data region before copying the command struct, since the channel may have to complete it first.
+    const void *region = cmd->region_size > 0 ? command_channel_get_data_region(chan, cmd) : NULL;
+    guint offset = batch->data->len;
+    g_byte_array_set_size(batch->data, offset + entry_size);
+    memcpy(batch->data->data + offset, cmd, cmd->command_size);
+    if (region != NULL)
+        memcpy(batch->data->data + offset + cmd->command_size, region, cmd->region_size);
+    batch->count++;
+    batch->flags |= cmd->flags & COMMAND_FLAG_COMPRESSIBLE;
+    // The command has been copied into the batch, so it will never be sent itself.
+    command_channel_free_command(chan, cmd);
+
+    if (batch->count >= max_commands)
+        batch_send_locked(batch, AVA_BATCH_FLUSH_COUNT);
+    else if (batch->data->len >= max_bytes)
+        batch_send_locked(batch, AVA_BATCH_FLUSH_SIZE);
+    started = started && batch->count > 0;
+    pthread_mutex_unlock(&batch->lock);
+
+    if (started) {
+        // Wake up the timeout thread to wait for this batch. Not done under `batch->lock`, since the
+        // timeout thread takes `batches_lock` first.
+        pthread_mutex_lock(&batches_lock);
+        pthread_cond_signal(&batches_cond);
+        pthread_mutex_unlock(&batches_lock);
+    }
+}
+
+EXPORTED_WEAKLY void ava_async_batch_flush(struct command_channel *chan, enum ava_async_batch_flush_reason reason) {
+    if (!batching(chan))
+        return;
+
+    struct ava_async_batch *batch = pthread_getspecific(batch_key);
+    if (batch == NULL)
+        return;
+    pthread_mutex_lock(&batch->lock);
+    assert(batch->count == 0 || batch->chan == chan);
+    (void)chan;
+    batch_send_locked(batch, reason);
+    pthread_mutex_unlock(&batch->lock);
+}
+
+EXPORTED_WEAKLY void ava_async_batch_begin_replies(struct command_channel *chan) {
+    // Replies are only batched where a batch can carry their buffers (not on shared memory channels).
+    if (batching(chan))
+        batching_replies++;
+}
+
+EXPORTED_WEAKLY void ava_async_batch_end_replies(struct command_channel *chan) {
+    if (!batching(chan))
+        return;
+    assert(batching_replies > 0);
+    if (--batching_replies == 0)
+        ava_async_batch_flush(chan, AVA_BATCH_FLUSH_EXPLICIT);
+}
+
+EXPORTED_WEAKLY void ava_async_batch_send_reply(struct command_channel *chan, struct command_base *cmd) {
+    if (batching_replies)
+        ava_async_batch_append(chan, cmd);
+    else
+        command_channel_send_command(chan, cmd);
+}
+
+EXPORTED_WEAKLY void ava_async_batch_get_stats(struct ava_async_batch_stats *stats) {
+    pthread_mutex_lock(&batch_stats_lock);
+    *stats = batch_stats;
+    pthread_mutex_unlock(&batch_stats_lock);
+}
+
+EXPORTED_WEAKLY void ava_async_batch_print_stats(FILE *file) {
+    struct ava_async_batch_stats stats;
+    ava_async_batch_get_stats(&stats);
+    fprintf(file, "Async batching: %" PRIu64 " batches, %" PRIu64 " commands, %" PRIu64 " bytes, average %.2f commands/batch, max %" PRIu64 "\n",
+            stats.batches, stats.commands, stats.bytes,
+            stats.batches ? (double)stats.commands / stats.batches : 0.0, stats.max_batch_commands);
+    fprintf(file, "Async batching flushes:");
+    for (int i = 0; i < AVA_BATCH_FLUSH_REASONS; i++)
+        fprintf(file, " %s=%" PRIu64, flush_reason_names[i], stats.flushes[i]);
+    fprintf(file, "\n");
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_BATCH_STATS", ava_async_batch_print_stats);
+}
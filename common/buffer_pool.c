@@ -0,0 +1,146 @@
+#include <assert.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <time.h>
+
+#include "common/buffer_pool.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/size_class.h"
+#include "common/stats.h"
+
+#define HEADER_SIZE 16
+#define ALIGNMENT 16
+#define SMALL_CLASS_SHIFT 7
+#define MAX_CLASS_SHIFT 20
+#define LARGE_CLASS UINT32_MAX
+#define DEFAULT_CACHE_SIZE (256 * 1024)
+/* The number of bytes moved between a thread cache and the depot at once. */
+#define BATCH_SIZE (32 * 1024)
+#define MAX_BATCH 64
+
+/* Precedes each buffer. Keeps the buffers aligned to 16 bytes. */
+struct buffer_header {
+    uint32_t class_index;
+    uint32_t unused;
+    uint64_t size;
+};
+
+static pthread_once_t pool_init_once = PTHREAD_ONCE_INIT;
+static struct ava_size_class_pool *pool;
+static struct timespec start_time;
+
+static struct ava_size_class_counters counters;
+static atomic_ulong large_allocations;
+static atomic_ulong reserved_bytes;
+
+/**
+ * The backing allocator of the classes. The chunks are kept for the life of the process.
+ */
+static void *chunk_alloc(void *context, size_t size, uint32_t class_index) {
+    (void)context;
+    void *chunk = malloc(size);
+    if (chunk != NULL) {
+        size_t class_size = ava_size_class_size(pool, class_index);
+        atomic_fetch_add_explicit(&reserved_bytes, size / (HEADER_SIZE + class_size) * class_size,
+                                  memory_order_relaxed);
+    }
+    return chunk;
+}
+
+static void pool_init(void) {
+    struct ava_size_class_config config = {
+        .alignment = ALIGNMENT,
+        .small_shift = SMALL_CLASS_SHIFT,
+        .max_shift = MAX_CLASS_SHIFT,
+        .header_size = HEADER_SIZE,
+        .batch_size = BATCH_SIZE,
+        .max_batch = MAX_BATCH,
+        .cache_size = ava_getenv_size("AVA_BUFFER_POOL_CACHE_SIZE", DEFAULT_CACHE_SIZE),
+        .chunk_alloc = chunk_alloc,
+        .counters = &counters,
+    };
+    pool = ava_size_class_pool_new(&config);
+    clock_gettime(CLOCK_MONOTONIC, &start_time);
+}
+
+static inline struct buffer_header *header_of(const void *buffer) {
+    return (struct buffer_header *)((char *)buffer - HEADER_SIZE);
+}
+
+EXPORTED_WEAKLY void *ava_buffer_pool_alloc(size_t size) {
+    pthread_once(&pool_init_once, pool_init);
+
+    if (size > ((size_t)1 << MAX_CLASS_SHIFT)) {
+        ava_size_class_count(pool, 1, 0, 0);
+        struct buffer_header *header = malloc(HEADER_SIZE + size);
+        if (header == NULL)
+            return NULL;
+        header->class_index = LARGE_CLASS;
+        header->size = size;
+        atomic_fetch_add_explicit(&large_allocations, 1, memory_order_relaxed);
+        return (char *)header + HEADER_SIZE;
+    }
+
+    uint32_t class_index = ava_size_class_index(pool, size);
+    void *buffer = ava_size_class_alloc(pool, class_index, size);
+    if (buffer == NULL)
+        return NULL;
+    struct buffer_header *header = header_of(buffer);
+    header->class_index = class_index;
+    header->size = size;
+    return buffer;
+}
+
+EXPORTED_WEAKLY void ava_buffer_pool_free(void *buffer) {
+    if (buffer == NULL)
+        return;
+    struct buffer_header *header = header_of(buffer);
+    if (header->class_index == LARGE_CLASS) {
+        ava_size_class_count(pool, 0, 1, 0);
+        free(header);
+        return;
+    }
+    assert(header->class_index < ava_size_class_count_classes(pool) &&
+           "Freeing a buffer which is not from the buffer pool");
+    ava_size_class_free(pool, buffer, header->class_index, header->size);
+}
+
+EXPORTED_WEAKLY size_t ava_buffer_pool_size(const void *buffer) {
+    return header_of(buffer)->size;
+}
+
+EXPORTED_WEAKLY void ava_buffer_pool_get_stats(struct ava_buffer_pool_stats *stats) {
+    pthread_once(&pool_init_once, pool_init);
+    // The counters of the other threads lag by less than 256 operations.
+    ava_size_class_flush_stats(pool);
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    stats->allocations = counters.allocations;
+    stats->large_allocations = large_allocations;
+    stats->frees = counters.frees;
+    stats->elapsed_us = (now.tv_sec - start_time.tv_sec) * 1000000 + (now.tv_nsec - start_time.tv_nsec) / 1000;
+    stats->requested_bytes = counters.requested_bytes;
+    stats->used_bytes = counters.used_bytes;
+    stats->reserved_bytes = reserved_bytes;
+}
+
+EXPORTED_WEAKLY void ava_buffer_pool_print_stats(FILE *file) {
+    struct ava_buffer_pool_stats stats;
+    ava_buffer_pool_get_stats(&stats);
+    double seconds = stats.elapsed_us / 1e6;
+    fprintf(file,
+            "Buffer pool: %lu allocations (%.0f/s, %lu large), %lu frees (%.0f/s), %lu bytes in use of %lu reserved, "
+            "%.1f%% lost to rounding, %.1f%% free in the pool\n",
+            (unsigned long)stats.allocations, seconds > 0 ? stats.allocations / seconds : 0.0,
+            (unsigned long)stats.large_allocations, (unsigned long)stats.frees,
+            seconds > 0 ? stats.frees / seconds : 0.0, (unsigned long)stats.used_bytes,
+            (unsigned long)stats.reserved_bytes,
+            stats.used_bytes > 0 ? 100.0 * (stats.used_bytes - stats.requested_bytes) / stats.used_bytes : 0.0,
+            stats.reserved_bytes > 0 ? 100.0 * (stats.reserved_bytes - stats.used_bytes) / stats.reserved_bytes : 0.0);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_BUFFER_POOL_STATS", ava_buffer_pool_print_stats);
+}
@@ -0,0 +1,212 @@
+#include <assert.h>
+#include <glib.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "common/async_batch.h"
+#include "common/call_cache.h"
+#include "common/debug.h"
+#include "common/endpoint_lib.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/murmur3.h"
+#include "common/shadow_thread_pool.h"
+#include "common/stats.h"
+
+#define DEFAULT_MAX_ENTRIES 1024
+
+struct ava_call_cache_entry {
+    GBytes *key;
+    GBytes *value;
+    /* The link of this entry in `lru`. `link.data` points to the entry. */
+    GList link;
+};
+
+static pthread_once_t cache_init_once = PTHREAD_ONCE_INIT;
+static size_t max_entries;
+
+static pthread_mutex_t cache_lock = PTHREAD_MUTEX_INITIALIZER;
+/* Maps GBytes keys to entries. */
+static GHashTable *cache;
+/* The entries from the most to the least recently used. */
+static GQueue lru = G_QUEUE_INIT;
+
+static atomic_ulong cache_hits;
+static atomic_ulong cache_misses;
+
+struct ava_call_cache_prefetch {
+    volatile char *complete;
+    void *call_record;
+    ava_call_cache_insert_function insert;
+    GByteArray *key;
+};
+
+static __thread int prefetching;
+/* The struct ava_call_cache_prefetch of the calls sent during the prefetch. */
+static __thread GArray *prefetch_calls;
+/* The output buffers allocated for the prefetch. */
+static __thread GPtrArray *prefetch_buffers;
+
+static guint key_hash(gconstpointer key) {
+    gsize size;
+    const void *data = g_bytes_get_data((GBytes *)key, &size);
+    guint ret;
+    MurmurHash3_x86_32(data, size, 0x5bd1e995, &ret);
+    return ret;
+}
+
+static void entry_free(struct ava_call_cache_entry *entry) {
+    g_bytes_unref(entry->key);
+    g_bytes_unref(entry->value);
+    free(entry);
+}
+
+static void cache_init(void) {
+    max_entries = ava_getenv_size("AVA_CALL_CACHE_SIZE", DEFAULT_MAX_ENTRIES);
+    cache = g_hash_table_new_full(key_hash, g_bytes_equal, NULL, (GDestroyNotify)entry_free);
+}
+
+EXPORTED_WEAKLY GByteArray *ava_call_cache_key_new(uintptr_t command_id) {
+    GByteArray *key = g_byte_array_new();
+    g_byte_array_append(key, (const guint8 *)&command_id, sizeof(command_id));
+    return key;
+}
+
+EXPORTED_WEAKLY void ava_call_cache_key_add(GByteArray *key, const void *data, size_t size) {
+    g_byte_array_append(key, (const guint8 *)data, size);
+}
+
+EXPORTED_WEAKLY void ava_call_cache_key_add_buffer(GByteArray *key, const void *buffer, size_t size,
+                                                   int include_contents) {
+    uint8_t is_null = buffer == NULL;
+    g_byte_array_append(key, &is_null, sizeof(is_null));
+    if (is_null)
+        return;
+    g_byte_array_append(key, (const guint8 *)&size, sizeof(size));
+    if (include_contents)
+        g_byte_array_append(key, (const guint8 *)buffer, size);
+}
+
+EXPORTED_WEAKLY GBytes *ava_call_cache_lookup(GByteArray *key) {
+    pthread_once(&cache_init_once, cache_init);
+    if (max_entries == 0)
+        return NULL;
+
+    GBytes *tmp_key = g_bytes_new_static(key->data, key->len);
+    GBytes *value = NULL;
+    pthread_mutex_lock(&cache_lock);
+    struct ava_call_cache_entry *entry = g_hash_table_lookup(cache, tmp_key);
+    if (entry != NULL) {
+        g_queue_unlink(&lru, &entry->link);
+        g_queue_push_head_link(&lru, &entry->link);
+        value = g_bytes_ref(entry->value);
+    }
+    pthread_mutex_unlock(&cache_lock);
+    g_bytes_unref(tmp_key);
+
+    if (value != NULL)
+        atomic_fetch_add(&cache_hits, 1);
+    else
+        atomic_fetch_add(&cache_misses, 1);
+    return value;
+}
+
+EXPORTED_WEAKLY void ava_call_cache_read(GBytes *value, size_t *offset, void *dest, size_t size) {
+    gsize value_size;
+    const uint8_t *data = g_bytes_get_data(value, &value_size);
+    assert(*offset + size <= value_size && "Cached value is smaller than the outputs of the call.");
+    memcpy(dest, data + *offset, size);
+    *offset += size;
+}
+
+EXPORTED_WEAKLY void ava_call_cache_insert(GByteArray *key, GByteArray *value) {
+    pthread_once(&cache_init_once, cache_init);
+    if (max_entries == 0) {
+        g_byte_array_unref(key);
+        g_byte_array_unref(value);
+        return;
+    }
+
+    struct ava_call_cache_entry *entry = malloc(sizeof(struct ava_call_cache_entry));
+    entry->key = g_byte_array_free_to_bytes(key);
+    entry->value = g_byte_array_free_to_bytes(value);
+    entry->link.data = entry;
+    entry->link.prev = entry->link.next = NULL;
+
+    pthread_mutex_lock(&cache_lock);
+    struct ava_call_cache_entry *old = g_hash_table_lookup(cache, entry->key);
+    if (old != NULL) {
+        // Another thread made the same call concurrently. Replace its entry.
+        g_queue_unlink(&lru, &old->link);
+        g_hash_table_remove(cache, old->key);
+    }
+    while (g_hash_table_size(cache) >= max_entries) {
+        struct ava_call_cache_entry *victim = g_queue_peek_tail(&lru);
+        g_queue_unlink(&lru, &victim->link);
+        g_hash_table_remove(cache, victim->key);
+    }
+    g_hash_table_insert(cache, entry->key, entry);
+    g_queue_push_head_link(&lru, &entry->link);
+    pthread_mutex_unlock(&cache_lock);
+}
+
+EXPORTED_WEAKLY void ava_call_cache_invalidate(void) {
+    pthread_once(&cache_init_once, cache_init);
+    pthread_mutex_lock(&cache_lock);
+    // Unlink all entries before the hash table frees them.
+    g_queue_init(&lru);
+    g_hash_table_remove_all(cache);
+    pthread_mutex_unlock(&cache_lock);
+}
+
+EXPORTED_WEAKLY void ava_call_cache_begin_prefetch(void) {
+    assert(!prefetching);
+    prefetching = 1;
+    prefetch_calls = g_array_new(FALSE, FALSE, sizeof(struct ava_call_cache_prefetch));
+    prefetch_buffers = g_ptr_array_new_with_free_func(free);
+}
+
+EXPORTED_WEAKLY int ava_call_cache_prefetching(void) {
+    return prefetching;
+}
+
+EXPORTED_WEAKLY void *ava_call_cache_prefetch_alloc(size_t size) {
+    assert(prefetching);
+    void *buffer = calloc(1, size > 0 ? size : 1);
+    g_ptr_array_add(prefetch_buffers, buffer);
+    return buffer;
+}
+
+EXPORTED_WEAKLY void ava_call_cache_add_prefetch(volatile char *complete, void *call_record,
+                                                 ava_call_cache_insert_function insert, GByteArray *key) {
+    assert(prefetching);
+    struct ava_call_cache_prefetch call = {complete, call_record, insert, key};
+    g_array_append_val(prefetch_calls, call);
+}
+
+EXPORTED_WEAKLY void ava_call_cache_end_prefetch(struct command_channel *chan) {
+    assert(prefetching);
+    prefetching = 0;
+    ava_async_batch_flush(chan, AVA_BATCH_FLUSH_EXPLICIT);
+    for (guint i = 0; i < prefetch_calls->len; i++) {
+        struct ava_call_cache_prefetch *call = &g_array_index(prefetch_calls, struct ava_call_cache_prefetch, i);
+        shadow_thread_handle_command_until(nw_shadow_thread_pool, *call->complete);
+        call->insert(call->call_record, call->key);
+        free(call->call_record);
+    }
+    DEBUG_PRINT("Prefetched %u calls\n", prefetch_calls->len);
+    g_array_free(prefetch_calls, TRUE);
+    g_ptr_array_unref(prefetch_buffers);
+    prefetch_calls = NULL;
+    prefetch_buffers = NULL;
+}
+
+EXPORTED_WEAKLY void ava_call_cache_print_stats(FILE *file) {
+    fprintf(file, "Call cache: %lu hits, %lu misses\n", (unsigned long)cache_hits, (unsigned long)cache_misses);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_CALL_CACHE_STATS", ava_call_cache_print_stats);
+}
@@ -0,0 +1,184 @@
+#include <assert.h>
+#include <glib.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "common/call_record.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/stats.h"
+
+#define DEFAULT_FREELIST_LENGTH 32
+#define SLOTS_PER_TABLE 64
+/* Slot key 0 means "no slot", so the keys of all tables must fit in AVA_CALL_SLOT_MASK. */
+#define MAX_SLOT_TABLES (AVA_CALL_SLOT_MASK / SLOTS_PER_TABLE)
+
+/* The in-flight calls of a thread. Only the owner adds calls, any thread removes them. */
+struct call_slot_table {
+    _Atomic(void *) records[SLOTS_PER_TABLE];
+    /* The slot after the last one used by the owner. */
+    uint32_t next;
+    uint32_t index;
+    struct call_slot_table *next_free;
+};
+
+static pthread_once_t call_record_init_once = PTHREAD_ONCE_INIT;
+static uint32_t freelist_max_length;
+static pthread_key_t thread_key;
+
+/* All tables, indexed by their index. Tables are never freed, so IDs stay valid after their
+ * thread exits. */
+static struct call_slot_table *slot_tables[MAX_SLOT_TABLES];
+static uint32_t slot_table_count;
+/* The tables of exited threads. They may still contain in-flight calls. */
+static struct call_slot_table *free_slot_tables;
+static pthread_mutex_t slot_tables_lock = PTHREAD_MUTEX_INITIALIZER;
+
+struct thread_state {
+    struct call_slot_table *slots;
+    /* The freelists holding records of this thread. */
+    GPtrArray *freelists;
+};
+
+static __thread struct thread_state *thread_state;
+/* Non-zero if no table was left for the calling thread. */
+static __thread int thread_slots_unavailable;
+
+/* Only the slow paths are counted, so the fast paths do not share a cache line. */
+static atomic_ulong map_calls;
+static atomic_ulong record_allocations;
+
+static void freelist_empty(struct ava_call_record_freelist *freelist) {
+    while (freelist->head != NULL) {
+        void *record = freelist->head;
+        freelist->head = *(void **)record;
+        free(record);
+    }
+    freelist->length = 0;
+    freelist->registered = 0;
+}
+
+static void thread_state_free(void *arg) {
+    struct thread_state *state = arg;
+    if (state->slots != NULL) {
+        pthread_mutex_lock(&slot_tables_lock);
+        state->slots->next_free = free_slot_tables;
+        free_slot_tables = state->slots;
+        pthread_mutex_unlock(&slot_tables_lock);
+    }
+    // The freelists are thread-local variables, which are still valid while the keys are destroyed.
+    for (guint i = 0; i < state->freelists->len; i++)
+        freelist_empty(g_ptr_array_index(state->freelists, i));
+    g_ptr_array_free(state->freelists, TRUE);
+    free(state);
+    thread_state = NULL;
+}
+
+static void call_record_init(void) {
+    freelist_max_length = ava_getenv_size("AVA_CALL_RECORD_FREELIST_LENGTH", DEFAULT_FREELIST_LENGTH);
+    pthread_key_create(&thread_key, thread_state_free);
+}
+
+static struct thread_state *get_thread_state(void) {
+    if (thread_state == NULL) {
+        pthread_once(&call_record_init_once, call_record_init);
+        thread_state = calloc(1, sizeof(struct thread_state));
+        thread_state->freelists = g_ptr_array_new();
+        pthread_setspecific(thread_key, thread_state);
+    }
+    return thread_state;
+}
+
+EXPORTED_WEAKLY void *ava_call_record_alloc(struct ava_call_record_freelist *freelist, size_t size) {
+    // Free records hold the link to the next one.
+    if (size < sizeof(void *))
+        size = sizeof(void *);
+    void *record = freelist->head;
+    if (record == NULL) {
+        atomic_fetch_add_explicit(&record_allocations, 1, memory_order_relaxed);
+        return calloc(1, size);
+    }
+    freelist->head = *(void **)record;
+    freelist->length--;
+    memset(record, 0, size);
+    return record;
+}
+
+EXPORTED_WEAKLY void ava_call_record_free(struct ava_call_record_freelist *freelist, void *record) {
+    if (!freelist->registered) {
+        g_ptr_array_add(get_thread_state()->freelists, freelist);
+        freelist->registered = 1;
+    }
+    if (freelist->length >= freelist_max_length) {
+        free(record);
+        return;
+    }
+    *(void **)record = freelist->head;
+    freelist->head = record;
+    freelist->length++;
+}
+
+static struct call_slot_table *get_slot_table(void) {
+    struct thread_state *state = get_thread_state();
+    if (state->slots != NULL || thread_slots_unavailable)
+        return state->slots;
+
+    pthread_mutex_lock(&slot_tables_lock);
+    struct call_slot_table *table = free_slot_tables;
+    if (table != NULL) {
+        free_slot_tables = table->next_free;
+    } else if (slot_table_count < MAX_SLOT_TABLES) {
+        table = calloc(1, sizeof(struct call_slot_table));
+        table->index = slot_table_count;
+        slot_tables[slot_table_count++] = table;
+    }
+    pthread_mutex_unlock(&slot_tables_lock);
+
+    state->slots = table;
+    thread_slots_unavailable = (table == NULL);
+    return table;
+}
+
+EXPORTED_WEAKLY intptr_t ava_call_slot_add(intptr_t number, void *record) {
+    struct call_slot_table *table = get_slot_table();
+    if (table != NULL) {
+        for (uint32_t i = 0; i < SLOTS_PER_TABLE; i++) {
+            uint32_t slot = (table->next + i) % SLOTS_PER_TABLE;
+            if (atomic_load_explicit(&table->records[slot], memory_order_relaxed) == NULL) {
+                atomic_store_explicit(&table->records[slot], record, memory_order_release);
+                table->next = slot + 1;
+                return (number << AVA_CALL_SLOT_BITS) | (table->index * SLOTS_PER_TABLE + slot + 1);
+            }
+        }
+    }
+    atomic_fetch_add_explicit(&map_calls, 1, memory_order_relaxed);
+    return 0;
+}
+
+EXPORTED_WEAKLY void *ava_call_slot_remove(intptr_t id) {
+    intptr_t key = (id & AVA_CALL_SLOT_MASK) - 1;
+    assert(key >= 0 && key / SLOTS_PER_TABLE < MAX_SLOT_TABLES);
+    // The table was published before the call ID was sent.
+    struct call_slot_table *table = slot_tables[key / SLOTS_PER_TABLE];
+    void *record = atomic_exchange_explicit(&table->records[key % SLOTS_PER_TABLE], NULL, memory_order_acquire);
+    assert(record != NULL && "Removing a call ID which does not exist");
+    return record;
+}
+
+EXPORTED_WEAKLY void ava_call_record_get_stats(struct ava_call_record_stats *stats) {
+    stats->map_calls = map_calls;
+    stats->record_allocations = record_allocations;
+}
+
+EXPORTED_WEAKLY void ava_call_record_print_stats(FILE *file) {
+    struct ava_call_record_stats stats;
+    ava_call_record_get_stats(&stats);
+    fprintf(file, "Call records: %lu calls in the call map, %lu records allocated\n", (unsigned long)stats.map_calls,
+            (unsigned long)stats.record_allocations);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_CALL_RECORD_STATS", ava_call_record_print_stats);
+}
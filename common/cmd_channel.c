@@ -20,6 +20,25 @@ void* command_channel_attach_buffer(struct command_channel* chan, struct command
   return ((struct command_channel_base*)chan)->vtable->command_channel_attach_buffer(chan, cmd, (void *) buffer, size);
 }
 
+void* command_channel_attach_buffer_by_reference(struct command_channel* chan, struct command_base* cmd,
+                                                 const void* buffer, size_t size) {
+  struct command_channel_vtable *vtable = ((struct command_channel_base*)chan)->vtable;
+  if (vtable->command_channel_attach_buffer_by_reference == NULL)
+    return vtable->command_channel_attach_buffer(chan, cmd, (void *) buffer, size);
+  return vtable->command_channel_attach_buffer_by_reference(chan, cmd, (void *) buffer, size);
+}
+
+struct command_channel* command_channel_new_thread_channel(struct command_channel* chan) {
+  struct command_channel_vtable *vtable = ((struct command_channel_base*)chan)->vtable;
+  if (vtable->command_channel_new_thread_channel == NULL)
+    return NULL;
+  return vtable->command_channel_new_thread_channel(chan);
+}
+
+int command_channel_has_command_relative_buffer_ids(const struct command_channel* chan) {
+  return ((const struct command_channel_base*)chan)->vtable->command_relative_buffer_ids;
+}
+
 void command_channel_send_command(struct command_channel* chan, struct command_base* cmd) {
   ((struct command_channel_base*)chan)->vtable->command_channel_send_command(chan, cmd);
 }
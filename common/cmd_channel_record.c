@@ -263,7 +263,8 @@ static struct command_channel_vtable command_channel_log_vtable = {
         .command_channel_get_buffer = command_channel_load_get_buffer,
         .command_channel_print_command = command_channel_simple_print_command,
         .command_channel_receive_command = command_channel_load_next_command,
-        .command_channel_get_data_region = command_channel_load_get_data_region
+        .command_channel_get_data_region = command_channel_load_get_data_region,
+        .command_relative_buffer_ids = 1
 };
 
 struct command_channel_log *command_channel_log_new(int worker_port)
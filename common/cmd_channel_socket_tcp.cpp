@@ -55,6 +55,9 @@ std::vector<struct command_channel*> command_channel_socket_tcp_guest_new()
       command_channel_preinitialize((struct command_channel *) chan, &command_channel_socket_tcp_vtable);
       pthread_mutex_init(&chan->send_mutex, NULL);
       pthread_mutex_init(&chan->recv_mutex, NULL);
+      chan->passes_fds = 0;
+      chan->memfd_min_size = 0;
+      chan->listen_fd = -1;
       channels.push_back((struct command_channel*)chan);
 
       char worker_name[128];
@@ -120,6 +123,8 @@ struct command_channel* command_channel_socket_tcp_worker_new(int worker_port)
     command_channel_preinitialize((struct command_channel *) chan, &command_channel_socket_tcp_vtable);
     pthread_mutex_init(&chan->send_mutex, NULL);
     pthread_mutex_init(&chan->recv_mutex, NULL);
+    chan->passes_fds = 0;
+    chan->memfd_min_size = 0;
 
     struct sockaddr_in address;
     int addrlen = sizeof(address);
@@ -188,6 +193,9 @@ struct command_channel* command_channel_socket_tcp_migration_new(int worker_port
     command_channel_preinitialize((struct command_channel *) chan, &command_channel_socket_tcp_vtable);
     pthread_mutex_init(&chan->send_mutex, NULL);
     pthread_mutex_init(&chan->recv_mutex, NULL);
+    chan->passes_fds = 0;
+    chan->memfd_min_size = 0;
+    chan->listen_fd = -1;
 
     chan->listen_port = worker_port + 2000;
 
@@ -261,7 +269,10 @@ namespace {
     chansocketutil::command_channel_socket_get_data_region,
     chansocketutil::command_channel_socket_free_command,
     chansocketutil::command_channel_socket_free,
-    chansocketutil::command_channel_socket_print_command
+    chansocketutil::command_channel_socket_print_command,
+    chansocketutil::command_channel_socket_attach_buffer_by_reference,
+    chansocketutil::command_channel_socket_new_thread_channel,
+    1
   };
 };
 
@@ -0,0 +1,182 @@
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <assert.h>
+#include <errno.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#include <chrono>
+#include <iostream>
+
+#include "common/cmd_channel_impl.h"
+#include "common/devconf.h"
+#include "common/debug.h"
+#include "common/env.h"
+#include "common/guest_mem.h"
+#include "common/cmd_handler.h"
+#include "cmd_channel_socket_utilities.h"
+#include "guest_config.h"
+
+extern int nw_global_vm_id;
+
+#define DEFAULT_MEMFD_MIN_SIZE (128 * 1024)
+
+namespace {
+  extern struct command_channel_vtable command_channel_socket_unix_vtable;
+}
+
+/**
+ * Unix socket channel.
+ *
+ * The guestlib and the worker must run on the same host. Commands are
+ * sent like in the TCP channel, except that commands whose data region
+ * is at least `AVA_UNIX_MEMFD_MIN_SIZE` bytes (default 128 KiB, 0 to
+ * disable) are built in a memfd segment. Only the command header and
+ * the memfd (as `SCM_RIGHTS`) go through the socket and the receiver
+ * maps the segment, so the data region is never copied by the kernel.
+ * These commands have `COMMAND_FLAG_MEMFD`. Each side accepts them
+ * whatever its own threshold is, so the two sides may set it differently.
+ *
+ * The socket path is `AVA_UNIX_SOCKET`. The worker defaults to
+ * `/tmp/ava_worker_<listen_port>.sock`.
+ */
+
+static struct chansocketutil::command_channel_socket *command_channel_socket_unix_alloc()
+{
+    struct chansocketutil::command_channel_socket *chan =
+      (struct chansocketutil::command_channel_socket *)malloc(sizeof(struct chansocketutil::command_channel_socket));
+    command_channel_preinitialize((struct command_channel *) chan, &command_channel_socket_unix_vtable);
+    pthread_mutex_init(&chan->send_mutex, NULL);
+    pthread_mutex_init(&chan->recv_mutex, NULL);
+
+    chan->passes_fds = 1;
+    chan->memfd_min_size = ava_getenv_size("AVA_UNIX_MEMFD_MIN_SIZE", DEFAULT_MEMFD_MIN_SIZE);
+    chan->listen_fd = -1;
+    return chan;
+}
+
+static void unix_socket_address(struct sockaddr_un *address, const char *path)
+{
+    memset(address, 0, sizeof(struct sockaddr_un));
+    address->sun_family = AF_UNIX;
+    assert(strlen(path) < sizeof(address->sun_path) && "AVA_UNIX_SOCKET is too long");
+    strncpy(address->sun_path, path, sizeof(address->sun_path) - 1);
+}
+
+/**
+ * Unix socket channel guestlib endpoint.
+ */
+struct command_channel* command_channel_socket_unix_guest_new()
+{
+    const char *path = getenv("AVA_UNIX_SOCKET");
+    assert(path != NULL && "AVA_UNIX_SOCKET is not set");
+
+    struct chansocketutil::command_channel_socket *chan = command_channel_socket_unix_alloc();
+    chan->vm_id = nw_global_vm_id = 1;
+
+    struct sockaddr_un address;
+    unix_socket_address(&address, path);
+    std::cerr << "Connect target API server at " << path << std::endl;
+
+    /* The worker may not be listening yet. */
+    int connect_ret = -1;
+    auto connect_start = std::chrono::steady_clock::now();
+    while (connect_ret) {
+        chan->sock_fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+        connect_ret = connect(chan->sock_fd, (struct sockaddr *)&address, sizeof(address));
+        if (!connect_ret)
+            break;
+
+        close(chan->sock_fd);
+        auto connect_checkpoint = std::chrono::steady_clock::now();
+        if ((uint64_t)std::chrono::duration_cast<std::chrono::milliseconds>(
+              connect_checkpoint - connect_start).count() > guestconfig::config->connect_timeout_) {
+            std::cerr << "Connection to " << path << " timeout" << std::endl;
+            free(chan);
+            return NULL;
+        }
+        usleep(10000);
+    }
+
+    chan->pfd.fd = chan->sock_fd;
+    chan->pfd.events = POLLIN | POLLRDHUP;
+
+    return (struct command_channel *)chan;
+}
+
+/**
+ * Unix socket channel API server endpoint.
+ * @listen_port: the worker port, used to name the default socket path.
+ */
+struct command_channel* command_channel_socket_unix_worker_new(int listen_port)
+{
+    struct chansocketutil::command_channel_socket *chan = command_channel_socket_unix_alloc();
+    chan->listen_port = listen_port;
+    assert(nw_worker_id == 0); // TODO: Move assignment to nw_worker_id out of unrelated constructor.
+    nw_worker_id = listen_port;
+
+    char default_path[sizeof(((struct sockaddr_un *)0)->sun_path)];
+    const char *path = getenv("AVA_UNIX_SOCKET");
+    if (path == NULL || *path == '\0') {
+        snprintf(default_path, sizeof(default_path), "/tmp/ava_worker_%d.sock", listen_port);
+        path = default_path;
+    }
+
+    struct sockaddr_un address;
+    unix_socket_address(&address, path);
+
+    /* start Unix socket server */
+    if ((chan->listen_fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0)) < 0) {
+        perror("socket");
+    }
+    // Remove the socket left by a previous worker.
+    unlink(path);
+    if (bind(chan->listen_fd, (struct sockaddr *)&address, sizeof(address)) < 0) {
+        perror("bind failed");
+    }
+    if (listen(chan->listen_fd, 10) < 0) {
+        perror("listen");
+    }
+
+    fprintf(stderr, "[%d] Waiting for guestlib connection at %s\n", listen_port, path);
+    chan->sock_fd = accept4(chan->listen_fd, NULL, NULL, SOCK_CLOEXEC);
+    if (chan->sock_fd < 0) {
+       perror("accept");
+    }
+    // The path stays bound for the thread channels of the guestlib (see thread_channel.h). It is
+    // removed by the next worker using it.
+
+    /* Receive handler initialization API */
+    struct command_handler_initialize_api_command init_msg;
+    recv_socket(chan->sock_fd, &init_msg, sizeof(struct command_handler_initialize_api_command));
+    chan->init_command_type = init_msg.new_api_id;
+    chan->vm_id = init_msg.base.vm_id;
+    fprintf(stderr, "[%d] Accept guestlib with API_ID=%x\n",
+            chan->listen_port, chan->init_command_type);
+
+    chan->pfd.fd = chan->sock_fd;
+    chan->pfd.events = POLLIN | POLLRDHUP;
+
+    return (struct command_channel *)chan;
+}
+
+namespace {
+  struct command_channel_vtable command_channel_socket_unix_vtable = {
+    chansocketutil::command_channel_socket_buffer_size,
+    chansocketutil::command_channel_socket_new_command,
+    chansocketutil::command_channel_socket_attach_buffer,
+    chansocketutil::command_channel_socket_send_command,
+    chansocketutil::command_channel_socket_transfer_command,
+    chansocketutil::command_channel_socket_receive_command,
+    chansocketutil::command_channel_socket_get_buffer,
+    chansocketutil::command_channel_socket_get_data_region,
+    chansocketutil::command_channel_socket_free_command,
+    chansocketutil::command_channel_socket_free,
+    chansocketutil::command_channel_socket_print_command,
+    chansocketutil::command_channel_socket_attach_buffer_by_reference,
+    chansocketutil::command_channel_socket_new_thread_channel,
+    1
+  };
+}
@@ -2,6 +2,8 @@
 #include <errno.h>
 #include <netinet/tcp.h>
 #include <string.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
 #include <unistd.h>
 
 #include "common/cmd_channel_impl.h"
@@ -9,10 +11,53 @@
 #include "common/debug.h"
 #include "common/guest_mem.h"
 #include "common/cmd_handler.h"
+#include "common/compress.h"
 #include "cmd_channel_socket_utilities.h"
 
 namespace chansocketutil {
 
+/* Smaller buffers are copied even if they are attached by reference, because sending them from
+ * their own iovec costs more than copying them. */
+#define MIN_REFERENCE_SIZE 4096
+
+static struct socket_command_reserved *command_reserved(const struct command_base *cmd) {
+    return (struct socket_command_reserved *)cmd->reserved_area;
+}
+
+/**
+ * Allocate a command in a new memfd segment, which the receiver maps
+ * instead of reading the command from the socket.
+ * @return The mapped command, or NULL if the segment cannot be created.
+ */
+static struct command_base *new_memfd_command(size_t size, int *memfd) {
+    int fd = memfd_create("ava_command", MFD_CLOEXEC);
+    if (fd < 0)
+        return NULL;
+    void *cmd = MAP_FAILED;
+    if (ftruncate(fd, size) == 0)
+        cmd = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    if (cmd == MAP_FAILED) {
+        close(fd);
+        return NULL;
+    }
+    *memfd = fd;
+    return (struct command_base *)cmd;
+}
+
+/**
+ * Copy the buffers attached by reference into the data region of `cmd`,
+ * so the region can be read in place.
+ */
+static void flatten_command(struct command_base *cmd) {
+    struct socket_command_reserved *reserved = command_reserved(cmd);
+    if (reserved->refs == NULL)
+        return;
+    for (const auto &ref : *reserved->refs)
+        memcpy((uint8_t *)cmd + ref.offset, ref.buffer, ref.size);
+    delete reserved->refs;
+    reserved->refs = NULL;
+}
+
 /**
  * Print a command for debugging.
  */
@@ -49,6 +94,56 @@ void command_channel_socket_free(struct command_channel* c) {
     free(chan);
 }
 
+/**
+ * Open another connection between the endpoints of this channel. The
+ * guestlib connects to the address of its peer, and the worker accepts
+ * the next connection on its listening socket.
+ */
+struct command_channel* command_channel_socket_new_thread_channel(struct command_channel* c) {
+    struct command_channel_socket* chan = (struct command_channel_socket*)c;
+    struct sockaddr_storage address;
+    socklen_t address_len = sizeof(address);
+    int fd;
+
+    if (chan->listen_fd < 0) {
+        if (getpeername(chan->sock_fd, (struct sockaddr *)&address, &address_len) < 0)
+            return NULL;
+        fd = socket(address.ss_family, SOCK_STREAM | SOCK_CLOEXEC, 0);
+        if (fd < 0)
+            return NULL;
+        if (connect(fd, (struct sockaddr *)&address, address_len) < 0) {
+            perror("connect thread channel");
+            close(fd);
+            return NULL;
+        }
+    }
+    else {
+        fd = accept4(chan->listen_fd, (struct sockaddr *)&address, &address_len, SOCK_CLOEXEC);
+        if (fd < 0) {
+            perror("accept thread channel");
+            return NULL;
+        }
+    }
+    if (address.ss_family == AF_INET)
+        setsockopt_lowlatency(fd);
+
+    struct command_channel_socket* thread_chan =
+        (struct command_channel_socket*)malloc(sizeof(struct command_channel_socket));
+    command_channel_preinitialize((struct command_channel *)thread_chan, chan->base.vtable);
+    pthread_mutex_init(&thread_chan->send_mutex, NULL);
+    pthread_mutex_init(&thread_chan->recv_mutex, NULL);
+    thread_chan->sock_fd = fd;
+    thread_chan->vm_id = chan->vm_id;
+    thread_chan->passes_fds = chan->passes_fds;
+    thread_chan->memfd_min_size = chan->memfd_min_size;
+    thread_chan->listen_fd = -1;
+    thread_chan->listen_port = chan->listen_port;
+    thread_chan->init_command_type = chan->init_command_type;
+    thread_chan->pfd.fd = fd;
+    thread_chan->pfd.events = POLLIN | POLLRDHUP;
+    return (struct command_channel *)thread_chan;
+}
+
 //! Sending
 
 /**
@@ -71,17 +166,26 @@ size_t command_channel_socket_buffer_size(const struct command_channel *c, size_
  */
 struct command_base* command_channel_socket_new_command(struct command_channel* c, size_t command_struct_size, size_t data_region_size) {
     struct command_channel_socket* chan = (struct command_channel_socket *)c;
-    struct command_base *cmd = (struct command_base *)malloc(command_struct_size + data_region_size);
-    static_assert(sizeof(struct block_seeker) <= sizeof(cmd->reserved_area),
+    size_t size = command_struct_size + data_region_size;
+    struct command_base *cmd = NULL;
+    int memfd = -1;
+    if (chan->memfd_min_size > 0 && data_region_size >= chan->memfd_min_size)
+        cmd = new_memfd_command(size, &memfd);
+    if (cmd == NULL)
+        cmd = (struct command_base *)malloc(size);
+    static_assert(sizeof(struct socket_command_reserved) <= sizeof(cmd->reserved_area),
                   "command_base::reserved_area is not large enough.");
-    struct block_seeker *seeker = (struct block_seeker *)cmd->reserved_area;
+    struct socket_command_reserved *reserved = command_reserved(cmd);
 
     memset(cmd, 0, command_struct_size);
     cmd->vm_id = chan->vm_id;
     cmd->command_size = command_struct_size;
     cmd->data_region = (void *)command_struct_size;
     cmd->region_size = data_region_size;
-    seeker->cur_offset = command_struct_size;
+    reserved->seeker.cur_offset = command_struct_size;
+    reserved->memfd = memfd;
+    if (memfd >= 0)
+        reserved->mapped_size = size;
 
     return cmd;
 }
@@ -106,7 +210,31 @@ void* command_channel_socket_attach_buffer(struct command_channel* c, struct com
 }
 
 /**
- * Send the message and all its attached buffers.
+ * Attach a buffer to a command without copying it. The buffer is sent
+ * from its own iovec by `command_channel_socket_send_command`, so it
+ * must not change until then. Small buffers are copied.
+ */
+void* command_channel_socket_attach_buffer_by_reference(struct command_channel* c, struct command_base* cmd, void* buffer, size_t size) {
+    // Commands in memfd segments are not copied again when sent, so copying into them is free.
+    if (size < MIN_REFERENCE_SIZE || command_reserved(cmd)->mapped_size > 0)
+        return command_channel_socket_attach_buffer(c, cmd, buffer, size);
+    assert(buffer);
+
+    struct socket_command_reserved *reserved = command_reserved(cmd);
+    void *offset = (void *)reserved->seeker.cur_offset;
+    if (reserved->refs == NULL)
+        reserved->refs = new std::vector<struct socket_buffer_ref>();
+    reserved->refs->push_back({reserved->seeker.cur_offset, buffer, size});
+    reserved->seeker.cur_offset += size;
+    return offset;
+}
+
+/**
+ * Send the message and all its attached buffers. A command stored in a
+ * memfd segment is sent as its header and the memfd. Otherwise the data
+ * region is compressed if the compression policy selects it (see
+ * compress.h), or the command, the copied buffers and the buffers
+ * attached by reference are gathered by a single `sendmsg`.
  *
  * This call is asynchronous and does not block for the command to
  * complete execution.
@@ -114,14 +242,56 @@ void* command_channel_socket_attach_buffer(struct command_channel* c, struct com
 void command_channel_socket_send_command(struct command_channel* c, struct command_base* cmd)
 {
     struct command_channel_socket *chan = (struct command_channel_socket *)c;
+    struct socket_command_reserved *reserved = command_reserved(cmd);
     cmd->command_type = NW_NEW_INVOCATION;
 
+    if (reserved->mapped_size > 0) {
+        // The receiver maps the segment, so only the header goes through the socket.
+        int memfd = reserved->memfd;
+        cmd->flags |= COMMAND_FLAG_MEMFD;
+        pthread_mutex_lock(&chan->send_mutex);
+        send_socket_fd(chan->sock_fd, cmd, sizeof(struct command_base), memfd);
+        pthread_mutex_unlock(&chan->send_mutex);
+        munmap(cmd, reserved->mapped_size);
+        close(memfd);
+        return;
+    }
+
+    // Compress before taking the lock, so threads compress in parallel.
+    void *compressed = NULL;
+    size_t compressed_size = 0;
+    if (ava_compress_selected(cmd)) {
+        flatten_command(cmd);
+        compressed_size = ava_compress_command(cmd, &compressed);
+    }
+
+    std::vector<struct iovec> iov;
+    if (compressed_size > 0) {
+        cmd->flags |= COMMAND_FLAG_COMPRESSED;
+        reserved->wire_region_size = compressed_size;
+        iov.push_back({cmd, cmd->command_size});
+        iov.push_back({compressed, compressed_size});
+    } else {
+        uintptr_t cur_offset = 0;
+        if (reserved->refs != NULL) {
+            iov.reserve(2 * reserved->refs->size() + 1);
+            for (const auto &ref : *reserved->refs) {
+                iov.push_back({(uint8_t *)cmd + cur_offset, ref.offset - cur_offset});
+                iov.push_back({(void *)ref.buffer, ref.size});
+                cur_offset = ref.offset + ref.size;
+            }
+        }
+        iov.push_back({(uint8_t *)cmd + cur_offset, cmd->command_size + cmd->region_size - cur_offset});
+    }
+
     /* vsock interposition does not block send_message */
     pthread_mutex_lock(&chan->send_mutex);
-    send_socket(chan->sock_fd, cmd, cmd->command_size + cmd->region_size);
+    send_socket_iov(chan->sock_fd, iov.data(), iov.size());
     pthread_mutex_unlock(&chan->send_mutex);
 
     // Free the local copy of the command and buffers.
+    delete reserved->refs;
+    free(compressed);
     free(cmd);
 }
 
@@ -129,10 +299,12 @@ void command_channel_socket_transfer_command(struct command_channel* c, const st
                                                     const struct command_base *cmd)
 {
     struct command_channel_socket *chan = (struct command_channel_socket *)c;
-    void *cmd_data_region = command_channel_get_data_region(source, cmd);
+    struct iovec iov[2] = {
+        {(void *)cmd, cmd->command_size},
+        {command_channel_get_data_region(source, cmd), cmd->region_size},
+    };
 
-    send_socket(chan->sock_fd, cmd, cmd->command_size);
-    send_socket(chan->sock_fd, cmd_data_region, cmd->region_size);
+    send_socket_iov(chan->sock_fd, iov, 2);
 }
 
 //! Receiving
@@ -160,8 +332,8 @@ struct command_base* command_channel_socket_receive_command(struct command_chann
     if (chan->pfd.revents == 0)
         return NULL;
 
-    /* terminate guestlib when worker exits */
-    if (chan->pfd.revents & POLLRDHUP) {
+    /* terminate guestlib when worker exits, once the last commands are read */
+    if ((chan->pfd.revents & POLLRDHUP) && !(chan->pfd.revents & POLLIN)) {
         DEBUG_PRINT("command_channel_socket shutdown\n");
         close(chan->pfd.fd);
         exit(-1);
@@ -170,13 +342,59 @@ struct command_base* command_channel_socket_receive_command(struct command_chann
     if (chan->pfd.revents & POLLIN) {
         pthread_mutex_lock(&chan->recv_mutex);
         memset(&cmd_base, 0, sizeof(struct command_base));
-        recv_socket(chan->pfd.fd, &cmd_base, sizeof(struct command_base));
+        // The sender may pass commands in memfd segments whatever this side's own threshold is.
+        int memfd = -1;
+        if (chan->passes_fds)
+            recv_socket_fd(chan->pfd.fd, &cmd_base, sizeof(struct command_base), &memfd);
+        else
+            recv_socket(chan->pfd.fd, &cmd_base, sizeof(struct command_base));
+        if ((memfd >= 0) != ((cmd_base.flags & COMMAND_FLAG_MEMFD) != 0)) {
+            fprintf(stderr, "ERROR: received a command whose memfd segment does not match COMMAND_FLAG_MEMFD\n");
+            exit(-1);
+        }
+
+        if (memfd >= 0) {
+            pthread_mutex_unlock(&chan->recv_mutex);
+            size_t size = cmd_base.command_size + cmd_base.region_size;
+            cmd = (struct command_base *)mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, memfd, 0);
+            close(memfd);
+            if (cmd == MAP_FAILED) {
+                perror("ERROR mapping command segment");
+                exit(-1);
+            }
+            command_reserved(cmd)->refs = NULL;
+            command_reserved(cmd)->mapped_size = size;
+            command_reserved(cmd)->memfd = -1;
+            cmd->flags &= ~COMMAND_FLAG_MEMFD;
+            command_channel_socket_print_command(c, cmd);
+            return cmd;
+        }
+
         cmd = (struct command_base *)malloc(cmd_base.command_size + cmd_base.region_size);
         memcpy(cmd, &cmd_base, sizeof(struct command_base));
+        // The references and mapping of the sender are meaningless here.
+        command_reserved(cmd)->refs = NULL;
+        command_reserved(cmd)->mapped_size = 0;
+
+        if (cmd_base.flags & COMMAND_FLAG_COMPRESSED) {
+            size_t wire_region_size = command_reserved(&cmd_base)->wire_region_size;
+            void *compressed = malloc(wire_region_size);
+            struct iovec iov[2] = {
+                {(uint8_t *)cmd + sizeof(struct command_base), cmd_base.command_size - sizeof(struct command_base)},
+                {compressed, wire_region_size},
+            };
+            recv_socket_iov(chan->pfd.fd, iov, 2);
+            pthread_mutex_unlock(&chan->recv_mutex);
 
-        recv_socket(chan->pfd.fd, (uint8_t *)cmd + sizeof(struct command_base),
-                    cmd_base.command_size + cmd_base.region_size - sizeof(struct command_base));
-        pthread_mutex_unlock(&chan->recv_mutex);
+            // Decompress in place, so command_channel_get_buffer sees the original data region.
+            ava_decompress_region(compressed, wire_region_size, (uint8_t *)cmd + cmd->command_size, cmd->region_size);
+            free(compressed);
+            cmd->flags &= ~COMMAND_FLAG_COMPRESSED;
+        } else {
+            recv_socket(chan->pfd.fd, (uint8_t *)cmd + sizeof(struct command_base),
+                        cmd_base.command_size + cmd_base.region_size - sizeof(struct command_base));
+            pthread_mutex_unlock(&chan->recv_mutex);
+        }
 
         command_channel_socket_print_command(c, cmd);
         return cmd;
@@ -197,18 +415,29 @@ void* command_channel_socket_get_buffer(const struct command_channel *chan, cons
 
 /**
  * Returns the pointer to data region. The returned pointer is mainly
- * used for data extraction for migration.
+ * used for data extraction for migration. Buffers attached by reference
+ * to an unsent command are copied into the region first.
  */
 void* command_channel_socket_get_data_region(const struct command_channel *c, const struct command_base *cmd)
 {
+    flatten_command((struct command_base *)cmd);
     return (void *)((uintptr_t)cmd + cmd->command_size);
 }
 
 /**
- * Free a command returned by `command_channel_receive_command`.
+ * Free a command returned by `command_channel_receive_command`, or an
+ * unsent command.
  */
 void command_channel_socket_free_command(struct command_channel* c, struct command_base* cmd) {
-    free(cmd);
+    struct socket_command_reserved *reserved = command_reserved(cmd);
+    delete reserved->refs;
+    if (reserved->mapped_size > 0) {
+        if (reserved->memfd >= 0)
+            close(reserved->memfd);
+        munmap(cmd, reserved->mapped_size);
+    } else {
+        free(cmd);
+    }
 }
 
 };  // namespace chansocketutil
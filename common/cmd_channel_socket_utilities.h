@@ -7,18 +7,49 @@
 
 namespace chansocketutil {
 
+/**
+ * A buffer attached by reference: it is sent from `buffer` instead of
+ * being copied to `offset` in the command.
+ */
+struct socket_buffer_ref {
+  uintptr_t offset;
+  const void *buffer;
+  size_t size;
+};
+
+/**
+ * The contents of `command_base::reserved_area` for socket channels.
+ */
+struct socket_command_reserved {
+  struct block_seeker seeker;
+  /* The size of the data region on the wire if the command has `COMMAND_FLAG_COMPRESSED`. */
+  uint64_t wire_region_size;
+  /* The buffers attached by reference, in offset order, or NULL. Only meaningful in the sender. */
+  std::vector<struct socket_buffer_ref> *refs;
+  /* The size of the mapping if the command is stored in a memfd segment, or 0 if it was malloc'ed. */
+  uint64_t mapped_size;
+  /* The memfd holding the command until it is sent, or -1. */
+  int32_t memfd;
+};
+
 struct command_channel_socket {
   struct command_channel_base base;
   int sock_fd;
   struct pollfd pfd;
   uint8_t vm_id;
+  /* True if the channel is a Unix socket, which can pass file descriptors with commands. */
+  int passes_fds;
+  /* Commands with data regions of at least this size are passed in memfd segments. 0 if the
+   * channel is not a Unix socket or does not send commands in memfd segments. */
+  size_t memfd_min_size;
 
   /* Channel locks */
   pthread_mutex_t send_mutex;
   pthread_mutex_t recv_mutex;
 
-  // TODO: Remove the following fields that don't seem to do anything.
+  /* The listening socket of the worker, which accepts thread channels. -1 in the guestlib. */
   int listen_fd;
+  // TODO: Remove the following fields that don't seem to do anything.
   int listen_port;
   uint8_t init_command_type;
 
@@ -28,6 +59,7 @@ struct command_channel_socket {
 void command_channel_socket_print_command(const struct command_channel *chan,
                                           const struct command_base *cmd);
 void command_channel_socket_free(struct command_channel* c);
+struct command_channel* command_channel_socket_new_thread_channel(struct command_channel* c);
 size_t command_channel_socket_buffer_size(const struct command_channel *c,
                                           size_t size);
 struct command_base* command_channel_socket_new_command(struct command_channel* c,
@@ -37,6 +69,10 @@ void* command_channel_socket_attach_buffer(struct command_channel* c,
                                            struct command_base* cmd,
                                            void* buffer,
                                            size_t size);
+void* command_channel_socket_attach_buffer_by_reference(struct command_channel* c,
+                                                        struct command_base* cmd,
+                                                        void* buffer,
+                                                        size_t size);
 void command_channel_socket_send_command(struct command_channel* c,
                                          struct command_base* cmd);
 void command_channel_socket_transfer_command(struct command_channel* c,
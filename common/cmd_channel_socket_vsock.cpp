@@ -29,6 +29,9 @@ struct command_channel* command_channel_socket_new()
     command_channel_preinitialize((struct command_channel *)chan, &command_channel_socket_vsock_vtable);
     pthread_mutex_init(&chan->send_mutex, NULL);
     pthread_mutex_init(&chan->recv_mutex, NULL);
+    chan->passes_fds = 0;
+    chan->memfd_min_size = 0;
+    chan->listen_fd = -1;
 
     chan->vm_id = nw_global_vm_id = 1;
 
@@ -81,6 +84,8 @@ struct command_channel* command_channel_socket_worker_new(int listen_port)
     command_channel_preinitialize((struct command_channel *)chan, &command_channel_socket_vsock_vtable);
     pthread_mutex_init(&chan->send_mutex, NULL);
     pthread_mutex_init(&chan->recv_mutex, NULL);
+    chan->passes_fds = 0;
+    chan->memfd_min_size = 0;
 
     // TODO: notify executor when VM created or destroyed
     printf("spawn worker port#%d\n", listen_port);
@@ -130,7 +135,10 @@ namespace {
     chansocketutil::command_channel_socket_get_data_region,
     chansocketutil::command_channel_socket_free_command,
     chansocketutil::command_channel_socket_free,
-    chansocketutil::command_channel_socket_print_command
+    chansocketutil::command_channel_socket_print_command,
+    chansocketutil::command_channel_socket_attach_buffer_by_reference,
+    chansocketutil::command_channel_socket_new_thread_channel,
+    1
   };
 }
 
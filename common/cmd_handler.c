@@ -3,6 +3,9 @@
 #include "common/cmd_handler.h"
 #include "common/endpoint_lib.h"
 #include "common/shadow_thread_pool.h"
+#include "common/async_batch.h"
+#include "common/stream.h"
+#include "common/thread_channel.h"
 
 #ifdef __cplusplus
 #include <atomic>
@@ -238,6 +241,8 @@ void internal_api_handler(struct command_channel *chan, struct nw_handle_pool *h
             //  and then destroy the reply_handle_pool.
             nw_handle_pool_free(nw_global_handle_pool);
             nw_global_handle_pool = replay_handle_pool;
+            // The replay rewrote the shadow buffers, so they must be sent whole again.
+            ava_shadow_buffer_reset_digests();
 
             {
                 struct command_base *log_end = command_channel_new_command(chan, sizeof(struct command_base), 0);
@@ -252,6 +257,8 @@ void internal_api_handler(struct command_channel *chan, struct nw_handle_pool *h
 
         case COMMAND_END_MIGRATION:
             // TODO: Move this command into a handler guestlib/src/init.c
+            // The new worker does not have the shadow buffers of the old one.
+            ava_shadow_buffer_reset_digests();
             nw_end_migration_flag = 1;
             break;
 
@@ -290,6 +297,7 @@ void internal_api_handler(struct command_channel *chan, struct nw_handle_pool *h
             }
 
             /* notify guestlib of completion */
+            ava_shadow_buffer_reset_digests();
             {
                 struct command_base *log_end = command_channel_new_command(chan, sizeof(struct command_base), 0);
                 log_end->api_id = COMMAND_HANDLER_API;
@@ -331,6 +339,42 @@ void internal_api_handler(struct command_channel *chan, struct nw_handle_pool *h
             }
             break;
 
+        case COMMAND_HANDLER_BATCH:
+            {
+                struct command_handler_batch_command *batch = (struct command_handler_batch_command *)cmd;
+                // The buffers of the batched commands are resolved relative to their copies in the batch.
+                assert(command_channel_has_command_relative_buffer_ids(chan));
+                char *entry = (char *)command_channel_get_buffer(chan, cmd, batch->commands);
+                // Send the replies to the batched commands together.
+                ava_async_batch_begin_replies(chan);
+                for (uint32_t i = 0; i < batch->command_count; i++) {
+                    struct command_base *batched_cmd = (struct command_base *)entry;
+                    assert(batched_cmd->thread_id == cmd->thread_id);
+                    assert(nw_apis[batched_cmd->api_id].handle != NULL);
+                    // The batched command is owned by the batch, so it is not freed here.
+                    nw_apis[batched_cmd->api_id].handle(chan, handle_pool, log, batched_cmd);
+                    entry += command_handler_batch_entry_size(batched_cmd);
+                }
+                ava_async_batch_end_replies(chan);
+            }
+            break;
+
+        case COMMAND_HANDLER_STREAM_CHUNK:
+            ava_stream_handle_chunk(chan, cmd);
+            break;
+
+        case COMMAND_HANDLER_STREAM_ACK:
+            ava_stream_handle_ack(cmd);
+            break;
+
+        case COMMAND_HANDLER_BARRIER:
+            ava_thread_channel_handle_barrier(cmd);
+            break;
+
+        case COMMAND_HANDLER_BARRIER_MARKER:
+            ava_thread_channel_handle_marker(cmd);
+            break;
+
         default:
             DEBUG_PRINT("Unknown internal command: %lu", cmd->command_id);
             exit(0);
@@ -0,0 +1,144 @@
+#include <glib.h>
+#include <math.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <string.h>
+#include <zlib.h>
+
+#include "common/cmd_channel.h"
+#include "common/compress.h"
+#include "common/debug.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/stats.h"
+
+#define DEFAULT_THRESHOLD (64 * 1024)
+
+/* The entropy probe reads SAMPLE_COUNT windows of SAMPLE_SIZE bytes spread over the region. */
+#define SAMPLE_COUNT 16
+#define SAMPLE_SIZE 256
+/* Regions whose samples have more bits of entropy per byte are not compressed. */
+#define MAX_ENTROPY 7.0
+
+enum compress_policy {
+    COMPRESS_OFF,
+    COMPRESS_ANNOTATED,
+    COMPRESS_ALL,
+};
+
+static pthread_once_t compress_init_once = PTHREAD_ONCE_INIT;
+static enum compress_policy policy;
+static size_t threshold;
+
+static atomic_ulong regions_compressed;
+static atomic_ulong regions_skipped;
+static atomic_ulong bytes_in;
+static atomic_ulong bytes_out;
+static atomic_ulong compress_time_us;
+
+static void compress_init(void) {
+    const char *s = getenv("AVA_COMPRESS");
+    if (s == NULL || *s == '\0' || !strcmp(s, "annotated"))
+        policy = COMPRESS_ANNOTATED;
+    else if (!strcmp(s, "all"))
+        policy = COMPRESS_ALL;
+    else if (!strcmp(s, "off"))
+        policy = COMPRESS_OFF;
+    else {
+        fprintf(stderr, "Unknown AVA_COMPRESS policy \"%s\" (expected off, annotated or all)\n", s);
+        policy = COMPRESS_ANNOTATED;
+    }
+    threshold = ava_getenv_size("AVA_COMPRESS_THRESHOLD", DEFAULT_THRESHOLD);
+}
+
+/**
+ * Estimate the entropy in bits per byte of `data` from a sample of it.
+ */
+static double sample_entropy(const uint8_t *data, size_t size) {
+    size_t counts[256] = {0};
+    size_t total = 0;
+    size_t stride = size / SAMPLE_COUNT;
+    for (size_t i = 0; i < SAMPLE_COUNT; i++) {
+        const uint8_t *sample = data + i * stride;
+        size_t n = stride < SAMPLE_SIZE ? stride : SAMPLE_SIZE;
+        for (size_t j = 0; j < n; j++)
+            counts[sample[j]]++;
+        total += n;
+    }
+
+    double entropy = 0;
+    for (size_t i = 0; i < 256; i++) {
+        if (counts[i] == 0)
+            continue;
+        double p = (double)counts[i] / total;
+        entropy -= p * log2(p);
+    }
+    return entropy;
+}
+
+EXPORTED_WEAKLY int ava_compress_selected(const struct command_base *cmd) {
+    pthread_once(&compress_init_once, compress_init);
+    return !(policy == COMPRESS_OFF || (policy == COMPRESS_ANNOTATED && !(cmd->flags & COMMAND_FLAG_COMPRESSIBLE)) ||
+             cmd->region_size < threshold || cmd->region_size < SAMPLE_COUNT);
+}
+
+EXPORTED_WEAKLY size_t ava_compress_command(const struct command_base *cmd, void **compressed) {
+    *compressed = NULL;
+    if (!ava_compress_selected(cmd))
+        return 0;
+
+    const uint8_t *region = (const uint8_t *)cmd + cmd->command_size;
+    if (sample_entropy(region, cmd->region_size) > MAX_ENTROPY) {
+        atomic_fetch_add(&regions_skipped, 1);
+        return 0;
+    }
+
+    gint64 start_time = g_get_monotonic_time();
+    uLongf size = compressBound(cmd->region_size);
+    void *out = malloc(size);
+    if (compress2(out, &size, region, cmd->region_size, 1) != Z_OK || size >= cmd->region_size) {
+        free(out);
+        atomic_fetch_add(&regions_skipped, 1);
+        return 0;
+    }
+    atomic_fetch_add(&compress_time_us, g_get_monotonic_time() - start_time);
+    atomic_fetch_add(&regions_compressed, 1);
+    atomic_fetch_add(&bytes_in, cmd->region_size);
+    atomic_fetch_add(&bytes_out, size);
+    DEBUG_PRINT("Compressed data region of command %ld from %zu to %lu bytes\n", (long)cmd->command_id,
+                cmd->region_size, (unsigned long)size);
+    *compressed = out;
+    return size;
+}
+
+EXPORTED_WEAKLY void ava_decompress_region(const void *src, size_t src_size, void *dst, size_t dst_size) {
+    gint64 start_time = g_get_monotonic_time();
+    uLongf size = dst_size;
+    if (uncompress(dst, &size, src, src_size) != Z_OK || size != dst_size) {
+        fprintf(stderr, "Failed to decompress a data region of %zu bytes\n", dst_size);
+        abort();
+    }
+    atomic_fetch_add(&compress_time_us, g_get_monotonic_time() - start_time);
+}
+
+EXPORTED_WEAKLY void ava_compress_get_stats(struct ava_compress_stats *stats) {
+    stats->compressed = regions_compressed;
+    stats->skipped = regions_skipped;
+    stats->bytes_in = bytes_in;
+    stats->bytes_out = bytes_out;
+    stats->time_us = compress_time_us;
+}
+
+EXPORTED_WEAKLY void ava_compress_print_stats(FILE *file) {
+    struct ava_compress_stats stats;
+    ava_compress_get_stats(&stats);
+    fprintf(file, "Compression: %lu regions compressed from %lu to %lu bytes (%.1f%%), %lu skipped, %.3f s\n",
+            (unsigned long)stats.compressed, (unsigned long)stats.bytes_in, (unsigned long)stats.bytes_out,
+            stats.bytes_in > 0 ? 100.0 * stats.bytes_out / stats.bytes_in : 0.0, (unsigned long)stats.skipped,
+            stats.time_us / 1e6);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_COMPRESS_STATS", ava_compress_print_stats);
+}
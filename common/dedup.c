@@ -0,0 +1,200 @@
+#include <assert.h>
+#include <glib.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "common/debug.h"
+#include "common/dedup.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/stats.h"
+
+#define DEFAULT_MIN_SIZE 4096
+#define DEFAULT_GUEST_ENTRIES 4096
+#define DEFAULT_STORE_SIZE (256 * 1024 * 1024)
+
+struct ava_dedup_entry {
+    /* The hash of the digest. Used as the key of the hash tables. */
+    uint64_t hash[4];
+    GBytes *data;
+    /* The link of this entry in the LRU list. `link.data` points to the entry. */
+    GList link;
+};
+
+static pthread_once_t dedup_init_once = PTHREAD_ONCE_INIT;
+static size_t min_size;
+static size_t max_guest_entries;
+static size_t max_store_size;
+
+static pthread_mutex_t dedup_lock = PTHREAD_MUTEX_INITIALIZER;
+/* The digests of the buffers the guest has sent with their data (entries without data). */
+static GHashTable *guest_digests;
+static GQueue guest_lru = G_QUEUE_INIT;
+/* The buffers stored by the worker. */
+static GHashTable *store;
+static GQueue store_lru = G_QUEUE_INIT;
+static size_t store_size;
+
+static atomic_ulong digests_sent;
+static atomic_ulong bytes_saved;
+static atomic_ulong store_hits;
+static atomic_ulong store_misses;
+
+static guint digest_hash(gconstpointer key) {
+    return (guint)((const uint64_t *)key)[0];
+}
+
+static gboolean digest_equal(gconstpointer a, gconstpointer b) {
+    return memcmp(a, b, sizeof(uint64_t[4])) == 0;
+}
+
+static void entry_free(struct ava_dedup_entry *entry) {
+    if (entry->data != NULL)
+        g_bytes_unref(entry->data);
+    free(entry);
+}
+
+static void dedup_init(void) {
+    min_size = ava_getenv_size("AVA_DEDUP_MIN_SIZE", DEFAULT_MIN_SIZE);
+    max_guest_entries = ava_getenv_size("AVA_DEDUP_GUEST_ENTRIES", DEFAULT_GUEST_ENTRIES);
+    max_store_size = ava_getenv_size("AVA_DEDUP_STORE_SIZE", DEFAULT_STORE_SIZE);
+    guest_digests = g_hash_table_new_full(digest_hash, digest_equal, NULL, (GDestroyNotify)entry_free);
+    store = g_hash_table_new_full(digest_hash, digest_equal, NULL, (GDestroyNotify)entry_free);
+}
+
+static struct ava_dedup_entry *entry_new(const uint64_t hash[4], GBytes *data) {
+    struct ava_dedup_entry *entry = malloc(sizeof(struct ava_dedup_entry));
+    memcpy(entry->hash, hash, sizeof(entry->hash));
+    entry->data = data;
+    entry->link.data = entry;
+    entry->link.prev = entry->link.next = NULL;
+    return entry;
+}
+
+/**
+ * Compute the SHA-256 of a buffer. The worker uses the buffer stored under a digest instead of the contents sent
+ * with the call, so the digest must be collision resistant.
+ */
+static void hash_buffer(const void *buffer, size_t size, uint64_t hash[4]) {
+    GChecksum *checksum = g_checksum_new(G_CHECKSUM_SHA256);
+    g_checksum_update(checksum, buffer, size);
+    gsize hash_size = sizeof(uint64_t[4]);
+    g_checksum_get_digest(checksum, (guint8 *)hash, &hash_size);
+    g_checksum_free(checksum);
+    assert(hash_size == sizeof(uint64_t[4]));
+}
+
+/**
+ * Remove an entry from `table` and `lru` and free it. The caller must hold `dedup_lock`.
+ */
+static void entry_remove(GHashTable *table, GQueue *lru, struct ava_dedup_entry *entry) {
+    g_queue_unlink(lru, &entry->link);
+    g_hash_table_remove(table, entry->hash);
+}
+
+EXPORTED_WEAKLY void ava_dedup_digest(const void *buffer, size_t size, int send_data,
+                                      struct ava_dedup_digest *digest) {
+    pthread_once(&dedup_init_once, dedup_init);
+    if (size < min_size || max_guest_entries == 0) {
+        memset(digest->hash, 0, sizeof(digest->hash));
+        digest->state = AVA_DEDUP_NONE;
+        return;
+    }
+
+    hash_buffer(buffer, size, digest->hash);
+
+    pthread_mutex_lock(&dedup_lock);
+    struct ava_dedup_entry *entry = g_hash_table_lookup(guest_digests, digest->hash);
+    if (entry != NULL) {
+        g_queue_unlink(&guest_lru, &entry->link);
+        g_queue_push_head_link(&guest_lru, &entry->link);
+        digest->state = send_data ? AVA_DEDUP_DATA : AVA_DEDUP_DIGEST;
+    } else {
+        // Assume the worker will store the buffer this call sends.
+        while (g_hash_table_size(guest_digests) >= max_guest_entries)
+            entry_remove(guest_digests, &guest_lru, g_queue_peek_tail(&guest_lru));
+        entry = entry_new(digest->hash, NULL);
+        g_hash_table_insert(guest_digests, entry->hash, entry);
+        g_queue_push_head_link(&guest_lru, &entry->link);
+        digest->state = AVA_DEDUP_DATA;
+    }
+    pthread_mutex_unlock(&dedup_lock);
+
+    if (digest->state == AVA_DEDUP_DIGEST) {
+        atomic_fetch_add(&digests_sent, 1);
+        atomic_fetch_add(&bytes_saved, size);
+    }
+}
+
+EXPORTED_WEAKLY void ava_dedup_forget(const struct ava_dedup_digest *digest) {
+    pthread_once(&dedup_init_once, dedup_init);
+    pthread_mutex_lock(&dedup_lock);
+    struct ava_dedup_entry *entry = g_hash_table_lookup(guest_digests, digest->hash);
+    if (entry != NULL)
+        entry_remove(guest_digests, &guest_lru, entry);
+    pthread_mutex_unlock(&dedup_lock);
+}
+
+EXPORTED_WEAKLY GBytes *ava_dedup_store_lookup(const struct ava_dedup_digest *digest) {
+    pthread_once(&dedup_init_once, dedup_init);
+    GBytes *data = NULL;
+    pthread_mutex_lock(&dedup_lock);
+    struct ava_dedup_entry *entry = g_hash_table_lookup(store, digest->hash);
+    if (entry != NULL) {
+        g_queue_unlink(&store_lru, &entry->link);
+        g_queue_push_head_link(&store_lru, &entry->link);
+        data = g_bytes_ref(entry->data);
+    }
+    pthread_mutex_unlock(&dedup_lock);
+
+    if (data != NULL) {
+        atomic_fetch_add(&store_hits, 1);
+    } else {
+        atomic_fetch_add(&store_misses, 1);
+        DEBUG_PRINT("Deduplicated buffer %016lx%016lx%016lx%016lx is not stored\n", (unsigned long)digest->hash[0],
+                    (unsigned long)digest->hash[1], (unsigned long)digest->hash[2], (unsigned long)digest->hash[3]);
+    }
+    return data;
+}
+
+EXPORTED_WEAKLY void ava_dedup_store_insert(const struct ava_dedup_digest *digest, const void *buffer,
+                                            size_t size) {
+    pthread_once(&dedup_init_once, dedup_init);
+    if (size > max_store_size)
+        return;
+    uint64_t hash[4];
+    hash_buffer(buffer, size, hash);
+    if (memcmp(hash, digest->hash, sizeof(hash)) != 0) {
+        DEBUG_PRINT("Deduplicated buffer does not match its digest\n");
+        return;
+    }
+
+    struct ava_dedup_entry *entry = entry_new(digest->hash, g_bytes_new(buffer, size));
+    pthread_mutex_lock(&dedup_lock);
+    struct ava_dedup_entry *old = g_hash_table_lookup(store, entry->hash);
+    if (old != NULL) {
+        store_size -= g_bytes_get_size(old->data);
+        entry_remove(store, &store_lru, old);
+    }
+    while (store_size + size > max_store_size) {
+        struct ava_dedup_entry *victim = g_queue_peek_tail(&store_lru);
+        store_size -= g_bytes_get_size(victim->data);
+        entry_remove(store, &store_lru, victim);
+    }
+    g_hash_table_insert(store, entry->hash, entry);
+    g_queue_push_head_link(&store_lru, &entry->link);
+    store_size += size;
+    pthread_mutex_unlock(&dedup_lock);
+}
+
+EXPORTED_WEAKLY void ava_dedup_print_stats(FILE *file) {
+    fprintf(file, "Input deduplication: %lu digests sent, %lu bytes saved, store %lu hits, %lu misses, %zu bytes\n",
+            (unsigned long)digests_sent, (unsigned long)bytes_saved, (unsigned long)store_hits,
+            (unsigned long)store_misses, store_size);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_DEDUP_STATS", ava_dedup_print_stats);
+}
@@ -1,18 +1,66 @@
 #include "common/endpoint_lib.h"
+#include "common/env.h"
 #include "common/shadow_thread_pool.h"
+#include "common/stats.h"
 
 #include <glib.h>
 #include <pthread.h>
 #include <stdint.h>
+#include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <stdatomic.h>
 
 struct ava_endpoint __ava_endpoint;
 
-struct nw_handle_pool {
-    GHashTable *to_handle;
-    GHashTable *to_id;
+/* The ID index of a handle pool is a three level radix tree of handles. Counter values are dense, so the leaves are
+ * densely used. */
+#define id_index_top_bits 12
+#define id_index_level_bits 14
+#define id_index_level_size (1UL << id_index_level_bits)
+
+/* The reverse map of a handle pool (from handles to IDs) is split into shards of open addressing tables. */
+#define handle_shard_bits 6
+#define handle_shard_count (1 << handle_shard_bits)
+#define handle_table_min_capacity 64
+/* Marks a slot whose handle was removed. Slots are never reused for another handle in the same table, so lock-free
+ * readers never see the ID of one handle with the key of another. */
+#define handle_tombstone ((void*)UINTPTR_MAX)
+/* Bound to the IDs of guest allocated handles whose creation failed (see nw_handle_pool_assign_poison). */
+static const char handle_poison_marker;
+#define handle_poison ((void*)&handle_poison_marker)
+
+struct handle_slot {
+    _Atomic(void*) handle;
+    _Atomic(void*) id;
+};
+
+struct handle_table {
+    size_t capacity;
+    /* The next table in the list of replaced tables of the shard. */
+    struct handle_table *next_retired;
+    struct handle_slot slots[];
+};
+
+struct handle_shard {
+    _Atomic(struct handle_table*) table;
+    /* The number of lookups running on this shard. Replaced tables are freed when no lookup is running. */
+    atomic_ulong readers;
+    /* The remaining fields are protected by lock. */
     pthread_mutex_t lock;
+    /* The number of slots in table which are not empty, including tombstones. */
+    size_t used;
+    size_t live;
+    struct handle_table *retired_tables;
+} __attribute__((aligned(64)));
+
+struct nw_handle_pool {
+    /* Indexed by ID (without the prefix and with the tag moved to the top). Lookups do not lock. */
+    _Atomic(void*) id_index[1 << id_index_top_bits];
+    struct handle_shard shards[handle_shard_count];
+    /* The errors of the poisoned IDs (struct ava_async_error*), protected by poisons_lock. */
+    GHashTable *poisons;
+    pthread_mutex_t poisons_lock;
 };
 
 struct ava_replay_command_t {
@@ -59,29 +107,194 @@ static int is_handle(const void *id) {
     return !(prefix ^ counter_count_prefix);
 }
 
+/**
+ * Get the entry of `id` in the ID index of `pool`, allocating the levels of
+ * the index on the way if `create` is true.
+ * @return The slot which holds the handle of `id`, or NULL if `create` is
+ * false and the ID was never used.
+ */
+static _Atomic(void*)* id_index_slot(struct nw_handle_pool *pool, const void *id, int create) {
+    uintptr_t v = (uintptr_t)id & ~counter_count_prefix;
+    uintptr_t i = ((v & counter_tag_mask) << (40 - counter_count_shift)) | (v >> counter_count_shift);
+    size_t indexes[3] = {
+        (i >> (2 * id_index_level_bits)) & ((1UL << id_index_top_bits) - 1),
+        (i >> id_index_level_bits) & (id_index_level_size - 1),
+        i & (id_index_level_size - 1),
+    };
+    _Atomic(void*) *level = pool->id_index;
+    for (int depth = 0; depth < 2; depth++) {
+        _Atomic(void*) *slot = &level[indexes[depth]];
+        void *next = atomic_load_explicit(slot, memory_order_acquire);
+        if (next == NULL) {
+            if (!create)
+                return NULL;
+            void *fresh = calloc(id_index_level_size, sizeof(_Atomic(void*)));
+            if (atomic_compare_exchange_strong(slot, &next, fresh))
+                next = fresh;
+            else
+                free(fresh);
+        }
+        level = (_Atomic(void*)*)next;
+    }
+    return &level[indexes[2]];
+}
+
+static void id_index_free(_Atomic(void*) *level, int depth) {
+    for (size_t i = 0; depth < 2 && i < (depth == 0 ? 1UL << id_index_top_bits : id_index_level_size); i++) {
+        void *next = atomic_load_explicit(&level[i], memory_order_relaxed);
+        if (next != NULL)
+            id_index_free((_Atomic(void*)*)next, depth + 1);
+    }
+    if (depth > 0)
+        free((void*)level);
+}
+
+static inline uint64_t handle_hash(const void *handle) {
+    uint64_t h = (uintptr_t)handle * 0x9e3779b97f4a7c15ULL;
+    return h ^ (h >> 29);
+}
+
+static inline struct handle_shard* handle_shard(struct nw_handle_pool *pool, uint64_t hash) {
+    return &pool->shards[hash >> (64 - handle_shard_bits)];
+}
+
+static struct handle_table* handle_table_new(size_t capacity) {
+    struct handle_table *table = calloc(1, sizeof(struct handle_table) + capacity * sizeof(struct handle_slot));
+    table->capacity = capacity;
+    return table;
+}
+
+static void handle_table_free_list(struct handle_table *table) {
+    while (table != NULL) {
+        struct handle_table *next = table->next_retired;
+        free(table);
+        table = next;
+    }
+}
+
+/**
+ * Find the slot of `handle` in `table`, or the empty slot at the end of its
+ * probe sequence. This may run concurrently with updates of the table.
+ */
+static struct handle_slot* handle_table_find(struct handle_table *table, const void *handle, uint64_t hash) {
+    size_t mask = table->capacity - 1;
+    for (size_t i = hash & mask;; i = (i + 1) & mask) {
+        void *key = atomic_load_explicit(&table->slots[i].handle, memory_order_acquire);
+        if (key == NULL || key == handle)
+            return &table->slots[i];
+    }
+}
+
+/**
+ * Look up the ID of `handle` without locking the shard.
+ */
+static void* reverse_lookup(struct nw_handle_pool *pool, const void *handle) {
+    uint64_t hash = handle_hash(handle);
+    struct handle_shard *shard = handle_shard(pool, hash);
+    atomic_fetch_add(&shard->readers, 1);
+    struct handle_slot *slot = handle_table_find(atomic_load(&shard->table), handle, hash);
+    void *id = NULL;
+    if (atomic_load_explicit(&slot->handle, memory_order_acquire) == handle)
+        id = atomic_load_explicit(&slot->id, memory_order_acquire);
+    atomic_fetch_sub(&shard->readers, 1);
+    return id;
+}
+
+/**
+ * Free the tables replaced in `shard` if no lookup can still be reading them.
+ * The caller must hold the shard lock.
+ */
+static void handle_shard_reclaim(struct handle_shard *shard) {
+    // Lookups which start after this load see the current table, since it was published before.
+    if (shard->retired_tables != NULL && atomic_load(&shard->readers) == 0) {
+        handle_table_free_list(shard->retired_tables);
+        shard->retired_tables = NULL;
+    }
+}
+
+/**
+ * Bind `handle` to `id` in the reverse map, replacing its old ID if there is
+ * one. The caller must hold the shard lock.
+ */
+static void reverse_insert(struct handle_shard *shard, const void *handle, uint64_t hash, const void *id) {
+    struct handle_table *table = atomic_load_explicit(&shard->table, memory_order_relaxed);
+    struct handle_slot *slot = handle_table_find(table, handle, hash);
+    if (atomic_load_explicit(&slot->handle, memory_order_relaxed) == handle) {
+        atomic_store_explicit(&slot->id, (void*)id, memory_order_release);
+        return;
+    }
+
+    if ((shard->used + 1) * 4 > table->capacity * 3) {
+        // Copy the live slots into a new table, dropping the tombstones.
+        size_t capacity = handle_table_min_capacity;
+        while (capacity < (shard->live + 1) * 2)
+            capacity *= 2;
+        struct handle_table *fresh = handle_table_new(capacity);
+        for (size_t i = 0; i < table->capacity; i++) {
+            void *key = atomic_load_explicit(&table->slots[i].handle, memory_order_relaxed);
+            if (key == NULL || key == handle_tombstone)
+                continue;
+            struct handle_slot *s = handle_table_find(fresh, key, handle_hash(key));
+            atomic_store_explicit(&s->id, atomic_load_explicit(&table->slots[i].id, memory_order_relaxed),
+                                  memory_order_relaxed);
+            atomic_store_explicit(&s->handle, key, memory_order_relaxed);
+        }
+        atomic_store(&shard->table, fresh);
+        table->next_retired = shard->retired_tables;
+        shard->retired_tables = table;
+        shard->used = shard->live;
+        table = fresh;
+        slot = handle_table_find(table, handle, hash);
+    }
+    handle_shard_reclaim(shard);
+
+    // Publish the ID before the key, so that readers which find the key see the ID.
+    atomic_store_explicit(&slot->id, (void*)id, memory_order_relaxed);
+    atomic_store_explicit(&slot->handle, (void*)handle, memory_order_release);
+    shard->used++;
+    shard->live++;
+}
+
 struct nw_handle_pool* nw_handle_pool_new() {
-    struct nw_handle_pool* ret = (struct nw_handle_pool*)malloc(sizeof(struct nw_handle_pool));
-    ret->to_handle = metadata_map_new();
-    ret->to_id = metadata_map_new();
-    pthread_mutex_init(&ret->lock, NULL);
+    struct nw_handle_pool* ret = (struct nw_handle_pool*)aligned_alloc(
+            _Alignof(struct nw_handle_pool), sizeof(struct nw_handle_pool));
+    memset(ret, 0, sizeof(struct nw_handle_pool));
+    for (int i = 0; i < handle_shard_count; i++) {
+        atomic_init(&ret->shards[i].table, handle_table_new(handle_table_min_capacity));
+        pthread_mutex_init(&ret->shards[i].lock, NULL);
+    }
+    ret->poisons = g_hash_table_new_full(g_direct_hash, g_direct_equal, NULL, free);
+    pthread_mutex_init(&ret->poisons_lock, NULL);
     return ret;
 }
 
 void nw_handle_pool_free(struct nw_handle_pool *pool) {
-    pthread_mutex_lock(&pool->lock);
-    g_hash_table_unref(pool->to_handle);
-    g_hash_table_unref(pool->to_id);
-    pthread_mutex_unlock(&pool->lock);
+    for (int i = 0; i < handle_shard_count; i++) {
+        struct handle_shard *shard = &pool->shards[i];
+        pthread_mutex_lock(&shard->lock);
+        free(atomic_load(&shard->table));
+        handle_table_free_list(shard->retired_tables);
+        pthread_mutex_unlock(&shard->lock);
+        pthread_mutex_destroy(&shard->lock);
+    }
+    id_index_free(pool->id_index, 0);
+    g_hash_table_unref(pool->poisons);
+    pthread_mutex_destroy(&pool->poisons_lock);
     free(pool);
 }
 
-static void* internal_handle_pool_insert(struct nw_handle_pool *pool, const void* handle) {
+/**
+ * Bind `handle` to a new ID. The caller must hold the shard lock.
+ */
+static void* internal_handle_pool_insert(struct nw_handle_pool *pool, struct handle_shard *shard,
+                                         const void* handle, uint64_t hash) {
     void* id = next_id();
-    gboolean b = g_hash_table_insert(pool->to_id, (gpointer) handle, id);
-    assert(b && "handle already exists");
-    b = g_hash_table_insert(pool->to_handle, id, (gpointer) handle);
+    _Atomic(void*) *slot = id_index_slot(pool, id, 1);
+    void *old_handle = NULL;
+    gboolean b = atomic_compare_exchange_strong(slot, &old_handle, (void*)handle);
     assert(b && "id already exists");
     (void)b;
+    reverse_insert(shard, handle, hash, id);
     return id;
 }
 
@@ -89,9 +302,12 @@ void* nw_handle_pool_insert(struct nw_handle_pool *pool,
                             const void* handle) {
     if (handle == NULL || pool == NULL)
         return (void*)handle;
-    pthread_mutex_lock(&pool->lock);
-    void* id = internal_handle_pool_insert(pool, handle);
-    pthread_mutex_unlock(&pool->lock);
+    uint64_t hash = handle_hash(handle);
+    struct handle_shard *shard = handle_shard(pool, hash);
+    pthread_mutex_lock(&shard->lock);
+    assert(reverse_lookup(pool, handle) == NULL && "handle already exists");
+    void* id = internal_handle_pool_insert(pool, shard, handle, hash);
+    pthread_mutex_unlock(&shard->lock);
     return id;
 }
 
@@ -99,25 +315,39 @@ void* nw_handle_pool_lookup_or_insert(struct nw_handle_pool *pool,
                                       const void* handle) {
     if (handle == NULL || pool == NULL)
         return (void*)handle;
-    pthread_mutex_lock(&pool->lock);
-    void* id = g_hash_table_lookup(pool->to_id, handle);
+    void* id = reverse_lookup(pool, handle);
+    if (id != NULL)
+        return id;
+    uint64_t hash = handle_hash(handle);
+    struct handle_shard *shard = handle_shard(pool, hash);
+    pthread_mutex_lock(&shard->lock);
+    // Another thread may have inserted the handle since the lookup.
+    id = reverse_lookup(pool, handle);
     if (id == NULL)
-        id = internal_handle_pool_insert(pool, handle);
-    pthread_mutex_unlock(&pool->lock);
+        id = internal_handle_pool_insert(pool, shard, handle, hash);
+    pthread_mutex_unlock(&shard->lock);
     return id;
 }
 
+void nw_handle_pool_lookup_or_insert_n(struct nw_handle_pool *pool, void **ids,
+                                       const void *const *handles, size_t n) {
+    for (size_t i = 0; i < n; i++)
+        ids[i] = nw_handle_pool_lookup_or_insert(pool, handles[i]);
+}
+
 GPtrArray * nw_handle_pool_get_live_handles(struct nw_handle_pool *pool) {
-    pthread_mutex_lock(&pool->lock);
-    GPtrArray *ret = g_ptr_array_sized_new(g_hash_table_size(pool->to_id));
-    GHashTableIter iter;
-    gpointer key;
-    g_hash_table_iter_init (&iter, pool->to_id);
-    while (g_hash_table_iter_next (&iter, &key, NULL))
-    {
-        g_ptr_array_add(ret, key);
+    GPtrArray *ret = g_ptr_array_new();
+    for (int i = 0; i < handle_shard_count; i++) {
+        struct handle_shard *shard = &pool->shards[i];
+        pthread_mutex_lock(&shard->lock);
+        struct handle_table *table = atomic_load(&shard->table);
+        for (size_t j = 0; j < table->capacity; j++) {
+            void *key = atomic_load_explicit(&table->slots[j].handle, memory_order_relaxed);
+            if (key != NULL && key != handle_tombstone)
+                g_ptr_array_add(ret, key);
+        }
+        pthread_mutex_unlock(&shard->lock);
     }
-    pthread_mutex_unlock(&pool->lock);
     return ret;
 }
 
@@ -127,22 +357,42 @@ void* nw_handle_pool_deref(struct nw_handle_pool *pool,
      * and this will probably change in the future. */
     if (id == NULL || pool == NULL || !is_handle(id))
         return (void*)id;
-    pthread_mutex_lock(&pool->lock);
-    void* handle = g_hash_table_lookup(pool->to_handle, id);
+    _Atomic(void*) *slot = id_index_slot(pool, id, 0);
+    void* handle = slot == NULL ? NULL : atomic_load_explicit(slot, memory_order_acquire);
     assert(handle != NULL);
-    pthread_mutex_unlock(&pool->lock);
-    return handle;
+    // Calls which use a poisoned ID are not executed (see nw_handle_pool_poisoned).
+    return handle == handle_poison ? NULL : handle;
+}
+
+void nw_handle_pool_deref_n(struct nw_handle_pool *pool, void **handles,
+                            const void *const *ids, size_t n) {
+    for (size_t i = 0; i < n; i++)
+        handles[i] = nw_handle_pool_deref(pool, ids[i]);
 }
 
 void* nw_handle_pool_deref_and_remove(struct nw_handle_pool *pool,
                                       const void* id) {
     if (id == NULL || pool == NULL)
         return (void*)id;
-    pthread_mutex_lock(&pool->lock);
-    void* handle = nw_hash_table_steal_value(pool->to_handle, id);
+    _Atomic(void*) *slot = id_index_slot(pool, id, 0);
+    void* handle = slot == NULL ? NULL : atomic_exchange(slot, NULL);
     assert(handle != NULL);
-    AVA_CHECK_RET(g_hash_table_remove(pool->to_id, handle));
-    pthread_mutex_unlock(&pool->lock);
+    if (handle == handle_poison) {
+        pthread_mutex_lock(&pool->poisons_lock);
+        g_hash_table_remove(pool->poisons, id);
+        pthread_mutex_unlock(&pool->poisons_lock);
+        return NULL;
+    }
+
+    uint64_t hash = handle_hash(handle);
+    struct handle_shard *shard = handle_shard(pool, hash);
+    pthread_mutex_lock(&shard->lock);
+    struct handle_slot *s = handle_table_find(atomic_load_explicit(&shard->table, memory_order_relaxed), handle, hash);
+    AVA_CHECK_RET(atomic_load_explicit(&s->handle, memory_order_relaxed) == handle);
+    // Lookups which already found the slot may still return the old ID, as if they ran before the removal.
+    atomic_store_explicit(&s->handle, handle_tombstone, memory_order_release);
+    shard->live--;
+    pthread_mutex_unlock(&shard->lock);
     return handle;
 }
 
@@ -152,24 +402,75 @@ void nw_handle_pool_assign_handle(struct nw_handle_pool *pool,
     if (id == NULL || pool == NULL)
         return;
 
-    pthread_mutex_lock(&pool->lock);
     update_next_id((uintptr_t) id);
 
-    // Check that there is not already a handle with this ID
-    void* old_handle = g_hash_table_lookup(pool->to_handle, id);
-    assert((old_handle == NULL || old_handle == handle) && "Handle ID assigned to a different handle during replay");
+    // Insert the handle if it is not already present, and check that there is not already a different handle with
+    // this ID.
+    _Atomic(void*) *slot = id_index_slot(pool, id, 1);
+    void* old_handle = NULL;
+    if (!atomic_compare_exchange_strong(slot, &old_handle, (void*)handle))
+        assert(old_handle == handle && "Handle ID assigned to a different handle during replay");
     // Do not check if there is already an ID with this handle since that could happen
     // legitimately (e.g., if a handle is reused by the underlying library in the
     // replay, but not in the original execution).
 
     // Allow overwriting an old ID with this ID.
-    g_hash_table_insert(pool->to_id, (gpointer) handle, (gpointer) id);
+    uint64_t hash = handle_hash(handle);
+    struct handle_shard *shard = handle_shard(pool, hash);
+    pthread_mutex_lock(&shard->lock);
+    reverse_insert(shard, handle, hash, id);
+    pthread_mutex_unlock(&shard->lock);
+}
+
+/**
+ * Bind `id` to a poison entry instead of a handle, because the call which
+ * should have created its handle failed. `nw_handle_pool_deref` returns NULL
+ * for the ID, and `nw_handle_pool_poisoned` returns `error`, so later calls
+ * using the ID report the failure instead of executing.
+ */
+void nw_handle_pool_assign_poison(struct nw_handle_pool *pool, const void *id,
+                                  const struct ava_async_error *error) {
+    if (id == NULL || pool == NULL)
+        return;
+
+    update_next_id((uintptr_t) id);
 
-    // Insert the handle if it is not already present
-    if (old_handle == NULL)
-        g_hash_table_insert(pool->to_handle, (gpointer) id, (gpointer) handle);
+    struct ava_async_error *copy = malloc(sizeof(struct ava_async_error));
+    *copy = *error;
+    pthread_mutex_lock(&pool->poisons_lock);
+    g_hash_table_insert(pool->poisons, (void*)id, copy);
+    pthread_mutex_unlock(&pool->poisons_lock);
 
-    pthread_mutex_unlock(&pool->lock);
+    _Atomic(void*) *slot = id_index_slot(pool, id, 1);
+    void* old_handle = NULL;
+    if (!atomic_compare_exchange_strong(slot, &old_handle, handle_poison))
+        assert(old_handle == handle_poison && "Handle ID assigned to a different handle during replay");
+}
+
+int nw_handle_pool_poisoned(struct nw_handle_pool *pool, const void *id,
+                            struct ava_async_error *error) {
+    if (id == NULL || pool == NULL || !is_handle(id))
+        return 0;
+    _Atomic(void*) *slot = id_index_slot(pool, id, 0);
+    if (slot == NULL || atomic_load_explicit(slot, memory_order_acquire) != handle_poison)
+        return 0;
+    pthread_mutex_lock(&pool->poisons_lock);
+    struct ava_async_error *poison = g_hash_table_lookup(pool->poisons, id);
+    if (poison != NULL)
+        *error = *poison;
+    pthread_mutex_unlock(&pool->poisons_lock);
+    return poison != NULL;
+}
+
+/**
+ * Mint a handle ID without binding it to a handle. This is used by the guest
+ * for `ava_guest_allocated_handle` values: the worker binds the ID with
+ * `nw_handle_pool_assign_handle` when the call executes. IDs minted in the
+ * guest carry the guest's counter tag, so they never collide with IDs minted
+ * by the worker.
+ */
+void* nw_handle_pool_new_id(void) {
+    return next_id();
 }
 
 gboolean nw_hash_table_remove_flipped(gconstpointer key, GHashTable *hash_table) {
@@ -245,7 +546,7 @@ static void _ava_extract_traverse(gpointer root, struct ava_extraction_state_t*
     gboolean added = g_hash_table_add(state->dependencies, root);
     if (added) {
         struct ava_metadata_base* metadata = g_hash_table_lookup(state->metadata_map, root);
-        DEBUG_PRINT("root addr=%lx, id=%lx\n", (uintptr_t)root, (uintptr_t)g_hash_table_lookup(state->pool->to_id, root));
+        DEBUG_PRINT("root addr=%lx, id=%lx\n", (uintptr_t)root, (uintptr_t)reverse_lookup(state->pool, root));
         if (metadata == NULL)
             return;
 
@@ -406,6 +707,56 @@ struct ava_buffer_with_deallocator {
     void *buffer;
 };
 
+static __thread struct ava_async_error thread_async_error;
+
+void ava_async_error_record(uintptr_t command_id, uint32_t type_id, int64_t value)
+{
+    if (thread_async_error.failed)
+        return;
+    thread_async_error.failed = 1;
+    thread_async_error.command_id = command_id;
+    thread_async_error.type_id = type_id;
+    thread_async_error.value = value;
+}
+
+void ava_async_error_take(struct ava_async_error *error)
+{
+    *error = thread_async_error;
+    thread_async_error.failed = 0;
+}
+
+static enum ava_async_error_policy async_error_policy;
+static pthread_once_t async_error_policy_once = PTHREAD_ONCE_INIT;
+
+static void init_async_error_policy(void)
+{
+    const char *policy = getenv("AVA_ASYNC_ERROR_POLICY");
+    if (policy == NULL || strcmp(policy, "return") == 0)
+        async_error_policy = AVA_ASYNC_ERROR_RETURN;
+    else if (strcmp(policy, "log") == 0)
+        async_error_policy = AVA_ASYNC_ERROR_LOG;
+    else if (strcmp(policy, "abort") == 0)
+        async_error_policy = AVA_ASYNC_ERROR_ABORT;
+    else {
+        fprintf(stderr, "Unknown AVA_ASYNC_ERROR_POLICY \"%s\" (expected return, log, or abort)\n", policy);
+        async_error_policy = AVA_ASYNC_ERROR_RETURN;
+    }
+}
+
+int ava_async_error_report(const struct ava_async_error *error, const char *function_name, int can_return)
+{
+    if (!error->failed)
+        return 0;
+    pthread_once(&async_error_policy_once, init_async_error_policy);
+    if (async_error_policy == AVA_ASYNC_ERROR_RETURN && can_return)
+        return 1;
+    fprintf(stderr, "An asynchronous call (command %lu) failed with %lld. Reported at %s.\n",
+            (unsigned long)error->command_id, (long long)error->value, function_name);
+    if (async_error_policy == AVA_ASYNC_ERROR_ABORT)
+        abort_with_reason("Asynchronous call failed");
+    return 0;
+}
+
 struct ava_buffer_with_deallocator *ava_buffer_with_deallocator_new(void (*deallocator)(void *), void *buffer)
 {
     struct ava_buffer_with_deallocator *ret = malloc(sizeof(struct ava_buffer_with_deallocator));
@@ -442,7 +793,7 @@ struct ava_coupled_record_t *ava_coupled_record_new()
 {
     struct ava_coupled_record_t *ret = (struct ava_coupled_record_t *)malloc(sizeof(struct ava_coupled_record_t));
     ret->key_list = g_ptr_array_new_full(1, NULL);
-    ret->buffer_list = g_ptr_array_new_full(1, (GDestroyNotify) g_array_unref);
+    ret->buffer_list = g_ptr_array_new_full(1, ava_buffer_pool_free);
     return ret;
 }
 
@@ -478,17 +829,27 @@ intptr_t ava_get_call_id(struct ava_endpoint *endpoint)
     return atomic_fetch_add(&endpoint->call_counter, 1);
 }
 
-void ava_add_call(struct ava_endpoint *endpoint, intptr_t id, void *ptr)
+intptr_t ava_add_call(struct ava_endpoint *endpoint, intptr_t number, void *ptr)
 {
+    intptr_t id = ava_call_slot_add(number, ptr);
+    if (id != 0)
+        return id;
+
+    // The slot bits of the ID are 0.
+    id = number << AVA_CALL_SLOT_BITS;
     pthread_mutex_lock(&endpoint->call_map_mutex);
     gboolean b = g_hash_table_insert(endpoint->call_map, (void *)id, ptr);
     assert(b && "Adding a call ID which currently exists.");
     (void)b;
     pthread_mutex_unlock(&endpoint->call_map_mutex);
+    return id;
 }
 
 void *ava_remove_call(struct ava_endpoint *endpoint, intptr_t id)
 {
+    if (id & AVA_CALL_SLOT_MASK)
+        return ava_call_slot_remove(id);
+
     pthread_mutex_lock(&endpoint->call_map_mutex);
     void *ptr = nw_hash_table_steal_value(endpoint->call_map, (void *)id);
     assert(ptr != NULL && "Removing a call ID which does not exist");
@@ -510,30 +871,47 @@ void *ava_cached_alloc(struct ava_endpoint *endpoint, int call_id, const void *c
 {
     pthread_mutex_lock(&endpoint->managed_buffer_map_mutex);
     struct call_id_and_handle_t key = { call_id, coupled };
-    GArray *buffer = (GArray *) g_hash_table_lookup(endpoint->managed_buffer_map, &key);
-    if (buffer == NULL) {
-        buffer = g_array_sized_new(FALSE, TRUE, 1, size);
-        struct call_id_and_handle_t *pkey = (struct call_id_and_handle_t *)malloc(sizeof(struct call_id_and_handle_t));
-        *pkey = key;
+    gpointer pkey;
+    void *buffer;
+    if (!g_hash_table_lookup_extended(endpoint->managed_buffer_map, &key, &pkey, &buffer)) {
+        buffer = ava_buffer_pool_alloc(size);
+        memset(buffer, 0, size);
+        pkey = malloc(sizeof(struct call_id_and_handle_t));
+        *(struct call_id_and_handle_t *)pkey = key;
         g_hash_table_insert(endpoint->managed_buffer_map, pkey, buffer);
         struct ava_coupled_record_t *rec = ava_get_coupled_record_unlocked(endpoint, coupled);
         g_ptr_array_add(rec->key_list, pkey);
         g_ptr_array_add(rec->buffer_list, buffer);
+    } else if (size > ava_buffer_pool_size(buffer)) {
+        // TODO: This will probably never shrink the buffer. We may need to implement that for large changes.
+        size_t old_size = ava_buffer_pool_size(buffer);
+        void *larger = ava_buffer_pool_alloc(size);
+        memcpy(larger, buffer, old_size);
+        memset((char *)larger + old_size, 0, size - old_size);
+        // Steal the entry to keep the key, which is also in the key list.
+        g_hash_table_steal(endpoint->managed_buffer_map, pkey);
+        g_hash_table_insert(endpoint->managed_buffer_map, pkey, larger);
+        GPtrArray *buffers = ava_get_coupled_record_unlocked(endpoint, coupled)->buffer_list;
+        for (guint i = 0; i < buffers->len; i++) {
+            if (g_ptr_array_index(buffers, i) == buffer)
+                g_ptr_array_index(buffers, i) = larger;
+        }
+        ava_buffer_pool_free(buffer);
+        buffer = larger;
     }
-    // TODO: This will probably never shrink the buffer. We may need to implement that for large changes.
-    g_array_set_size(buffer, size);
     pthread_mutex_unlock(&endpoint->managed_buffer_map_mutex);
-    return buffer->data;
+    return buffer;
 }
 
 void *ava_uncached_alloc(struct ava_endpoint *endpoint, const void *coupled, size_t size)
 {
+    void *buffer = ava_buffer_pool_alloc(size);
+    memset(buffer, 0, size);
     pthread_mutex_lock(&endpoint->managed_buffer_map_mutex);
-    GArray *buffer = g_array_sized_new(FALSE, TRUE, 1, size);
     struct ava_coupled_record_t *rec = ava_get_coupled_record_unlocked(endpoint, coupled);
     g_ptr_array_add(rec->buffer_list, buffer);
     pthread_mutex_unlock(&endpoint->managed_buffer_map_mutex);
-    return buffer->data;
+    return buffer;
 }
 
 void ava_coupled_free(struct ava_endpoint *endpoint, const void *coupled)
@@ -548,6 +926,26 @@ void *ava_static_alloc(struct ava_endpoint *endpoint, int call_id, size_t size)
     return ava_cached_alloc(endpoint, call_id, NULL, size);
 }
 
+const void *ava_zcopy_select(struct ava_endpoint *endpoint, const void *data, size_t size, size_t threshold,
+                             void **staging)
+{
+    struct ava_zcopy_region *region = endpoint->zcopy_region;
+    *staging = NULL;
+    if (region == NULL || data == NULL || size == 0)
+        return NULL;
+    if (ava_zcopy_region_contains(region, data, size))
+        return data;
+    if (size < threshold)
+        return NULL;
+    // Fall back to copying into the command if the region is full.
+    void *copy = ava_zcopy_region_alloc(region, size);
+    if (copy == NULL)
+        return NULL;
+    memcpy(copy, data, size);
+    *staging = copy;
+    return copy;
+}
+
 void ava_add_recorded_call(struct ava_endpoint *endpoint, void *handle, struct ava_offset_pair_t *pair)
 {
     pthread_mutex_lock(&metadata_map_mutex);
@@ -584,6 +982,8 @@ void ava_add_dependency(struct ava_endpoint *endpoint, void *a, void *b)
     pthread_mutex_unlock(&metadata_map_mutex);
 }
 
+static void ava_shadow_record_free(struct ava_shadow_record_t *record);
+
 void ava_endpoint_init(struct ava_endpoint *endpoint, size_t metadata_size, uint8_t counter_tag, struct ava_zcopy_region*zcopy_region)
 {
     assert(counter_tag == (counter_tag & 0xf) && "Only the low 4 bits of the tag may be used.");
@@ -591,6 +991,8 @@ void ava_endpoint_init(struct ava_endpoint *endpoint, size_t metadata_size, uint
 
     endpoint->metadata_size = metadata_size;
     endpoint->zcopy_region = zcopy_region;
+    endpoint->zcopy_threshold = ava_getenv_size("AVA_ZCOPY_THRESHOLD", AVA_ZCOPY_DEFAULT_THRESHOLD);
+    endpoint->shadow_block_size = ava_getenv_size("AVA_SHADOW_BLOCK_SIZE", AVA_SHADOW_DEFAULT_BLOCK_SIZE);
 
 #ifdef AVA_BENCHMARKING_MIGRATE
     endpoint->migration_call_id = -1;
@@ -611,8 +1013,7 @@ void ava_endpoint_init(struct ava_endpoint *endpoint, size_t metadata_size, uint
 #endif
 
     endpoint->managed_buffer_map =
-            g_hash_table_new_full(nw_hash_call_id_and_handle, nw_equal_call_id_and_handle, free,
-                                  (GDestroyNotify) g_array_unref);
+            g_hash_table_new_full(nw_hash_call_id_and_handle, nw_equal_call_id_and_handle, free, NULL);
     endpoint->managed_by_coupled_map =
             g_hash_table_new_full(nw_hash_pointer, g_direct_equal, NULL, (GDestroyNotify) ava_coupled_record_free);
     // endpoint->metadata_map = metadata_map_new();
@@ -624,7 +1025,7 @@ void ava_endpoint_init(struct ava_endpoint *endpoint, size_t metadata_size, uint
     // shadow_buffers
     pthread_mutex_init(&endpoint->shadow_buffers.mutex, NULL);
     endpoint->shadow_buffers.buffers_by_id =
-            g_hash_table_new_full(nw_hash_pointer, g_direct_equal, NULL, free);
+            g_hash_table_new_full(nw_hash_pointer, g_direct_equal, NULL, (GDestroyNotify)ava_shadow_record_free);
 }
 
 void ava_endpoint_destroy(struct ava_endpoint *endpoint)
@@ -695,8 +1096,161 @@ struct ava_shadow_record_t {
     ava_deallocator deallocator;
     void *id;
     void *local;
+    /* The digests of the blocks of the buffer as of its last transfer, or NULL if they are unknown. */
+    uint64_t *digests;
+    /* The size of the buffer and of the blocks when the digests were computed. */
+    size_t digests_size;
+    size_t block_size;
+    /* The version of the buffer the digests describe (see `ava_buffer_header_t`), or 0 if it is unknown. */
+    uintptr_t version;
+    /* The value of `shadow_epoch` when the digests were computed. Older digests are ignored. */
+    unsigned long epoch;
+};
+
+/* The choice made by `ava_shadow_buffer_delta_size` for a buffer which has not been attached yet. */
+struct ava_shadow_delta_plan_t {
+    const void *local;
+    size_t size;
+    size_t block_size;
+    /* The digests of the blocks of `local`, which become the digests of the record once it is attached. */
+    uint64_t *digests;
+    /* The changed ranges (`struct ava_shadow_buffer_range_t`), or NULL if the whole buffer is sent. */
+    GArray *ranges;
+    /* True if the digests and versions have been committed to the record of `local`. */
+    int committed;
+    uintptr_t version;
+    uintptr_t base_version;
 };
 
+/* The plans of the calling thread, in the order their sizes were computed. */
+static __thread GPtrArray *pending_delta_plans;
+
+/* True if a retryable delta received by this thread did not apply to the local version of its buffer. */
+static __thread int shadow_delta_missed;
+
+/* Incremented by `ava_shadow_buffer_reset_digests` to invalidate the digests of all records. */
+static atomic_ulong shadow_epoch;
+
+static atomic_ulong shadow_full_transfers;
+static atomic_ulong shadow_delta_transfers;
+static atomic_ulong shadow_bytes_sent;
+static atomic_ulong shadow_bytes_saved;
+static atomic_ulong shadow_delta_misses;
+
+static void ava_shadow_record_free(struct ava_shadow_record_t *record)
+{
+    free(record->digests);
+    free(record);
+}
+
+static uint64_t ava_shadow_block_digest(const void *data, size_t size)
+{
+    uint64_t digest[2];
+    MurmurHash3_x64_128(data, (int)size, 0x5bd1e995, digest);
+    return digest[0];
+}
+
+/**
+ * Compute the digests of the blocks of `data` from `offset` to `offset + size` (rounded out to whole blocks).
+ */
+static void ava_shadow_digest_blocks(uint64_t *digests, const void *data, size_t data_size, size_t block_size,
+                                     size_t offset, size_t size)
+{
+    size_t end = offset + size;
+    for (size_t i = offset / block_size; i * block_size < end; i++) {
+        size_t block_start = i * block_size;
+        size_t n = data_size - block_start < block_size ? data_size - block_start : block_size;
+        digests[i] = ava_shadow_block_digest((const char *)data + block_start, n);
+    }
+}
+
+/**
+ * Replace the digests of `record` with the digests of `data`.
+ */
+static void ava_shadow_record_track_unlocked(struct ava_shadow_record_t *record, const void *data, size_t size,
+                                             size_t block_size)
+{
+    free(record->digests);
+    record->digests = malloc((size + block_size - 1) / block_size * sizeof(uint64_t));
+    record->digests_size = size;
+    record->block_size = block_size;
+    ava_shadow_digest_blocks(record->digests, data, size, block_size, 0, size);
+}
+
+static void ava_shadow_record_forget_unlocked(struct ava_shadow_record_t *record)
+{
+    free(record->digests);
+    record->digests = NULL;
+    record->version = 0;
+}
+
+/**
+ * @return True if the digests of `record` describe the current version of a buffer of `size` bytes.
+ */
+static int ava_shadow_record_tracked_unlocked(const struct ava_shadow_record_t *record, size_t size,
+                                              size_t block_size)
+{
+    return record->digests != NULL && record->digests_size == size && record->block_size == block_size &&
+           record->epoch == atomic_load(&shadow_epoch);
+}
+
+/**
+ * Make the digests of `plan` the digests of `record`, as a new version of the buffer.
+ */
+static void ava_shadow_delta_plan_commit_unlocked(struct ava_shadow_delta_plan_t *plan,
+                                                  struct ava_shadow_record_t *record)
+{
+    plan->base_version = record->version;
+    plan->version = (uintptr_t)next_id();
+    plan->committed = 1;
+    free(record->digests);
+    record->digests = plan->digests;
+    record->digests_size = plan->size;
+    record->block_size = plan->block_size;
+    record->version = plan->version;
+    record->epoch = atomic_load(&shadow_epoch);
+    plan->digests = NULL;
+}
+
+static void ava_shadow_delta_plan_free(struct ava_shadow_delta_plan_t *plan)
+{
+    free(plan->digests);
+    if (plan->ranges != NULL)
+        g_array_free(plan->ranges, TRUE);
+    free(plan);
+}
+
+static size_t ava_shadow_delta_plan_size(struct command_channel *chan, const struct ava_shadow_delta_plan_t *plan)
+{
+    size_t ret = command_channel_buffer_size(chan, sizeof(struct ava_buffer_header_t));
+    if (plan->ranges == NULL)
+        return ret + command_channel_buffer_size(chan, plan->size);
+    ret += command_channel_buffer_size(chan, sizeof(struct ava_shadow_buffer_delta_t) +
+                                             plan->ranges->len * sizeof(struct ava_shadow_buffer_range_t));
+    for (guint i = 0; i < plan->ranges->len; i++)
+        ret += command_channel_buffer_size(chan, g_array_index(plan->ranges, struct ava_shadow_buffer_range_t, i).size);
+    return ret;
+}
+
+/**
+ * Remove and return the first plan of the calling thread for `local`, or NULL.
+ */
+static struct ava_shadow_delta_plan_t *ava_shadow_delta_plan_take(const void *local, size_t size)
+{
+    if (pending_delta_plans == NULL)
+        return NULL;
+    for (guint i = 0; i < pending_delta_plans->len; i++) {
+        struct ava_shadow_delta_plan_t *plan = g_ptr_array_index(pending_delta_plans, i);
+        if (plan->local == local) {
+            assert(plan->size == size && "The size of a shadow buffer changed between its size computation and its "
+                                         "attachment.");
+            g_ptr_array_remove_index(pending_delta_plans, i);
+            return plan;
+        }
+    }
+    return NULL;
+}
+
 void *ava_shadow_buffer_get_unlocked(struct ava_endpoint *endpoint, void *id, size_t size,
                             enum ava_lifetime_t lifetime, void *lifetime_coupled,
                                     ava_allocator alloc, ava_deallocator dealloc)
@@ -725,7 +1279,7 @@ struct ava_shadow_record_t *ava_shadow_buffer_new_record_unlocked(
         void* local, ava_deallocator dealloc,
         struct ava_metadata_base *metadata)
 {
-    struct ava_shadow_record_t *record = malloc(sizeof(struct ava_shadow_record_t));
+    struct ava_shadow_record_t *record = calloc(1, sizeof(struct ava_shadow_record_t));
     record->deallocator = dealloc;
     record->id = id;
     record->local = local;
@@ -831,6 +1385,58 @@ void ava_shadow_buffer_free_coupled_unlocked(struct ava_endpoint *endpoint, void
     }
 }
 
+size_t ava_shadow_buffer_delta_size(struct ava_endpoint *endpoint, struct command_channel *chan, const void *local,
+                                    size_t size, int whole)
+{
+    size_t block_size = endpoint->shadow_block_size;
+    if (block_size == 0 || size == 0)
+        return ava_shadow_buffer_size(endpoint, chan, size);
+
+    size_t block_count = (size + block_size - 1) / block_size;
+    struct ava_shadow_delta_plan_t *plan = calloc(1, sizeof(struct ava_shadow_delta_plan_t));
+    plan->local = local;
+    plan->size = size;
+    plan->block_size = block_size;
+    plan->digests = malloc(block_count * sizeof(uint64_t));
+    ava_shadow_digest_blocks(plan->digests, local, size, block_size, 0, size);
+
+    // The plan is made and committed under the lock, so every transfer is a delta of the version before it.
+    struct ava_metadata_base *metadata = ava_internal_metadata_no_create(endpoint, local);
+    pthread_mutex_lock(&endpoint->shadow_buffers.mutex);
+    struct ava_shadow_record_t *record = metadata != NULL ? metadata->shadow : NULL;
+    if (!whole && record != NULL && ava_shadow_record_tracked_unlocked(record, size, block_size)) {
+        // Coalesce the runs of changed blocks into ranges.
+        plan->ranges = g_array_new(FALSE, FALSE, sizeof(struct ava_shadow_buffer_range_t));
+        for (size_t i = 0; i < block_count; i++) {
+            if (plan->digests[i] == record->digests[i])
+                continue;
+            size_t start = i;
+            while (i + 1 < block_count && plan->digests[i + 1] != record->digests[i + 1])
+                i++;
+            size_t end = (i + 1) * block_size < size ? (i + 1) * block_size : size;
+            struct ava_shadow_buffer_range_t range = {start * block_size, end - start * block_size};
+            g_array_append_val(plan->ranges, range);
+        }
+    }
+
+    size_t ret = ava_shadow_delta_plan_size(chan, plan);
+    if (plan->ranges != NULL && ret >= ava_shadow_buffer_size(endpoint, chan, size)) {
+        // Too much changed: send the whole buffer.
+        g_array_free(plan->ranges, TRUE);
+        plan->ranges = NULL;
+        ret = ava_shadow_delta_plan_size(chan, plan);
+    }
+    // A buffer without a record is committed when its record is created by `ava_shadow_buffer_attach_buffer`.
+    if (record != NULL)
+        ava_shadow_delta_plan_commit_unlocked(plan, record);
+    pthread_mutex_unlock(&endpoint->shadow_buffers.mutex);
+
+    if (pending_delta_plans == NULL)
+        pending_delta_plans = g_ptr_array_new();
+    g_ptr_array_add(pending_delta_plans, plan);
+    return ret;
+}
+
 void *
 ava_shadow_buffer_attach_buffer(struct ava_endpoint *endpoint, struct command_channel *chan, struct command_base *cmd,
                                 const void *local, const void *data_buffer, size_t size,
@@ -841,14 +1447,60 @@ ava_shadow_buffer_attach_buffer(struct ava_endpoint *endpoint, struct command_ch
     ava_shadow_buffer_new_solid(endpoint, (void*)local, size, lifetime, alloc, dealloc);
     struct ava_metadata_base *metadata = ava_internal_metadata(endpoint, local);
     assert(metadata->shadow != NULL && "The shadow buffer should have already been created.");
-    header->id = (void *) metadata->shadow->id;
-    header->has_data = 1;
+    struct ava_shadow_delta_plan_t *plan = ava_shadow_delta_plan_take(local, size);
+    if (plan != NULL && data_buffer != local)
+        abort_with_reason("Only buffers attached as themselves can be sent as deltas.");
+
+    pthread_mutex_lock(&endpoint->shadow_buffers.mutex);
+    struct ava_shadow_record_t *record = metadata->shadow;
+    header->id = (void *) record->id;
     header->size = size;
+    if (plan == NULL) {
+        header->has_data = AVA_SHADOW_BUFFER_FULL;
+        header->version = 0;
+        header->base_version = 0;
+        ava_shadow_record_forget_unlocked(record);
+    } else {
+        header->has_data = plan->ranges == NULL ? AVA_SHADOW_BUFFER_FULL_TRACKED : AVA_SHADOW_BUFFER_DELTA;
+        // The receiver will have the data the digests were computed from.
+        if (!plan->committed)
+            ava_shadow_delta_plan_commit_unlocked(plan, record);
+        header->version = plan->version;
+        header->base_version = plan->base_version;
+    }
+    pthread_mutex_unlock(&endpoint->shadow_buffers.mutex);
+
     // TODO: This relies on the fact that buffers are allocated contiguously in some larger space which is available to the command receiver.
     void *header_offset = command_channel_attach_buffer(chan, cmd, header, sizeof(struct ava_buffer_header_t));
-    void *buffer_offset = command_channel_attach_buffer(chan, cmd, data_buffer, size);
+    void *buffer_offset;
+    if (header->has_data != AVA_SHADOW_BUFFER_DELTA) {
+        buffer_offset = command_channel_attach_buffer(chan, cmd, data_buffer, size);
+        atomic_fetch_add(&shadow_full_transfers, 1);
+        atomic_fetch_add(&shadow_bytes_sent, size);
+    } else {
+        size_t delta_size = sizeof(struct ava_shadow_buffer_delta_t) +
+                            plan->ranges->len * sizeof(struct ava_shadow_buffer_range_t);
+        struct ava_shadow_buffer_delta_t *delta = malloc(delta_size);
+        delta->range_count = plan->ranges->len;
+        memcpy(delta->ranges, plan->ranges->data, plan->ranges->len * sizeof(struct ava_shadow_buffer_range_t));
+        buffer_offset = command_channel_attach_buffer(chan, cmd, delta, delta_size);
+        size_t sent = 0;
+        for (uint64_t i = 0; i < delta->range_count; i++) {
+            command_channel_attach_buffer(chan, cmd, (const char *)data_buffer + delta->ranges[i].offset,
+                                          delta->ranges[i].size);
+            sent += delta->ranges[i].size;
+        }
+        atomic_fetch_add(&shadow_delta_transfers, 1);
+        atomic_fetch_add(&shadow_bytes_sent, sent);
+        atomic_fetch_add(&shadow_bytes_saved, size - sent);
+        DEBUG_PRINT("shadow buffer: Sending delta: id=%#lx, %ld ranges, %ld of %ld bytes\n",
+                    (long int)header->id, (long int)delta->range_count, (long int)sent, (long int)size);
+        free(delta);
+    }
     assert(buffer_offset - header_offset == sizeof(struct ava_buffer_header_t));
     (void)header_offset;
+    if (plan != NULL)
+        ava_shadow_delta_plan_free(plan);
     return buffer_offset;
 }
 
@@ -866,28 +1518,112 @@ ava_shadow_buffer_attach_buffer_without_data(struct ava_endpoint *endpoint, stru
     header->id = (void *) metadata->shadow->id;
     header->has_data = 0;
     header->size = size;
+    header->version = 0;
+    header->base_version = 0;
     // TODO: This relies on the fact that buffers are allocated contiguously in some larger space which is available to the command receiver.
     void *header_offset = command_channel_attach_buffer(chan, cmd, header, sizeof(struct ava_buffer_header_t));
     return header_offset + sizeof(struct ava_buffer_header_t);
 }
 
+/**
+ * Copy the ranges of a delta transfer into `local` and update the digests of its record.
+ */
+static void ava_shadow_buffer_apply_delta_unlocked(struct ava_endpoint *endpoint, struct command_channel *chan,
+                                                   struct ava_shadow_record_t *record,
+                                                   const struct ava_shadow_buffer_delta_t *delta, size_t size)
+{
+    const char *data = (const char *)delta + command_channel_buffer_size(chan,
+            sizeof(struct ava_shadow_buffer_delta_t) + delta->range_count * sizeof(struct ava_shadow_buffer_range_t));
+    int tracked = ava_shadow_record_tracked_unlocked(record, size, endpoint->shadow_block_size);
+    for (uint64_t i = 0; i < delta->range_count; i++) {
+        const struct ava_shadow_buffer_range_t *range = &delta->ranges[i];
+        assert(range->offset + range->size <= size);
+        memcpy((char *)record->local + range->offset, data, range->size);
+        data += command_channel_buffer_size(chan, range->size);
+        if (tracked)
+            ava_shadow_digest_blocks(record->digests, record->local, size, record->block_size, range->offset,
+                                     range->size);
+    }
+    if (!tracked && endpoint->shadow_block_size != 0)
+        ava_shadow_record_track_unlocked(record, record->local, size, endpoint->shadow_block_size);
+    record->epoch = atomic_load(&shadow_epoch);
+}
+
 void *
 ava_shadow_buffer_get_buffer(struct ava_endpoint *endpoint, struct command_channel *chan, struct command_base *cmd,
                              void *offset, enum ava_lifetime_t lifetime, void *lifetime_coupled, size_t *size_out,
-                             ava_allocator alloc, ava_deallocator dealloc)
+                             ava_allocator alloc, ava_deallocator dealloc, int retryable)
 {
     assert(lifetime != AVA_CALL);
     struct ava_buffer_header_t *header = command_channel_get_buffer(chan, cmd,
                                                                     offset - sizeof(struct ava_buffer_header_t));
-    // void *data = ((void *) header) + sizeof(struct ava_buffer_header_t);
+    void *data = ((void *) header) + sizeof(struct ava_buffer_header_t);
     if (size_out)
         *size_out = header->size;
+    // A delta for a buffer which does not exist on this side is applied to a new zeroed buffer of version 0.
     void *shadow = ava_shadow_buffer_new_shadow(endpoint, header->id, header->size, lifetime, lifetime_coupled, alloc,
                                                 dealloc);
-    // memcpy(shadow, data, header->size);
+
+    pthread_mutex_lock(&endpoint->shadow_buffers.mutex);
+    struct ava_shadow_record_t *record = g_hash_table_lookup(endpoint->shadow_buffers.buffers_by_id, header->id);
+    switch (header->has_data) {
+    case AVA_SHADOW_BUFFER_FULL:
+        ava_shadow_record_forget_unlocked(record);
+        break;
+    case AVA_SHADOW_BUFFER_FULL_TRACKED:
+        // The data is copied into the shadow buffer by the caller.
+        if (endpoint->shadow_block_size != 0) {
+            ava_shadow_record_track_unlocked(record, data, header->size, endpoint->shadow_block_size);
+            record->version = header->version;
+            record->epoch = atomic_load(&shadow_epoch);
+        }
+        break;
+    case AVA_SHADOW_BUFFER_DELTA:
+        if (record->version == header->base_version && record->version != 0 &&
+            record->epoch == atomic_load(&shadow_epoch)) {
+            ava_shadow_buffer_apply_delta_unlocked(endpoint, chan, record, data, header->size);
+            record->version = header->version;
+            break;
+        }
+        atomic_fetch_add(&shadow_delta_misses, 1);
+        DEBUG_PRINT("shadow buffer: Delta for another version: id=%#lx, base=%#lx, local=%#lx\n",
+                    (long int)header->id, (long int)header->base_version, (long int)record->version);
+        if (retryable) {
+            // The sender sends the command again with the whole buffer.
+            shadow_delta_missed = 1;
+        } else {
+            // Keep what changed, but the rest of the buffer may be stale, so it must be sent whole next time.
+            ava_shadow_buffer_apply_delta_unlocked(endpoint, chan, record, data, header->size);
+            ava_shadow_record_forget_unlocked(record);
+        }
+        break;
+    }
+    pthread_mutex_unlock(&endpoint->shadow_buffers.mutex);
     return shadow;
 }
 
+int ava_shadow_buffer_take_miss(void)
+{
+    int ret = shadow_delta_missed;
+    shadow_delta_missed = 0;
+    return ret;
+}
+
+void ava_shadow_buffer_reset_digests(void)
+{
+    atomic_fetch_add(&shadow_epoch, 1);
+}
+
+const void *ava_shadow_buffer_get_data(struct command_channel *chan, struct command_base *cmd, void *offset,
+                                       const void *local)
+{
+    const struct ava_buffer_header_t *header = command_channel_get_buffer(chan, cmd,
+                                                                          offset - sizeof(struct ava_buffer_header_t));
+    if (header->has_data == AVA_SHADOW_BUFFER_DELTA)
+        return local;
+    return ((const void *) header) + sizeof(struct ava_buffer_header_t);
+}
+
 void ava_shadow_buffer_free(struct ava_endpoint *endpoint, void *local)
 {
     pthread_mutex_lock(&endpoint->shadow_buffers.mutex);
@@ -928,3 +1664,29 @@ void ava_shadow_buffer_free_coupled(struct ava_endpoint *endpoint, void *obj)
     ava_shadow_buffer_free_coupled_unlocked(endpoint, obj);
     pthread_mutex_unlock(&endpoint->shadow_buffers.mutex);
 }
+
+void ava_shadow_buffer_get_stats(struct ava_shadow_buffer_stats *stats)
+{
+    stats->full_transfers = shadow_full_transfers;
+    stats->delta_transfers = shadow_delta_transfers;
+    stats->bytes_sent = shadow_bytes_sent;
+    stats->bytes_saved = shadow_bytes_saved;
+    stats->delta_misses = shadow_delta_misses;
+}
+
+void ava_shadow_buffer_print_stats(FILE *file)
+{
+    struct ava_shadow_buffer_stats stats;
+    ava_shadow_buffer_get_stats(&stats);
+    uint64_t total = stats.bytes_sent + stats.bytes_saved;
+    fprintf(file, "Shadow buffers: %lu full and %lu delta transfers, %lu bytes sent, %lu bytes saved (%.1f%%), "
+            "%lu delta misses\n",
+            (unsigned long)stats.full_transfers, (unsigned long)stats.delta_transfers,
+            (unsigned long)stats.bytes_sent, (unsigned long)stats.bytes_saved,
+            total > 0 ? 100.0 * stats.bytes_saved / total : 0.0, (unsigned long)stats.delta_misses);
+}
+
+static void __attribute__ ((constructor)) register_shadow_buffer_stats(void)
+{
+    ava_stats_register("AVA_SHADOW_STATS", ava_shadow_buffer_print_stats);
+}
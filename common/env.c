@@ -0,0 +1,11 @@
+#include <stdlib.h>
+
+#include "common/env.h"
+#include "common/linkage.h"
+
+EXPORTED_WEAKLY size_t ava_getenv_size(const char *name, size_t default_value) {
+    const char *s = getenv(name);
+    if (s == NULL || *s == '\0')
+        return default_value;
+    return strtoull(s, NULL, 0);
+}
@@ -0,0 +1,313 @@
+#include <assert.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <glib.h>
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include "common/cmd_channel.h"
+#include "common/debug.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/memoize.h"
+#include "common/stats.h"
+
+#define DEFAULT_MAX_SIZE (1024L * 1024 * 1024)
+#define FILE_MAGIC 0x4f4d4541  // "AEMO"
+
+/* The length of the hexadecimal file name of a key, including the terminator. */
+#define NAME_SIZE (sizeof(struct ava_memoize_key) * 2 + 1)
+
+struct ava_memoize_file_header {
+    uint32_t magic;
+    uint32_t reserved;
+    uint64_t command_size;
+    uint64_t region_size;
+};
+
+struct ava_memoize_entry {
+    char name[NAME_SIZE];
+    uint64_t size;
+    /* The link of this entry in `lru`. `link.data` points to the entry. */
+    GList link;
+};
+
+static pthread_once_t memoize_init_once = PTHREAD_ONCE_INIT;
+static char *cache_dir;
+static uint64_t max_size;
+
+static pthread_mutex_t memoize_lock = PTHREAD_MUTEX_INITIALIZER;
+/* Maps file names to entries. */
+static GHashTable *entries;
+/* The entries from the most to the least recently used. */
+static GQueue lru = G_QUEUE_INIT;
+static struct ava_memoize_stats memoize_stats;
+
+static void key_name(const struct ava_memoize_key *key, char name[NAME_SIZE]) {
+    for (size_t i = 0; i < sizeof(key->hash); i++)
+        snprintf(name + i * 2, NAME_SIZE - i * 2, "%02x", key->hash[i]);
+}
+
+static char *entry_path(const char *name) {
+    return g_build_filename(cache_dir, name, NULL);
+}
+
+static gint compare_mtime(gconstpointer a, gconstpointer b) {
+    const struct stat *sa = a, *sb = b;
+    if (sa->st_mtime != sb->st_mtime)
+        return sa->st_mtime < sb->st_mtime ? -1 : 1;
+    return 0;
+}
+
+/**
+ * Add an entry as the most recently used. The caller must hold `memoize_lock`.
+ */
+static void entry_add(const char *name, uint64_t size) {
+    struct ava_memoize_entry *entry = g_hash_table_lookup(entries, name);
+    if (entry != NULL) {
+        memoize_stats.size -= entry->size;
+        g_queue_unlink(&lru, &entry->link);
+    } else {
+        entry = malloc(sizeof(struct ava_memoize_entry));
+        strncpy(entry->name, name, NAME_SIZE);
+        entry->link.data = entry;
+        entry->link.prev = entry->link.next = NULL;
+        g_hash_table_insert(entries, entry->name, entry);
+    }
+    entry->size = size;
+    memoize_stats.size += size;
+    g_queue_push_head_link(&lru, &entry->link);
+}
+
+/**
+ * Remove an entry and its file. The caller must hold `memoize_lock`.
+ */
+static void entry_remove(struct ava_memoize_entry *entry, int unlink_file) {
+    if (unlink_file) {
+        char *path = entry_path(entry->name);
+        unlink(path);
+        g_free(path);
+    }
+    memoize_stats.size -= entry->size;
+    g_queue_unlink(&lru, &entry->link);
+    g_hash_table_remove(entries, entry->name);
+}
+
+/**
+ * Check that the cache directory is a directory which only the current user can access, so other users can neither
+ * plant replies nor read them.
+ * @return True (non-zero) if the directory is safe to use.
+ */
+static int cache_dir_private(void) {
+    struct stat st;
+    if (lstat(cache_dir, &st) != 0) {
+        fprintf(stderr, "Cannot access memoization cache directory %s: %s\n", cache_dir, strerror(errno));
+        return 0;
+    }
+    if (!S_ISDIR(st.st_mode) || st.st_uid != geteuid() || (st.st_mode & 0777) != 0700) {
+        fprintf(stderr, "Memoization cache directory %s must be a directory owned by the current user with mode 0700\n",
+                cache_dir);
+        return 0;
+    }
+    return 1;
+}
+
+/**
+ * Index the entries already in the cache directory, ordered by modification time.
+ */
+static void memoize_init(void) {
+    const char *dir = getenv("AVA_MEMOIZE_DIR");
+    if (dir != NULL && *dir != '\0')
+        cache_dir = g_strdup(dir);
+    else
+        cache_dir = g_build_filename(g_get_user_cache_dir(), "ava", "memoize", NULL);
+    max_size = ava_getenv_size("AVA_MEMOIZE_MAX_SIZE", DEFAULT_MAX_SIZE);
+    entries = g_hash_table_new_full(g_str_hash, g_str_equal, NULL, free);
+    if (max_size == 0)
+        return;
+
+    if (g_mkdir_with_parents(cache_dir, 0700) != 0) {
+        fprintf(stderr, "Cannot create memoization cache directory %s: %s\n", cache_dir, strerror(errno));
+        max_size = 0;
+        return;
+    }
+    if (!cache_dir_private()) {
+        max_size = 0;
+        return;
+    }
+
+    GDir *d = g_dir_open(cache_dir, 0, NULL);
+    if (d == NULL)
+        return;
+    GArray *files = g_array_new(FALSE, FALSE, sizeof(struct stat));
+    GPtrArray *names = g_ptr_array_new_with_free_func(g_free);
+    const char *name;
+    while ((name = g_dir_read_name(d)) != NULL) {
+        struct stat st;
+        char *path = entry_path(name);
+        if (strlen(name) == NAME_SIZE - 1 && lstat(path, &st) == 0 && S_ISREG(st.st_mode)) {
+            // Keep the index of the name in st_ino, since the stats are sorted below.
+            st.st_ino = names->len;
+            g_array_append_val(files, st);
+            g_ptr_array_add(names, g_strdup(name));
+        }
+        g_free(path);
+    }
+    g_dir_close(d);
+
+    g_array_sort(files, compare_mtime);
+    pthread_mutex_lock(&memoize_lock);
+    for (guint i = 0; i < files->len; i++) {
+        struct stat *st = &g_array_index(files, struct stat, i);
+        entry_add(g_ptr_array_index(names, st->st_ino), st->st_size);
+    }
+    pthread_mutex_unlock(&memoize_lock);
+    g_array_free(files, TRUE);
+    g_ptr_array_unref(names);
+    DEBUG_PRINT("Memoization cache %s: %u replies, %lu bytes\n", cache_dir, g_hash_table_size(entries),
+                (unsigned long)memoize_stats.size);
+}
+
+EXPORTED_WEAKLY void ava_memoize_key(const struct command_channel *chan, const struct command_base *call,
+                                     size_t header_size, struct ava_memoize_key *key) {
+    // The cached reply is sent in place of executing the call, so the key must be collision resistant.
+    GChecksum *checksum = g_checksum_new(G_CHECKSUM_SHA256);
+    g_checksum_update(checksum, (const guchar *)&call->api_id, sizeof(call->api_id));
+    g_checksum_update(checksum, (const guchar *)&call->command_id, sizeof(call->command_id));
+    g_checksum_update(checksum, (const guchar *)&call->region_size, sizeof(call->region_size));
+    g_checksum_update(checksum, (const guchar *)call + header_size, call->command_size - header_size);
+    if (call->region_size > 0)
+        g_checksum_update(checksum, command_channel_get_data_region(chan, call), call->region_size);
+    gsize key_size = sizeof(key->hash);
+    g_checksum_get_digest(checksum, key->hash, &key_size);
+    g_checksum_free(checksum);
+    assert(key_size == sizeof(key->hash));
+}
+
+/**
+ * Open a file in the cache directory without following symbolic links.
+ * @return The file, or NULL if it cannot be opened.
+ */
+static FILE *open_entry(const char *path, int flags, const char *mode) {
+    int fd = open(path, flags | O_NOFOLLOW | O_CLOEXEC, 0600);
+    if (fd < 0)
+        return NULL;
+    FILE *file = fdopen(fd, mode);
+    if (file == NULL)
+        close(fd);
+    return file;
+}
+
+EXPORTED_WEAKLY struct command_base *ava_memoize_load(struct command_channel *chan,
+                                                      const struct ava_memoize_key *key) {
+    pthread_once(&memoize_init_once, memoize_init);
+    if (max_size == 0)
+        return NULL;
+
+    char name[NAME_SIZE];
+    key_name(key, name);
+    char *path = entry_path(name);
+    struct command_base *ret = NULL;
+    struct ava_memoize_file_header header;
+    FILE *file = open_entry(path, O_RDONLY, "rb");
+    if (file != NULL && fread(&header, sizeof(header), 1, file) == 1 && header.magic == FILE_MAGIC &&
+        header.command_size >= sizeof(struct command_base)) {
+        ret = command_channel_new_command(chan, header.command_size, header.region_size);
+        void *region = header.region_size > 0 ? malloc(header.region_size) : NULL;
+        if (fread((char *)ret + sizeof(struct command_base), header.command_size - sizeof(struct command_base), 1,
+                  file) != 1 ||
+            (region != NULL && fread(region, header.region_size, 1, file) != 1)) {
+            command_channel_free_command(chan, ret);
+            ret = NULL;
+        } else if (region != NULL) {
+            // The buffer IDs in the reply are offsets in the data region, which are preserved by
+            // attaching the whole region as one buffer.
+            command_channel_attach_buffer(chan, ret, region, header.region_size);
+        }
+        free(region);
+    }
+    if (file != NULL)
+        fclose(file);
+
+    pthread_mutex_lock(&memoize_lock);
+    if (ret != NULL) {
+        memoize_stats.hits++;
+        entry_add(name, sizeof(header) + header.command_size + header.region_size);
+    } else {
+        memoize_stats.misses++;
+        // Another worker may have evicted the reply.
+        struct ava_memoize_entry *entry = g_hash_table_lookup(entries, name);
+        if (entry != NULL)
+            entry_remove(entry, 0);
+    }
+    pthread_mutex_unlock(&memoize_lock);
+
+    if (ret != NULL)
+        utimensat(AT_FDCWD, path, NULL, AT_SYMLINK_NOFOLLOW);
+    g_free(path);
+    return ret;
+}
+
+EXPORTED_WEAKLY void ava_memoize_store(const struct command_channel *chan, const struct command_base *ret,
+                                       const struct ava_memoize_key *key) {
+    pthread_once(&memoize_init_once, memoize_init);
+    struct ava_memoize_file_header header = {FILE_MAGIC, 0, ret->command_size, ret->region_size};
+    uint64_t size = sizeof(header) + header.command_size + header.region_size;
+    if (size > max_size)
+        return;
+
+    char name[NAME_SIZE];
+    key_name(key, name);
+    char *path = entry_path(name);
+    // Write to a temporary file and rename it, so other workers never read a partial reply.
+    char *tmp_path = g_strdup_printf("%s.%d.%lx.tmp", path, getpid(), (unsigned long)pthread_self());
+    FILE *file = open_entry(tmp_path, O_WRONLY | O_CREAT | O_EXCL, "wb");
+    int ok = file != NULL && fwrite(&header, sizeof(header), 1, file) == 1 &&
+             fwrite((const char *)ret + sizeof(struct command_base), header.command_size - sizeof(struct command_base),
+                    1, file) == 1 &&
+             (header.region_size == 0 ||
+              fwrite(command_channel_get_data_region(chan, ret), header.region_size, 1, file) == 1);
+    if (file != NULL && fclose(file) != 0)
+        ok = 0;
+    if (ok && rename(tmp_path, path) != 0)
+        ok = 0;
+    if (!ok) {
+        DEBUG_PRINT("Cannot write memoized reply %s: %s\n", path, strerror(errno));
+        unlink(tmp_path);
+    }
+    g_free(tmp_path);
+    g_free(path);
+    if (!ok)
+        return;
+
+    pthread_mutex_lock(&memoize_lock);
+    memoize_stats.stores++;
+    entry_add(name, size);
+    while (memoize_stats.size > max_size) {
+        memoize_stats.evictions++;
+        entry_remove(g_queue_peek_tail(&lru), 1);
+    }
+    pthread_mutex_unlock(&memoize_lock);
+}
+
+EXPORTED_WEAKLY void ava_memoize_get_stats(struct ava_memoize_stats *stats) {
+    pthread_mutex_lock(&memoize_lock);
+    *stats = memoize_stats;
+    pthread_mutex_unlock(&memoize_lock);
+}
+
+EXPORTED_WEAKLY void ava_memoize_print_stats(FILE *file) {
+    struct ava_memoize_stats stats;
+    ava_memoize_get_stats(&stats);
+    fprintf(file, "Memoization: %lu hits, %lu misses, %lu stores, %lu evictions, %lu bytes\n",
+            (unsigned long)stats.hits, (unsigned long)stats.misses, (unsigned long)stats.stores,
+            (unsigned long)stats.evictions, (unsigned long)stats.size);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_MEMOIZE_STATS", ava_memoize_print_stats);
+}
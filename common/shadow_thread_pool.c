@@ -4,21 +4,41 @@
 
 #include <stdio.h>
 #include <assert.h>
+#include <stdatomic.h>
+#include <string.h>
+#include "common/async_batch.h"
 #include "common/endpoint_lib.h"
 #include "common/cmd_handler.h"
 #include "common/debug.h"
 #include "common/linkage.h"
 #include "common/shadow_thread_pool.h"
+#include "common/spsc_ring.h"
+
+/* The number of commands each thread's ring holds before commands overflow into its queue. */
+#define RING_CAPACITY 1024
 
 struct shadow_thread_pool_t {
     GHashTable *threads; /* Keys are ava IDs, values are shadow_thread_t* */
+    GHashTable *channels; /* Keys are ava IDs, values are the shadow_thread_t* of their thread channels */
     pthread_mutex_t lock;
     pthread_key_t key;
+    /* Non-zero if commands are handed off through rings instead of only through queues. */
+    int use_rings;
 };
 
 struct shadow_thread_t {
     intptr_t ava_id;
+    /* Commands are pushed under the pool lock, so the ring has a single producer. NULL if the pool
+     * does not use rings. */
+    struct ava_spsc_ring *ring;
+    /* Holds the commands which did not fit in the ring. */
     GAsyncQueue *queue;
+    /* The number of commands in `queue`. Commands go to the queue while it is not empty, so they
+     * are handled in order. */
+    atomic_uint overflow;
+    /* The thread channel this thread receives its commands from, instead of the pool, or NULL.
+     * Owned by the thread (see thread_channel.h). */
+    struct command_channel *chan;
     pthread_t thread;
     struct shadow_thread_pool_t *pool;
 };
@@ -35,7 +55,10 @@ struct shadow_thread_t* shadow_thread_new(struct shadow_thread_pool_t *pool, int
     DEBUG_PRINT("Creating shadow thread id = %lx\n", ava_id);
     struct shadow_thread_t* t = malloc(sizeof(struct shadow_thread_t));
     t->ava_id = ava_id;
+    t->ring = pool->use_rings ? ava_spsc_ring_new(RING_CAPACITY) : NULL;
     t->queue = g_async_queue_new_full(NULL);
+    atomic_init(&t->overflow, 0);
+    t->chan = NULL;
     t->pool = pool;
     int r = pthread_create(&t->thread, NULL, shadow_thread_loop, t);
     assert(r == 0);
@@ -53,10 +76,15 @@ struct shadow_thread_t* shadow_thread_self(struct shadow_thread_pool_t *pool) {
         intptr_t ava_id = (intptr_t)pthread_self(); // TODO: This may not work correctly on non-Linux
         assert(g_hash_table_lookup(pool->threads, (gpointer) ava_id) == NULL);
         t->ava_id = ava_id;
+        t->ring = pool->use_rings ? ava_spsc_ring_new(RING_CAPACITY) : NULL;
         t->queue = g_async_queue_new_full(NULL);
+        atomic_init(&t->overflow, 0);
+        t->chan = NULL;
         t->pool = pool;
         t->thread = pthread_self();
+        pthread_mutex_lock(&pool->lock);
         gboolean r = g_hash_table_insert(pool->threads, (gpointer) ava_id, t);
+        pthread_mutex_unlock(&pool->lock);
         assert(r);
         (void)r;
         pthread_setspecific(pool->key, t);
@@ -64,26 +92,91 @@ struct shadow_thread_t* shadow_thread_self(struct shadow_thread_pool_t *pool) {
     return t;
 }
 
+struct shadow_thread_t* shadow_thread_new_on_channel(struct shadow_thread_pool_t *pool, intptr_t ava_id,
+                                                     struct command_channel *chan) {
+    DEBUG_PRINT("Creating shadow thread id = %lx on its own channel\n", ava_id);
+    struct shadow_thread_t* t = malloc(sizeof(struct shadow_thread_t));
+    t->ava_id = ava_id;
+    t->ring = NULL;
+    t->queue = NULL;
+    atomic_init(&t->overflow, 0);
+    t->chan = chan;
+    t->pool = pool;
+    // The thread is not in the table: it only handles the commands of its channel.
+    pthread_mutex_lock(&pool->lock);
+    g_hash_table_insert(pool->channels, (gpointer) ava_id, t);
+    pthread_mutex_unlock(&pool->lock);
+    int r = pthread_create(&t->thread, NULL, shadow_thread_loop, t);
+    assert(r == 0);
+    (void)r;
+    return t;
+}
+
+struct command_channel* shadow_thread_channel(struct shadow_thread_pool_t *pool) {
+    struct shadow_thread_t *t = shadow_thread_self(pool);
+    if (t->chan != NULL)
+        return t->chan;
+    // The remote thread only receives from its thread channel, so commands with its ID must go
+    // there, even if they are sent by another thread with the same ID.
+    pthread_mutex_lock(&pool->lock);
+    struct shadow_thread_t *owner = g_hash_table_lookup(pool->channels, (gpointer) t->ava_id);
+    struct command_channel *chan = owner != NULL ? owner->chan : NULL;
+    pthread_mutex_unlock(&pool->lock);
+    return chan;
+}
+
+void shadow_thread_set_channel(struct shadow_thread_pool_t *pool, struct command_channel *chan) {
+    struct shadow_thread_t *t = shadow_thread_self(pool);
+    pthread_mutex_lock(&pool->lock);
+    assert(t->chan == NULL);
+    t->chan = chan;
+    pthread_mutex_unlock(&pool->lock);
+}
+
+void shadow_thread_pool_foreach_channel(struct shadow_thread_pool_t *pool,
+                                        void (*func)(struct command_channel *chan, intptr_t ava_id, void *arg),
+                                        void *arg) {
+    pthread_mutex_lock(&pool->lock);
+    GHashTableIter iter;
+    gpointer value;
+    g_hash_table_iter_init(&iter, pool->threads);
+    while (g_hash_table_iter_next(&iter, NULL, &value)) {
+        struct shadow_thread_t *t = value;
+        if (t->chan != NULL)
+            func(t->chan, t->ava_id, arg);
+    }
+    pthread_mutex_unlock(&pool->lock);
+}
+
 void shadow_thread_free_from_thread(struct shadow_thread_t*t) {
     pthread_mutex_lock(&t->pool->lock);
 
     // If our ID is the same as the local thread reference then we must be a solid (instead of shadow) thread.
     // If we are solid, send a command to exit the shadow.
     if (t->ava_id == t->thread) {
-        struct command_base *cmd = command_channel_new_command(
-                nw_global_command_channel, sizeof(struct command_base), 0);
+        struct command_channel *chan = t->chan != NULL ? t->chan : nw_global_command_channel;
+        ava_async_batch_flush(chan, AVA_BATCH_FLUSH_THREAD_EXIT);
+        struct command_base *cmd = command_channel_new_command(chan, sizeof(struct command_base), 0);
         cmd->api_id = COMMAND_HANDLER_API;
         cmd->command_id = COMMAND_HANDLER_THREAD_EXIT;
         cmd->thread_id = t->ava_id;
-        command_channel_send_command(nw_global_command_channel, cmd);
+        command_channel_send_command(chan, cmd);
     }
 
-    // Drop this thread from the pool.
-    g_hash_table_remove(t->pool->threads, (gpointer) t->ava_id);
+    // Drop this thread from the pool. Shadow threads of thread channels are not in it.
+    if (g_hash_table_lookup(t->pool->threads, (gpointer) t->ava_id) == t)
+        g_hash_table_remove(t->pool->threads, (gpointer) t->ava_id);
+    if (g_hash_table_lookup(t->pool->channels, (gpointer) t->ava_id) == t)
+        g_hash_table_remove(t->pool->channels, (gpointer) t->ava_id);
     pthread_mutex_unlock(&t->pool->lock);
 
-    g_async_queue_unref(t->queue);
+    if (t->queue != NULL)
+        g_async_queue_unref(t->queue);
     t->queue = NULL;
+    if (t->ring != NULL)
+        ava_spsc_ring_free(t->ring);
+    if (t->chan != NULL)
+        command_channel_free(t->chan);
     free(t);
 }
 
@@ -93,8 +186,11 @@ struct shadow_thread_pool_t* shadow_thread_pool_new() {
             nw_hash_pointer,
             g_direct_equal,
             NULL, NULL);
+    pool->channels = g_hash_table_new(nw_hash_pointer, g_direct_equal);
     pthread_key_create(&pool->key, (void (*)(void *)) shadow_thread_free_from_thread);
     pthread_mutex_init(&pool->lock, NULL);
+    const char *queue = getenv("AVA_SHADOW_QUEUE");
+    pool->use_rings = queue == NULL || *queue == '\0' || strcmp(queue, "async_queue") != 0;
     return pool;
 }
 
@@ -103,13 +199,40 @@ intptr_t shadow_thread_id(struct shadow_thread_pool_t *pool) {
     return t->ava_id;
 }
 
+/**
+ * Take the next command for this thread, waiting for one if there is none.
+ */
+static struct shadow_thread_command_t *shadow_thread_pop(struct shadow_thread_t *t) {
+    if (t->ring == NULL)
+        return g_async_queue_pop(t->queue);
+
+    while (1) {
+        uint32_t sequence = ava_spsc_ring_sequence(t->ring);
+        uint64_t value;
+        // The ring holds the commands older than the ones in the queue.
+        if (ava_spsc_ring_try_pop(t->ring, &value))
+            return (struct shadow_thread_command_t *)(uintptr_t)value;
+        if (atomic_load(&t->overflow) > 0) {
+            atomic_fetch_sub(&t->overflow, 1);
+            return g_async_queue_pop(t->queue);
+        }
+        ava_spsc_ring_wait(t->ring, sequence);
+    }
+}
+
 int shadow_thread_handle_single_command(struct shadow_thread_pool_t *pool) {
     struct shadow_thread_t *t = shadow_thread_self(pool);
-    struct shadow_thread_command_t *scmd = g_async_queue_pop(t->queue);
-
-    struct command_channel *chan = scmd->chan;
-    struct command_base *cmd = scmd->cmd;
-    free(scmd);
+    struct command_channel *chan;
+    struct command_base *cmd;
+    if (t->chan != NULL) {
+        chan = t->chan;
+        cmd = command_channel_receive_command(chan);
+    } else {
+        struct shadow_thread_command_t *scmd = shadow_thread_pop(t);
+        chan = scmd->chan;
+        cmd = scmd->cmd;
+        free(scmd);
+    }
 
     if (cmd->api_id == COMMAND_HANDLER_API && cmd->command_id == COMMAND_HANDLER_THREAD_EXIT) {
         command_channel_free_command(chan, cmd);
@@ -136,6 +259,7 @@ static void* shadow_thread_loop(void *arg) {
 void shadow_thread_pool_free(struct shadow_thread_pool_t *pool) {
     pthread_mutex_lock(&pool->lock);
     g_hash_table_destroy(pool->threads);
+    g_hash_table_destroy(pool->channels);
     free(pool);
 }
 
@@ -153,6 +277,12 @@ void shadow_thread_pool_dispatch(struct shadow_thread_pool_t *pool, struct comma
     struct shadow_thread_command_t* scmd = malloc(sizeof(struct shadow_thread_command_t));
     scmd->chan = chan;
     scmd->cmd = cmd;
-    g_async_queue_push(t->queue, scmd);
+    if (t->ring == NULL || atomic_load(&t->overflow) > 0 || !ava_spsc_ring_try_push(t->ring, (uintptr_t)scmd)) {
+        if (t->ring != NULL)
+            atomic_fetch_add(&t->overflow, 1);
+        g_async_queue_push(t->queue, scmd);
+        if (t->ring != NULL)
+            ava_spsc_ring_kick(t->ring);
+    }
     pthread_mutex_unlock(&pool->lock);
 }
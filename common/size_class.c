@@ -0,0 +1,333 @@
+#include <assert.h>
+#include <pthread.h>
+#include <stdlib.h>
+
+#include "common/linkage.h"
+#include "common/size_class.h"
+
+/* The number of operations a thread counts before adding its counters to the global ones. */
+#define STATS_PERIOD 256
+
+/* A free block holds the link to the next one. */
+struct free_block {
+    struct free_block *next;
+};
+
+struct class_cache {
+    struct free_block *head;
+    uint32_t count;
+};
+
+struct thread_cache {
+    struct ava_size_class_pool *pool;
+    struct thread_cache *next;
+    struct thread_cache *prev;
+    /* The counters of the thread which are not in the pool counters yet. */
+    uint32_t operations;
+    uint64_t allocations;
+    uint64_t frees;
+    int64_t requested_bytes;
+    int64_t used_bytes;
+    struct class_cache classes[];
+};
+
+struct depot {
+    pthread_mutex_t lock;
+    struct free_block *head;
+};
+
+struct ava_size_class_pool {
+    struct ava_size_class_config config;
+    unsigned alignment_shift;
+    uint32_t small_classes;
+    uint32_t class_count;
+    pthread_key_t thread_key;
+    /* The thread caches, so they can be dropped with the pool. Protected by `lock`. */
+    struct thread_cache *caches;
+    pthread_mutex_t lock;
+    struct depot depots[];
+};
+
+static void fold_stats(struct ava_size_class_pool *pool, struct thread_cache *cache) {
+    struct ava_size_class_counters *counters = pool->config.counters;
+    atomic_fetch_add_explicit(&counters->allocations, cache->allocations, memory_order_relaxed);
+    atomic_fetch_add_explicit(&counters->frees, cache->frees, memory_order_relaxed);
+    atomic_fetch_add_explicit(&counters->requested_bytes, cache->requested_bytes, memory_order_relaxed);
+    atomic_fetch_add_explicit(&counters->used_bytes, cache->used_bytes, memory_order_relaxed);
+    cache->operations = 0;
+    cache->allocations = cache->frees = 0;
+    cache->requested_bytes = cache->used_bytes = 0;
+}
+
+static inline void count_operation(struct ava_size_class_pool *pool, struct thread_cache *cache) {
+    if (++cache->operations >= STATS_PERIOD)
+        fold_stats(pool, cache);
+}
+
+static uint32_t batch_count(struct ava_size_class_pool *pool, uint32_t class_index) {
+    size_t count = pool->config.batch_size / ava_size_class_size(pool, class_index);
+    return count < 1 ? 1 : count > pool->config.max_batch ? pool->config.max_batch : count;
+}
+
+static uint32_t cache_limit(struct ava_size_class_pool *pool, uint32_t class_index) {
+    size_t limit = pool->config.cache_size / ava_size_class_size(pool, class_index);
+    uint32_t batch = batch_count(pool, class_index);
+    return limit < 2 * batch ? 2 * batch : limit;
+}
+
+/**
+ * Move the blocks of `class_cache` to the depot of `class_index`.
+ */
+static void class_cache_release(struct ava_size_class_pool *pool, struct class_cache *class_cache,
+                                uint32_t class_index) {
+    if (class_cache->head == NULL)
+        return;
+    struct free_block *tail = class_cache->head;
+    while (tail->next != NULL)
+        tail = tail->next;
+    struct depot *depot = &pool->depots[class_index];
+    pthread_mutex_lock(&depot->lock);
+    tail->next = depot->head;
+    depot->head = class_cache->head;
+    pthread_mutex_unlock(&depot->lock);
+    class_cache->head = NULL;
+    class_cache->count = 0;
+}
+
+static void thread_cache_release(struct ava_size_class_pool *pool, struct thread_cache *cache) {
+    for (uint32_t c = 0; c < pool->class_count; c++)
+        class_cache_release(pool, &cache->classes[c], c);
+}
+
+static void thread_cache_free(void *arg) {
+    struct thread_cache *cache = arg;
+    struct ava_size_class_pool *pool = cache->pool;
+    thread_cache_release(pool, cache);
+    fold_stats(pool, cache);
+    pthread_mutex_lock(&pool->lock);
+    if (cache->prev != NULL)
+        cache->prev->next = cache->next;
+    else
+        pool->caches = cache->next;
+    if (cache->next != NULL)
+        cache->next->prev = cache->prev;
+    pthread_mutex_unlock(&pool->lock);
+    free(cache);
+}
+
+static struct thread_cache *get_thread_cache(struct ava_size_class_pool *pool) {
+    struct thread_cache *cache = pthread_getspecific(pool->thread_key);
+    if (cache == NULL) {
+        cache = calloc(1, sizeof(struct thread_cache) + pool->class_count * sizeof(struct class_cache));
+        cache->pool = pool;
+        pthread_setspecific(pool->thread_key, cache);
+        pthread_mutex_lock(&pool->lock);
+        cache->next = pool->caches;
+        if (cache->next != NULL)
+            cache->next->prev = cache;
+        pool->caches = cache;
+        pthread_mutex_unlock(&pool->lock);
+    }
+    return cache;
+}
+
+/**
+ * Fill the empty cache of a class from the depot, or from a new chunk if the depot is empty. The
+ * blocks of a new chunk which do not fit in a batch go to the depot.
+ */
+static void refill(struct ava_size_class_pool *pool, struct class_cache *class_cache, uint32_t class_index) {
+    uint32_t batch = batch_count(pool, class_index);
+
+    struct depot *depot = &pool->depots[class_index];
+    pthread_mutex_lock(&depot->lock);
+    while (depot->head != NULL && class_cache->count < batch) {
+        struct free_block *block = depot->head;
+        depot->head = block->next;
+        block->next = class_cache->head;
+        class_cache->head = block;
+        class_cache->count++;
+    }
+    pthread_mutex_unlock(&depot->lock);
+    if (class_cache->count > 0)
+        return;
+
+    size_t stride = pool->config.header_size + ava_size_class_size(pool, class_index);
+    size_t chunk_size = pool->config.chunk_size != 0 ? pool->config.chunk_size : batch * stride;
+    char *chunk = pool->config.chunk_alloc(pool->config.context, chunk_size, class_index);
+    if (chunk == NULL)
+        return;
+    uint32_t count = chunk_size / stride;
+    struct free_block *rest = NULL;
+    for (uint32_t i = count; i-- > 0;) {
+        struct free_block *block = (struct free_block *)(chunk + i * stride + pool->config.header_size);
+        if (i < batch) {
+            block->next = class_cache->head;
+            class_cache->head = block;
+        } else {
+            block->next = rest;
+            rest = block;
+        }
+    }
+    class_cache->count = count < batch ? count : batch;
+    if (rest != NULL) {
+        struct class_cache rest_cache = {rest, count - class_cache->count};
+        class_cache_release(pool, &rest_cache, class_index);
+    }
+}
+
+/**
+ * Move a batch of blocks from the full cache of a class to the depot.
+ */
+static void flush(struct ava_size_class_pool *pool, struct class_cache *class_cache, uint32_t class_index) {
+    uint32_t batch = batch_count(pool, class_index);
+    struct free_block *first = class_cache->head;
+    struct free_block *last = first;
+    for (uint32_t i = 1; i < batch; i++)
+        last = last->next;
+    class_cache->head = last->next;
+    class_cache->count -= batch;
+
+    struct depot *depot = &pool->depots[class_index];
+    pthread_mutex_lock(&depot->lock);
+    last->next = depot->head;
+    depot->head = first;
+    pthread_mutex_unlock(&depot->lock);
+}
+
+EXPORTED_WEAKLY struct ava_size_class_pool *ava_size_class_pool_new(const struct ava_size_class_config *config) {
+    assert(config->alignment != 0 && (config->alignment & (config->alignment - 1)) == 0 &&
+           "The alignment must be a power of 2");
+    assert(config->alignment <= ((size_t)1 << config->small_shift) >> 2 && config->small_shift <= config->max_shift);
+    uint32_t small_classes = ((size_t)1 << config->small_shift) / config->alignment;
+    uint32_t class_count = small_classes + (config->max_shift - config->small_shift) * 4;
+    struct ava_size_class_pool *pool = calloc(1, sizeof(struct ava_size_class_pool) + class_count * sizeof(struct depot));
+    if (pool == NULL)
+        return NULL;
+    pool->config = *config;
+    pool->alignment_shift = __builtin_ctzl(config->alignment);
+    pool->small_classes = small_classes;
+    pool->class_count = class_count;
+    for (uint32_t c = 0; c < class_count; c++)
+        pthread_mutex_init(&pool->depots[c].lock, NULL);
+    pthread_mutex_init(&pool->lock, NULL);
+    pthread_key_create(&pool->thread_key, thread_cache_free);
+    return pool;
+}
+
+EXPORTED_WEAKLY void ava_size_class_pool_free(struct ava_size_class_pool *pool) {
+    pthread_mutex_lock(&pool->lock);
+    // The caches of the threads which are still running are dropped with the pool.
+    pthread_key_delete(pool->thread_key);
+    while (pool->caches != NULL) {
+        struct thread_cache *cache = pool->caches;
+        pool->caches = cache->next;
+        fold_stats(pool, cache);
+        free(cache);
+    }
+    pthread_mutex_unlock(&pool->lock);
+    for (uint32_t c = 0; c < pool->class_count; c++)
+        pthread_mutex_destroy(&pool->depots[c].lock);
+    pthread_mutex_destroy(&pool->lock);
+    free(pool);
+}
+
+EXPORTED_WEAKLY uint32_t ava_size_class_count_classes(struct ava_size_class_pool *pool) {
+    return pool->class_count;
+}
+
+EXPORTED_WEAKLY uint32_t ava_size_class_index(struct ava_size_class_pool *pool, size_t size) {
+    unsigned small_shift = pool->config.small_shift;
+    if (size <= ((size_t)1 << small_shift))
+        return size == 0 ? 0 : (size - 1) >> pool->alignment_shift;
+    // size is in (2^k, 2^(k+1)], which is split in 4 classes.
+    unsigned k = 63 - __builtin_clzl(size - 1);
+    return pool->small_classes + (k - small_shift) * 4 + (((size - 1) >> (k - 2)) & 3);
+}
+
+EXPORTED_WEAKLY size_t ava_size_class_size(struct ava_size_class_pool *pool, uint32_t class_index) {
+    if (class_index < pool->small_classes)
+        return (size_t)(class_index + 1) << pool->alignment_shift;
+    class_index -= pool->small_classes;
+    return (size_t)(5 + class_index % 4) << (pool->config.small_shift + class_index / 4 - 2);
+}
+
+EXPORTED_WEAKLY void *ava_size_class_alloc(struct ava_size_class_pool *pool, uint32_t class_index, size_t requested) {
+    assert(class_index < pool->class_count);
+    struct thread_cache *cache = get_thread_cache(pool);
+    cache->allocations++;
+    count_operation(pool, cache);
+
+    struct class_cache *class_cache = &cache->classes[class_index];
+    if (class_cache->head == NULL) {
+        refill(pool, class_cache, class_index);
+        if (class_cache->head == NULL) {
+            // Return the free blocks of this thread, so the backing allocator may reuse their memory.
+            thread_cache_release(pool, cache);
+            refill(pool, class_cache, class_index);
+        }
+        if (class_cache->head == NULL)
+            return NULL;
+    }
+    struct free_block *block = class_cache->head;
+    class_cache->head = block->next;
+    class_cache->count--;
+    cache->requested_bytes += requested;
+    cache->used_bytes += ava_size_class_size(pool, class_index);
+    return block;
+}
+
+EXPORTED_WEAKLY void ava_size_class_free(struct ava_size_class_pool *pool, void *block, uint32_t class_index,
+                                         size_t requested) {
+    assert(class_index < pool->class_count);
+    struct thread_cache *cache = get_thread_cache(pool);
+    cache->frees++;
+    count_operation(pool, cache);
+    cache->requested_bytes -= requested;
+    cache->used_bytes -= ava_size_class_size(pool, class_index);
+
+    struct class_cache *class_cache = &cache->classes[class_index];
+    struct free_block *free_block = block;
+    free_block->next = class_cache->head;
+    class_cache->head = free_block;
+    if (++class_cache->count >= cache_limit(pool, class_index))
+        flush(pool, class_cache, class_index);
+}
+
+EXPORTED_WEAKLY void ava_size_class_count(struct ava_size_class_pool *pool, uint64_t allocations, uint64_t frees,
+                                          int64_t used_bytes) {
+    struct thread_cache *cache = get_thread_cache(pool);
+    cache->allocations += allocations;
+    cache->frees += frees;
+    cache->used_bytes += used_bytes;
+    count_operation(pool, cache);
+}
+
+EXPORTED_WEAKLY void ava_size_class_release_thread(struct ava_size_class_pool *pool) {
+    thread_cache_release(pool, get_thread_cache(pool));
+}
+
+EXPORTED_WEAKLY void ava_size_class_flush_stats(struct ava_size_class_pool *pool) {
+    struct thread_cache *cache = pthread_getspecific(pool->thread_key);
+    if (cache != NULL)
+        fold_stats(pool, cache);
+}
+
+EXPORTED_WEAKLY void ava_size_class_reclaim(struct ava_size_class_pool *pool,
+                                            void (*visit)(void *context, void *block, uint32_t class_index),
+                                            int (*remove)(void *context, void *block, uint32_t class_index),
+                                            void *context) {
+    for (uint32_t c = 0; c < pool->class_count; c++) {
+        struct depot *depot = &pool->depots[c];
+        pthread_mutex_lock(&depot->lock);
+        for (struct free_block *block = depot->head; block != NULL; block = block->next)
+            visit(context, block, c);
+        struct free_block **link = &depot->head;
+        while (*link != NULL) {
+            if (remove(context, *link, c))
+                *link = (*link)->next;
+            else
+                link = &(*link)->next;
+        }
+        pthread_mutex_unlock(&depot->lock);
+    }
+}
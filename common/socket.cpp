@@ -2,6 +2,7 @@
 
 #include <errno.h>
 #include <fcntl.h>
+#include <limits.h>
 #include <netinet/tcp.h>
 #include <stdio.h>
 #include <string.h>
@@ -234,6 +235,132 @@ size_t recv_socket(int sockfd, void *buf, size_t size)
     return size;
 }
 
+/* Skip the first `n` bytes of the list of buffers `*iov` and any empty buffers after them. */
+static void advance_iov(struct iovec **iov, int *iovcnt, size_t n)
+{
+    while (*iovcnt > 0 && n >= (*iov)->iov_len) {
+        n -= (*iov)->iov_len;
+        (*iov)++;
+        (*iovcnt)--;
+    }
+    if (n > 0) {
+        (*iov)->iov_base = (void *)((char *)(*iov)->iov_base + n);
+        (*iov)->iov_len -= n;
+    }
+}
+
+size_t send_socket_iov(int sockfd, struct iovec *iov, int iovcnt)
+{
+    size_t size = 0;
+    struct msghdr msg;
+    memset(&msg, 0, sizeof(msg));
+    advance_iov(&iov, &iovcnt, 0);
+    while (iovcnt > 0) {
+        msg.msg_iov = iov;
+        msg.msg_iovlen = iovcnt < IOV_MAX ? iovcnt : IOV_MAX;
+        ssize_t ret = sendmsg(sockfd, &msg, 0);
+        if (ret < 0 && errno == EINTR)
+            continue;
+        if (ret <= 0) {
+            perror("ERROR sending to socket");
+            close(sockfd);
+            exit(0);
+        }
+        size += ret;
+        advance_iov(&iov, &iovcnt, ret);
+    }
+    return size;
+}
+
+size_t recv_socket_iov(int sockfd, struct iovec *iov, int iovcnt)
+{
+    size_t size = 0;
+    struct msghdr msg;
+    memset(&msg, 0, sizeof(msg));
+    advance_iov(&iov, &iovcnt, 0);
+    while (iovcnt > 0) {
+        msg.msg_iov = iov;
+        msg.msg_iovlen = iovcnt < IOV_MAX ? iovcnt : IOV_MAX;
+        ssize_t ret = recvmsg(sockfd, &msg, MSG_WAITALL);
+        if (ret < 0 && errno == EINTR)
+            continue;
+        if (ret <= 0) {
+            perror("ERROR receiving from socket");
+            close(sockfd);
+            exit(0);
+        }
+        size += ret;
+        advance_iov(&iov, &iovcnt, ret);
+    }
+    return size;
+}
+
+size_t send_socket_fd(int sockfd, const void *buf, size_t size, int fd)
+{
+    assert(size > 0);
+    struct iovec iov = {(void *)buf, size};
+    union {
+        char buf[CMSG_SPACE(sizeof(int))];
+        struct cmsghdr align;
+    } control;
+    struct msghdr msg;
+    memset(&msg, 0, sizeof(msg));
+    msg.msg_iov = &iov;
+    msg.msg_iovlen = 1;
+    msg.msg_control = control.buf;
+    msg.msg_controllen = sizeof(control.buf);
+    struct cmsghdr *cmsg = CMSG_FIRSTHDR(&msg);
+    cmsg->cmsg_level = SOL_SOCKET;
+    cmsg->cmsg_type = SCM_RIGHTS;
+    cmsg->cmsg_len = CMSG_LEN(sizeof(int));
+    memcpy(CMSG_DATA(cmsg), &fd, sizeof(int));
+
+    ssize_t ret;
+    while ((ret = sendmsg(sockfd, &msg, 0)) < 0 && errno == EINTR)
+        ;
+    if (ret <= 0) {
+        perror("ERROR sending to socket");
+        close(sockfd);
+        exit(0);
+    }
+    // The descriptor went with the first byte, so the rest is plain data.
+    if ((size_t)ret < size)
+        send_socket(sockfd, (const char *)buf + ret, size - ret);
+    return size;
+}
+
+size_t recv_socket_fd(int sockfd, void *buf, size_t size, int *fd)
+{
+    struct iovec iov = {buf, size};
+    union {
+        char buf[CMSG_SPACE(sizeof(int))];
+        struct cmsghdr align;
+    } control;
+    struct msghdr msg;
+    memset(&msg, 0, sizeof(msg));
+    msg.msg_iov = &iov;
+    msg.msg_iovlen = 1;
+    msg.msg_control = control.buf;
+    msg.msg_controllen = sizeof(control.buf);
+
+    ssize_t ret;
+    while ((ret = recvmsg(sockfd, &msg, MSG_CMSG_CLOEXEC)) < 0 && errno == EINTR)
+        ;
+    if (ret <= 0) {
+        perror("ERROR receiving from socket");
+        close(sockfd);
+        exit(0);
+    }
+    *fd = -1;
+    for (struct cmsghdr *cmsg = CMSG_FIRSTHDR(&msg); cmsg != NULL; cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+        if (cmsg->cmsg_level == SOL_SOCKET && cmsg->cmsg_type == SCM_RIGHTS)
+            memcpy(fd, CMSG_DATA(cmsg), sizeof(int));
+    }
+    if ((size_t)ret < size)
+        recv_socket(sockfd, (char *)buf + ret, size - ret);
+    return size;
+}
+
 void parseServerAddress(const char* full_address, struct hostent** info,
                         char* ip, int* port) {
   char* port_s = strchr((char *)full_address, ':');
@@ -0,0 +1,181 @@
+#include <assert.h>
+#include <linux/futex.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/syscall.h>
+#include <unistd.h>
+
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/spsc_ring.h"
+#include "common/stats.h"
+
+#define CACHE_LINE_SIZE 64
+#define DEFAULT_MAX_SPIN 4000
+#define MIN_SPIN 16
+
+struct ava_spsc_ring {
+    /* Written by the producer. */
+    _Alignas(CACHE_LINE_SIZE) atomic_uint head;
+    /* Incremented by every push and kick. This is the futex word the consumer sleeps on. */
+    atomic_uint sequence;
+    /* The last value of `tail` seen by the producer. */
+    uint32_t cached_tail;
+
+    /* Written by the consumer. */
+    _Alignas(CACHE_LINE_SIZE) atomic_uint tail;
+    /* Non-zero while the consumer is asleep or about to sleep on `sequence`. */
+    atomic_uint waiting;
+    /* The last value of `head` seen by the consumer. */
+    uint32_t cached_head;
+    /* The current spin budget of the consumer. */
+    uint32_t spin;
+
+    /* Constant after initialization. */
+    _Alignas(CACHE_LINE_SIZE) uint32_t mask;
+    int futex_op_flags;
+    uint64_t values[];
+};
+
+static pthread_once_t ring_init_once = PTHREAD_ONCE_INIT;
+static uint32_t max_spin;
+
+static atomic_ulong spin_waits;
+static atomic_ulong futex_waits;
+
+static void ring_init(void) {
+    max_spin = ava_getenv_size("AVA_RING_SPIN", DEFAULT_MAX_SPIN);
+}
+
+static inline void cpu_relax(void) {
+#if defined(__x86_64__) || defined(__i386__)
+    __builtin_ia32_pause();
+#endif
+}
+
+static void futex_wait(struct ava_spsc_ring *ring, uint32_t value) {
+    syscall(SYS_futex, &ring->sequence, FUTEX_WAIT | ring->futex_op_flags, value, NULL, NULL, 0);
+}
+
+static void futex_wake(struct ava_spsc_ring *ring) {
+    syscall(SYS_futex, &ring->sequence, FUTEX_WAKE | ring->futex_op_flags, 1, NULL, NULL, 0);
+}
+
+static void notify(struct ava_spsc_ring *ring) {
+    // The sequentially consistent increment orders the push before the read of `waiting`, and
+    // `ava_spsc_ring_wait` orders its write of `waiting` before its last read of `sequence`, so
+    // either the consumer sees the new sequence number or the producer sees it waiting.
+    atomic_fetch_add(&ring->sequence, 1);
+    if (atomic_load(&ring->waiting))
+        futex_wake(ring);
+}
+
+EXPORTED_WEAKLY size_t ava_spsc_ring_size(uint32_t capacity) {
+    return sizeof(struct ava_spsc_ring) + capacity * sizeof(uint64_t);
+}
+
+EXPORTED_WEAKLY void ava_spsc_ring_init(struct ava_spsc_ring *ring, uint32_t capacity, int shared) {
+    pthread_once(&ring_init_once, ring_init);
+    assert(capacity > 0 && (capacity & (capacity - 1)) == 0);
+    memset(ring, 0, sizeof(struct ava_spsc_ring));
+    ring->mask = capacity - 1;
+    ring->futex_op_flags = shared ? 0 : FUTEX_PRIVATE_FLAG;
+    ring->spin = max_spin;
+}
+
+EXPORTED_WEAKLY struct ava_spsc_ring *ava_spsc_ring_new(uint32_t capacity) {
+    void *ring;
+    if (posix_memalign(&ring, CACHE_LINE_SIZE, ava_spsc_ring_size(capacity)) != 0)
+        abort();
+    ava_spsc_ring_init(ring, capacity, 0);
+    return ring;
+}
+
+EXPORTED_WEAKLY void ava_spsc_ring_free(struct ava_spsc_ring *ring) {
+    free(ring);
+}
+
+EXPORTED_WEAKLY int ava_spsc_ring_try_push(struct ava_spsc_ring *ring, uint64_t value) {
+    uint32_t head = atomic_load_explicit(&ring->head, memory_order_relaxed);
+    if (head - ring->cached_tail > ring->mask) {
+        ring->cached_tail = atomic_load_explicit(&ring->tail, memory_order_acquire);
+        if (head - ring->cached_tail > ring->mask)
+            return 0;
+    }
+    ring->values[head & ring->mask] = value;
+    atomic_store_explicit(&ring->head, head + 1, memory_order_release);
+    notify(ring);
+    return 1;
+}
+
+EXPORTED_WEAKLY int ava_spsc_ring_try_pop(struct ava_spsc_ring *ring, uint64_t *value) {
+    uint32_t tail = atomic_load_explicit(&ring->tail, memory_order_relaxed);
+    if (tail == ring->cached_head) {
+        ring->cached_head = atomic_load_explicit(&ring->head, memory_order_acquire);
+        if (tail == ring->cached_head)
+            return 0;
+    }
+    *value = ring->values[tail & ring->mask];
+    atomic_store_explicit(&ring->tail, tail + 1, memory_order_release);
+    return 1;
+}
+
+EXPORTED_WEAKLY void ava_spsc_ring_kick(struct ava_spsc_ring *ring) {
+    notify(ring);
+}
+
+EXPORTED_WEAKLY uint32_t ava_spsc_ring_sequence(const struct ava_spsc_ring *ring) {
+    return atomic_load((atomic_uint *)&ring->sequence);
+}
+
+EXPORTED_WEAKLY void ava_spsc_ring_wait(struct ava_spsc_ring *ring, uint32_t sequence) {
+    for (uint32_t i = 0; i < ring->spin; i++) {
+        if (atomic_load_explicit(&ring->sequence, memory_order_acquire) != sequence) {
+            // Spinning was enough: allow longer spins next time.
+            ring->spin = ring->spin * 2 < max_spin ? ring->spin * 2 : max_spin;
+            atomic_fetch_add_explicit(&spin_waits, 1, memory_order_relaxed);
+            return;
+        }
+        cpu_relax();
+    }
+    // Spinning was wasted: spin less next time.
+    ring->spin = ring->spin / 2 > MIN_SPIN ? ring->spin / 2 : MIN_SPIN;
+    if (ring->spin > max_spin)
+        ring->spin = max_spin;
+
+    atomic_store(&ring->waiting, 1);
+    while (atomic_load(&ring->sequence) == sequence)
+        futex_wait(ring, sequence);
+    atomic_store_explicit(&ring->waiting, 0, memory_order_relaxed);
+    atomic_fetch_add_explicit(&futex_waits, 1, memory_order_relaxed);
+}
+
+EXPORTED_WEAKLY uint64_t ava_spsc_ring_pop(struct ava_spsc_ring *ring) {
+    uint64_t value;
+    while (1) {
+        uint32_t sequence = ava_spsc_ring_sequence(ring);
+        if (ava_spsc_ring_try_pop(ring, &value))
+            return value;
+        ava_spsc_ring_wait(ring, sequence);
+    }
+}
+
+EXPORTED_WEAKLY void ava_spsc_ring_get_stats(struct ava_spsc_ring_stats *stats) {
+    stats->spin_waits = spin_waits;
+    stats->futex_waits = futex_waits;
+}
+
+EXPORTED_WEAKLY void ava_spsc_ring_print_stats(FILE *file) {
+    struct ava_spsc_ring_stats stats;
+    ava_spsc_ring_get_stats(&stats);
+    uint64_t waits = stats.spin_waits + stats.futex_waits;
+    fprintf(file, "Rings: %lu waits, %lu ended spinning (%.1f%%), %lu slept\n", (unsigned long)waits,
+            (unsigned long)stats.spin_waits, waits > 0 ? 100.0 * stats.spin_waits / waits : 0.0,
+            (unsigned long)stats.futex_waits);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_RING_STATS", ava_spsc_ring_print_stats);
+}
@@ -0,0 +1,37 @@
+#include <pthread.h>
+#include <stdlib.h>
+
+#include "common/linkage.h"
+#include "common/stats.h"
+
+struct stats_module {
+    const char *env_name;
+    ava_stats_printer print_stats;
+};
+
+/* Modules register from constructors, so the registry must not need initialization. */
+static pthread_mutex_t modules_lock = PTHREAD_MUTEX_INITIALIZER;
+static struct stats_module modules[AVA_STATS_MAX_MODULES];
+static size_t module_count;
+
+EXPORTED_WEAKLY void ava_stats_register(const char *env_name, ava_stats_printer print_stats) {
+    pthread_mutex_lock(&modules_lock);
+    if (module_count == AVA_STATS_MAX_MODULES) {
+        fprintf(stderr, "Cannot register the statistics of more than %d modules\n", AVA_STATS_MAX_MODULES);
+        abort();
+    }
+    modules[module_count].env_name = env_name;
+    modules[module_count].print_stats = print_stats;
+    module_count++;
+    pthread_mutex_unlock(&modules_lock);
+}
+
+EXPORTED_WEAKLY void ava_stats_print(FILE *file) {
+    int all = getenv("AVA_STATS") != NULL;
+    pthread_mutex_lock(&modules_lock);
+    for (size_t i = 0; i < module_count; i++) {
+        if (all || getenv(modules[i].env_name) != NULL)
+            modules[i].print_stats(file);
+    }
+    pthread_mutex_unlock(&modules_lock);
+}
@@ -0,0 +1,187 @@
+#include <assert.h>
+#include <glib.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "common/cmd_channel.h"
+#include "common/cmd_handler.h"
+#include "common/debug.h"
+#include "common/endpoint_lib.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/shadow_thread_pool.h"
+#include "common/stats.h"
+#include "common/stream.h"
+
+#define DEFAULT_CHUNK_SIZE (1024 * 1024)
+#define DEFAULT_DEPTH 4
+
+struct ava_stream {
+    int64_t id;
+    void *data;
+    size_t size;
+    size_t received;
+    /* Non-zero if `data` is a staging buffer allocated by the first chunk. */
+    int staging;
+};
+
+static pthread_once_t stream_init_once = PTHREAD_ONCE_INIT;
+static size_t chunk_size;
+static size_t depth;
+
+static atomic_long next_stream_id = 1;
+
+/* The streams being received by the calling thread, keyed by ID. */
+static __thread GHashTable *streams;
+/* The number of chunks sent by the calling thread which have not been acknowledged. */
+static __thread size_t unacked_chunks;
+
+static atomic_ulong streams_sent;
+static atomic_ulong chunks_sent;
+static atomic_ulong bytes_sent;
+static atomic_ulong send_time_us;
+
+static void stream_init(void) {
+    chunk_size = ava_getenv_size("AVA_STREAM_CHUNK_SIZE", DEFAULT_CHUNK_SIZE);
+    depth = ava_getenv_size("AVA_STREAM_DEPTH", DEFAULT_DEPTH);
+    if (chunk_size == 0)
+        chunk_size = DEFAULT_CHUNK_SIZE;
+    if (depth == 0)
+        depth = 1;
+}
+
+static void stream_free(struct ava_stream *stream) {
+    if (stream->staging)
+        free(stream->data);
+    free(stream);
+}
+
+static struct ava_stream *stream_add(int64_t stream_id, void *data, size_t size, int staging) {
+    if (streams == NULL)
+        streams = g_hash_table_new_full(g_int64_hash, g_int64_equal, NULL, (GDestroyNotify)stream_free);
+    struct ava_stream *stream = malloc(sizeof(struct ava_stream));
+    stream->id = stream_id;
+    stream->data = data;
+    stream->size = size;
+    stream->received = 0;
+    stream->staging = staging;
+    g_hash_table_insert(streams, &stream->id, stream);
+    return stream;
+}
+
+EXPORTED_WEAKLY size_t ava_stream_chunk_size(void) {
+    pthread_once(&stream_init_once, stream_init);
+    return chunk_size;
+}
+
+EXPORTED_WEAKLY int64_t ava_stream_new_id(void) {
+    return atomic_fetch_add(&next_stream_id, 1);
+}
+
+EXPORTED_WEAKLY void ava_stream_send(struct command_channel *chan, int64_t stream_id, const void *data, size_t size,
+                                     intptr_t thread_id) {
+    pthread_once(&stream_init_once, stream_init);
+    gint64 start_time = g_get_monotonic_time();
+    size_t chunks = 0;
+    for (size_t offset = 0; offset < size; offset += chunk_size) {
+        size_t n = size - offset < chunk_size ? size - offset : chunk_size;
+        // Acknowledgements are dispatched to this thread like replies.
+        shadow_thread_handle_command_until(nw_shadow_thread_pool, unacked_chunks < depth);
+
+        struct command_handler_stream_chunk_command *cmd =
+                (struct command_handler_stream_chunk_command *)command_channel_new_command(
+                        chan, sizeof(struct command_handler_stream_chunk_command), command_channel_buffer_size(chan, n));
+        cmd->base.api_id = COMMAND_HANDLER_API;
+        cmd->base.command_id = COMMAND_HANDLER_STREAM_CHUNK;
+        cmd->base.thread_id = thread_id;
+        cmd->base.original_thread_id = thread_id;
+        cmd->stream_id = stream_id;
+        cmd->total_size = size;
+        cmd->offset = offset;
+        cmd->size = n;
+        cmd->data = command_channel_attach_buffer(chan, (struct command_base *)cmd, (const char *)data + offset, n);
+        command_channel_send_command(chan, (struct command_base *)cmd);
+        unacked_chunks++;
+        chunks++;
+    }
+
+    atomic_fetch_add(&streams_sent, 1);
+    atomic_fetch_add(&chunks_sent, chunks);
+    atomic_fetch_add(&bytes_sent, size);
+    atomic_fetch_add(&send_time_us, g_get_monotonic_time() - start_time);
+    DEBUG_PRINT("Sent stream %ld: %zu bytes in %zu chunks\n", (long)stream_id, size, chunks);
+}
+
+EXPORTED_WEAKLY void ava_stream_expect(int64_t stream_id, void *dest, size_t size) {
+    stream_add(stream_id, dest, size, 0);
+}
+
+EXPORTED_WEAKLY void *ava_stream_take(int64_t stream_id, size_t size) {
+    struct ava_stream *stream = streams != NULL ? g_hash_table_lookup(streams, &stream_id) : NULL;
+    if (stream == NULL || stream->received != size) {
+        fprintf(stderr, "Stream %ld is incomplete: %zu of %zu bytes received\n", (long)stream_id,
+                stream != NULL ? stream->received : 0, size);
+        abort();
+    }
+    void *data = stream->data;
+    // The caller now owns the staging buffer.
+    g_hash_table_steal(streams, &stream_id);
+    free(stream);
+    return data;
+}
+
+EXPORTED_WEAKLY void ava_stream_forget(int64_t stream_id) {
+    if (streams != NULL)
+        g_hash_table_remove(streams, &stream_id);
+}
+
+EXPORTED_WEAKLY void ava_stream_handle_chunk(struct command_channel *chan, const struct command_base *cmd) {
+    const struct command_handler_stream_chunk_command *chunk =
+            (const struct command_handler_stream_chunk_command *)cmd;
+    struct ava_stream *stream = streams != NULL ? g_hash_table_lookup(streams, &chunk->stream_id) : NULL;
+    if (stream == NULL)
+        stream = stream_add(chunk->stream_id, malloc(chunk->total_size), chunk->total_size, 1);
+    if (chunk->offset + chunk->size > stream->size) {
+        fprintf(stderr, "Chunk [%lu, %lu) does not fit in the %zu bytes of stream %ld\n",
+                (unsigned long)chunk->offset, (unsigned long)(chunk->offset + chunk->size), stream->size,
+                (long)chunk->stream_id);
+        abort();
+    }
+    memcpy((char *)stream->data + chunk->offset, command_channel_get_buffer(chan, cmd, chunk->data), chunk->size);
+    stream->received += chunk->size;
+
+    struct command_base *ack = command_channel_new_command(chan, sizeof(struct command_base), 0);
+    ack->api_id = COMMAND_HANDLER_API;
+    ack->command_id = COMMAND_HANDLER_STREAM_ACK;
+    ack->thread_id = cmd->thread_id;
+    ack->original_thread_id = cmd->thread_id;
+    command_channel_send_command(chan, ack);
+}
+
+EXPORTED_WEAKLY void ava_stream_handle_ack(const struct command_base *cmd) {
+    (void)cmd;
+    assert(unacked_chunks > 0);
+    unacked_chunks--;
+}
+
+EXPORTED_WEAKLY void ava_stream_get_stats(struct ava_stream_stats *stats) {
+    stats->streams = streams_sent;
+    stats->chunks = chunks_sent;
+    stats->bytes = bytes_sent;
+    stats->send_time_us = send_time_us;
+}
+
+EXPORTED_WEAKLY void ava_stream_print_stats(FILE *file) {
+    struct ava_stream_stats stats;
+    ava_stream_get_stats(&stats);
+    double mib_per_s = stats.send_time_us > 0 ? (double)stats.bytes / stats.send_time_us * 1e6 / (1024 * 1024) : 0;
+    fprintf(file, "Streaming: %lu streams, %lu chunks, %lu bytes sent in %.3f s (%.1f MiB/s)\n",
+            (unsigned long)stats.streams, (unsigned long)stats.chunks, (unsigned long)stats.bytes,
+            stats.send_time_us / 1e6, mib_per_s);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_STREAM_STATS", ava_stream_print_stats);
+}
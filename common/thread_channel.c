@@ -0,0 +1,207 @@
+#include <assert.h>
+#include <glib.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdlib.h>
+
+#include "common/async_batch.h"
+#include "common/cmd_channel.h"
+#include "common/cmd_handler.h"
+#include "common/debug.h"
+#include "common/endpoint_lib.h"
+#include "common/env.h"
+#include "common/linkage.h"
+#include "common/shadow_thread_pool.h"
+#include "common/stats.h"
+#include "common/thread_channel.h"
+
+/* Non-zero if guest threads open thread channels. Cleared if a channel cannot be opened. */
+static atomic_int thread_channels_enabled;
+
+/* Serializes the barriers of the guestlib, so the markers of two barriers are in the same order
+ * on all channels and the barriers cannot wait for each other. */
+static pthread_mutex_t barrier_lock = PTHREAD_MUTEX_INITIALIZER;
+static uint64_t next_barrier_id = 1;
+
+/* The number of markers the worker handled for each pending barrier, keyed by barrier ID. */
+static GHashTable *barrier_markers;
+static pthread_mutex_t markers_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t markers_cond = PTHREAD_COND_INITIALIZER;
+
+static pthread_t server_thread;
+
+static atomic_ulong channels;
+static atomic_ulong barriers;
+static atomic_ulong barrier_wait_us;
+
+struct barrier_markers {
+    uint64_t barrier_id;
+    /* The thread which sends the barrier. */
+    intptr_t thread_id;
+    uint32_t count;
+};
+
+EXPORTED_WEAKLY void ava_thread_channel_init_guest(void) {
+    atomic_store(&thread_channels_enabled, ava_getenv_size("AVA_THREAD_CHANNELS", 0) != 0);
+}
+
+/**
+ * Accept thread channels and start a shadow thread serving each of them.
+ */
+static void *server_thread_loop(void *arg) {
+    struct command_channel *listener = arg;
+    while (1) {
+        struct command_channel *chan = command_channel_new_thread_channel(listener);
+        if (chan == NULL)
+            break;
+
+        struct command_base *cmd = command_channel_receive_command(chan);
+        assert(cmd->api_id == COMMAND_HANDLER_API && cmd->command_id == COMMAND_HANDLER_THREAD_CHANNEL);
+        intptr_t thread_id = cmd->thread_id;
+        command_channel_free_command(chan, cmd);
+        DEBUG_PRINT("Serving thread channel of thread %lx\n", (long)thread_id);
+        shadow_thread_new_on_channel(nw_shadow_thread_pool, thread_id, chan);
+        atomic_fetch_add(&channels, 1);
+
+        struct command_base *ack = command_channel_new_command(chan, sizeof(struct command_base), 0);
+        ack->api_id = COMMAND_HANDLER_API;
+        ack->command_id = COMMAND_HANDLER_THREAD_CHANNEL;
+        ack->thread_id = thread_id;
+        command_channel_send_command(chan, ack);
+    }
+    return NULL;
+}
+
+EXPORTED_WEAKLY void ava_thread_channel_start_server(struct command_channel *listener) {
+    barrier_markers = g_hash_table_new(g_direct_hash, g_direct_equal);
+    int r = pthread_create(&server_thread, NULL, server_thread_loop, listener);
+    assert(r == 0);
+    (void)r;
+    pthread_detach(server_thread);
+}
+
+/**
+ * Open a thread channel for the calling thread and wait until the worker serves it.
+ * @return The channel, or NULL if the global channel does not support thread channels.
+ */
+static struct command_channel *open_thread_channel(intptr_t thread_id) {
+    struct command_channel *chan = command_channel_new_thread_channel(nw_global_command_channel);
+    if (chan == NULL)
+        return NULL;
+
+    struct command_base *cmd = command_channel_new_command(chan, sizeof(struct command_base), 0);
+    cmd->api_id = COMMAND_HANDLER_API;
+    cmd->command_id = COMMAND_HANDLER_THREAD_CHANNEL;
+    cmd->thread_id = thread_id;
+    cmd->original_thread_id = thread_id;
+    command_channel_send_command(chan, cmd);
+
+    // Once acknowledged, the channel has a shadow thread which will handle barrier markers.
+    struct command_base *ack = command_channel_receive_command(chan);
+    assert(ack->api_id == COMMAND_HANDLER_API && ack->command_id == COMMAND_HANDLER_THREAD_CHANNEL);
+    command_channel_free_command(chan, ack);
+    return chan;
+}
+
+EXPORTED_WEAKLY struct command_channel *ava_thread_command_channel(void) {
+    struct command_channel *chan = shadow_thread_channel(nw_shadow_thread_pool);
+    if (chan != NULL)
+        return chan;
+    if (!atomic_load_explicit(&thread_channels_enabled, memory_order_relaxed))
+        return nw_global_command_channel;
+
+    chan = open_thread_channel(shadow_thread_id(nw_shadow_thread_pool));
+    if (chan == NULL) {
+        fprintf(stderr, "Cannot open a thread channel, all threads use the global channel\n");
+        atomic_store(&thread_channels_enabled, 0);
+        return nw_global_command_channel;
+    }
+    shadow_thread_set_channel(nw_shadow_thread_pool, chan);
+    atomic_fetch_add(&channels, 1);
+    return chan;
+}
+
+static void send_marker(struct command_channel *chan, intptr_t thread_id, void *arg) {
+    struct barrier_markers *markers = arg;
+    if (thread_id == markers->thread_id)
+        return;
+
+    struct command_handler_barrier_command *marker = (struct command_handler_barrier_command *)command_channel_new_command(
+            chan, sizeof(struct command_handler_barrier_command), 0);
+    marker->base.api_id = COMMAND_HANDLER_API;
+    marker->base.command_id = COMMAND_HANDLER_BARRIER_MARKER;
+    marker->base.thread_id = thread_id;
+    marker->base.original_thread_id = thread_id;
+    marker->base.flags = COMMAND_FLAG_NO_REPLY;
+    marker->barrier_id = markers->barrier_id;
+    command_channel_send_command(chan, (struct command_base *)marker);
+    markers->count++;
+}
+
+EXPORTED_WEAKLY void ava_thread_channel_barrier(struct command_channel *chan) {
+    if (chan == nw_global_command_channel)
+        return;
+
+    // The commands this thread batched must stay before the barrier.
+    ava_async_batch_flush(chan, AVA_BATCH_FLUSH_EXPLICIT);
+
+    pthread_mutex_lock(&barrier_lock);
+    struct barrier_markers markers = {next_barrier_id++, shadow_thread_id(nw_shadow_thread_pool), 0};
+    shadow_thread_pool_foreach_channel(nw_shadow_thread_pool, send_marker, &markers);
+
+    struct command_handler_barrier_command *cmd = (struct command_handler_barrier_command *)command_channel_new_command(
+            chan, sizeof(struct command_handler_barrier_command), 0);
+    cmd->base.api_id = COMMAND_HANDLER_API;
+    cmd->base.command_id = COMMAND_HANDLER_BARRIER;
+    cmd->base.thread_id = markers.thread_id;
+    cmd->base.original_thread_id = markers.thread_id;
+    cmd->base.flags = COMMAND_FLAG_NO_REPLY;
+    cmd->barrier_id = markers.barrier_id;
+    cmd->marker_count = markers.count;
+    command_channel_send_command(chan, (struct command_base *)cmd);
+    pthread_mutex_unlock(&barrier_lock);
+    atomic_fetch_add(&barriers, 1);
+}
+
+EXPORTED_WEAKLY void ava_thread_channel_handle_barrier(const struct command_base *cmd) {
+    const struct command_handler_barrier_command *barrier = (const struct command_handler_barrier_command *)cmd;
+    gpointer key = GSIZE_TO_POINTER(barrier->barrier_id);
+    gint64 start_time = g_get_monotonic_time();
+
+    pthread_mutex_lock(&markers_lock);
+    while (GPOINTER_TO_SIZE(g_hash_table_lookup(barrier_markers, key)) < barrier->marker_count)
+        pthread_cond_wait(&markers_cond, &markers_lock);
+    g_hash_table_remove(barrier_markers, key);
+    pthread_mutex_unlock(&markers_lock);
+
+    atomic_fetch_add(&barrier_wait_us, g_get_monotonic_time() - start_time);
+    atomic_fetch_add(&barriers, 1);
+}
+
+EXPORTED_WEAKLY void ava_thread_channel_handle_marker(const struct command_base *cmd) {
+    const struct command_handler_barrier_command *marker = (const struct command_handler_barrier_command *)cmd;
+    gpointer key = GSIZE_TO_POINTER(marker->barrier_id);
+
+    pthread_mutex_lock(&markers_lock);
+    gsize count = GPOINTER_TO_SIZE(g_hash_table_lookup(barrier_markers, key));
+    g_hash_table_insert(barrier_markers, key, GSIZE_TO_POINTER(count + 1));
+    pthread_cond_broadcast(&markers_cond);
+    pthread_mutex_unlock(&markers_lock);
+}
+
+EXPORTED_WEAKLY void ava_thread_channel_get_stats(struct ava_thread_channel_stats *stats) {
+    stats->channels = channels;
+    stats->barriers = barriers;
+    stats->barrier_wait_us = barrier_wait_us;
+}
+
+EXPORTED_WEAKLY void ava_thread_channel_print_stats(FILE *file) {
+    struct ava_thread_channel_stats stats;
+    ava_thread_channel_get_stats(&stats);
+    fprintf(file, "Thread channels: %lu channels, %lu barriers, %.3f s waiting for barriers\n",
+            (unsigned long)stats.channels, (unsigned long)stats.barriers, stats.barrier_wait_us / 1e6);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_THREAD_CHANNEL_STATS", ava_thread_channel_print_stats);
+}
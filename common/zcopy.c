@@ -6,39 +6,233 @@
 #include <sys/stat.h>
 #include <sys/ioctl.h>
 #include <sys/mman.h>
+#include <sys/syscall.h>
+#include <linux/mempolicy.h>
 #include <fcntl.h>
 #include <unistd.h>
 #include <errno.h>
 #include <string.h>
 #include <pthread.h>
+#include <stdatomic.h>
+#include <time.h>
 #include <assert.h>
 
 #include "common/devconf.h"
+#include "common/env.h"
 #include "common/ioctl.h"
+#include "common/linkage.h"
+#include "common/size_class.h"
+#include "common/stats.h"
 #include "common/zcopy.h"
 
+/* The region is divided in spans. A span holds blocks of one class, or is part of a large allocation. */
+#define SPAN_SHIFT 16
+#define SPAN_SIZE ((size_t)1 << SPAN_SHIFT)
+#define FREE_SPAN 0xff
+#define LARGE_SPAN 0xfe
+#define ALIGNMENT 64
+#define SMALL_CLASS_SHIFT 8
+#define MAX_CLASS_SHIFT 15
+#define DEFAULT_CACHE_SIZE (32 * 1024)
+/* The number of bytes moved between a thread cache and the depot at once. */
+#define BATCH_SIZE (16 * 1024)
+#define MAX_BATCH 32
+
 struct ava_zcopy_region {
     int fd;
     uintptr_t physical_base;
     void *base;
     size_t size;
 
-    void *allocation_ptr;
+    // The allocator state is local to this process. The guest and the worker map the same memory,
+    // but only the process which allocates a buffer frees it.
+    size_t span_count;
+    /* The class of each span, FREE_SPAN or LARGE_SPAN. */
+    uint8_t *span_class;
+    /* The number of spans of the large allocation starting at each span. */
+    uint32_t *span_length;
+    /* Scratch space to count the free blocks of each span while reclaiming spans. */
+    uint16_t *span_free_blocks;
+    /* The classes, whose chunks are spans. */
+    struct ava_size_class_pool *pool;
+    struct ava_zcopy_region *next_region;
 
-    // TODO: The mutex will not work across the guest/worker boundary. We will need to use an in region lock-free data structure. For the moment we are assuming all alloc/free is done in the guest.
-    // TODO: alloc and free should be lock-free.
+    // Protects the spans. Only taken when a span is allocated or freed; locks of the depots may be
+    // taken while it is held, but not the other way around.
     pthread_mutex_t lock;
 };
 
 #define ENCODED_PTR_OFFSET 4096 // One page (not actually important as long as it is > 0)
 
+static pthread_once_t zcopy_init_once = PTHREAD_ONCE_INIT;
+static size_t cache_size;
+static long numa_node = -1;
+static struct timespec start_time;
+
+/* The live regions, to find the largest free runs of spans when the stats are printed. */
+static struct ava_zcopy_region *regions;
+static pthread_mutex_t regions_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static struct ava_size_class_counters counters;
+static atomic_ulong large_allocations;
+static atomic_ulong failed_allocations;
+static atomic_ulong reserved_bytes;
+static atomic_ulong region_bytes;
+
+static void zcopy_init(void) {
+    cache_size = ava_getenv_size("AVA_ZCOPY_CACHE_SIZE", DEFAULT_CACHE_SIZE);
+    const char *s = getenv("AVA_ZCOPY_NUMA_NODE");
+    if (s != NULL && *s != '\0')
+        numa_node = strtol(s, NULL, 0);
+    clock_gettime(CLOCK_MONOTONIC, &start_time);
+}
+
+static inline uint32_t blocks_per_span(struct ava_zcopy_region *region, uint32_t class_index) {
+    return SPAN_SIZE / ava_size_class_size(region->pool, class_index);
+}
+
+static inline size_t span_of(struct ava_zcopy_region *region, const void *ptr) {
+    return ((const char *)ptr - (const char *)region->base) >> SPAN_SHIFT;
+}
+
+static inline void *span_address(struct ava_zcopy_region *region, size_t span) {
+    return (char *)region->base + (span << SPAN_SHIFT);
+}
+
+/**
+ * Return the spans of a class whose blocks are all in the depot. Called with the region lock held
+ * when no run of free spans is large enough. The blocks in the thread caches are not counted, so
+ * their spans are kept.
+ */
+static void count_free_block(void *context, void *block, uint32_t class_index) {
+    (void)class_index;
+    struct ava_zcopy_region *region = context;
+    region->span_free_blocks[span_of(region, block)]++;
+}
+
+static int is_span_free(void *context, void *block, uint32_t class_index) {
+    struct ava_zcopy_region *region = context;
+    return region->span_free_blocks[span_of(region, block)] == blocks_per_span(region, class_index);
+}
+
+static void reclaim_spans(struct ava_zcopy_region *region) {
+    memset(region->span_free_blocks, 0, region->span_count * sizeof(uint16_t));
+    ava_size_class_reclaim(region->pool, count_free_block, is_span_free, region);
+    uint32_t class_count = ava_size_class_count_classes(region->pool);
+    for (size_t i = 0; i < region->span_count; i++) {
+        uint8_t c = region->span_class[i];
+        if (c < class_count && region->span_free_blocks[i] == blocks_per_span(region, c)) {
+            region->span_class[i] = FREE_SPAN;
+            atomic_fetch_sub_explicit(&reserved_bytes, SPAN_SIZE, memory_order_relaxed);
+        }
+    }
+}
+
+static size_t find_free_spans(struct ava_zcopy_region *region, size_t count) {
+    size_t run = 0;
+    for (size_t i = 0; i < region->span_count; i++) {
+        run = region->span_class[i] == FREE_SPAN ? run + 1 : 0;
+        if (run == count)
+            return i + 1 - count;
+    }
+    return region->span_count;
+}
+
+/**
+ * Allocate the first run of `count` free spans (first fit).
+ * @return The first span of the run, or NULL if no run is large enough.
+ */
+static void *alloc_spans(struct ava_zcopy_region *region, size_t count, uint8_t class_index) {
+    pthread_mutex_lock(&region->lock);
+    size_t first = find_free_spans(region, count);
+    if (first == region->span_count) {
+        reclaim_spans(region);
+        first = find_free_spans(region, count);
+    }
+    if (first < region->span_count) {
+        memset(&region->span_class[first], class_index, count);
+        region->span_length[first] = count;
+        atomic_fetch_add_explicit(&reserved_bytes, count * SPAN_SIZE, memory_order_relaxed);
+    }
+    pthread_mutex_unlock(&region->lock);
+    return first < region->span_count ? span_address(region, first) : NULL;
+}
+
+static size_t free_spans(struct ava_zcopy_region *region, void *ptr) {
+    size_t first = span_of(region, ptr);
+    pthread_mutex_lock(&region->lock);
+    size_t count = region->span_length[first];
+    memset(&region->span_class[first], FREE_SPAN, count);
+    atomic_fetch_sub_explicit(&reserved_bytes, count * SPAN_SIZE, memory_order_relaxed);
+    pthread_mutex_unlock(&region->lock);
+    return count;
+}
+
+/**
+ * The backing allocator of the classes.
+ */
+static void *alloc_class_span(void *context, size_t size, uint32_t class_index) {
+    assert(size == SPAN_SIZE);
+    return alloc_spans(context, 1, class_index);
+}
+
+static void region_set_numa_node(struct ava_zcopy_region *region) {
+    if (numa_node < 0)
+        return;
+    unsigned long nodemask[4] = {0};
+    if (numa_node >= (long)(sizeof(nodemask) * 8)) {
+        DEBUG_PRINT("AVA_ZCOPY_NUMA_NODE=%ld is out of range\n", numa_node);
+        return;
+    }
+    nodemask[numa_node / (sizeof(unsigned long) * 8)] = 1UL << (numa_node % (sizeof(unsigned long) * 8));
+    if (syscall(SYS_mbind, region->base, region->size, MPOL_PREFERRED, nodemask, sizeof(nodemask) * 8 + 1,
+                MPOL_MF_MOVE) < 0)
+        DEBUG_PRINT("Placing the zero-copy region on NUMA node %ld failed: %s\n", numa_node, strerror(errno));
+}
+
+/**
+ * Set up the allocator of a newly mapped region.
+ */
+static void region_init(struct ava_zcopy_region *region) {
+    pthread_once(&zcopy_init_once, zcopy_init);
+#ifdef MADV_HUGEPAGE
+    // Only takes effect if the driver backs the mapping with pages which can be huge.
+    madvise(region->base, region->size, MADV_HUGEPAGE);
+#endif
+    region_set_numa_node(region);
+
+    region->span_count = region->size >> SPAN_SHIFT;
+    region->span_class = malloc(region->span_count);
+    memset(region->span_class, FREE_SPAN, region->span_count);
+    region->span_length = calloc(region->span_count, sizeof(uint32_t));
+    region->span_free_blocks = calloc(region->span_count, sizeof(uint16_t));
+    struct ava_size_class_config config = {
+        .alignment = ALIGNMENT,
+        .small_shift = SMALL_CLASS_SHIFT,
+        .max_shift = MAX_CLASS_SHIFT,
+        .batch_size = BATCH_SIZE,
+        .max_batch = MAX_BATCH,
+        .cache_size = cache_size,
+        .chunk_size = SPAN_SIZE,
+        .chunk_alloc = alloc_class_span,
+        .context = region,
+        .counters = &counters,
+    };
+    region->pool = ava_size_class_pool_new(&config);
+    atomic_fetch_add_explicit(&region_bytes, region->span_count * SPAN_SIZE, memory_order_relaxed);
+
+    pthread_mutex_lock(&regions_lock);
+    region->next_region = regions;
+    regions = region;
+    pthread_mutex_unlock(&regions_lock);
+}
+
 struct ava_zcopy_region *ava_zcopy_region_new_worker() {
     struct ava_zcopy_region*ret = malloc(sizeof(struct ava_zcopy_region));
     bzero(ret, sizeof(struct ava_zcopy_region));
 
     int r;
     pthread_mutex_init(&ret->lock, NULL);
-    pthread_mutex_lock(&ret->lock);
 
     ret->fd = open("/dev/ava_zcopy", O_RDWR);
     if (ret->fd < 0) {
@@ -60,8 +254,7 @@ struct ava_zcopy_region *ava_zcopy_region_new_worker() {
         return NULL;
     }
 
-    ret->allocation_ptr = ret->base;
-    pthread_mutex_unlock(&ret->lock);
+    region_init(ret);
     return ret;
 }
 
@@ -71,7 +264,6 @@ struct ava_zcopy_region *ava_zcopy_region_new_guest() {
 
     int r;
     pthread_mutex_init(&ret->lock, NULL);
-    pthread_mutex_lock(&ret->lock);
 
     ret->fd = open("/dev/scea-vgpu0", O_RDWR);
     if (ret->fd < 0) {
@@ -95,15 +287,32 @@ struct ava_zcopy_region *ava_zcopy_region_new_guest() {
         return NULL;
     }
 
-    ret->allocation_ptr = ret->base;
-    pthread_mutex_unlock(&ret->lock);
+    region_init(ret);
     return ret;
 }
 
 void ava_zcopy_region_free_region(struct ava_zcopy_region *region) {
     assert(region != NULL);
+    pthread_mutex_lock(&regions_lock);
+    struct ava_zcopy_region **link = &regions;
+    while (*link != region)
+        link = &(*link)->next_region;
+    *link = region->next_region;
+    pthread_mutex_unlock(&regions_lock);
+
+    // The caches of the threads which are still running are dropped with the region.
+    ava_size_class_pool_free(region->pool);
     pthread_mutex_lock(&region->lock);
-    if (region->base > 0)
+    for (size_t i = 0; i < region->span_count; i++) {
+        if (region->span_class[i] != FREE_SPAN)
+            atomic_fetch_sub_explicit(&reserved_bytes, SPAN_SIZE, memory_order_relaxed);
+    }
+    atomic_fetch_sub_explicit(&region_bytes, region->span_count * SPAN_SIZE, memory_order_relaxed);
+    free(region->span_class);
+    free(region->span_length);
+    free(region->span_free_blocks);
+
+    if (region->base != NULL)
         munmap(region->base, VGPU_ZERO_COPY_SIZE);
 
     close(region->fd);
@@ -116,25 +325,53 @@ void ava_zcopy_region_free_region(struct ava_zcopy_region *region) {
 
 void *ava_zcopy_region_alloc(struct ava_zcopy_region *region, size_t size) {
     assert(region != NULL && "The appropriate zero-copy driver may not be installed.");
-    pthread_mutex_lock(&region->lock);
-    // TODO: Align the allocated memory.
-    void *ret = region->allocation_ptr;
-    // TODO: Add header to each allocation so they can be freed.
-    if (region->base != NULL && ret + size < region->base + region->size) {
-        region->allocation_ptr += size;
-    } else {
-        ret = NULL;
+
+    if (size > ((size_t)1 << MAX_CLASS_SHIFT)) {
+        size_t count = (size + SPAN_SIZE - 1) >> SPAN_SHIFT;
+        void *ret = count <= region->span_count ? alloc_spans(region, count, LARGE_SPAN) : NULL;
+        if (ret == NULL) {
+            // Return the free blocks of this thread, so their spans can be reclaimed.
+            ava_size_class_release_thread(region->pool);
+            ret = count <= region->span_count ? alloc_spans(region, count, LARGE_SPAN) : NULL;
+        }
+        if (ret == NULL) {
+            ava_size_class_count(region->pool, 1, 0, 0);
+            atomic_fetch_add_explicit(&failed_allocations, 1, memory_order_relaxed);
+            errno = ENOMEM;
+            return NULL;
+        }
+        ava_size_class_count(region->pool, 1, 0, count * SPAN_SIZE);
+        atomic_fetch_add_explicit(&large_allocations, 1, memory_order_relaxed);
+        return ret;
+    }
+
+    void *block = ava_size_class_alloc(region->pool, ava_size_class_index(region->pool, size), 0);
+    if (block == NULL) {
+        atomic_fetch_add_explicit(&failed_allocations, 1, memory_order_relaxed);
         errno = ENOMEM;
     }
-    pthread_mutex_unlock(&region->lock);
-    return ret;
+    return block;
 }
 
 void ava_zcopy_region_free(struct ava_zcopy_region *region, void *ptr) {
     assert(region != NULL && "The appropriate zero-copy driver may not be installed.");
-    pthread_mutex_lock(&region->lock);
-    // TODO: Implement deallocation. This will be complicated by the need for potential coordination between the guest and worker allocating in the same region.
-    pthread_mutex_unlock(&region->lock);
+    if (ptr == NULL)
+        return;
+    assert(ava_zcopy_region_contains(region, ptr, 1) && "Freeing a pointer which is not in the zero-copy region");
+
+    uint8_t class_index = region->span_class[span_of(region, ptr)];
+    if (class_index == LARGE_SPAN) {
+        assert(((char *)ptr - (char *)region->base) % SPAN_SIZE == 0 && "Freeing a pointer inside an allocation");
+        ava_size_class_count(region->pool, 0, 1, -(int64_t)(free_spans(region, ptr) * SPAN_SIZE));
+        return;
+    }
+    assert(class_index < ava_size_class_count_classes(region->pool) && "Freeing a pointer which was not allocated");
+    ava_size_class_free(region->pool, ptr, class_index, 0);
+}
+int ava_zcopy_region_contains(struct ava_zcopy_region *region, const void *ptr, size_t size) {
+    assert(region != NULL && "The appropriate zero-copy driver may not be installed.");
+    return region->base != NULL && ptr >= region->base && size <= region->size &&
+           (size_t)((const char *)ptr - (const char *)region->base) <= region->size - size;
 }
 
 uintptr_t ava_zcopy_region_get_physical_address(struct ava_zcopy_region *region, const void *ptr) {
@@ -170,3 +407,56 @@ void *ava_zcopy_region_decode_position_independent(struct ava_zcopy_region *regi
     // Remove offset from encoding
     return region->base + (uintptr_t)ptr - ENCODED_PTR_OFFSET;
 }
+
+EXPORTED_WEAKLY void ava_zcopy_get_stats(struct ava_zcopy_stats *stats) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    stats->large_allocations = large_allocations;
+    stats->failed_allocations = failed_allocations;
+    stats->elapsed_us = start_time.tv_sec == 0 ? 0 :
+            (now.tv_sec - start_time.tv_sec) * 1000000 + (now.tv_nsec - start_time.tv_nsec) / 1000;
+    stats->reserved_bytes = reserved_bytes;
+    stats->region_bytes = region_bytes;
+    stats->largest_free_bytes = 0;
+
+    pthread_mutex_lock(&regions_lock);
+    // The counters of the calling thread are added; the others lag by less than 256 operations.
+    for (struct ava_zcopy_region *region = regions; region != NULL; region = region->next_region)
+        ava_size_class_flush_stats(region->pool);
+    stats->allocations = counters.allocations;
+    stats->frees = counters.frees;
+    stats->used_bytes = counters.used_bytes;
+    for (struct ava_zcopy_region *region = regions; region != NULL; region = region->next_region) {
+        pthread_mutex_lock(&region->lock);
+        size_t run = 0;
+        for (size_t i = 0; i < region->span_count; i++) {
+            run = region->span_class[i] == FREE_SPAN ? run + 1 : 0;
+            if (run * SPAN_SIZE > stats->largest_free_bytes)
+                stats->largest_free_bytes = run * SPAN_SIZE;
+        }
+        pthread_mutex_unlock(&region->lock);
+    }
+    pthread_mutex_unlock(&regions_lock);
+}
+
+EXPORTED_WEAKLY void ava_zcopy_print_stats(FILE *file) {
+    struct ava_zcopy_stats stats;
+    ava_zcopy_get_stats(&stats);
+    double seconds = stats.elapsed_us / 1e6;
+    uint64_t free_bytes = stats.region_bytes - stats.reserved_bytes;
+    fprintf(file,
+            "Zero-copy region: %lu allocations (%.0f/s, %lu large, %lu failed), %lu frees (%.0f/s), "
+            "%lu bytes in use of %lu reserved of %lu (%.1f%% occupied), %.1f%% of reserved free in the classes, "
+            "largest free run %lu of %lu free bytes\n",
+            (unsigned long)stats.allocations, seconds > 0 ? stats.allocations / seconds : 0.0,
+            (unsigned long)stats.large_allocations, (unsigned long)stats.failed_allocations,
+            (unsigned long)stats.frees, seconds > 0 ? stats.frees / seconds : 0.0, (unsigned long)stats.used_bytes,
+            (unsigned long)stats.reserved_bytes, (unsigned long)stats.region_bytes,
+            stats.region_bytes > 0 ? 100.0 * stats.used_bytes / stats.region_bytes : 0.0,
+            stats.reserved_bytes > 0 ? 100.0 * (stats.reserved_bytes - stats.used_bytes) / stats.reserved_bytes : 0.0,
+            (unsigned long)stats.largest_free_bytes, (unsigned long)free_bytes);
+}
+
+static void __attribute__((constructor)) register_stats(void) {
+    ava_stats_register("AVA_ZCOPY_STATS", ava_zcopy_print_stats);
+}
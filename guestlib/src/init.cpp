@@ -12,6 +12,8 @@
 #include "guestlib.h"
 #include "guest_config.h"
 #include "common/linkage.h"
+#include "common/stats.h"
+#include "common/thread_channel.h"
 #include "common/cmd_handler.h"
 #include "common/shadow_thread_pool.h"
 #include "common/endpoint_lib.h"
@@ -55,10 +57,13 @@ EXPORTED_WEAKLY void nw_init_guestlib(intptr_t api_id)
     else if (guestconfig::config->channel_ == "VSOCK") {
         chan = command_channel_socket_new();
     }
+    else if (guestconfig::config->channel_ == "UNIX") {
+        chan = command_channel_socket_unix_guest_new();
+    }
     else {
         std::cerr << "Unsupported channel specified in "
                   << guestconfig::kConfigFilePath
-                  << ", expect channel = [\"TCP\" | \"SHM\" | \"VSOCK\"]" << std::endl;
+                  << ", expect channel = [\"TCP\" | \"SHM\" | \"VSOCK\" | \"UNIX\"]" << std::endl;
         exit(0);
     }
     if (!chan) {
@@ -67,6 +72,7 @@ EXPORTED_WEAKLY void nw_init_guestlib(intptr_t api_id)
     }
     init_command_handler(channel_create);
     init_internal_command_handler();
+    ava_thread_channel_init_guest();
 
     /* Send initialize API command to the worker */
     struct command_handler_initialize_api_command* api_init_command =
@@ -98,6 +104,8 @@ EXPORTED_WEAKLY void nw_destroy_guestlib(void)
     api_shutdown_command = command_channel_receive_command(chan);
     */
 
+    ava_stats_print(stderr);
+
     // TODO: This is called by the guestlib so destructor for each API. This is safe, but will make the handler shutdown when the FIRST API unloads when having it shutdown with the last would be better.
     destroy_command_handler();
 }
@@ -151,6 +159,8 @@ EXPORTED_WEAKLY void start_migration(void)
     close(manager_fd);
 
     // TODO: connect to new worker (replace chan->worker_fd)
+    // The new worker does not have the shadow buffers of the old one.
+    ava_shadow_buffer_reset_digests();
 }
 
 // TODO: Should be removed once the guestlib can register it's own separate command handler in a single file.
@@ -164,11 +174,13 @@ extern int nw_end_migration_flag;
 EXPORTED_WEAKLY void start_self_migration(void)
 {
     nw_end_migration_flag = 0;
-    struct command_base* msg = command_channel_new_command(chan, sizeof(struct command_base), 0);
+    // The reply comes back on the channel of this thread.
+    struct command_channel *thread_chan = ava_thread_command_channel();
+    struct command_base* msg = command_channel_new_command(thread_chan, sizeof(struct command_base), 0);
     msg->api_id = COMMAND_HANDLER_API;
     msg->command_id = COMMAND_START_MIGRATION;
     msg->thread_id = shadow_thread_id(nw_shadow_thread_pool);
-    command_channel_send_command(chan, msg);
+    command_channel_send_command(thread_chan, msg);
 
     /* wait until the migration finishes */
     shadow_thread_handle_command_until(nw_shadow_thread_pool, nw_end_migration_flag);
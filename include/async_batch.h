@@ -0,0 +1,122 @@
+#ifndef AVA_ASYNC_BATCH_H
+#define AVA_ASYNC_BATCH_H
+
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+// Forward declarations of structs to avoid dependency cycles in the includes.
+struct command_channel;
+struct command_base;
+
+/**
+ * \section Asynchronous call batching
+ *
+ * If `AVA_BATCH` is set, generated stubs for `ava_async` functions append their CALL commands to
+ * a per-thread batch instead of sending them directly. The batch is sent as a single
+ * `COMMAND_HANDLER_BATCH` command when:
+ *
+ * - the same thread makes a synchronous call or calls an `ava_flush` function,
+ * - the batch contains `AVA_BATCH_MAX_COMMANDS` commands or `AVA_BATCH_MAX_BYTES` bytes, or
+ * - the oldest command in the batch has waited for `AVA_BATCH_TIMEOUT_US` microseconds.
+ *
+ * The limits are read from the environment variables of the same names. Setting
+ * `AVA_BATCH_MAX_COMMANDS` to 1 or less disables batching. The receiver executes the batched
+ * commands in order on the shadow thread of the sending thread. If `AVA_BATCH_STATS` is set, the
+ * guestlib prints the batching counters when it is unloaded.
+ *
+ * The batch carries copies of the commands, so only channels whose buffers are resolved relative
+ * to their command (the socket channels) batch commands. On the shared memory channel the
+ * commands are sent directly.
+ *
+ * While the receiver executes a batch, the replies to the batched commands are batched in the
+ * same way and sent together when the batch is done. The same channel restriction applies, so
+ * replies are never batched on the shared memory channel.
+ */
+
+/**
+ * The reasons a batch is sent. Used to index `ava_async_batch_stats::flushes`.
+ */
+enum ava_async_batch_flush_reason {
+    AVA_BATCH_FLUSH_SYNC = 0,
+    AVA_BATCH_FLUSH_EXPLICIT,
+    AVA_BATCH_FLUSH_COUNT,
+    AVA_BATCH_FLUSH_SIZE,
+    AVA_BATCH_FLUSH_TIMEOUT,
+    AVA_BATCH_FLUSH_THREAD_EXIT,
+    AVA_BATCH_FLUSH_REASONS
+};
+
+/**
+ * Batching counters of this process (summed over all threads).
+ */
+struct ava_async_batch_stats {
+    /** The number of batches sent. */
+    uint64_t batches;
+    /** The number of commands sent in batches. */
+    uint64_t commands;
+    /** The number of bytes sent in batches. */
+    uint64_t bytes;
+    /** The largest number of commands sent in one batch. */
+    uint64_t max_batch_commands;
+    /** The number of batches sent for each `ava_async_batch_flush_reason`. */
+    uint64_t flushes[AVA_BATCH_FLUSH_REASONS];
+};
+
+/**
+ * Append a command to the calling thread's batch. The batch takes ownership of `cmd`.
+ * The batch may be sent before this call returns if it reaches a size or count limit.
+ * If batching is disabled the command is sent immediately.
+ * @param chan The channel `cmd` was created on and the batch will be sent on.
+ * @param cmd The command.
+ */
+void ava_async_batch_append(struct command_channel *chan, struct command_base *cmd);
+
+/**
+ * Send the calling thread's batch, if it is not empty.
+ * @param chan The channel to send the batch on.
+ * @param reason Why the batch is being sent (for statistics).
+ */
+void ava_async_batch_flush(struct command_channel *chan, enum ava_async_batch_flush_reason reason);
+
+/**
+ * Start batching the replies sent with `ava_async_batch_send_reply` on the calling thread.
+ * Nothing is batched if batching is disabled or `chan` does not resolve buffer IDs relative to
+ * their command (shared memory channels), so the replies are sent immediately.
+ * @param chan The channel the replies will be sent on.
+ */
+void ava_async_batch_begin_replies(struct command_channel *chan);
+
+/**
+ * Stop batching replies on the calling thread and send the batched replies.
+ * @param chan The channel the replies were sent on.
+ */
+void ava_async_batch_end_replies(struct command_channel *chan);
+
+/**
+ * Send a reply. The reply is appended to the calling thread's batch between
+ * `ava_async_batch_begin_replies` and `ava_async_batch_end_replies`, and sent immediately otherwise.
+ * @param chan The channel `cmd` was created on.
+ * @param cmd The reply.
+ */
+void ava_async_batch_send_reply(struct command_channel *chan, struct command_base *cmd);
+
+/**
+ * Get a snapshot of the batching counters.
+ * @param stats The structure to fill.
+ */
+void ava_async_batch_get_stats(struct ava_async_batch_stats *stats);
+
+/**
+ * Print the batching counters to `file`.
+ */
+void ava_async_batch_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_ASYNC_BATCH_H
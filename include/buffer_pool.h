@@ -0,0 +1,82 @@
+#ifndef AVA_BUFFER_POOL_H
+#define AVA_BUFFER_POOL_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * \section Buffer pool
+ *
+ * The shadow buffers (with the default `ava_buffer_allocator(malloc, free)`) and the buffers of
+ * `ava_cached_alloc`, `ava_uncached_alloc` and `ava_static_alloc` are allocated from a pool of size
+ * classes instead of the general allocator. Each thread caches free buffers of each class, so
+ * objects created and destroyed at high rates reuse their buffers without a lock. Full caches
+ * move a batch of buffers to a shared depot per class, and empty caches take a batch from it. The
+ * memory of the pool is carved from chunks which are kept for the life of the process.
+ *
+ * Sizes up to 128 bytes are rounded up to a multiple of 16 bytes, larger sizes to one of 4 classes
+ * per power of 2, so rounding wastes at most 20% of a class above 128 bytes. Buffers larger than
+ * 1 MiB are allocated with `malloc`. Each thread caches `AVA_BUFFER_POOL_CACHE_SIZE` bytes (default
+ * 256 KiB) or two batches of buffers per class, whichever is more. Buffers are aligned to 16 bytes.
+ *
+ * `ava_buffer_pool_alloc` and `ava_buffer_pool_free` can also be named in `ava_buffer_allocator`.
+ * The allocation rates and fragmentation of the pool are printed when the guestlib or the worker
+ * exits if `AVA_BUFFER_POOL_STATS` is set.
+ */
+
+/**
+ * Buffer pool counters of this process.
+ */
+struct ava_buffer_pool_stats {
+    /** The number of allocations, and the number of them which were larger than the classes. */
+    uint64_t allocations;
+    uint64_t large_allocations;
+    /** The number of frees. */
+    uint64_t frees;
+    /** The time since the pool was first used, in microseconds. */
+    uint64_t elapsed_us;
+    /** The sizes requested by the buffers in use, except the large ones. */
+    uint64_t requested_bytes;
+    /** The sizes of the classes of the buffers in use, except the large ones. */
+    uint64_t used_bytes;
+    /** The size of the chunks of the classes, which hold the buffers in use and the free buffers. */
+    uint64_t reserved_bytes;
+};
+
+/**
+ * Allocate an uninitialized buffer. Has the signature of `ava_allocator`.
+ */
+void *ava_buffer_pool_alloc(size_t size);
+
+/**
+ * Free a buffer allocated by `ava_buffer_pool_alloc`. Has the signature of `ava_deallocator`.
+ * @param buffer The buffer or NULL.
+ */
+void ava_buffer_pool_free(void *buffer);
+
+/**
+ * @return The size requested when `buffer` was allocated.
+ */
+size_t ava_buffer_pool_size(const void *buffer);
+
+/**
+ * Get a snapshot of the pool counters.
+ * @param stats The structure to fill.
+ */
+void ava_buffer_pool_get_stats(struct ava_buffer_pool_stats *stats);
+
+/**
+ * Print the allocation rate and fragmentation of the pool to `file`.
+ */
+void ava_buffer_pool_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_BUFFER_POOL_H
@@ -0,0 +1,121 @@
+#ifndef AVA_CALL_CACHE_H
+#define AVA_CALL_CACHE_H
+
+#include <glib.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * \section Guest call cache
+ *
+ * Generated guest stubs for `ava_cacheable` functions look up the results of a call in this
+ * cache before sending it. The key is built from the ID of the CALL command, the values of the
+ * arguments, and the contents of input buffers. The value is the return value followed by the
+ * contents of the output buffers. Keys are hashed with MurmurHash3 and compared byte-for-byte.
+ *
+ * The cache holds at most `AVA_CALL_CACHE_SIZE` entries (default 1024; 0 disables caching) and
+ * evicts the least recently used entry. Calls to `ava_invalidates_cache` functions clear it. If
+ * `AVA_CALL_CACHE_STATS` is set, the guestlib prints the hit and miss counters when it is unloaded.
+ *
+ * Functions annotated with `ava_prefetch_at_init` are called by the guestlib constructor between
+ * `ava_call_cache_begin_prefetch` and `ava_call_cache_end_prefetch`. During the prefetch, the stubs
+ * append their CALL commands to the thread's batch (see async_batch.h) without waiting for the
+ * replies, so all the calls are sent in one command. The worker batches the replies of the calls
+ * in a batch in the same way. Where batching is disabled (including on the shared memory channel)
+ * the calls are sent one by one, still without waiting for their replies until the prefetch ends.
+ */
+
+struct command_channel;
+
+/**
+ * Copy the results of a completed call from its call record into the cache.
+ * Generated for each `ava_cacheable` function.
+ */
+typedef void (*ava_call_cache_insert_function)(void *call_record, GByteArray *key);
+
+/**
+ * Create a new cache key.
+ * @param command_id The ID of the CALL command of the function.
+ * @return A new key. It must be passed to `ava_call_cache_insert` or freed with
+ * `g_byte_array_unref`.
+ */
+GByteArray *ava_call_cache_key_new(uintptr_t command_id);
+
+/**
+ * Append a value to a key.
+ */
+void ava_call_cache_key_add(GByteArray *key, const void *data, size_t size);
+
+/**
+ * Append a buffer argument to a key. The key includes whether the buffer is NULL and its size, and
+ * its contents if `include_contents` is true (non-zero).
+ */
+void ava_call_cache_key_add_buffer(GByteArray *key, const void *buffer, size_t size, int include_contents);
+
+/**
+ * Look up a key.
+ * @return A new reference to the cached value, or NULL if the key is not cached.
+ */
+GBytes *ava_call_cache_lookup(GByteArray *key);
+
+/**
+ * Copy the next `size` bytes of a cached value, starting at `*offset`, to `dest`.
+ */
+void ava_call_cache_read(GBytes *value, size_t *offset, void *dest, size_t size);
+
+/**
+ * Insert a value into the cache. The cache takes ownership of `key` and `value`.
+ */
+void ava_call_cache_insert(GByteArray *key, GByteArray *value);
+
+/**
+ * Remove all entries from the cache.
+ */
+void ava_call_cache_invalidate(void);
+
+/**
+ * Start prefetching on the calling thread.
+ */
+void ava_call_cache_begin_prefetch(void);
+
+/**
+ * @return True (non-zero) if the calling thread is prefetching.
+ */
+int ava_call_cache_prefetching(void);
+
+/**
+ * Allocate a zeroed output buffer for a prefetched call. The buffer is freed by
+ * `ava_call_cache_end_prefetch`.
+ */
+void *ava_call_cache_prefetch_alloc(size_t size);
+
+/**
+ * Register a prefetched call whose CALL command has been sent.
+ * @param complete The completion flag of the call record.
+ * @param call_record The call record. It is freed by `ava_call_cache_end_prefetch`.
+ * @param insert The function to cache the results of the call.
+ * @param key The key of the call. The cache takes ownership of it.
+ */
+void ava_call_cache_add_prefetch(volatile char *complete, void *call_record, ava_call_cache_insert_function insert,
+                                 GByteArray *key);
+
+/**
+ * Send the prefetched calls, wait for their replies, and cache their results.
+ * @param chan The channel the calls were created on.
+ */
+void ava_call_cache_end_prefetch(struct command_channel *chan);
+
+/**
+ * Print the cache hit and miss counters to `file`.
+ */
+void ava_call_cache_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_CALL_CACHE_H
@@ -0,0 +1,99 @@
+#ifndef AVA_CALL_RECORD_H
+#define AVA_CALL_RECORD_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * \section Call records
+ *
+ * A stub keeps a call record with the arguments of each call until the worker replies. The
+ * record of a synchronous call lives on the stack of the stub, which waits for the reply anyway.
+ * The records of asynchronous calls (and of cacheable calls, which the prefetch keeps) are
+ * allocated from a freelist per record type and thread. Freed records go back to the freelist of
+ * the freeing thread, up to `AVA_CALL_RECORD_FREELIST_LENGTH` records (default 32); the others are
+ * freed with `free`, so records can still be freed with `free` directly.
+ *
+ * In-flight calls are registered in a table of slots owned by the calling thread. The slot is
+ * encoded in the low `AVA_CALL_SLOT_BITS` bits of the call ID sent to the worker, so the reply
+ * finds its record without a lock or a hash lookup, on any thread. A thread without a free slot
+ * falls back to the locked call map of the endpoint.
+ *
+ * The calls which fall back to the call map and the records which are not reused are counted and
+ * printed when the guestlib or the worker exits if `AVA_CALL_RECORD_STATS` is set.
+ */
+
+/** The number of bits of a call ID which hold its slot. The other bits are the call number. */
+#define AVA_CALL_SLOT_BITS 16
+#define AVA_CALL_SLOT_MASK ((((intptr_t)1) << AVA_CALL_SLOT_BITS) - 1)
+
+/**
+ * A freelist of call records of one type for one thread. Must be zero-initialized (and usually
+ * `static __thread`).
+ */
+struct ava_call_record_freelist {
+    void *head;
+    uint32_t length;
+    /* Non-zero once the freelist is registered to be emptied when its thread exits. */
+    uint32_t registered;
+};
+
+/**
+ * Call record counters of this process.
+ */
+struct ava_call_record_stats {
+    /** The number of calls registered in the locked call map because no slot was free. */
+    uint64_t map_calls;
+    /** The number of records allocated with `calloc` because the freelist was empty. */
+    uint64_t record_allocations;
+};
+
+/**
+ * Allocate a zeroed call record.
+ * @param freelist The freelist of the record type for the calling thread.
+ * @param size The size of the record.
+ */
+void *ava_call_record_alloc(struct ava_call_record_freelist *freelist, size_t size);
+
+/**
+ * Free a record allocated by `ava_call_record_alloc`.
+ * @param freelist The freelist of the record type for the calling thread.
+ */
+void ava_call_record_free(struct ava_call_record_freelist *freelist, void *record);
+
+/**
+ * Register an in-flight call in a slot of the calling thread.
+ * @param number The call number from `ava_get_call_id`.
+ * @param record The call record.
+ * @return The call ID encoding the slot, or 0 if the calling thread has no free slot.
+ */
+intptr_t ava_call_slot_add(intptr_t number, void *record);
+
+/**
+ * Unregister an in-flight call. May be called from any thread.
+ * @param id A call ID returned by `ava_call_slot_add`.
+ * @return The call record.
+ */
+void *ava_call_slot_remove(intptr_t id);
+
+/**
+ * Get a snapshot of the call record counters.
+ * @param stats The structure to fill.
+ */
+void ava_call_record_get_stats(struct ava_call_record_stats *stats);
+
+/**
+ * Print the call record counters to `file`.
+ */
+void ava_call_record_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_CALL_RECORD_H
@@ -81,7 +81,7 @@ struct command_base {
    */
   /**
    * The flags of the command, and is assigned by hypervisor to mark the
-   * status of the command.
+   * status of the command. The sender may also set `COMMAND_FLAG_*` bits.
    */
   int8_t flags;
   /**
@@ -108,12 +108,99 @@ struct command_base {
   char reserved_area[64];
 };
 
+/**
+ * The sender does not expect a reply to this command. This is set on
+ * asynchronous calls which have no outputs, so the receiver can skip
+ * building and sending the RET command.
+ */
+#define COMMAND_FLAG_NO_REPLY 0x1
+
+/**
+ * The data region of this command is worth compressing on channels which
+ * support it (see compress.h). This is set on commands carrying an
+ * `ava_compress` buffer.
+ */
+#define COMMAND_FLAG_COMPRESSIBLE 0x2
+
+/**
+ * The data region of this command is compressed on the wire. Set and
+ * cleared by the channel, so received commands never have it.
+ */
+#define COMMAND_FLAG_COMPRESSED 0x4
+
+/**
+ * The command is stored in a memfd segment which is passed with its
+ * header, instead of following the header on the wire. Set and cleared
+ * by the channel, so received commands never have it.
+ */
+#define COMMAND_FLAG_MEMFD 0x8
+
+/**
+ * The first failure of an asynchronous call whose success was forged by the
+ * guest. The worker keeps one per guest thread and sends it in the RET command
+ * of the next synchronous call made by that thread. See
+ * `ava_async_error_report`.
+ */
+struct ava_async_error {
+  /** True (non-zero) if an asynchronous call failed. */
+  uint8_t failed;
+  /** The command ID of the CALL command of the failed call. */
+  uintptr_t command_id;
+  /** Identifies the return type of the failed function (a CRC-32 of its
+   * spelling), so only functions of the same return type return the error. */
+  uint32_t type_id;
+  /** The value returned by the failed call. */
+  int64_t value;
+};
+
+/**
+ * How an `ava_dedup_input` buffer is sent in a CALL command. See dedup.h.
+ */
+enum ava_dedup_state {
+  /** The buffer is attached and is not stored by the worker. */
+  AVA_DEDUP_NONE = 0,
+  /** The buffer is attached and the worker stores it under its digest. */
+  AVA_DEDUP_DATA,
+  /** Only the digest is sent. The worker reads the buffer from its store. */
+  AVA_DEDUP_DIGEST,
+};
+
+/**
+ * The digest of an `ava_dedup_input` buffer.
+ */
+struct ava_dedup_digest {
+  /** The SHA-256 of the contents of the buffer. */
+  uint64_t hash[4];
+  /** An `enum ava_dedup_state`. */
+  uint8_t state;
+};
+
 /**
  * Disconnect this command channel and free all resources associated
  * with it.
  */
 void command_channel_free(struct command_channel* c);
 
+/**
+ * Open another channel between the endpoints of `chan`, for the
+ * commands of a single thread (see thread_channel.h). In the guestlib
+ * this connects to the worker of `chan`; in the worker this waits for
+ * the next such connection.
+ *
+ * @return The new channel, or NULL if `chan` does not support thread
+ * channels or the connection failed.
+ */
+struct command_channel* command_channel_new_thread_channel(struct command_channel* chan);
+
+/**
+ * @return Non-zero if the buffers of a command on `chan` are resolved
+ * relative to the command itself, so commands can be copied into a
+ * `COMMAND_HANDLER_BATCH` (see async_batch.h). Shared memory channels
+ * resolve buffers through their reservation in the parameter block,
+ * which a copy does not carry.
+ */
+int command_channel_has_command_relative_buffer_ids(const struct command_channel* chan);
+
 //! Sending
 
 /**
@@ -143,6 +230,17 @@ struct command_base* command_channel_new_command(struct command_channel* chan, s
  */
 void* command_channel_attach_buffer(struct command_channel* chan, struct command_base* cmd, const void* buffer, size_t size);
 
+/**
+ * Attach a buffer to a command like `command_channel_attach_buffer`,
+ * but allow the channel to send `buffer` from where it is instead of
+ * copying it into the command. `buffer` must not be modified or freed
+ * until after the call to `command_channel_send_command`.
+ *
+ * Channels which cannot reference buffers copy them.
+ */
+void* command_channel_attach_buffer_by_reference(struct command_channel* chan, struct command_base* cmd,
+                                                 const void* buffer, size_t size);
+
 /**
  * Send the message and all its attached buffers.
  *
@@ -322,6 +420,8 @@ struct command_channel* command_channel_socket_tcp_migration_new(int worker_port
 std::vector<struct command_channel*> command_channel_socket_tcp_guest_new();
 #endif
 struct command_channel* command_channel_socket_tcp_worker_new(int worker_port);
+struct command_channel* command_channel_socket_unix_guest_new(void);
+struct command_channel* command_channel_socket_unix_worker_new(int listen_port);
 struct command_channel_log *command_channel_log_new(int worker_port);
 
 //! Hypervisor
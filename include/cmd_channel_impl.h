@@ -23,6 +23,13 @@ struct command_channel_vtable {
     void (*command_channel_free_command)(struct command_channel* chan, struct command_base* cmd);
     void (*command_channel_free)(struct command_channel* chan);
     void (*command_channel_print_command)(const struct command_channel* chan, const struct command_base* cmd);
+    /* Optional: NULL if the channel always copies attached buffers. */
+    void* (*command_channel_attach_buffer_by_reference)(struct command_channel* chan, struct command_base* cmd, void* buffer, size_t size);
+    /* Optional: NULL if the channel cannot open more connections between its endpoints. */
+    struct command_channel* (*command_channel_new_thread_channel)(struct command_channel* chan);
+    /* Non-zero if buffer IDs are offsets from the start of their command, so a copy of a command
+     * (e.g., in a batch) still resolves its buffers. */
+    int command_relative_buffer_ids;
 };
 
 #define __COMMAND_CHANNEL_VTABLE_CHECK_METHOD(vtable, n) assert(vtable.n != NULL && (#vtable " is missing value for " #n))
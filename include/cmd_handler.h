@@ -101,7 +101,13 @@ enum command_handler_command_id {
     COMMAND_START_LIVE_MIGRATION,
     COMMAND_END_MIGRATION,
     COMMAND_ACCEPT_LIVE_MIGRATION,
-    COMMAND_END_LIVE_MIGRATION
+    COMMAND_END_LIVE_MIGRATION,
+    COMMAND_HANDLER_BATCH,
+    COMMAND_HANDLER_STREAM_CHUNK,
+    COMMAND_HANDLER_STREAM_ACK,
+    COMMAND_HANDLER_THREAD_CHANNEL,
+    COMMAND_HANDLER_BARRIER,
+    COMMAND_HANDLER_BARRIER_MARKER
 };
 
 struct command_handler_initialize_api_command {
@@ -116,6 +122,51 @@ struct ava_replay_command_pair_t {
     void* ret_cmd;
 };
 
+/**
+ * A batch of commands sent by one thread (see common/async_batch.h).
+ * `commands` is a buffer containing `command_count` commands. Each
+ * command is immediately followed by its data region and padded to
+ * `COMMAND_HANDLER_BATCH_ALIGNMENT` bytes.
+ */
+struct command_handler_batch_command {
+    struct command_base base;
+    uint32_t command_count;
+    void* commands;
+};
+
+#define COMMAND_HANDLER_BATCH_ALIGNMENT 8
+#define command_handler_batch_entry_size(cmd) \
+    (((cmd)->command_size + (cmd)->region_size + COMMAND_HANDLER_BATCH_ALIGNMENT - 1) & \
+     ~((size_t)COMMAND_HANDLER_BATCH_ALIGNMENT - 1))
+
+/**
+ * A chunk of a streamed buffer (see common/stream.h). `data` is a
+ * buffer containing bytes `offset` to `offset + size` of the stream.
+ * The receiver acknowledges each chunk with a
+ * `COMMAND_HANDLER_STREAM_ACK` command without payload.
+ */
+struct command_handler_stream_chunk_command {
+    struct command_base base;
+    int64_t stream_id;
+    uint64_t total_size;
+    uint64_t offset;
+    uint64_t size;
+    void* data;
+};
+
+/**
+ * A barrier between thread channels (see common/thread_channel.h). A
+ * `COMMAND_HANDLER_BARRIER_MARKER` with the same `barrier_id` is sent
+ * on each of the `marker_count` other thread channels, and the
+ * receiver handles the commands following the
+ * `COMMAND_HANDLER_BARRIER` only once all markers were handled.
+ */
+struct command_handler_barrier_command {
+    struct command_base base;
+    uint64_t barrier_id;
+    uint32_t marker_count;
+};
+
 #endif
 
 /**
@@ -0,0 +1,91 @@
+#ifndef AVA_COMPRESS_H
+#define AVA_COMPRESS_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+// Forward declarations of structs to avoid dependency cycles in the includes.
+struct command_base;
+
+/**
+ * \section Data region compression
+ *
+ * The socket channels (TCP and vsock) can compress the data region of a command with zlib at
+ * level 1 before sending it. The receiver decompresses it before returning the command, so
+ * `command_channel_get_buffer` and the generated handlers see the original data.
+ *
+ * Which commands are compressed is chosen by the `AVA_COMPRESS` environment variable of the
+ * sender:
+ *
+ * - `annotated` (the default): commands carrying an `ava_compress` buffer (marked with
+ *   `COMMAND_FLAG_COMPRESSIBLE` by the generated code),
+ * - `all`: all commands,
+ * - `off`: none.
+ *
+ * Only data regions of at least `AVA_COMPRESS_THRESHOLD` bytes (default 64 KiB) are compressed.
+ * Before compressing, the sender estimates the entropy of a sample of the region and sends
+ * regions which look incompressible (for instance already compressed or encrypted data) as
+ * they are. The compressed region is also sent as it is if it is not smaller. If
+ * `AVA_COMPRESS_STATS` is set, the guestlib and the worker print their counters when they exit.
+ */
+
+/**
+ * Compression counters of this process (summed over all threads).
+ */
+struct ava_compress_stats {
+    /** The number of data regions compressed. */
+    uint64_t compressed;
+    /** The number of data regions considered but sent uncompressed. */
+    uint64_t skipped;
+    /** The size of the compressed regions before compression. */
+    uint64_t bytes_in;
+    /** The size of the compressed regions after compression. */
+    uint64_t bytes_out;
+    /** The time spent compressing and decompressing, in microseconds. */
+    uint64_t time_us;
+};
+
+/**
+ * @return Non-zero if the compression policy selects the data region of `cmd` for compression. The
+ *     region may still be sent as it is if it turns out to be incompressible.
+ */
+int ava_compress_selected(const struct command_base *cmd);
+
+/**
+ * Compress the data region of a command if the compression policy selects it.
+ * @param cmd The command. Its data region must be stored right after the command struct.
+ * @param compressed Set to the compressed data region, which the caller must free, or NULL.
+ * @return The size of the compressed data region, or 0 if the region should be sent as it is.
+ */
+size_t ava_compress_command(const struct command_base *cmd, void **compressed);
+
+/**
+ * Decompress a data region compressed by `ava_compress_command`.
+ * @param src The compressed data.
+ * @param src_size The size of the compressed data.
+ * @param dst The buffer to decompress into.
+ * @param dst_size The size of the original data region.
+ */
+void ava_decompress_region(const void *src, size_t src_size, void *dst, size_t dst_size);
+
+/**
+ * Get a snapshot of the compression counters.
+ * @param stats The structure to fill.
+ */
+void ava_compress_get_stats(struct ava_compress_stats *stats);
+
+/**
+ * Print the compression counters to `file`.
+ */
+void ava_compress_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_COMPRESS_H
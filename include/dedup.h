@@ -0,0 +1,68 @@
+#ifndef AVA_DEDUP_H
+#define AVA_DEDUP_H
+
+#include <glib.h>
+#include <stddef.h>
+#include <stdio.h>
+
+#include "common/cmd_channel.h"
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * \section Input buffer deduplication
+ *
+ * Generated guest stubs hash `ava_dedup_input` buffers of at least `AVA_DEDUP_MIN_SIZE` bytes
+ * (default 4096) with SHA-256. The guest remembers the digests of the last `AVA_DEDUP_GUEST_ENTRIES` buffers it
+ * sent (default 4096). If a buffer has been sent before, the CALL command carries only its digest
+ * and the worker reads the buffer from its content store. Otherwise the buffer is attached and the
+ * worker stores it, after checking that the buffer matches its digest.
+ *
+ * The worker's store holds at most `AVA_DEDUP_STORE_SIZE` bytes (default 256 MiB) and evicts the
+ * least recently used buffer. If the worker no longer has a buffer, it replies without executing
+ * the call and the guest stub forgets the digest and sends the call once more with the data of
+ * all its deduplicated buffers. If
+ * `AVA_DEDUP_STATS` is set, the guestlib and the worker print their counters when they exit.
+ */
+
+/**
+ * Hash an `ava_dedup_input` buffer and decide how to send it.
+ * @param buffer The buffer.
+ * @param size The size of the buffer in bytes.
+ * @param send_data If non-zero the buffer is attached even if the worker should have it (used to
+ * send a call again after a miss).
+ * @param digest The digest to fill. `digest->state` is set to `AVA_DEDUP_DIGEST` if the worker
+ * should already have the buffer, `AVA_DEDUP_DATA` if it should store it, and `AVA_DEDUP_NONE` if
+ * the buffer is too small to deduplicate.
+ */
+void ava_dedup_digest(const void *buffer, size_t size, int send_data, struct ava_dedup_digest *digest);
+
+/**
+ * Forget that the worker has the buffer with `digest`. Called when the worker reports a miss.
+ */
+void ava_dedup_forget(const struct ava_dedup_digest *digest);
+
+/**
+ * Look up a buffer in the worker's content store.
+ * @return A new reference to the buffer, or NULL if it is not stored.
+ */
+GBytes *ava_dedup_store_lookup(const struct ava_dedup_digest *digest);
+
+/**
+ * Copy a buffer into the worker's content store. The buffer is not stored if it does not match
+ * `digest`.
+ */
+void ava_dedup_store_insert(const struct ava_dedup_digest *digest, const void *buffer, size_t size);
+
+/**
+ * Print the deduplication counters of this process to `file`.
+ */
+void ava_dedup_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_DEDUP_H
@@ -22,6 +22,8 @@ using namespace std;
 #include <sys/time.h>
 
 #include "common/murmur3.h"
+#include "common/buffer_pool.h"
+#include "common/call_record.h"
 #include "common/cmd_channel.h"
 #include "common/cmd_handler.h"
 #include "common/shadow_thread_pool.h"
@@ -35,6 +37,11 @@ extern "C" {
 
 #define __ava_check_type(type, expr) ({ type __tmp = (expr); __tmp; })
 
+/**
+ * A handle pool maps the handles of one side to the IDs sent over the
+ * channel. Dereferencing an ID never locks; looking up the ID of a handle
+ * only locks if the handle is new.
+ */
 struct nw_handle_pool;
 
 struct nw_handle_pool* nw_handle_pool_new();
@@ -43,13 +50,36 @@ void* nw_handle_pool_insert(struct nw_handle_pool *pool,
                             const void* handle);
 void* nw_handle_pool_lookup_or_insert(struct nw_handle_pool *pool,
                                       const void* handle);
+/**
+ * Translate `n` handles to IDs as `nw_handle_pool_lookup_or_insert` does.
+ * `ids` may alias `handles`.
+ */
+void nw_handle_pool_lookup_or_insert_n(struct nw_handle_pool *pool, void **ids,
+                                       const void *const *handles, size_t n);
 GPtrArray * nw_handle_pool_get_live_handles(struct nw_handle_pool *pool);
 void* nw_handle_pool_deref(struct nw_handle_pool *pool,
                            const void* id);
+/**
+ * Translate `n` IDs to handles as `nw_handle_pool_deref` does. `handles`
+ * may alias `ids`.
+ */
+void nw_handle_pool_deref_n(struct nw_handle_pool *pool, void **handles,
+                            const void *const *ids, size_t n);
 void* nw_handle_pool_deref_and_remove(struct nw_handle_pool *pool,
                                       const void* id);
 void nw_handle_pool_assign_handle(struct nw_handle_pool *pool, const void *id,
                                   const void *handle);
+void* nw_handle_pool_new_id(void);
+void nw_handle_pool_assign_poison(struct nw_handle_pool *pool, const void *id,
+                                  const struct ava_async_error *error);
+/**
+ * Check if `id` was poisoned by `nw_handle_pool_assign_poison`.
+ * @param error Filled with the error of the call which failed to create the
+ * handle of `id`, if it was poisoned.
+ * @return True (non-zero) if `id` is poisoned.
+ */
+int nw_handle_pool_poisoned(struct nw_handle_pool *pool, const void *id,
+                            struct ava_async_error *error);
 
 gboolean nw_hash_table_remove_flipped(gconstpointer key, GHashTable *hash_table);
 
@@ -224,6 +254,47 @@ void ava_extract_objects_in_pair(struct command_channel *output_chan, struct com
  */
 void ava_handle_replace_explicit_state(struct command_channel *chan, struct nw_handle_pool *handle_pool, struct ava_replay_command_t *cmd);
 
+//! Deferred errors of asynchronous calls
+
+/**
+ * How the guest reports deferred errors. The policy is selected with the
+ * `AVA_ASYNC_ERROR_POLICY` environment variable (`return`, `log`, or `abort`).
+ */
+enum ava_async_error_policy {
+    /** Return the error from the synchronous call, if that call succeeded and returns a value with a success value
+     * of the same type as the failed call. Otherwise, log it. */
+    AVA_ASYNC_ERROR_RETURN = 0,
+    /** Log the error to stderr. */
+    AVA_ASYNC_ERROR_LOG,
+    /** Log the error and abort. */
+    AVA_ASYNC_ERROR_ABORT,
+};
+
+/**
+ * Record the failure of an asynchronous call on the current (worker) thread.
+ * Only the first failure is kept until it is taken.
+ * @param command_id The ID of the CALL command which failed.
+ * @param type_id The identifier of the return type of the function (see `struct ava_async_error`).
+ * @param value The value returned by the call.
+ */
+void ava_async_error_record(uintptr_t command_id, uint32_t type_id, int64_t value);
+
+/**
+ * Move the current (worker) thread's deferred error into `error` and clear it.
+ * @param error The error field of a RET command.
+ */
+void ava_async_error_take(struct ava_async_error *error);
+
+/**
+ * Report a deferred error received by the guest according to the policy.
+ * @param error The error received in the RET command of a synchronous call.
+ * @param function_name The name of the synchronous function.
+ * @param can_return True (non-zero) if the synchronous function can return the error, i.e., its return type is the
+ *     type of the error.
+ * @return True (non-zero) if the synchronous function should return the error.
+ */
+int ava_async_error_report(const struct ava_async_error *error, const char *function_name, int can_return);
+
 //! Custom allocator/deallocator handling
 struct ava_buffer_with_deallocator;
 
@@ -279,6 +350,10 @@ struct ava_endpoint {
     pthread_mutex_t call_map_mutex;
     atomic_long call_counter;
     struct ava_zcopy_region *zcopy_region;
+    /* The size in bytes from which input buffers are staged in the zero-copy region. */
+    size_t zcopy_threshold;
+    /* The size in bytes of the blocks compared by shadow buffer delta transfers, or 0 to always send them whole. */
+    size_t shadow_block_size;
     struct ava_shadow_buffer_pool shadow_buffers;
 #ifdef AVA_BENCHMARKING_MIGRATE
     intptr_t migration_call_id;
@@ -301,19 +376,21 @@ __attribute__ ((pure))
 struct ava_metadata_base *ava_internal_metadata(struct ava_endpoint *endpoint, const void *p);
 
 /**
- * Get the next call ID.
+ * Get the next call number.
  * @param endpoint The endpoint structure.
- * @return A new call ID.
+ * @return A new call number, which is also the ID of calls which are not added with `ava_add_call`.
  */
 intptr_t ava_get_call_id(struct ava_endpoint *endpoint);
 
 /**
- * Add a call record to the collection on in-flight calls.
+ * Add a call record to the collection on in-flight calls. The record is put in a slot of the
+ * calling thread if it has a free one (see call_record.h), otherwise in the locked call map.
  * @param endpoint
- * @param id The call ID.
+ * @param number The call number from `ava_get_call_id`.
  * @param ptr The call record itself.
+ * @return The call ID to send with the call.
  */
-void ava_add_call(struct ava_endpoint *endpoint, intptr_t id, void *ptr);
+intptr_t ava_add_call(struct ava_endpoint *endpoint, intptr_t number, void *ptr);
 
 /**
  * Find and remove a call record by its ID.
@@ -379,6 +456,28 @@ static uintptr_t ava_endpoint_zerocopy_get_physical_address(struct ava_endpoint
     return ava_zcopy_region_get_physical_address(endpoint->zcopy_region, ptr);
 }
 
+/**
+ * The default size in bytes from which input buffers are passed through the zero-copy region. It can be overridden
+ * with the `AVA_ZCOPY_THRESHOLD` environment variable and, for one function, with `ava_zerocopy_threshold`.
+ */
+#define AVA_ZCOPY_DEFAULT_THRESHOLD (256 * 1024)
+
+/**
+ * Choose how to transfer an input buffer of a synchronous call. Buffers which are already in the zero-copy region
+ * are passed by reference. Buffers of at least `threshold` bytes are copied into the zero-copy region (if it has
+ * room). Other buffers are copied into the command as usual.
+ * @param endpoint
+ * @param data The buffer.
+ * @param size The size of the buffer in bytes.
+ * @param threshold The size from which the buffer is staged in the zero-copy region.
+ * @param staging Set to the staged copy of `data`, or NULL. The caller must free it with
+ * `ava_endpoint_zerocopy_free` once the reply to the call has arrived.
+ * @return The pointer in the zero-copy region to send (encoded with
+ * `ava_zcopy_region_encode_position_independent`), or NULL if the buffer must be copied into the command.
+ */
+const void *ava_zcopy_select(struct ava_endpoint *endpoint, const void *data, size_t size, size_t threshold,
+                             void **staging);
+
 /**
  * Record a call with for the object `handle`.
  * @param endpoint
@@ -442,6 +541,8 @@ struct ava_buffer_header_t {
     /**
      * True (non-zero) if this buffer has real data. If this is False then there
      * is no data attached to this buffer and the content can be undefined.
+     * The non-zero values (`enum ava_shadow_buffer_data_t`) tell how the data
+     * is sent.
      */
     uint8_t has_data;
 
@@ -451,6 +552,70 @@ struct ava_buffer_header_t {
      * removed if the space this value takes up becomes an issue.
      */
     size_t size;
+
+    /**
+     * The version of the buffer the receiver has after this transfer, if the
+     * data is `AVA_SHADOW_BUFFER_FULL_TRACKED` or `AVA_SHADOW_BUFFER_DELTA`.
+     */
+    uintptr_t version;
+
+    /**
+     * The version of the buffer a delta applies to. The receiver does not
+     * apply a delta to any other version.
+     */
+    uintptr_t base_version;
+};
+
+/**
+ * How the data of a shadow buffer is attached after its `ava_buffer_header_t`.
+ */
+enum ava_shadow_buffer_data_t {
+    AVA_SHADOW_BUFFER_NO_DATA = 0,
+    /** The whole buffer. */
+    AVA_SHADOW_BUFFER_FULL,
+    /** The whole buffer, and the receiver should keep the digests of its blocks. */
+    AVA_SHADOW_BUFFER_FULL_TRACKED,
+    /** Only the ranges which changed since the last transfer (`ava_shadow_buffer_delta_t`). */
+    AVA_SHADOW_BUFFER_DELTA,
+};
+
+/**
+ * A range of a shadow buffer sent in a delta transfer.
+ */
+struct ava_shadow_buffer_range_t {
+    uint64_t offset;
+    uint64_t size;
+};
+
+/**
+ * The data of a delta transfer. The contents of the ranges are attached after this structure, each one as a
+ * separate buffer.
+ */
+struct ava_shadow_buffer_delta_t {
+    uint64_t range_count;
+    struct ava_shadow_buffer_range_t ranges[];
+};
+
+/**
+ * The default size in bytes of the blocks compared by delta transfers. It can be overridden with the
+ * `AVA_SHADOW_BLOCK_SIZE` environment variable. Setting it to 0 sends shadow buffers whole every time.
+ */
+#define AVA_SHADOW_DEFAULT_BLOCK_SIZE 4096
+
+/**
+ * Shadow buffer transfer counters of this process (summed over all threads).
+ */
+struct ava_shadow_buffer_stats {
+    /** The number of buffers sent whole. */
+    uint64_t full_transfers;
+    /** The number of buffers sent as deltas. */
+    uint64_t delta_transfers;
+    /** The number of data bytes sent. */
+    uint64_t bytes_sent;
+    /** The number of data bytes which were not sent because they did not change. */
+    uint64_t bytes_saved;
+    /** The number of deltas received for another version of the buffer. */
+    uint64_t delta_misses;
 };
 
 __attribute__ ((pure))
@@ -468,9 +633,34 @@ static inline size_t ava_shadow_buffer_size_without_data(
     return command_channel_buffer_size(chan, sizeof(struct ava_buffer_header_t));
 }
 
+/**
+ * Compute the size of a simple buffer attached with `ava_shadow_buffer_attach_buffer`, sending only the blocks of
+ * `local` which changed since its last transfer. The blocks are compared with the digests kept since then. If too
+ * much changed (or the buffer has not been sent yet), the size of the whole buffer is returned instead.
+ *
+ * The new digests are committed to the record of `local` under its lock, together with a new version of the
+ * buffer. A delta names the version it applies to, and the receiver only applies it to that version, so concurrent
+ * transfers of the same buffer cannot leave the two sides with different digests.
+ *
+ * The choice is remembered by the calling thread until `local` is attached, so `local` must not change in between.
+ * Every call must be followed by the attachment of `local` with `ava_shadow_buffer_attach_buffer`.
+ *
+ * Delta transfers assume that the receiver does not change its copy of the buffer unless it sends it back.
+ * @param endpoint
+ * @param chan
+ * @param local The buffer.
+ * @param size The size of the buffer in bytes.
+ * @param whole If true, the whole buffer is sent, and the receiver starts tracking it again.
+ * @return The size to reserve in the command.
+ */
+size_t ava_shadow_buffer_delta_size(
+        struct ava_endpoint *endpoint, struct command_channel *chan, const void *local, size_t size, int whole);
+
 
 /**
  * Attach a buffer to a command with all information need to make or update a shadow buffer.
+ * If the size of the buffer was computed with `ava_shadow_buffer_delta_size`, only the blocks which changed are
+ * attached.
  * @param endpoint
  * @param chan
  * @param cmd
@@ -510,14 +700,55 @@ void *ava_shadow_buffer_attach_buffer_without_data(
         ava_allocator alloc, ava_deallocator dealloc,
         struct ava_buffer_header_t *header);
 
-__attribute__ ((pure))
+/**
+ * Find or create the local buffer of a buffer attached with `ava_shadow_buffer_attach_buffer`. If only the changed
+ * blocks were attached, they are copied into the local buffer.
+ *
+ * A delta for another version of the local buffer is a miss. If `retryable` is true, the delta is not applied and
+ * the miss is reported by `ava_shadow_buffer_take_miss`, so the command can be sent again with whole buffers.
+ * Otherwise the delta is applied anyway and the buffer is no longer tracked, so its next transfer is whole.
+ * @param retryable True if the sender can send the command again.
+ * @return The local buffer.
+ */
 void *ava_shadow_buffer_get_buffer(
         struct ava_endpoint *endpoint, struct command_channel *chan, struct command_base *cmd,
         void *offset, enum ava_lifetime_t lifetime, void *lifetime_coupled, size_t *size_out,
-        ava_allocator alloc, ava_deallocator dealloc);
+        ava_allocator alloc, ava_deallocator dealloc, int retryable);
+
+/**
+ * @return True if a retryable delta received by the calling thread missed since the last call, and reset the flag.
+ */
+int ava_shadow_buffer_take_miss(void);
+
+/**
+ * Forget the digests of all shadow buffers, so their next transfers are whole. This must be called when the other
+ * side of the channel may have lost or replaced its copies of the buffers, as on migration.
+ */
+void ava_shadow_buffer_reset_digests(void);
+
+/**
+ * @param offset The attached buffer.
+ * @param local The local buffer returned by `ava_shadow_buffer_get_buffer`.
+ * @return The data to copy into `local`. This is `local` itself if only the changed blocks were attached, because
+ * `ava_shadow_buffer_get_buffer` has already copied them.
+ */
+__attribute__ ((pure))
+const void *ava_shadow_buffer_get_data(struct command_channel *chan, struct command_base *cmd, void *offset,
+                                       const void *local);
 
 void ava_shadow_buffer_free_coupled(struct ava_endpoint *endpoint, void *obj);
 
+/**
+ * Get a snapshot of the shadow buffer transfer counters.
+ * @param stats The structure to fill.
+ */
+void ava_shadow_buffer_get_stats(struct ava_shadow_buffer_stats *stats);
+
+/**
+ * Print the shadow buffer transfer counters to `file`.
+ */
+void ava_shadow_buffer_print_stats(FILE *file);
+
 #ifdef __cplusplus
 }
 #endif
@@ -0,0 +1,30 @@
+#ifndef AVA_ENV_H
+#define AVA_ENV_H
+
+#include <stddef.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * \section Environment configuration
+ *
+ * The runtime modules read their tuning parameters from `AVA_*` environment variables once, when
+ * they are first used.
+ */
+
+/**
+ * Read a size or count from the environment.
+ * @param name The name of the environment variable.
+ * @param default_value The value if the variable is unset or empty.
+ * @return The value of the variable, parsed with `strtoull` (so it may be decimal, octal or
+ * hexadecimal).
+ */
+size_t ava_getenv_size(const char *name, size_t default_value);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_ENV_H
@@ -0,0 +1,103 @@
+#ifndef AVA_MEMOIZE_H
+#define AVA_MEMOIZE_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+// Forward declarations of structs to avoid dependency cycles in the includes.
+struct command_channel;
+struct command_base;
+
+/**
+ * \section Worker call memoization
+ *
+ * Generated worker handlers for `ava_memoize` functions look up the SHA-256 of the CALL command
+ * (its API and command IDs, arguments and data region, excluding the call ID) in a persistent
+ * on-disk cache before executing the call. On a hit, the cached RET command is sent without
+ * calling the native function. Successful replies are added to the cache.
+ *
+ * The cache is stored in `AVA_MEMOIZE_DIR` (default `$XDG_CACHE_HOME/ava/memoize`, or
+ * `~/.cache/ava/memoize`), one file per reply, and is shared by all workers using the directory.
+ * The directory must be owned by the user running the worker and have mode 0700, otherwise
+ * memoization is disabled. Symbolic links in the directory are not followed. The cache holds at
+ * most `AVA_MEMOIZE_MAX_SIZE` bytes (default 1 GiB; 0 disables memoization) and evicts the least
+ * recently used replies. If `AVA_MEMOIZE_STATS` is set, the worker prints the hit and miss
+ * counters when it exits.
+ *
+ * Replaying a reply cannot reproduce the effects of a call on worker objects, so `ava_memoize`
+ * functions cannot take or return handles, callbacks, files or zero-copy buffers.
+ */
+
+/**
+ * The digest of a CALL command.
+ */
+struct ava_memoize_key {
+    /** The SHA-256 of the command. */
+    uint8_t hash[32];
+};
+
+/**
+ * Memoization counters of this process.
+ */
+struct ava_memoize_stats {
+    /** The number of calls answered from the cache. */
+    uint64_t hits;
+    /** The number of calls which were executed. */
+    uint64_t misses;
+    /** The number of replies added to the cache. */
+    uint64_t stores;
+    /** The number of replies evicted from the cache. */
+    uint64_t evictions;
+    /** The size of the cache in bytes. */
+    uint64_t size;
+};
+
+/**
+ * Compute the key of a CALL command.
+ * @param chan The channel `call` was received on.
+ * @param call The CALL command.
+ * @param header_size The size of the part of `call` which is not hashed (the command header and the
+ * call ID).
+ * @param key The key to fill.
+ */
+void ava_memoize_key(const struct command_channel *chan, const struct command_base *call, size_t header_size,
+                     struct ava_memoize_key *key);
+
+/**
+ * Load a cached reply.
+ * @param chan The channel to create the reply on.
+ * @param key The key of the CALL command.
+ * @return A new RET command, or NULL if the key is not cached. The caller must set the header
+ * fields of the command which identify the call.
+ */
+struct command_base *ava_memoize_load(struct command_channel *chan, const struct ava_memoize_key *key);
+
+/**
+ * Add a reply to the cache.
+ * @param chan The channel `ret` was created on.
+ * @param ret The RET command. It is not modified.
+ * @param key The key of the CALL command.
+ */
+void ava_memoize_store(const struct command_channel *chan, const struct command_base *ret,
+                       const struct ava_memoize_key *key);
+
+/**
+ * Get a snapshot of the memoization counters.
+ */
+void ava_memoize_get_stats(struct ava_memoize_stats *stats);
+
+/**
+ * Print the memoization counters to `file`.
+ */
+void ava_memoize_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_MEMOIZE_H
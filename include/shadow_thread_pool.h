@@ -14,12 +14,17 @@ extern "C" {
 // Forward declarations of structs to avoid dependency cycles in the includes.
 struct command_channel;
 struct command_base;
+struct shadow_thread_t;
 
 /**
  * A shadow thread pool manages a set of threads based on incoming command's `thread_id`s.
  * The pool will also handle "solid" threads: threads where are not managed by the pool,
  * and have a remote shadow at the other end of the AvA transport. A thread become a solid
  * thread as soon as it calls `shadow_thread_id(pool)`.
+ *
+ * Commands are handed to each thread through a lock-free ring (see spsc_ring.h), or through a
+ * `GAsyncQueue` only if `AVA_SHADOW_QUEUE=async_queue` is set. Threads with a thread channel
+ * (see thread_channel.h) receive their commands from it directly instead.
  */
 struct shadow_thread_pool_t;
 
@@ -51,6 +56,45 @@ int shadow_thread_handle_single_command(struct shadow_thread_pool_t *pool);
  */
 intptr_t shadow_thread_id(struct shadow_thread_pool_t *pool);
 
+/**
+ * Start a shadow thread which receives the commands of the remote thread `ava_id` from `chan`
+ * instead of from the pool (see thread_channel.h). The thread frees `chan` when it exits.
+ *
+ * @param pool The pool.
+ * @param ava_id The ID of the remote solid thread.
+ * @param chan The thread channel of the remote thread.
+ */
+struct shadow_thread_t* shadow_thread_new_on_channel(struct shadow_thread_pool_t *pool, intptr_t ava_id,
+                                                     struct command_channel *chan);
+
+/**
+ * @param pool The pool.
+ * @return The thread channel of the current thread or, if it has none, the thread channel served
+ * for its ID by `shadow_thread_new_on_channel`, or NULL if it uses the global channel.
+ */
+struct command_channel* shadow_thread_channel(struct shadow_thread_pool_t *pool);
+
+/**
+ * Make the current thread send and receive all its commands on `chan`. The thread frees `chan`
+ * when it exits.
+ *
+ * @param pool The pool.
+ * @param chan The new thread channel of the current thread.
+ */
+void shadow_thread_set_channel(struct shadow_thread_pool_t *pool, struct command_channel *chan);
+
+/**
+ * Call `func` for every solid thread in the pool which has a thread channel. The pool is locked
+ * during the calls, so the channels are not freed.
+ *
+ * @param pool The pool.
+ * @param func The function to call with each channel and the ID of its thread.
+ * @param arg The last argument of `func`.
+ */
+void shadow_thread_pool_foreach_channel(struct shadow_thread_pool_t *pool,
+                                        void (*func)(struct command_channel *chan, intptr_t ava_id, void *arg),
+                                        void *arg);
+
 /**
  * Dispatch a single command to a thread pool. This call in non-blocking.
  *
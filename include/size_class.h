@@ -0,0 +1,144 @@
+#ifndef AVA_SIZE_CLASS_H
+#define AVA_SIZE_CLASS_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+#ifdef __cplusplus
+#include <atomic>
+using namespace std;
+#else
+#include <stdatomic.h>
+#endif
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+struct ava_size_class_pool;
+
+/**
+ * \section Size classes
+ *
+ * The buffer pool (`common/buffer_pool.h`) and the zero-copy region (`common/zcopy.h`) allocate
+ * blocks of size classes with per-thread caches. Sizes up to `1 << small_shift` bytes are rounded
+ * up to a multiple of the alignment, larger sizes to one of 4 classes per power of 2 up to
+ * `1 << max_shift` bytes. Each thread caches `cache_size` bytes or two batches of free blocks per
+ * class, whichever is more, so allocating and freeing does not take a lock. Full caches move a
+ * batch to a shared depot per class, and empty caches take a batch from it. Empty depots are
+ * refilled with chunks from the backing allocator, which the pool never returns to it.
+ *
+ * Allocations larger than the classes are left to the user of the pool.
+ */
+
+/**
+ * Counters of one or more pools. The threads add their counters every 256 operations.
+ */
+struct ava_size_class_counters {
+    atomic_ulong allocations;
+    atomic_ulong frees;
+    /** The sizes requested by the blocks in use, as passed to `ava_size_class_alloc`. */
+    atomic_long requested_bytes;
+    /** The sizes of the classes of the blocks in use, and the sizes passed to `ava_size_class_count`. */
+    atomic_long used_bytes;
+};
+
+/**
+ * The parameters of a pool.
+ */
+struct ava_size_class_config {
+    /** The granularity of the small classes. A power of 2; the blocks are aligned to it if the
+     * chunks and the header size are. */
+    size_t alignment;
+    /** The classes up to `1 << small_shift` bytes are multiples of the alignment. */
+    unsigned small_shift;
+    /** The size of the largest class is `1 << max_shift` bytes. */
+    unsigned max_shift;
+    /** The bytes reserved for the user before each block. */
+    size_t header_size;
+    /** The number of bytes moved between a thread cache and the depot at once, and the maximum
+     * number of blocks. */
+    size_t batch_size;
+    uint32_t max_batch;
+    /** The number of bytes each thread caches per class. */
+    size_t cache_size;
+    /** The size of the chunks, or 0 for chunks of one batch of blocks. */
+    size_t chunk_size;
+    /** The backing allocator. Returns a chunk of `size` bytes for blocks of `class_index`, or NULL. */
+    void *(*chunk_alloc)(void *context, size_t size, uint32_t class_index);
+    void *context;
+    /** The counters to which the threads add theirs. */
+    struct ava_size_class_counters *counters;
+};
+
+/**
+ * Create a pool. The configuration is copied.
+ */
+struct ava_size_class_pool *ava_size_class_pool_new(const struct ava_size_class_config *config);
+
+/**
+ * Destroy a pool. The counters of the thread caches are added, and the caches of the threads which
+ * are still running are dropped. The chunks belong to the backing allocator.
+ */
+void ava_size_class_pool_free(struct ava_size_class_pool *pool);
+
+/**
+ * @return The number of classes of the pool.
+ */
+uint32_t ava_size_class_count_classes(struct ava_size_class_pool *pool);
+
+/**
+ * @return The class of `size`, which must be at most `1 << max_shift`.
+ */
+uint32_t ava_size_class_index(struct ava_size_class_pool *pool, size_t size);
+
+/**
+ * @return The size of the blocks of `class_index`.
+ */
+size_t ava_size_class_size(struct ava_size_class_pool *pool, uint32_t class_index);
+
+/**
+ * Allocate a block from the cache of the calling thread. If neither the depot nor the backing
+ * allocator has a block, the free blocks of the thread are moved to the depots and the backing
+ * allocator is tried again.
+ * @param requested The size requested by the user, for the counters.
+ * @return The block, or NULL.
+ */
+void *ava_size_class_alloc(struct ava_size_class_pool *pool, uint32_t class_index, size_t requested);
+
+/**
+ * Free a block to the cache of the calling thread.
+ * @param requested The size passed to `ava_size_class_alloc`.
+ */
+void ava_size_class_free(struct ava_size_class_pool *pool, void *block, uint32_t class_index, size_t requested);
+
+/**
+ * Count operations which did not go through the classes in the counters of the calling thread.
+ */
+void ava_size_class_count(struct ava_size_class_pool *pool, uint64_t allocations, uint64_t frees,
+                          int64_t used_bytes);
+
+/**
+ * Move the free blocks of the calling thread to the depots.
+ */
+void ava_size_class_release_thread(struct ava_size_class_pool *pool);
+
+/**
+ * Add the counters of the calling thread to the counters of the pool.
+ */
+void ava_size_class_flush_stats(struct ava_size_class_pool *pool);
+
+/**
+ * Remove blocks from the depots, so the backing allocator can reuse their memory. For each class,
+ * `visit` is called on each block in the depot, then the blocks for which `remove` returns true are
+ * removed. The lock of the depot is held meanwhile.
+ */
+void ava_size_class_reclaim(struct ava_size_class_pool *pool,
+                            void (*visit)(void *context, void *block, uint32_t class_index),
+                            int (*remove)(void *context, void *block, uint32_t class_index), void *context);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_SIZE_CLASS_H
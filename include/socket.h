@@ -85,6 +85,54 @@ size_t send_socket(int sockfd, const void *buf, size_t size);
  **/
 size_t recv_socket(int sockfd, void *buf, size_t size);
 
+/**
+ * send_socket_iov - Send a list of buffers to the socket
+ * @sockfd: socket file descriptor
+ * @iov: the buffers to be sent, in order
+ * @iovcnt: the number of buffers
+ *
+ * The buffers are sent with as few `sendmsg` calls as possible. The
+ * entries of `iov` are modified to track partial sends. This function
+ * is lock-free, and should be protected by locks when being used.
+ **/
+size_t send_socket_iov(int sockfd, struct iovec *iov, int iovcnt);
+
+/**
+ * recv_socket_iov - Receive into a list of buffers from the socket
+ * @sockfd: socket file descriptor
+ * @iov: the buffers to be filled, in order
+ * @iovcnt: the number of buffers
+ *
+ * The entries of `iov` are modified to track partial receives. This
+ * function is lock-free, and should be protected by locks when being
+ * used.
+ **/
+size_t recv_socket_iov(int sockfd, struct iovec *iov, int iovcnt);
+
+/**
+ * send_socket_fd - Send buffer and a file descriptor to a Unix socket
+ * @sockfd: Unix socket file descriptor
+ * @buf: the buffer to be sent
+ * @size: the buffer size
+ * @fd: the file descriptor to pass with the first byte of `buf`
+ *
+ * This function is lock-free, and should be protected by locks when
+ * being used.
+ **/
+size_t send_socket_fd(int sockfd, const void *buf, size_t size, int fd);
+
+/**
+ * recv_socket_fd - Receive buffer and a file descriptor from a Unix socket
+ * @sockfd: Unix socket file descriptor
+ * @buf: the buffer to contain the received data
+ * @size: the data size
+ * @fd: set to the file descriptor passed with the data, or -1
+ *
+ * This function is lock-free, and should be protected by locks when
+ * being used.
+ **/
+size_t recv_socket_fd(int sockfd, void *buf, size_t size, int *fd);
+
 /**
  * parseServerAddress - Get host IP and port from a given full address
  * @full_address: can either be a full IP:port (e.g. 0.0.0.0:3333) or just
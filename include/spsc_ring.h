@@ -0,0 +1,114 @@
+#ifndef AVA_SPSC_RING_H
+#define AVA_SPSC_RING_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * \section Single-producer/single-consumer rings
+ *
+ * A ring is a bounded lock-free queue of 64-bit values with one producer thread and one consumer
+ * thread. It contains no pointers, so it can be placed in memory shared between processes (with
+ * `shared` set in `ava_spsc_ring_init`).
+ *
+ * A consumer which finds the ring empty waits adaptively: it spins for a while, then sleeps on a
+ * futex. The spin budget of each ring grows when spinning was enough to see the next value and
+ * shrinks when it was not, up to `AVA_RING_SPIN` iterations (default 4000, 0 to always sleep).
+ * The producer only makes a system call if the consumer is asleep.
+ *
+ * Waits are counted and printed when the guestlib or the worker exits if `AVA_RING_STATS` is set.
+ */
+struct ava_spsc_ring;
+
+/**
+ * Counters of the ring waits of this process (summed over all rings).
+ */
+struct ava_spsc_ring_stats {
+    /** The number of waits which ended while spinning. */
+    uint64_t spin_waits;
+    /** The number of waits which slept on the futex. */
+    uint64_t futex_waits;
+};
+
+/**
+ * @param capacity The number of values in the ring. Must be a power of 2.
+ * @return The size of a ring of `capacity` values.
+ */
+size_t ava_spsc_ring_size(uint32_t capacity);
+
+/**
+ * Initialize an empty ring.
+ * @param ring The memory of the ring, of `ava_spsc_ring_size(capacity)` bytes aligned to a cache line.
+ * @param capacity The number of values in the ring. Must be a power of 2.
+ * @param shared Non-zero if the ring is in memory shared between processes.
+ */
+void ava_spsc_ring_init(struct ava_spsc_ring *ring, uint32_t capacity, int shared);
+
+/**
+ * Allocate and initialize a ring for use inside this process.
+ */
+struct ava_spsc_ring *ava_spsc_ring_new(uint32_t capacity);
+
+/**
+ * Free a ring allocated by `ava_spsc_ring_new`.
+ */
+void ava_spsc_ring_free(struct ava_spsc_ring *ring);
+
+/**
+ * Append a value to the ring and wake the consumer if it is asleep. Producer only.
+ * @return Non-zero on success, 0 if the ring is full.
+ */
+int ava_spsc_ring_try_push(struct ava_spsc_ring *ring, uint64_t value);
+
+/**
+ * Remove the oldest value of the ring. Consumer only.
+ * @return Non-zero on success, 0 if the ring is empty.
+ */
+int ava_spsc_ring_try_pop(struct ava_spsc_ring *ring, uint64_t *value);
+
+/**
+ * Wake the consumer as if a value had been pushed. This lets a producer signal events which are
+ * not in the ring itself. Producer only.
+ */
+void ava_spsc_ring_kick(struct ava_spsc_ring *ring);
+
+/**
+ * @return The event sequence number of the ring, for `ava_spsc_ring_wait`. Consumer only.
+ */
+uint32_t ava_spsc_ring_sequence(const struct ava_spsc_ring *ring);
+
+/**
+ * Wait until a value is pushed or the ring is kicked after `sequence` was read with
+ * `ava_spsc_ring_sequence`. Consumer only.
+ *
+ * The consumer should read the sequence number, then check the ring and any other state signaled by
+ * kicks, and only then wait, so no event is missed.
+ */
+void ava_spsc_ring_wait(struct ava_spsc_ring *ring, uint32_t sequence);
+
+/**
+ * Remove the oldest value of the ring, waiting for one if the ring is empty. Consumer only.
+ */
+uint64_t ava_spsc_ring_pop(struct ava_spsc_ring *ring);
+
+/**
+ * Get a snapshot of the wait counters.
+ * @param stats The structure to fill.
+ */
+void ava_spsc_ring_get_stats(struct ava_spsc_ring_stats *stats);
+
+/**
+ * Print the wait counters to `file`.
+ */
+void ava_spsc_ring_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_SPSC_RING_H
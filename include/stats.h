@@ -0,0 +1,45 @@
+#ifndef AVA_STATS_H
+#define AVA_STATS_H
+
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/**
+ * \section Statistics
+ *
+ * The runtime modules which keep counters register the function which prints them, together with
+ * the environment variable which enables it (e.g., `AVA_BATCH_STATS`). When the guestlib or the
+ * worker exits, it prints the counters of every module whose variable is set, or of every module
+ * if `AVA_STATS` is set.
+ */
+
+/**
+ * A function which prints the counters of a module to `file`.
+ */
+typedef void (*ava_stats_printer)(FILE *file);
+
+/**
+ * The maximum number of modules which can register their counters.
+ */
+#define AVA_STATS_MAX_MODULES 32
+
+/**
+ * Register the counters of a module. Usually called from a constructor of the module.
+ * @param env_name The environment variable which enables printing the counters.
+ * @param print_stats The function which prints the counters.
+ */
+void ava_stats_register(const char *env_name, ava_stats_printer print_stats);
+
+/**
+ * Print the counters of the registered modules which are enabled, in registration order.
+ */
+void ava_stats_print(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_STATS_H
@@ -0,0 +1,127 @@
+#ifndef AVA_STREAM_H
+#define AVA_STREAM_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+// Forward declarations of structs to avoid dependency cycles in the includes.
+struct command_channel;
+struct command_base;
+
+/**
+ * \section Streamed buffer transfer
+ *
+ * Generated stubs send `ava_stream` buffers larger than `AVA_STREAM_CHUNK_SIZE` bytes (default
+ * 1 MiB) as a stream of `COMMAND_HANDLER_STREAM_CHUNK` commands instead of attaching them to the
+ * CALL or RET command. The receiver copies each chunk into place while the sender is still
+ * copying the following chunks into the channel, so the two copies overlap instead of adding up.
+ *
+ * Chunks are sent with the `thread_id` of the call, so they are handled in order by the thread
+ * which then handles the CALL or RET command:
+ *
+ * - For input buffers, the guest stub sends the chunks before the CALL command. The worker copies
+ *   them into a staging buffer, which the handler takes with `ava_stream_take`.
+ * - For output buffers, the guest stub registers the destination with `ava_stream_expect` and
+ *   the worker sends the chunks before the RET command. The guest copies them directly into the
+ *   destination.
+ *
+ * The receiver acknowledges every chunk. The sender waits for acknowledgements when
+ * `AVA_STREAM_DEPTH` chunks (default 4) are unacknowledged, which bounds the amount of channel
+ * memory used by a stream. If `AVA_STREAM_STATS` is set, the guestlib and the worker print the
+ * number of bytes they streamed and their throughput when they exit.
+ */
+
+/**
+ * Streaming counters of this process (summed over all threads).
+ */
+struct ava_stream_stats {
+    /** The number of streams sent. */
+    uint64_t streams;
+    /** The number of chunks sent. */
+    uint64_t chunks;
+    /** The number of bytes sent. */
+    uint64_t bytes;
+    /** The time spent sending streams, including waiting for acknowledgements, in microseconds. */
+    uint64_t send_time_us;
+};
+
+/**
+ * @return The size of a chunk in bytes. Generated stubs stream buffers larger than this.
+ */
+size_t ava_stream_chunk_size(void);
+
+/**
+ * @return A new stream ID. Stream IDs are never 0.
+ */
+int64_t ava_stream_new_id(void);
+
+/**
+ * Send a buffer as a stream of chunks and return once all of them are sent. The receiver may
+ * still be copying the last chunks.
+ * @param chan The channel to send the chunks on.
+ * @param stream_id The ID of the stream.
+ * @param data The buffer.
+ * @param size The size of the buffer in bytes.
+ * @param thread_id The thread which handles the chunks on the other end (the guest thread
+ * making the call).
+ */
+void ava_stream_send(struct command_channel *chan, int64_t stream_id, const void *data, size_t size,
+                     intptr_t thread_id);
+
+/**
+ * Register the destination of a stream which will be received by the calling thread. Chunks of
+ * streams which have not been registered are received into a staging buffer.
+ * @param stream_id The ID of the stream.
+ * @param dest The buffer to copy the chunks into.
+ * @param size The size of `dest` in bytes.
+ */
+void ava_stream_expect(int64_t stream_id, void *dest, size_t size);
+
+/**
+ * Take a stream which has been completely received by the calling thread.
+ * @param stream_id The ID of the stream.
+ * @param size The expected size of the stream in bytes.
+ * @return The received buffer. The caller must free it if it is a staging buffer, that is if the
+ * stream was not registered with `ava_stream_expect`.
+ */
+void *ava_stream_take(int64_t stream_id, size_t size);
+
+/**
+ * Drop a stream registered with `ava_stream_expect` by the calling thread, if it is still
+ * registered. Used when the sender did not stream the buffer after all.
+ */
+void ava_stream_forget(int64_t stream_id);
+
+/**
+ * Handle a `COMMAND_HANDLER_STREAM_CHUNK` command and acknowledge it.
+ * @param chan The channel `cmd` was received on.
+ * @param cmd The chunk.
+ */
+void ava_stream_handle_chunk(struct command_channel *chan, const struct command_base *cmd);
+
+/**
+ * Handle a `COMMAND_HANDLER_STREAM_ACK` command.
+ */
+void ava_stream_handle_ack(const struct command_base *cmd);
+
+/**
+ * Get a snapshot of the streaming counters.
+ * @param stats The structure to fill.
+ */
+void ava_stream_get_stats(struct ava_stream_stats *stats);
+
+/**
+ * Print the streaming counters to `file`.
+ */
+void ava_stream_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_STREAM_H
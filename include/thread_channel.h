@@ -0,0 +1,102 @@
+#ifndef AVA_THREAD_CHANNEL_H
+#define AVA_THREAD_CHANNEL_H
+
+#include <stdint.h>
+#include <stdio.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+// Forward declarations of structs to avoid dependency cycles in the includes.
+struct command_channel;
+struct command_base;
+
+/**
+ * \section Per-thread command channels
+ *
+ * By default every guest thread sends its commands on `nw_global_command_channel`, and a single
+ * handler thread in each process receives all commands and dispatches them to the shadow threads.
+ * If `AVA_THREAD_CHANNELS=1` is set for the guestlib, each guest thread instead opens its own
+ * channel to the worker the first time it calls the API (see
+ * `command_channel_new_thread_channel`). The worker serves each thread channel with a dedicated
+ * shadow thread, which sends the replies and callbacks back on the same channel, where the guest
+ * thread receives them itself. Threads therefore neither share the channel locks nor wait for the
+ * handler threads. Channels which do not support thread channels (only the socket channels do)
+ * keep using the global channel. A guest thread with a thread channel only receives from it, so
+ * the worker sends every command with the ID of that thread on its thread channel, including the
+ * commands of worker threads other than its shadow thread.
+ *
+ * The commands of a thread are handled in order, but the commands of different threads are not
+ * ordered anymore. Functions annotated `ava_global_order` are barriers: before sending the call,
+ * the guest sends a `COMMAND_HANDLER_BARRIER_MARKER` on every other thread channel, and the
+ * worker executes the call only once it has handled all markers, that is all commands which
+ * other threads sent before the call.
+ *
+ * If `AVA_THREAD_CHANNEL_STATS` is set, the guestlib and the worker print the number of thread
+ * channels and barriers when they exit.
+ */
+
+/**
+ * Thread channel counters of this process.
+ */
+struct ava_thread_channel_stats {
+    /** The number of thread channels opened (in the guestlib) or served (in the worker). */
+    uint64_t channels;
+    /** The number of barriers sent (in the guestlib) or executed (in the worker). */
+    uint64_t barriers;
+    /** The time the worker waited for the markers of barriers, in microseconds. */
+    uint64_t barrier_wait_us;
+};
+
+/**
+ * Enable thread channels in the guestlib if `AVA_THREAD_CHANNELS` is set. Must be called after
+ * the global channel is created.
+ */
+void ava_thread_channel_init_guest(void);
+
+/**
+ * Accept the thread channels of the guestlib in a background thread of the worker.
+ * @param listener The global channel of the worker.
+ */
+void ava_thread_channel_start_server(struct command_channel *listener);
+
+/**
+ * @return The channel the calling thread sends its commands on: its thread channel, opened on
+ * first use in the guestlib, or `nw_global_command_channel`.
+ */
+struct command_channel *ava_thread_command_channel(void);
+
+/**
+ * Order the next command of the calling thread after all commands already sent by other
+ * threads. Does nothing if the calling thread does not have a thread channel.
+ * @param chan The channel of the calling thread.
+ */
+void ava_thread_channel_barrier(struct command_channel *chan);
+
+/**
+ * Handle a `COMMAND_HANDLER_BARRIER` command: wait until all its markers are handled.
+ */
+void ava_thread_channel_handle_barrier(const struct command_base *cmd);
+
+/**
+ * Handle a `COMMAND_HANDLER_BARRIER_MARKER` command.
+ */
+void ava_thread_channel_handle_marker(const struct command_base *cmd);
+
+/**
+ * Get a snapshot of the thread channel counters.
+ * @param stats The structure to fill.
+ */
+void ava_thread_channel_get_stats(struct ava_thread_channel_stats *stats);
+
+/**
+ * Print the thread channel counters to `file`.
+ */
+void ava_thread_channel_print_stats(FILE *file);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif // AVA_THREAD_CHANNEL_H
@@ -7,6 +7,7 @@
 
 #include <stdlib.h>
 #include <stdint.h>
+#include <stdio.h>
 
 #ifdef __cplusplus
 extern "C" {
@@ -19,7 +20,47 @@ struct ava_zcopy_region;
  *
  * This API provides a simple way to access the zero-copy region provided by AvA.
  * The API is thread-safe.
+ *
+ * The region is divided in spans of 64 KiB. Allocations up to 32 KiB are rounded up to a multiple
+ * of 64 bytes up to 256 bytes, and to one of 4 classes per power of 2 above, and are carved from
+ * spans holding one class each. Each thread caches `AVA_ZCOPY_CACHE_SIZE` bytes (default 32 KiB)
+ * or two batches of free blocks per class, whichever is more, so allocating and freeing small and
+ * medium buffers does not take a lock. Full caches move a batch to a shared depot per class, and
+ * empty caches take a batch from it. Larger allocations take a run of whole spans (first fit).
+ * When no run of free spans is large enough, the spans whose blocks are all in the depots are
+ * returned to the free spans. Blocks are aligned to 64 bytes, and to their size if it is a power
+ * of 2; large allocations are aligned to spans (offsets in the region).
+ *
+ * The allocator state is local to the process: a buffer must be freed by the process (guest or
+ * worker) which allocated it. The region is advised to use huge pages, which takes effect if the
+ * driver backs it with pages which can be huge. If `AVA_ZCOPY_NUMA_NODE` is set, the pages of the
+ * region are preferably placed on that NUMA node.
+ *
+ * The allocation rates, occupancy and fragmentation of the regions are printed when the guestlib
+ * or the worker exits if `AVA_ZCOPY_STATS` is set.
+ */
+
+/**
+ * Zero-copy allocation counters of this process, for all regions.
  */
+struct ava_zcopy_stats {
+    /** The number of allocations, the number of them which took whole spans, and the number of them which failed. */
+    uint64_t allocations;
+    uint64_t large_allocations;
+    uint64_t failed_allocations;
+    /** The number of frees. */
+    uint64_t frees;
+    /** The time since the first region was created, in microseconds. */
+    uint64_t elapsed_us;
+    /** The sizes of the classes (or of the spans) of the buffers in use. */
+    uint64_t used_bytes;
+    /** The size of the spans holding buffers in use or free blocks of a class. */
+    uint64_t reserved_bytes;
+    /** The size of the regions. */
+    uint64_t region_bytes;
+    /** The size of the largest run of free spans, which bounds the largest allocation. */
+    uint64_t largest_free_bytes;
+};
 
 /**
  * Create a new zero-copy region. This version works in the worker.
@@ -42,6 +83,7 @@ void ava_zcopy_region_free_region(struct ava_zcopy_region *region);
  * @param region The region from which to allocate.
  * @param size The number of bytes to allocate.
  * @return A pointer to the allocated memory (in virtual memory) or NULL for failure (with errno set to ENOMEM).
+ *     The memory is uninitialized.
  */
 void *ava_zcopy_region_alloc(struct ava_zcopy_region *region, size_t size)
         __attribute_malloc__ __attribute_alloc_size__((2));
@@ -49,10 +91,20 @@ void *ava_zcopy_region_alloc(struct ava_zcopy_region *region, size_t size)
 /**
  * Free memory allocated in the region.
  * @param region The region from which the data was allocated.
- * @param ptr A pointer to the region to free.
+ * @param ptr A pointer returned by `ava_zcopy_region_alloc` in this process, or NULL.
  */
 void ava_zcopy_region_free(struct ava_zcopy_region *region, void *ptr);
 
+/**
+ * Check if a buffer is entirely inside the region.
+ * @param region The region.
+ * @param ptr The start of the buffer.
+ * @param size The size of the buffer in bytes.
+ * @return Non-zero if the buffer is in the region.
+ */
+int ava_zcopy_region_contains(struct ava_zcopy_region *region, const void *ptr, size_t size)
+        __attribute_pure__;
+
 /**
  * Get the physical pointer to a pointer in the given zero-copy region.
  * @param region The containing region.
@@ -80,6 +132,17 @@ void *ava_zcopy_region_encode_position_independent(struct ava_zcopy_region *regi
 void *ava_zcopy_region_decode_position_independent(struct ava_zcopy_region *region, const void *ptr)
         __attribute_pure__;
 
+/**
+ * Get a snapshot of the zero-copy allocation counters.
+ * @param stats The structure to fill.
+ */
+void ava_zcopy_get_stats(struct ava_zcopy_stats *stats);
+
+/**
+ * Print the allocation rate, occupancy and fragmentation of the zero-copy regions to `file`.
+ */
+void ava_zcopy_print_stats(FILE *file);
+
 #ifdef __cplusplus
 }
 #endif
@@ -44,6 +44,15 @@ void write_simple_buffer(struct simple_buffer_t *buf)
     }
 }
 
+void write_simple_buffers(struct simple_buffer_t *bufs, size_t count)
+{
+    for (int j=0; j < count; j ++) {
+        for (int i=0; i < bufs[j].size; i ++) {
+            bufs[j].buffer[i] = j * 100 + i;
+        }
+    }
+}
+
 void read_simple_buffer(struct simple_buffer_t *buf)
 {
     if (buf == NULL) {
@@ -333,6 +342,22 @@ void *benchmark_copy_out_shadow_buffer(size_t size, time_t execution_time)
     return data;
 }
 
+void benchmark_stream_in(void *data, size_t size, time_t execution_time)
+{
+    struct timeval start_time;
+    gettimeofday(&start_time, NULL);
+    benchmark_check_buffer(data, size);
+    benchmark_noop(execution_time, start_time);
+}
+
+void benchmark_stream_out(void *data, size_t size, time_t execution_time)
+{
+    struct timeval start_time;
+    gettimeofday(&start_time, NULL);
+    benchmark_fill_buffer(data, size);
+    benchmark_noop(execution_time, start_time);
+}
+
 static int touch_data = 1;
 
 void benchmark_check_buffer(const void *data, size_t size)
@@ -32,6 +32,7 @@ void function3b(int session, void *userdata);
 void write_simple_buffer(struct simple_buffer_t *buf);
 void mutate_simple_buffer(struct simple_buffer_t *buf);
 void read_simple_buffer(struct simple_buffer_t *buf);
+void write_simple_buffers(struct simple_buffer_t *bufs, size_t count);
 
 void read_call_buffer(int *buffer, size_t size);
 void mutate_call_buffer(int *buffer, size_t size);
@@ -74,5 +75,7 @@ void benchmark_copy_in_transfer_buffer(void *data, size_t size, time_t execution
 void benchmark_copy_in_shadow_buffer(void *data, size_t size, time_t execution_time);
 void benchmark_copy_out_existing_buffer(void *data, size_t size, time_t execution_time);
 void *benchmark_copy_out_shadow_buffer(size_t size, time_t execution_time);
+void benchmark_stream_in(void *data, size_t size, time_t execution_time);
+void benchmark_stream_out(void *data, size_t size, time_t execution_time);
 
 #endif //AVA_LIBTRIVIAL_H
@@ -1,4 +1,7 @@
+#include <math.h>
 #include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
 #include <unistd.h>
 #include <string.h>
 #include "libtrivial.h"
@@ -10,12 +13,13 @@ typedef void (*free_function)(void*);
 typedef void (*benchmark_function)(void *, size_t size, time_t work);
 
 void benchmark(const char* kind, int repetitions, size_t size, time_t work, benchmark_function func, alloc_function alloc, free_function free);
+void print_latency_histogram(const char *kind, double *latencies_us, int count);
 
 void benchmark_noop_wrapper(void *, size_t, time_t);
 void benchmark_copy_out_shadow_buffer_wrapper(void *, size_t, time_t);
 
 static void usage(const char *name) {
-    fprintf(stderr, "Usage: %s [-w ms] [-r nreps] [-s kiB] benchmark\nbenchmarks are: noop, in_transfer, in_shadow, out_existing, out_shadow\n",
+    fprintf(stderr, "Usage: %s [-w ms] [-r nreps] [-s kiB] benchmark\nbenchmarks are: noop, in_transfer, in_shadow, in_stream, out_existing, out_shadow, out_stream\n",
             name);
     exit(EXIT_FAILURE);
 }
@@ -53,10 +57,12 @@ int main(int argc, const char **argv)
 #define BENCHMARK_TYPE_CASE(name, n, func, alloc, free) if(strncmp(benchmark_name, name, n) == 0) { benchmark_name = name; benchmark_func = func; alloc_func = alloc; free_func = free; }
     BENCHMARK_TYPE_CASE("noop", 2, benchmark_noop_wrapper, malloc, free);
     BENCHMARK_TYPE_CASE("in_transfer", 4, benchmark_copy_in_transfer_buffer, malloc, free);
-    BENCHMARK_TYPE_CASE("in_shadow", 4, benchmark_copy_in_shadow_buffer, malloc, free);
+    BENCHMARK_TYPE_CASE("in_shadow", 5, benchmark_copy_in_shadow_buffer, malloc, free);
+    BENCHMARK_TYPE_CASE("in_stream", 5, benchmark_stream_in, malloc, free);
     BENCHMARK_TYPE_CASE("in_zerocopy", 4, benchmark_zero_copy_in, special_alloc, special_free);
     BENCHMARK_TYPE_CASE("out_existing", 5, benchmark_copy_out_existing_buffer, malloc, free);
-    BENCHMARK_TYPE_CASE("out_shadow", 5, benchmark_copy_out_shadow_buffer_wrapper, malloc, free);
+    BENCHMARK_TYPE_CASE("out_shadow", 6, benchmark_copy_out_shadow_buffer_wrapper, malloc, free);
+    BENCHMARK_TYPE_CASE("out_stream", 6, benchmark_stream_out, malloc, free);
     BENCHMARK_TYPE_CASE("out_zerocopy", 5, benchmark_zero_copy_out, special_alloc, special_free);
     BENCHMARK_TYPE_CASE("all", 3, (void*)1, NULL, NULL);
 #undef BENCHMARK_TYPE_CASE
@@ -64,14 +70,18 @@ int main(int argc, const char **argv)
         usage(argv[0]);
 
     printf("test,rep,time_ms\n");
+    // The histograms go to stderr, so stdout stays CSV. Set AVA_SHADOW_QUEUE to compare hand-off paths.
+    fprintf(stderr, "Command hand-off: %s\n", getenv("AVA_SHADOW_QUEUE") ? getenv("AVA_SHADOW_QUEUE") : "default");
 
     if (benchmark_func == (void*)1) {
         benchmark("noop", repetitions, size, work, benchmark_noop_wrapper, malloc, free);
         benchmark("in_transfer", repetitions, size, work, benchmark_copy_in_transfer_buffer, malloc, free);
         benchmark("in_shadow", repetitions, size, work, benchmark_copy_in_shadow_buffer, malloc, free);
+        benchmark("in_stream", repetitions, size, work, benchmark_stream_in, malloc, free);
         benchmark("in_zerocopy", repetitions, size, work, benchmark_zero_copy_in, special_alloc, special_free);
         benchmark("out_existing", repetitions, size, work, benchmark_copy_out_existing_buffer, malloc, free);
         benchmark("out_shadow", repetitions, size, work, benchmark_copy_out_shadow_buffer_wrapper, malloc, free);
+        benchmark("out_stream", repetitions, size, work, benchmark_stream_out, malloc, free);
         benchmark("out_zerocopy", repetitions, size, work, benchmark_zero_copy_out, special_alloc, special_free);
     } else {
         benchmark(benchmark_name, repetitions, size, work, benchmark_func, alloc_func, free_func);
@@ -82,8 +92,9 @@ int main(int argc, const char **argv)
 
 void benchmark(const char *kind, int repetitions, size_t size, time_t work, benchmark_function func, alloc_function alloc, free_function free)
 {
-    struct timestamp total_time;
+    struct timespec start, end;
     char *buffer = alloc(size);
+    double *latencies_us = malloc(sizeof(double) * repetitions);
 
     // Warm-up
     memset(buffer, 42, size);
@@ -92,15 +103,53 @@ void benchmark(const char *kind, int repetitions, size_t size, time_t work, benc
     // Real runs
     for (int rep = 0; rep < repetitions; rep++) {
 
-        probe_time_start(&total_time);
+        clock_gettime(CLOCK_MONOTONIC, &start);
         func(buffer, size, work);
-        float total = probe_time_end(&total_time);
+        clock_gettime(CLOCK_MONOTONIC, &end);
+        latencies_us[rep] = (end.tv_sec - start.tv_sec) * 1e6 + (end.tv_nsec - start.tv_nsec) / 1e3;
 
-        printf("%s,%2d,%.3f\n", kind, rep, total);
+        printf("%s,%2d,%.3f\n", kind, rep, latencies_us[rep] / 1000);
     }
+    print_latency_histogram(kind, latencies_us, repetitions);
+    free(latencies_us);
     free(buffer);
 }
 
+static int compare_doubles(const void *a, const void *b)
+{
+    double x = *(const double *)a, y = *(const double *)b;
+    return (x > y) - (x < y);
+}
+
+/**
+ * Print the percentiles of the latencies and their histogram with power-of-two buckets to stderr.
+ */
+void print_latency_histogram(const char *kind, double *latencies_us, int count)
+{
+    if (count == 0)
+        return;
+    qsort(latencies_us, count, sizeof(double), compare_doubles);
+    fprintf(stderr, "%s latency (us): min %.1f, p50 %.1f, p90 %.1f, p99 %.1f, max %.1f\n", kind, latencies_us[0],
+            latencies_us[count / 2], latencies_us[count * 9 / 10], latencies_us[count * 99 / 100],
+            latencies_us[count - 1]);
+
+    int buckets[64] = {0};
+    int first = 63, last = 0;
+    for (int i = 0; i < count; i++) {
+        int b = latencies_us[i] < 1 ? 0 : (int)log2(latencies_us[i]) + 1;
+        b = b < 63 ? b : 63;
+        buckets[b]++;
+        first = b < first ? b : first;
+        last = b > last ? b : last;
+    }
+    for (int b = first; b <= last; b++) {
+        fprintf(stderr, "  [%8.0f, %8.0f) us %6d ", b == 0 ? 0.0 : ldexp(1, b - 1), ldexp(1, b), buckets[b]);
+        for (int i = 0; i < buckets[b] * 50 / count; i++)
+            fputc('#', stderr);
+        fputc('\n', stderr);
+    }
+}
+
 
 void benchmark_noop_wrapper(void *data, size_t size, time_t work)
 {
@@ -30,13 +30,17 @@ echo "Running benchmark..."
 #INSTRUMENT="valgrind --tool=callgrind --trace-children=yes --collect-systime=yes"
 #INSTRUMENT="valgrind --tool=memcheck --trace-children=yes --show-leak-kinds=definite,indirect --leak-check=yes"
 
+# The first argument selects how commands are handed to guest and worker threads (ring or async_queue).
 function benchmark_ava() {
+    export AVA_SHADOW_QUEUE=$1
+    shift
     cd $DIR/../cava/trivial_nw
     PATH=.:$PATH $INSTRUMENT ../../worker/manager_tcp &
     sleep 1
     LD_LIBRARY_PATH=. $INSTRUMENT $DIR/micro_benchmark "$@"
 
     kill_manager
+    unset AVA_SHADOW_QUEUE
 }
 
 function benchmark_native() {
@@ -49,4 +53,5 @@ SIZE=1024    # Kilobytes (*1024) of data transferred into or out-of the library
 REPS=10      # The number of repetitions to run during the call.
 
 benchmark_native -w $WORK -s $SIZE -r $REPS all
-benchmark_ava -w $WORK -s $SIZE -r $REPS all
+benchmark_ava async_queue -w $WORK -s $SIZE -r $REPS all
+benchmark_ava ring -w $WORK -s $SIZE -r $REPS all
@@ -159,6 +159,23 @@ START_TEST(buffers_struct)
         ck_assert_int_eq(i, buf.buffer[i]);
 END_TEST
 
+START_TEST(buffers_struct_array)
+    int data[2][18];
+    struct simple_buffer_t bufs[2];
+    for (int j=0; j < 2; j ++) {
+        bufs[j].size = 18 - j;
+        bufs[j].buffer = data[j];
+    }
+    write_simple_buffers(bufs, 2);
+    // The nested buffers are copied into the buffers of the application, not over its pointers.
+    for (int j=0; j < 2; j ++) {
+        ck_assert_ptr_eq(data[j], bufs[j].buffer);
+        ck_assert_int_eq(18 - j, bufs[j].size);
+        for (int i=0; i < bufs[j].size; i++)
+            ck_assert_int_eq(j * 100 + i, data[j][i]);
+    }
+END_TEST
+
 START_TEST(buffers_null)
     ck_assert_int_eq(-1, function4b(NULL));
     ck_assert_int_eq(-1, function4c(NULL));
@@ -240,6 +257,7 @@ Suite *suite_trivial(void)
         ADD_TEST(buffers_with_handles);
         ADD_TEST(buffers_null);
         ADD_TEST(buffers_struct);
+        ADD_TEST(buffers_struct_array);
         ADD_TEST(shadow_buffers_simple);
     END_TCASE
 
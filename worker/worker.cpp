@@ -17,6 +17,8 @@
 #include "common/cmd_channel.h"
 #include "common/cmd_channel_impl.h"
 #include "common/cmd_handler.h"
+#include "common/stats.h"
+#include "common/thread_channel.h"
 #include "common/ioctl.h"
 #include "common/register.h"
 #include "common/socket.h"
@@ -137,16 +139,22 @@ int main(int argc, char *argv[])
         chan_hv = command_channel_hv_new(listen_port);
         chan = command_channel_socket_worker_new(listen_port);
     }
+    else if (!strcmp(getenv("AVA_CHANNEL"), "UNIX")) {
+        chan_hv = NULL;
+        chan = command_channel_socket_unix_worker_new(listen_port);
+    }
     else {
-        printf("Unsupported AVA_CHANNEL type (export AVA_CHANNEL=[TCP | SHM | VSOCK]\n");
+        printf("Unsupported AVA_CHANNEL type (export AVA_CHANNEL=[TCP | SHM | VSOCK | UNIX]\n");
         return 0;
     }
 
     nw_record_command_channel = command_channel_log_new(listen_port);
     init_internal_command_handler();
     init_command_handler(channel_create);
+    ava_thread_channel_start_server(chan);
     DEBUG_PRINT("[worker#%d] start polling tasks\n", listen_port);
     wait_for_command_handler();
+    ava_stats_print(stderr);
     command_channel_free(chan);
     command_channel_free((struct command_channel *) nw_record_command_channel);
     if (chan_hv) command_channel_hv_free(chan_hv);